@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+# Shared by the Lambdas in this directory. Copy this file next to a Lambda's index.py when building its code.zip.
+
+import abc
+import json
+import os
+
+import boto3
+import botocore
+
+
+class DocumentStore(abc.ABC):
+    """
+    Keeps one JSON document between runs.
+
+    Subclasses only implement _read and _write of the serialized document;
+    load and save convert it from and to plain data.
+    """
+
+    def load(self):
+        """Returns the document, or None when there is none yet; raises ValueError when it is not JSON."""
+        data = self._read()
+        if not data:
+            return None
+        return json.loads(data)
+
+    def save(self, document):
+        self._write(json.dumps(document, sort_keys=True))
+
+    @abc.abstractmethod
+    def _read(self):
+        """Returns the serialized document, or None when there is none yet."""
+
+    @abc.abstractmethod
+    def _write(self, data):
+        """Stores the serialized document."""
+
+
+class FileDocumentStore(DocumentStore):
+    """
+    Document stored as a JSON file. On Lambda only /tmp is writable, which survives warm invocations only.
+    """
+
+    def __init__(self, path):
+        super(FileDocumentStore, self).__init__()
+        self.path = path
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            return f.read()
+
+    def _write(self, data):
+        # Written aside and moved into place, so an interrupted write never leaves half a document
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+
+class S3DocumentStore(DocumentStore):
+    """
+    Document stored as a JSON object in S3, so it outlives Lambda containers.
+    """
+
+    def __init__(self, bucket, key, client=None):
+        super(S3DocumentStore, self).__init__()
+        self.bucket = bucket
+        self.key = key
+        self.client = client or boto3.client('s3')
+
+    def _read(self):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.key)['Body'].read().decode('utf-8')
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+
+    def _write(self, data):
+        self.client.put_object(Bucket=self.bucket, Key=self.key, Body=data.encode('utf-8'),
+                               ContentType='application/json')
+
+
+def document_store_from_url(url, client=None):
+    """Returns a document store for an s3://bucket/key URL or a local path; client is the S3 client to use."""
+    if url.startswith('s3://'):
+        bucket, _, key = url[len('s3://'):].partition('/')
+        return S3DocumentStore(bucket, key, client=client)
+    return FileDocumentStore(url)
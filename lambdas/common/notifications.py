@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+# Shared by the Lambdas in this directory. Copy this file next to a Lambda's index.py when building its code.zip.
+
+import json
+import logging
+import os
+import tempfile
+import time
+
+import boto3
+
+from documents import document_store_from_url
+
+logger = logging.getLogger('index.notifications')
+
+# SNS rejects messages over 256 KiB and subjects over 100 characters
+SNS_MESSAGE_LIMIT = 256 * 1024
+SNS_SUBJECT_LIMIT = 100
+
+_sns_client = None
+
+
+def sns_client():
+    """Returns one SNS client per process, so warm invocations do not rebuild it for every publish."""
+    global _sns_client
+    if _sns_client is None:
+        _sns_client = boto3.client('sns')
+    return _sns_client
+
+
+class AlertStateStore(object):
+    """
+    Remembers when each finding was last notified, in a DocumentStore.
+
+    Entries are held in memory between load and save.
+    """
+
+    def __init__(self, store):
+        super(AlertStateStore, self).__init__()
+        self.store = store
+        # "category/finding" -> epoch seconds of the last notification
+        self.sent = {}
+
+    def load(self):
+        try:
+            self.sent = self.store.load() or {}
+        except ValueError:
+            logger.warning("Ignoring unreadable alert state")
+        return self
+
+    def last_sent(self, category, finding):
+        return self.sent.get('%s/%s' % (category, finding))
+
+    def mark_sent(self, category, findings, now):
+        for finding in findings:
+            self.sent['%s/%s' % (category, finding)] = now
+
+    def save(self, max_age):
+        """Writes the state, dropping entries too old to suppress anything."""
+        now = time.time()
+        self.sent = dict((key, sent) for key, sent in self.sent.items() if now - sent < max_age)
+        self.store.save(self.sent)
+
+
+def state_store_from_url(url, client=None):
+    """Returns an unloaded alert state store for an s3://bucket/key URL or a local path."""
+    return AlertStateStore(document_store_from_url(url, client=client))
+
+
+class Notifier(object):
+    """
+    Publishes findings to an SNS topic as structured JSON messages.
+
+    Findings are sorted and packed into as few messages as fit under the SNS
+    size limit, less some headroom for the subject. With a state store,
+    findings already notified within suppress_window seconds are left out, so
+    a persistent problem is notified once per window rather than on every run.
+    """
+
+    def __init__(self, topic_arn, source, client=None, state_store=None, suppress_window=0,
+                 max_bytes=SNS_MESSAGE_LIMIT - 1024):
+        super(Notifier, self).__init__()
+        self.topic_arn = topic_arn
+        self.source = source
+        self.client = client or sns_client()
+        self.state_store = state_store
+        self.suppress_window = suppress_window
+        self.max_bytes = max_bytes
+
+    def _suppressed(self, category, finding, now):
+        if self.state_store is None or not self.suppress_window:
+            return False
+        last_sent = self.state_store.last_sent(category, finding)
+        return last_sent is not None and now - last_sent < self.suppress_window
+
+    def chunk(self, header, findings):
+        """Splits findings into lists whose JSON message, header included, stays within max_bytes."""
+        # Room for the "part"/"parts"/"count" counters added when publishing
+        overhead = len(json.dumps(dict(header, findings=[], part=0, parts=0, count=0)).encode('utf-8')) + 32
+        chunks = []
+        current = []
+        size = overhead
+        for finding in findings:
+            finding_size = len(json.dumps(finding).encode('utf-8')) + 2
+            if current and size + finding_size > self.max_bytes:
+                chunks.append(current)
+                current = []
+                size = overhead
+            current.append(finding)
+            size += finding_size
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def notify(self, category, subject, description, findings):
+        """Publishes findings not notified recently; returns the number of messages sent."""
+        now = time.time()
+        fresh = sorted(finding for finding in findings if not self._suppressed(category, finding, now))
+        suppressed = len(findings) - len(fresh)
+        if suppressed:
+            logger.info("Suppressed %d %s findings already notified within %ss" % (
+                suppressed, category, self.suppress_window))
+        if not fresh:
+            return 0
+
+        header = {'source': self.source, 'category': category, 'description': description}
+        chunks = self.chunk(header, fresh)
+        for part, chunk in enumerate(chunks, 1):
+            message = dict(header, part=part, parts=len(chunks), count=len(chunk), findings=chunk)
+            # The part counter is kept whole; a long subject is cut short before it instead
+            suffix = '' if len(chunks) == 1 else " (%d/%d)" % (part, len(chunks))
+            self.client.publish(
+                TargetArn=self.topic_arn,
+                Message=json.dumps(message),
+                Subject=subject[:SNS_SUBJECT_LIMIT - len(suffix)] + suffix
+            )
+            if self.state_store is not None:
+                self.state_store.mark_sent(category, chunk, now)
+        return len(chunks)
+
+    def save(self):
+        if self.state_store is not None:
+            self.state_store.save(max(self.suppress_window, 1))
+
+
+def notifier_from_environment(source, client=None):
+    """
+    Builds a Notifier from the sns_topic_arn, alert_suppress_hours and
+    alert_state_url Lambda environment variables. alert_state_url is an
+    s3://bucket/key URL or a local path; without it the state is kept in the
+    temp directory, which on Lambda only lasts as long as the warm container.
+    """
+    suppress_window = float(os.environ.get('alert_suppress_hours', 0)) * 3600
+    state_store = None
+    if suppress_window:
+        state_url = os.environ.get('alert_state_url')
+        if not state_url:
+            state_url = os.path.join(tempfile.gettempdir(), source + '-alerts.json')
+            logger.warning("No alert_state_url set; alerts are only suppressed while this container stays warm")
+        state_store = state_store_from_url(state_url).load()
+    return Notifier(os.environ['sns_topic_arn'], source, client=client, state_store=state_store,
+                    suppress_window=suppress_window)
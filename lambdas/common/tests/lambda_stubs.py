@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+
+# Shared by the tests of every Lambda in this directory; not copied into any code.zip.
+
+import io
+
+import boto3
+from botocore.response import StreamingBody
+
+
+def client(service, region='us-east-1'):
+    """A client with dummy credentials, for a botocore Stubber to answer."""
+    return boto3.client(service, region_name=region, aws_access_key_id='testing', aws_secret_access_key='testing')
+
+
+def streaming_body(data):
+    """A StreamingBody of data, as get_object and invoke responses carry."""
+    return StreamingBody(io.BytesIO(data), len(data))
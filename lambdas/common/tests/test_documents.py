@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import botocore
+from botocore.stub import Stubber
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from documents import FileDocumentStore, S3DocumentStore, document_store_from_url  # noqa: E402
+from lambda_stubs import client, streaming_body  # noqa: E402
+
+DOCUMENT = {'b': [1, 2], 'a': {'nested': 'value'}}
+
+
+class FileDocumentStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'document.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_round_trip(self):
+        store = document_store_from_url(self.path)
+        self.assertIsInstance(store, FileDocumentStore)
+        self.assertIsNone(store.load())
+        store.save(DOCUMENT)
+        self.assertEqual(FileDocumentStore(self.path).load(), DOCUMENT)
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+        with open(self.path) as f:
+            self.assertEqual(f.read(), '{"a": {"nested": "value"}, "b": [1, 2]}')
+
+    def test_unreadable_document_raises_value_error(self):
+        with open(self.path, 'w') as f:
+            f.write('{not json')
+        with self.assertRaises(ValueError):
+            FileDocumentStore(self.path).load()
+
+
+class S3DocumentStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.s3 = client('s3')
+        self.location = {'Bucket': 'bucket', 'Key': 'source/document.json'}
+
+    def test_round_trip(self):
+        store = document_store_from_url('s3://bucket/source/document.json', client=self.s3)
+        self.assertIsInstance(store, S3DocumentStore)
+        document = b'{"a": {"nested": "value"}, "b": [1, 2]}'
+        with Stubber(self.s3) as stubber:
+            stubber.add_client_error('get_object', service_error_code='NoSuchKey', http_status_code=404,
+                                     expected_params=self.location)
+            self.assertIsNone(store.load())
+            stubber.add_response('put_object', {}, dict(self.location, Body=document, ContentType='application/json'))
+            store.save(DOCUMENT)
+            stubber.add_response('get_object', {'Body': streaming_body(document)},
+                                 self.location)
+            self.assertEqual(store.load(), DOCUMENT)
+            stubber.assert_no_pending_responses()
+
+    def test_other_errors_are_raised(self):
+        with Stubber(self.s3) as stubber:
+            stubber.add_client_error('get_object', service_error_code='AccessDenied', http_status_code=403)
+            with self.assertRaises(botocore.exceptions.ClientError):
+                S3DocumentStore('bucket', 'document.json', client=self.s3).load()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from botocore.stub import ANY, Stubber
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from documents import DocumentStore, FileDocumentStore, S3DocumentStore  # noqa: E402
+from lambda_stubs import client, streaming_body  # noqa: E402
+from notifications import AlertStateStore, Notifier, notifier_from_environment, state_store_from_url  # noqa: E402
+
+TOPIC = 'arn:aws:sns:us-east-1:123456789012:alerts'
+NOW = 1700000000.0
+HOUR = 3600
+
+
+class MemoryDocumentStore(DocumentStore):
+
+    def __init__(self):
+        super(MemoryDocumentStore, self).__init__()
+        self.document = None
+
+    def _read(self):
+        return self.document
+
+    def _write(self, data):
+        self.document = data
+
+
+class NotifierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sns = client('sns')
+        self.stubber = Stubber(self.sns)
+        self.stubber.activate()
+        self.messages = []
+
+    def tearDown(self):
+        self.stubber.deactivate()
+
+    def expect_publish(self, count=1):
+        for _ in range(count):
+            self.stubber.add_response('publish', {'MessageId': 'm'},
+                                      {'TargetArn': TOPIC, 'Message': ANY, 'Subject': ANY})
+
+    def published(self, notifier):
+        """Wraps the client to record every publish call's parameters."""
+        publish = self.sns.publish
+
+        def record(**kwargs):
+            self.messages.append(kwargs)
+            return publish(**kwargs)
+        notifier.client = mock.Mock(publish=record)
+
+    def test_single_message_payload(self):
+        notifier = Notifier(TOPIC, 'https-certificate-check', client=self.sns)
+        self.published(notifier)
+        self.expect_publish()
+        findings = set(['b.example.com', 'a.example.com'])
+        self.assertEqual(notifier.notify('expired', 'Expired', 'Expired hosts', findings), 1)
+        self.stubber.assert_no_pending_responses()
+        message, = self.messages
+        self.assertEqual(message['Subject'], 'Expired')
+        self.assertEqual(json.loads(message['Message']), {
+            'source': 'https-certificate-check', 'category': 'expired', 'description': 'Expired hosts',
+            'part': 1, 'parts': 1, 'count': 2, 'findings': ['a.example.com', 'b.example.com'],
+        })
+
+    def test_nothing_is_published_without_findings(self):
+        notifier = Notifier(TOPIC, 'source', client=self.sns)
+        self.assertEqual(notifier.notify('expired', 'Expired', 'Expired hosts', set()), 0)
+
+    def test_chunks_stay_under_max_bytes_and_are_numbered(self):
+        findings = set('host%03d.example.com' % number for number in range(200))
+        notifier = Notifier(TOPIC, 'source', client=self.sns, max_bytes=1024)
+        self.published(notifier)
+        chunks = notifier.chunk({'source': 'source', 'category': 'expired', 'description': 'Expired hosts'},
+                                sorted(findings))
+        self.expect_publish(len(chunks))
+        self.assertEqual(notifier.notify('expired', 'Expired', 'Expired hosts', findings), len(chunks))
+        self.stubber.assert_no_pending_responses()
+        self.assertGreater(len(chunks), 1)
+
+        seen = []
+        for part, message in enumerate(self.messages, 1):
+            self.assertLessEqual(len(message['Message'].encode('utf-8')), 1024)
+            self.assertEqual(message['Subject'], 'Expired (%d/%d)' % (part, len(chunks)))
+            payload = json.loads(message['Message'])
+            self.assertEqual((payload['part'], payload['parts']), (part, len(chunks)))
+            self.assertEqual(payload['count'], len(payload['findings']))
+            seen.extend(payload['findings'])
+        self.assertEqual(seen, sorted(findings))
+
+    def test_long_subjects_are_truncated(self):
+        notifier = Notifier(TOPIC, 'source', client=self.sns)
+        self.published(notifier)
+        self.expect_publish()
+        notifier.notify('expired', 'x' * 150, 'Expired hosts', set(['a']))
+        self.assertEqual(len(self.messages[0]['Subject']), 100)
+
+    def test_long_subjects_keep_their_part_counter(self):
+        notifier = Notifier(TOPIC, 'source', client=self.sns, max_bytes=256)
+        self.published(notifier)
+        findings = set('host%03d.example.com' % number for number in range(20))
+        self.expect_publish(len(notifier.chunk({'source': 'source', 'category': 'expired',
+                                                'description': 'Expired hosts'}, sorted(findings))))
+        parts = notifier.notify('expired', 'x' * 150, 'Expired hosts', findings)
+        self.assertGreater(parts, 1)
+        subjects = [message['Subject'] for message in self.messages]
+        self.assertEqual(subjects, ['x' * (100 - len(' (%d/%d)' % (part, parts))) + ' (%d/%d)' % (part, parts)
+                                    for part in range(1, parts + 1)])
+
+    def test_suppresses_findings_notified_within_the_window(self):
+        store = AlertStateStore(MemoryDocumentStore())
+        store.mark_sent('expired', ['recent.example.com'], NOW - HOUR)
+        store.mark_sent('expired', ['old.example.com'], NOW - 3 * HOUR)
+        store.mark_sent('expiring', ['other-category.example.com'], NOW - HOUR)
+        notifier = Notifier(TOPIC, 'source', client=self.sns, state_store=store, suppress_window=2 * HOUR)
+        self.published(notifier)
+        self.expect_publish()
+        with mock.patch('notifications.time.time', return_value=NOW):
+            notifier.notify('expired', 'Expired', 'Expired hosts',
+                            set(['recent.example.com', 'old.example.com', 'other-category.example.com']))
+            notifier.save()
+        self.assertEqual(json.loads(self.messages[0]['Message'])['findings'],
+                         ['old.example.com', 'other-category.example.com'])
+        # Re-notified findings restart their window; the suppressed one keeps its old time
+        self.assertEqual(json.loads(store.store.document), {
+            'expired/old.example.com': NOW,
+            'expired/other-category.example.com': NOW,
+            'expired/recent.example.com': NOW - HOUR,
+            'expiring/other-category.example.com': NOW - HOUR,
+        })
+
+    def test_everything_suppressed_publishes_nothing(self):
+        store = AlertStateStore(MemoryDocumentStore())
+        store.mark_sent('expired', ['a.example.com'], NOW - HOUR)
+        notifier = Notifier(TOPIC, 'source', client=self.sns, state_store=store, suppress_window=2 * HOUR)
+        with mock.patch('notifications.time.time', return_value=NOW):
+            self.assertEqual(notifier.notify('expired', 'Expired', 'Expired hosts', set(['a.example.com'])), 0)
+
+    def test_save_drops_entries_outside_the_window(self):
+        store = AlertStateStore(MemoryDocumentStore())
+        store.mark_sent('expired', ['a'], NOW - HOUR)
+        store.mark_sent('expired', ['b'], NOW - 3 * HOUR)
+        notifier = Notifier(TOPIC, 'source', client=self.sns, state_store=store, suppress_window=2 * HOUR)
+        with mock.patch('notifications.time.time', return_value=NOW):
+            notifier.save()
+        self.assertEqual(json.loads(store.store.document), {'expired/a': NOW - HOUR})
+
+
+class AlertStateStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'alerts.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_round_trip_through_a_file(self):
+        store = state_store_from_url(self.path)
+        self.assertIsInstance(store.store, FileDocumentStore)
+        self.assertEqual(store.load().sent, {})
+        store.mark_sent('expired', ['a.example.com'], NOW)
+        with mock.patch('notifications.time.time', return_value=NOW):
+            store.save(HOUR)
+        self.assertEqual(state_store_from_url(self.path).load().last_sent('expired', 'a.example.com'), NOW)
+
+    def test_unreadable_state_is_ignored(self):
+        with open(self.path, 'w') as f:
+            f.write('{not json')
+        self.assertEqual(state_store_from_url(self.path).load().sent, {})
+
+    def test_round_trip_through_s3(self):
+        s3 = client('s3')
+        store = state_store_from_url('s3://bucket/source/alerts.json', client=s3)
+        self.assertIsInstance(store.store, S3DocumentStore)
+        location = {'Bucket': 'bucket', 'Key': 'source/alerts.json'}
+        with Stubber(s3) as stubber:
+            stubber.add_client_error('get_object', service_error_code='NoSuchKey', http_status_code=404,
+                                     expected_params=location)
+            self.assertEqual(store.load().sent, {})
+
+            store.mark_sent('expired', ['a.example.com'], NOW)
+            document = json.dumps({'expired/a.example.com': NOW}, sort_keys=True).encode('utf-8')
+            stubber.add_response('put_object', {}, dict(location, Body=document, ContentType='application/json'))
+            with mock.patch('notifications.time.time', return_value=NOW):
+                store.save(HOUR)
+
+            stubber.add_response('get_object', {'Body': streaming_body(document)},
+                                 location)
+            self.assertEqual(state_store_from_url('s3://bucket/source/alerts.json', client=s3).load().sent,
+                             {'expired/a.example.com': NOW})
+            stubber.assert_no_pending_responses()
+
+
+class NotifierFromEnvironmentTest(unittest.TestCase):
+
+    def test_state_store_only_with_a_suppress_window(self):
+        sns = client('sns')
+        with mock.patch.dict(os.environ, {'sns_topic_arn': TOPIC, 'alert_suppress_hours': '0'}):
+            self.assertIsNone(notifier_from_environment('source', client=sns).state_store)
+        with mock.patch.dict(os.environ, {'sns_topic_arn': TOPIC, 'alert_suppress_hours': '12',
+                                          'alert_state_url': 's3://bucket/alerts.json'}), \
+                mock.patch('documents.S3DocumentStore._read', return_value=None):
+            notifier = notifier_from_environment('source', client=sns)
+        self.assertIsInstance(notifier.state_store.store, S3DocumentStore)
+        self.assertEqual(notifier.suppress_window, 12 * HOUR)
+
+
+if __name__ == '__main__':
+    unittest.main()
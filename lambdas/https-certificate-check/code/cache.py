@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import datetime
+import logging
+import os
+import sys
+
+try:
+    from documents import document_store_from_url
+except ImportError:
+    # Running from a checkout rather than code.zip: the shared module lives in lambdas/common
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common'))
+    from documents import document_store_from_url
+
+logger = logging.getLogger('index.cache')
+
+DATE_FMT = '%Y-%m-%dT%H:%M:%S'
+
+
+class CacheEntry(object):
+    """
+    What is remembered about a host's certificate between runs.
+    """
+
+    def __init__(self, not_after, fingerprint, checked):
+        super(CacheEntry, self).__init__()
+        self.not_after = not_after
+        self.fingerprint = fingerprint
+        self.checked = checked
+
+    def to_dict(self):
+        return {
+            'not_after': self.not_after.strftime(DATE_FMT),
+            'fingerprint': self.fingerprint,
+            'checked': self.checked.strftime(DATE_FMT),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            datetime.datetime.strptime(data['not_after'], DATE_FMT),
+            data['fingerprint'],
+            datetime.datetime.strptime(data['checked'], DATE_FMT),
+        )
+
+
+class CertCache(object):
+    """
+    Certificate cache keyed by hostname, kept as a JSON document in a DocumentStore.
+
+    Entries are held in memory between load and save.
+    """
+
+    def __init__(self, store):
+        super(CertCache, self).__init__()
+        self.store = store
+        self.entries = {}
+
+    def load(self):
+        data = self.store.load()
+        if data:
+            self.entries = dict((host, CacheEntry.from_dict(entry)) for host, entry in data.items())
+        logger.debug("Loaded %d cached certificates" % len(self.entries))
+
+    def save(self):
+        self.store.save(dict((host, entry.to_dict()) for host, entry in self.entries.items()))
+
+    def get(self, hostname):
+        return self.entries.get(hostname)
+
+    def put(self, hostname, not_after, fingerprint, checked):
+        previous = self.entries.get(hostname)
+        if previous is not None and previous.fingerprint != fingerprint:
+            logger.info("Host %s presents a new certificate (expires %s)" % (hostname, not_after))
+        self.entries[hostname] = CacheEntry(not_after, fingerprint, checked)
+
+
+def cache_from_url(url, client=None):
+    """Returns an unloaded cache for an s3://bucket/key URL or a local path; client is the S3 client to use."""
+    return CertCache(document_store_from_url(url, client=client))
+
+
+class RescanScheduler(object):
+    """
+    Decides which hosts must be handshaken again and which can be answered from the cache.
+
+    A host is re-probed when it has no entry, when its entry is older than
+    max_age_days, or when its certificate could enter the buffer_days window
+    before the entry would age out anyway. Expired and expiring hosts therefore
+    are always re-probed, and reissued certificates are picked up at least
+    every max_age_days.
+    """
+
+    def __init__(self, cache, buffer_days, max_age_days=7):
+        super(RescanScheduler, self).__init__()
+        self.cache = cache
+        self.buffer = datetime.timedelta(days=buffer_days)
+        self.max_age = datetime.timedelta(days=max_age_days)
+
+    def needs_probe(self, hostname, now):
+        entry = self.cache.get(hostname)
+        if entry is None:
+            return True
+        if now - entry.checked >= self.max_age:
+            return True
+        return entry.not_after - self.buffer <= now + self.max_age
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import datetime
+import hashlib
+import logging
+
+try:
+    from cryptography import x509
+    from cryptography.hazmat.primitives.asymmetric import ec
+except ImportError:
+    x509 = None
+
+from cache import DATE_FMT
+
+logger = logging.getLogger('index.certs')
+
+SSL_DATE_FMT = r'%b %d %H:%M:%S %Y %Z'
+
+
+def _name_from_peercert(name):
+    return ', '.join('%s=%s' % attribute for rdn in name for attribute in rdn)
+
+
+class CertificateInfo(object):
+    """
+    The parts of a certificate the detector reports on.
+    """
+
+    def __init__(self, fingerprint, subject, issuer, not_after, sans, key_size):
+        super(CertificateInfo, self).__init__()
+        self.fingerprint = fingerprint
+        self.subject = subject
+        self.issuer = issuer
+        self.not_after = not_after
+        self.sans = sans
+        self.key_size = key_size
+
+    def to_dict(self):
+        return {
+            'fingerprint': self.fingerprint,
+            'subject': self.subject,
+            'issuer': self.issuer,
+            'not_after': self.not_after.strftime(DATE_FMT),
+            'sans': self.sans,
+            'key_size': self.key_size,
+        }
+
+
+class CertificateParser(object):
+    """
+    Parses certificates once per fingerprint.
+
+    Hosts sharing a wildcard certificate or an intermediate hand over the same
+    DER bytes, so everything after the first host is a dictionary lookup.
+    Full parsing (intermediates, key size) needs the optional cryptography
+    package; without it leaf certificates are parsed from getpeercert().
+    """
+
+    def __init__(self):
+        super(CertificateParser, self).__init__()
+        self.memo = {}
+
+    def parse(self, der, peercert=None):
+        fingerprint = hashlib.sha256(der).hexdigest()
+        if fingerprint not in self.memo:
+            if x509 is not None:
+                self.memo[fingerprint] = self._parse_der(fingerprint, der)
+            elif peercert:
+                self.memo[fingerprint] = self._parse_peercert(fingerprint, peercert)
+            else:
+                logger.debug("cryptography not installed, cannot parse certificate %s" % fingerprint)
+                return None
+        return self.memo[fingerprint]
+
+    def _parse_der(self, fingerprint, der):
+        cert = x509.load_der_x509_certificate(der)
+        try:
+            sans = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+            sans = sans.get_values_for_type(x509.DNSName)
+        except x509.ExtensionNotFound:
+            sans = []
+        not_after = getattr(cert, 'not_valid_after_utc', None)
+        not_after = not_after.replace(tzinfo=None) if not_after else cert.not_valid_after
+        public_key = cert.public_key()
+        if isinstance(public_key, ec.EllipticCurvePublicKey):
+            key_size = public_key.curve.key_size
+        else:
+            key_size = getattr(public_key, 'key_size', None)
+        return CertificateInfo(fingerprint, cert.subject.rfc4514_string(), cert.issuer.rfc4514_string(),
+                               not_after, sans, key_size)
+
+    def _parse_peercert(self, fingerprint, peercert):
+        return CertificateInfo(
+            fingerprint,
+            _name_from_peercert(peercert.get('subject', ())),
+            _name_from_peercert(peercert.get('issuer', ())),
+            datetime.datetime.strptime(peercert['notAfter'], SSL_DATE_FMT),
+            [value for kind, value in peercert.get('subjectAltName', ()) if kind == 'DNS'],
+            None,
+        )
+
+    def parse_chain(self, chain):
+        """Parses a presented chain (leaf first), skipping certificates that cannot be parsed."""
+        return [info for info in (self.parse(der) for der in chain) if info is not None]
+
+
+def intermediates_expiring_before_leaf(chain_info):
+    """Returns the certificates of a parsed chain (leaf first) that expire before the leaf does."""
+    if not chain_info:
+        return []
+    leaf = chain_info[0]
+    return [info for info in chain_info[1:] if info.not_after < leaf.not_after]
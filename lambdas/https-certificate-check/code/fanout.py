@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import hashlib
+import json
+import logging
+
+import boto3
+from botocore.config import Config
+
+logger = logging.getLogger('index.fanout')
+
+
+def shard_hosts(targets, shard_count):
+    """
+    Splits targets into shard_count lists.
+
+    A target always lands in the same shard (md5 of its label, not the salted
+    built-in hash), so reruns and retries of a shard cover the same targets.
+    """
+    shards = [[] for _ in range(shard_count)]
+    for target in sorted(targets, key=lambda target: target.label):
+        digest = hashlib.md5(target.label.encode('utf-8')).hexdigest()
+        shards[int(digest, 16) % shard_count].append(target)
+    return shards
+
+
+# Seconds the coordinator waits for a worker beyond the worker's own timeout
+WORKER_TIMEOUT_MARGIN = 10
+
+
+class LambdaTransport(object):
+    """
+    Dispatches a shard by synchronously invoking the worker Lambda function.
+
+    The invocation only answers once the worker is done, so the client waits up
+    to worker_timeout seconds plus a margin for it, and never retries: a retry
+    would run the shard a second time while the first worker is still probing.
+    """
+
+    def __init__(self, function_name, client=None, worker_timeout=60):
+        super(LambdaTransport, self).__init__()
+        self.function_name = function_name
+        self.client = client or boto3.client('lambda', config=Config(
+            read_timeout=worker_timeout + WORKER_TIMEOUT_MARGIN, retries={'max_attempts': 0}
+        ))
+
+    def dispatch(self, payload):
+        response = self.client.invoke(
+            FunctionName=self.function_name,
+            InvocationType='RequestResponse',
+            Payload=json.dumps(payload).encode('utf-8')
+        )
+        body = response['Payload'].read().decode('utf-8')
+        if 'FunctionError' in response:
+            raise RuntimeError("Worker for shard %s failed: %s" % (payload['shard'], body))
+        return json.loads(body)
+
+
+class InProcessTransport(object):
+    """
+    Dispatches a shard by calling a handler in this process.
+
+    Payload and result go through a JSON round trip so the handler sees exactly
+    what a real Lambda invocation would.
+    """
+
+    def __init__(self, handler):
+        super(InProcessTransport, self).__init__()
+        self.handler = handler
+
+    def dispatch(self, payload):
+        result = self.handler(json.loads(json.dumps(payload)), None)
+        return json.loads(json.dumps(result))
+
+
+class Coordinator(object):
+    """
+    Splits hosts into shards, dispatches them concurrently and collects the partial results.
+    """
+
+    def __init__(self, transport, shard_count, max_workers=None):
+        super(Coordinator, self).__init__()
+        self.transport = transport
+        self.shard_count = shard_count
+        self.max_workers = max_workers or shard_count
+
+    def run(self, hosts):
+        """Returns a list of (shard targets, partial result or None when the shard failed)."""
+        shards = [shard for shard in shard_hosts(hosts, self.shard_count) if shard]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = []
+            for index, shard in enumerate(shards):
+                payload = {'mode': 'worker', 'shard': index, 'shard_count': len(shards),
+                           'hosts': [target.to_entry() for target in shard]}
+                futures.append((shard, executor.submit(self.transport.dispatch, payload)))
+
+            results = []
+            for shard, future in futures:
+                try:
+                    results.append((shard, future.result()))
+                except Exception as e:
+                    logger.error("Shard of %d hosts failed: %s" % (len(shard), e))
+                    results.append((shard, None))
+        return results
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+import codecs
+import json
+import logging
+import os
+import re
+import urllib.error
+import urllib.request
+
+import yaml
+
+logger = logging.getLogger('index.hosts')
+
+CHUNK_SIZE = 64 * 1024
+YAML_KEY = re.compile(r'^[\w-]+\s*:(\s|$)')
+
+
+class _PrefixedStream(object):
+    """
+    File-like object that replays already peeked bytes before reading on from the wrapped stream.
+    """
+
+    def __init__(self, prefix, stream):
+        super(_PrefixedStream, self).__init__()
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, size=-1):
+        if self.prefix:
+            data, self.prefix = self.prefix, b''
+            if size is None or size < 0:
+                return data + self.stream.read()
+            if len(data) < size:
+                data += self.stream.read(size - len(data))
+            else:
+                data, self.prefix = data[:size], data[size:]
+            return data
+        return self.stream.read(size)
+
+
+def _iter_text(stream):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            tail = decoder.decode(b'', final=True)
+            if tail:
+                yield tail
+            return
+        yield decoder.decode(chunk)
+
+
+def _find_json_hosts(chunks):
+    """
+    Reads chunks until the opening bracket of the top level "hosts" array (or of a bare top level array).
+    Returns the text read so far and the position just past that bracket.
+
+    Object depth and whether a string is a key or a value are tracked, so "hosts" keys of nested objects and
+    "hosts" string values are not mistaken for it. Only the text of an unfinished string is kept between chunks.
+    """
+    buffer = ''
+    depth = 0
+    in_string = escape = is_key = expecting_key = hosts_value = False
+    string_start = 0
+    key = None
+    for chunk in chunks:
+        buffer += chunk
+        for i in range(len(buffer) - len(chunk), len(buffer)):
+            c = buffer[i]
+            if in_string:
+                if escape:
+                    escape = False
+                elif c == '\\':
+                    escape = True
+                elif c == '"':
+                    in_string = False
+                    if is_key:
+                        key = json.loads(buffer[string_start:i + 1])
+                continue
+            if c in ' \t\r\n':
+                continue
+            if hosts_value:
+                if c != '[':
+                    raise ValueError("hosts in JSON host list is not an array")
+                return buffer, i + 1
+            if depth == 0:
+                if c == '[':
+                    return buffer, i + 1
+                if c != '{':
+                    raise ValueError("JSON host list is neither an object nor an array")
+                depth = 1
+                expecting_key = True
+            elif c == '"':
+                in_string = True
+                string_start = i
+                is_key = depth == 1 and expecting_key
+                expecting_key = False
+            elif c == ':':
+                hosts_value = depth == 1 and key == 'hosts'
+                key = None
+            elif c == ',':
+                expecting_key = depth == 1
+            elif c in '{[':
+                depth += 1
+            elif c in '}]':
+                depth -= 1
+                if depth == 0:
+                    break
+        else:
+            cut = string_start if in_string else len(buffer)
+            buffer = buffer[cut:]
+            string_start -= cut
+            continue
+        break
+    raise ValueError("No hosts array found in JSON host list")
+
+
+def iter_json_hosts(stream):
+    """
+    Yields the elements of the top level "hosts" array (or of a bare top level array)
+    one at a time, decoding each as soon as its closing character has been read.
+    """
+    chunks = _iter_text(stream)
+    buffer, position = _find_json_hosts(chunks)
+
+    decoder = json.JSONDecoder()
+    exhausted = False
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        if position < len(buffer):
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+                # A number or literal may continue in the next chunk
+                if end < len(buffer) or exhausted:
+                    yield value
+                    position = end
+                    continue
+            except ValueError:
+                if exhausted:
+                    raise
+        chunk = next(chunks, None)
+        if chunk is None:
+            if exhausted:
+                raise ValueError("Unterminated hosts array in JSON host list")
+            exhausted = True
+        else:
+            # Values already decoded are only dropped here, so each chunk is copied once rather than per host
+            buffer = buffer[position:] + chunk
+            position = 0
+
+
+def _compose(events, event):
+    """Builds the plain Python value that starts with event from the yaml event stream."""
+    if isinstance(event, yaml.ScalarEvent):
+        return event.value
+    if isinstance(event, yaml.SequenceStartEvent):
+        items = []
+        for item in events:
+            if isinstance(item, yaml.SequenceEndEvent):
+                return items
+            items.append(_compose(events, item))
+    if isinstance(event, yaml.MappingStartEvent):
+        mapping = {}
+        for key in events:
+            if isinstance(key, yaml.MappingEndEvent):
+                return mapping
+            mapping[_compose(events, key)] = _compose(events, next(events))
+    raise ValueError("Unsupported YAML event in host list: %s" % event)
+
+
+def iter_yaml_hosts(stream):
+    """
+    Yields the items of the top level "hosts" sequence using the incremental yaml event parser.
+    Only a key of the top level mapping counts; nested "hosts" keys and "hosts" values are skipped.
+    """
+    events = iter(yaml.parse(stream, Loader=yaml.SafeLoader))
+    # One [is a mapping, next node is a key] pair per open collection
+    open_collections = []
+    for event in events:
+        if isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+            open_collections.pop()
+            continue
+        if not isinstance(event, yaml.NodeEvent):
+            continue
+        is_key = False
+        if open_collections and open_collections[-1][0]:
+            is_key = open_collections[-1][1]
+            open_collections[-1][1] = not is_key
+        if is_key and len(open_collections) == 1 and isinstance(event, yaml.ScalarEvent) and event.value == 'hosts':
+            start = next(events)
+            if not isinstance(start, yaml.SequenceStartEvent):
+                raise ValueError("hosts in YAML host list is not a sequence")
+            for item in events:
+                if isinstance(item, yaml.SequenceEndEvent):
+                    return
+                yield _compose(events, item)
+        if isinstance(event, yaml.MappingStartEvent):
+            open_collections.append([True, True])
+        elif isinstance(event, yaml.SequenceStartEvent):
+            open_collections.append([False, False])
+    raise ValueError("No hosts sequence found in YAML host list")
+
+
+def iter_lines_hosts(stream):
+    """Yields one host per non-empty line, ignoring # comments."""
+    remainder = ''
+    for chunk in _iter_text(stream):
+        lines = (remainder + chunk).split('\n')
+        remainder = lines.pop()
+        for line in lines:
+            host = line.split('#', 1)[0].strip()
+            if host:
+                yield host
+    host = remainder.split('#', 1)[0].strip()
+    if host:
+        yield host
+
+
+def iter_hosts(stream):
+    """Sniffs the format of a host list (JSON, YAML or one host per line) and yields its hosts."""
+    prefix = stream.read(CHUNK_SIZE)
+    stream = _PrefixedStream(prefix, stream)
+    for line in prefix.decode('utf-8', 'replace').splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line[0] in '{[':
+            return iter_json_hosts(stream)
+        if line.startswith('---') or line.startswith('%') or YAML_KEY.match(line):
+            return iter_yaml_hosts(stream)
+        break
+    return iter_lines_hosts(stream)
+
+
+class HostListLoader(object):
+    """
+    Streams the host list from a URL.
+
+    When a state_path is given the response validators (ETag and Last-Modified)
+    and the resulting host list are remembered there, and the next fetch is
+    conditional: an unchanged list answers 304 and the remembered hosts are
+    replayed without downloading or parsing the document again.
+    """
+
+    def __init__(self, url, state_path=None):
+        super(HostListLoader, self).__init__()
+        self.url = url
+        self.state_path = state_path
+
+    def _load_state(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return None
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except ValueError:
+            return None
+        return state if state.get('url') == self.url else None
+
+    def _save_state(self, response, hosts):
+        if not self.state_path:
+            return
+        if not response.headers.get('ETag') and not response.headers.get('Last-Modified'):
+            return
+        state = {
+            'url': self.url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'hosts': hosts,
+        }
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def iter_hosts(self):
+        """Yields hosts as they are parsed off the wire, or from the saved state when unchanged."""
+        state = self._load_state()
+        request = urllib.request.Request(self.url)
+        if state is not None:
+            if state.get('etag'):
+                request.add_header('If-None-Match', state['etag'])
+            if state.get('last_modified'):
+                request.add_header('If-Modified-Since', state['last_modified'])
+
+        try:
+            response = urllib.request.urlopen(request)
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and state is not None:
+                logger.info("Host list %s not modified, reusing %d saved hosts" % (self.url, len(state['hosts'])))
+                for host in state['hosts']:
+                    yield host
+                return
+            raise
+
+        with response:
+            hosts = []
+            for host in iter_hosts(response):
+                hosts.append(host)
+                yield host
+            self._save_state(response, hosts)
@@ -1,15 +1,25 @@
 #!/usr/bin/env python3
 
 import argparse
-import boto3
 import datetime
-import json, yaml
 import logging
 import os
-import socket
-import ssl
 import sys
-import urllib.request
+import tempfile
+
+from cache import DATE_FMT, RescanScheduler, cache_from_url
+from certs import CertificateParser, intermediates_expiring_before_leaf
+from fanout import Coordinator, LambdaTransport
+from hosts import HostListLoader
+from probe import engine_from_environment
+from targets import entry_label, targets_from_entry
+
+try:
+    from notifications import notifier_from_environment
+except ImportError:
+    # Running from a checkout rather than code.zip: the shared module lives in lambdas/common
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common'))
+    from notifications import notifier_from_environment
 
 # Logging: from https://docs.python.org/3/howto/logging-cookbook.html
 # Lambda has read-only filesystem. So only create the filehandler when running locally (down in __main__.
@@ -36,57 +46,162 @@ class ExpiredCertDetector(object):
         self.expiring_certs = set()
         self.long_lasting_certs = set()
         self.unable_to_connect = set()
+        # Hosts whose connect address did not resolve
+        self.dns_failures = set()
+        # Hosts presenting an intermediate that expires before their leaf certificate
+        self.short_lived_intermediates = set()
         self.buffer_days = int(os.environ['expiration_buffer'])
         self.hosts = set()
+        # hostname -> (notAfter, fingerprint) of every certificate handshaken in this run
+        self.certificates = {}
+        # hostname -> list of CertificateInfo dicts (leaf first); only filled when inspecting chains
+        self.chains = {}
+        self.parser = CertificateParser()
+        if 'cache' in kwargs:
+            self.cache = kwargs['cache']
+        elif os.environ.get('cert_cache_url'):
+            self.cache = cache_from_url(os.environ['cert_cache_url'])
+        else:
+            self.cache = None
+
+    def host_loader(self):
+        state_path = os.environ.get(
+            'hosts_state_path', os.path.join(tempfile.gettempdir(), 'https-certificate-check-hosts.json')
+        )
+        return HostListLoader(os.environ['hosts_url'], state_path)
 
     def get_hosts(self):
-        with urllib.request.urlopen(os.environ['hosts_url']) as url:
-            data = url.read().decode()
+        self.hosts = set(self.stream_hosts())
 
-        try:
-            hosts = json.loads(data)['hosts']
-        except json.decoder.JSONDecodeError:
-            hosts = yaml.load(data)['hosts']
+    def stream_hosts(self):
+        """Yields targets while the host list is still downloading, recording them in self.hosts."""
+        for entry in self.host_loader().iter_hosts():
+            for target in self.expand_entry(entry):
+                self.hosts.add(target)
+                yield target
 
-        self.hosts = set(hosts)
+    def expand_entry(self, entry):
+        """Returns the targets of one host list entry, reporting a malformed entry as unable to connect."""
+        try:
+            return targets_from_entry(entry)
+        except ValueError as e:
+            logger.error("Skipping host list entry: %s" % e)
+            self.unable_to_connect.add(entry_label(entry))
+            return []
 
     def run(self):
+        self.check_https_expiry_datetime(self.hosts_to_probe(self.stream_hosts()))
+        self.save_cache()
+
+    def run_sharded(self, coordinator):
+        """Fetches the host list and lets coordinator probe it shard by shard."""
         self.get_hosts()
-        self.check_https_expiry_datetime()
+        for shard, partial in coordinator.run(self.hosts_to_probe(self.hosts)):
+            if partial is None:
+                # A lost shard is reported rather than silently dropped
+                self.unable_to_connect.update(target.label for target in shard)
+            else:
+                self.merge(partial)
+        self.save_cache()
+
+    def hosts_to_probe(self, targets):
+        """Classifies targets the cache can answer for and yields the ones that still need a handshake."""
+        if self.cache is None:
+            for target in targets:
+                yield target
+            return
+
+        self.cache.load()
+        scheduler = RescanScheduler(self.cache, self.buffer_days, int(os.environ.get('cache_max_age_days', 7)))
+        now = datetime.datetime.utcnow()
+        cached = 0
+        for target in targets:
+            if scheduler.needs_probe(target.label, now):
+                yield target
+            else:
+                cached += 1
+                self.classify_expiry(target.label, self.cache.get(target.label).not_after)
+        logger.info("%d hosts answered from cache" % cached)
+
+    def save_cache(self):
+        if self.cache is None:
+            return
+        now = datetime.datetime.utcnow()
+        for hostname, (not_after, fingerprint) in self.certificates.items():
+            self.cache.put(hostname, not_after, fingerprint, now)
+        self.cache.save()
+
+    def to_dict(self):
+        """Returns the result sets as a JSON serializable dict, as returned by a worker."""
+        return {
+            'expired': sorted(self.expired_certs),
+            'expiring': sorted(self.expiring_certs),
+            'long_lasting': sorted(self.long_lasting_certs),
+            'unable_to_connect': sorted(self.unable_to_connect),
+            'dns_failures': sorted(self.dns_failures),
+            'short_lived_intermediates': sorted(self.short_lived_intermediates),
+            'chains': self.chains,
+            'certificates': dict(
+                (hostname, {'not_after': not_after.strftime(DATE_FMT), 'fingerprint': fingerprint})
+                for hostname, (not_after, fingerprint) in self.certificates.items()
+            ),
+        }
+
+    def merge(self, partial):
+        """Adds a worker's to_dict() result to this detector's result sets."""
+        self.expired_certs.update(partial['expired'])
+        self.expiring_certs.update(partial['expiring'])
+        self.long_lasting_certs.update(partial['long_lasting'])
+        self.unable_to_connect.update(partial['unable_to_connect'])
+        self.dns_failures.update(partial['dns_failures'])
+        self.short_lived_intermediates.update(partial['short_lived_intermediates'])
+        self.chains.update(partial['chains'])
+        for hostname, certificate in partial['certificates'].items():
+            self.certificates[hostname] = (
+                datetime.datetime.strptime(certificate['not_after'], DATE_FMT), certificate['fingerprint']
+            )
 
     # Code basically taken from https://serverlesscode.com/post/ssl-expiration-alerts-with-lambda/
-    def check_https_expiry_datetime(self):
-        ssl_date_fmt = r'%b %d %H:%M:%S %Y %Z'
-
-        context = ssl.create_default_context()
-
-        for hostname in self.hosts:
-            conn = context.wrap_socket(
-                socket.socket(socket.AF_INET),
-                server_hostname=hostname,
-            )
-            # 1 second timeout because Lambda has runtime limitations
-            conn.settimeout(1.0)
-
-            try:
-                conn.connect((hostname, 443))
-                ssl_info = conn.getpeercert()
-                ssl_expiration_date = datetime.datetime.strptime(ssl_info['notAfter'], ssl_date_fmt)
-                logger.debug("Host %s has certificate expiration of %s" % (hostname, ssl_expiration_date))
-
-                if ssl_expiration_date < datetime.datetime.utcnow():
-                    # already expired!
-                    self.expired_certs.add(hostname)
-                elif ssl_expiration_date < (datetime.datetime.utcnow() + datetime.timedelta(days=self.buffer_days)):
-                    # going to expire in buffer
-                    self.expiring_certs.add(hostname)
-                else:
-                    # expires after buffer days
-                    self.long_lasting_certs.add(hostname)
-            except:
-                logger.warning("Failed to connect to %s" % hostname)
-                self.unable_to_connect.add(hostname)
-                pass
+    def check_https_expiry_datetime(self, hosts=None):
+        results = engine_from_environment().run(self.hosts if hosts is None else hosts)
+        for result in results.values():
+            self.classify(result)
+
+    def classify(self, result):
+        """Sorts one ProbeResult into the expired/expiring/long lasting/dns failure/unable to connect sets."""
+        if result.dns_failure:
+            self.dns_failures.add(result.hostname)
+            return
+        if not result.connected:
+            self.unable_to_connect.add(result.hostname)
+            return
+
+        # Memoized by fingerprint, so a certificate shared by many hosts is parsed once per run
+        ssl_expiration_date = self.parser.parse(result.der, result.peercert).not_after
+        if result.chain:
+            self.inspect_chain(result)
+        logger.debug("Host %s has certificate expiration of %s" % (result.hostname, ssl_expiration_date))
+        self.certificates[result.hostname] = (ssl_expiration_date, result.fingerprint)
+        self.classify_expiry(result.hostname, ssl_expiration_date)
+
+    def inspect_chain(self, result):
+        chain_info = self.parser.parse_chain(result.chain)
+        self.chains[result.hostname] = [info.to_dict() for info in chain_info]
+        for info in intermediates_expiring_before_leaf(chain_info):
+            logger.warning("Host %s presents intermediate %s expiring %s, before its leaf certificate" % (
+                result.hostname, info.subject, info.not_after))
+            self.short_lived_intermediates.add(result.hostname)
+
+    def classify_expiry(self, hostname, ssl_expiration_date):
+        if ssl_expiration_date < datetime.datetime.utcnow():
+            # already expired!
+            self.expired_certs.add(hostname)
+        elif ssl_expiration_date < (datetime.datetime.utcnow() + datetime.timedelta(days=self.buffer_days)):
+            # going to expire in buffer
+            self.expiring_certs.add(hostname)
+        else:
+            # expires after buffer days
+            self.long_lasting_certs.add(hostname)
 
 
 def report(detector_object):
@@ -110,6 +225,18 @@ def report(detector_object):
         )
         print(expired_log)
 
+    if len(detector_object.short_lived_intermediates) > 0:
+        intermediates_log = "Found {} hosts presenting intermediates that expire before the leaf certificate. Hosts: {}".format(
+            len(detector_object.short_lived_intermediates), detector_object.short_lived_intermediates
+        )
+        print(intermediates_log)
+
+    if len(detector_object.dns_failures) > 0:
+        dns_error_log = "Unable to resolve {} hosts!!! Hosts: {}".format(
+            len(detector_object.dns_failures), detector_object.dns_failures
+        )
+        print(dns_error_log)
+
     if len(detector_object.unable_to_connect) > 0:
         connect_error_log = "Unable to connect to {} hosts!!! Hosts: {}".format(
             len(detector_object.unable_to_connect), detector_object.unable_to_connect
@@ -119,41 +246,49 @@ def report(detector_object):
     print("---------------")
 
 
-def send_sns(detector_object):
-    if len(detector_object.expired_certs) > 0:
-        message = "The following hosts were identified as having expired certs: {}".format(
-            detector_object.expired_certs)
+def send_sns(detector_object, notifier=None):
+    notifier = notifier or notifier_from_environment('https-certificate-check')
 
-        boto3.client('sns').publish(
-            TargetArn=os.environ['sns_topic_arn'],
-            Message=message,
-            Subject="Lambda Monitor: Expired HTTPS Certificates"
-        )
+    notifier.notify('expired', "Lambda Monitor: Expired HTTPS Certificates",
+                    "The following hosts were identified as having expired certs",
+                    detector_object.expired_certs)
 
-    if len(detector_object.expiring_certs) > 0:
-        message = "The following hosts were identified as having certs that will expire soon: {}".format(
-            detector_object.expiring_certs)
+    notifier.notify('expiring', "Lambda Monitor: Expiring HTTPS Certificates",
+                    "The following hosts were identified as having certs that will expire soon",
+                    detector_object.expiring_certs)
 
-        boto3.client('sns').publish(
-            TargetArn=os.environ['sns_topic_arn'],
-            Message=message,
-            Subject="Lambda Monitor: Expiring HTTPS Certificates"
-        )
+    notifier.notify('short_lived_intermediates', "Lambda Monitor: Short-lived Intermediate Certificates",
+                    "The following hosts present intermediate certificates that expire before their leaf",
+                    detector_object.short_lived_intermediates)
 
-    if len(detector_object.unable_to_connect) > 0:
-        message = "Unable to connect to the following hosts: {}".format(detector_object.unable_to_connect)
+    notifier.notify('dns_failures', "Lambda Monitor: Unable to resolve HTTPS hosts",
+                    "Unable to resolve the following hosts",
+                    detector_object.dns_failures)
 
-        boto3.client('sns').publish(
-            TargetArn=os.environ['sns_topic_arn'],
-            Message=message,
-            Subject="Lambda Monitor: Unable to check HTTPS Certificates"
-        )
-    print("foo")
+    notifier.notify('unable_to_connect', "Lambda Monitor: Unable to check HTTPS Certificates",
+                    "Unable to connect to the following hosts",
+                    detector_object.unable_to_connect)
+
+    notifier.save()
 
 
 def lambda_handler(event, context):
+    if isinstance(event, dict) and event.get('mode') == 'worker':
+        # Worker: probe only the hosts handed over by the coordinator and return the partial result
+        detector = ExpiredCertDetector(cache=None)
+        detector.hosts = set(target for entry in event['hosts'] for target in detector.expand_entry(entry))
+        detector.check_https_expiry_datetime()
+        return detector.to_dict()
+
     detector = ExpiredCertDetector()
-    detector.run()
+    shard_count = int(os.environ.get('shard_count', 1))
+    if shard_count > 1:
+        # Coordinator: fan the host list out to the worker function, this same one unless configured
+        transport = LambdaTransport(os.environ.get('worker_function_name') or context.function_name,
+                                    worker_timeout=int(os.environ.get('worker_timeout', 60)))
+        detector.run_sharded(Coordinator(transport, shard_count))
+    else:
+        detector.run()
     send_sns(detector)
 
 
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+import asyncio
+import hashlib
+import importlib.util
+import logging
+import os
+import ssl
+
+from resolver import DNS_CACHE, DnsCache, DnsResolutionError
+
+logger = logging.getLogger('index.probe')
+
+# Whether a missing prerequisite of inspect_chain was already logged by this container
+_chain_warning_logged = False
+
+
+async def _reply(reader, final):
+    """Reads lines until final(line) holds and returns that line."""
+    while True:
+        line = (await reader.readline()).decode('ascii', 'replace')
+        if not line:
+            raise ConnectionError("Connection closed during STARTTLS negotiation")
+        if final(line):
+            return line
+
+
+async def _starttls_smtp(reader, writer):
+    # Multi-line SMTP replies continue with "250-", the last line is "250 "
+    if not (await _reply(reader, lambda line: line[3:4] == ' ')).startswith('220'):
+        raise ConnectionError("Unexpected SMTP greeting")
+    writer.write(b'EHLO certificate-check\r\n')
+    await _reply(reader, lambda line: line[3:4] == ' ')
+    writer.write(b'STARTTLS\r\n')
+    line = await _reply(reader, lambda line: line[3:4] == ' ')
+    if not line.startswith('220'):
+        raise ConnectionError("SMTP STARTTLS refused: %s" % line.strip())
+
+
+async def _starttls_imap(reader, writer):
+    await _reply(reader, lambda line: line.startswith('* '))
+    writer.write(b'a1 STARTTLS\r\n')
+    line = await _reply(reader, lambda line: line.startswith('a1 '))
+    if not line.startswith('a1 OK'):
+        raise ConnectionError("IMAP STARTTLS refused: %s" % line.strip())
+
+
+async def _starttls_pop3(reader, writer):
+    await _reply(reader, lambda line: True)
+    writer.write(b'STLS\r\n')
+    line = await _reply(reader, lambda line: True)
+    if not line.startswith('+OK'):
+        raise ConnectionError("POP3 STLS refused: %s" % line.strip())
+
+
+STARTTLS = {
+    'smtp': _starttls_smtp,
+    'imap': _starttls_imap,
+    'pop3': _starttls_pop3,
+}
+
+
+class ProbeResult(object):
+    """
+    Outcome of a single TLS handshake against a target.
+    """
+
+    def __init__(self, target, peercert=None, der=None, chain=None, error=None):
+        super(ProbeResult, self).__init__()
+        self.target = target
+        # Results are keyed by the target label, which is the plain hostname for default targets
+        self.hostname = target.label
+        self.peercert = peercert
+        self.der = der
+        # DER certificates as presented by the server, leaf first; only collected when inspecting chains
+        self.chain = chain
+        self.error = error
+
+    @property
+    def connected(self):
+        return self.peercert is not None
+
+    @property
+    def dns_failure(self):
+        return isinstance(self.error, DnsResolutionError)
+
+    @property
+    def fingerprint(self):
+        """SHA-256 of the DER encoded leaf certificate."""
+        return hashlib.sha256(self.der).hexdigest() if self.der else None
+
+
+class AsyncProbeEngine(object):
+    """
+    Probes many targets (see targets.Target) concurrently with asyncio.
+
+    Targets flow through two stages. The resolution stage looks every connect
+    address up through a DnsCache, with its own `resolve_timeout`, so DNS
+    latency does not eat into the handshake budget and failures are reported
+    as DNS failures. The probe stage then runs at most `concurrency`
+    handshakes at once, each with its own `timeout` deadline covering connect
+    plus handshake, so a slow or unreachable host only delays itself.
+
+    Targets sharing an address (many SNI names behind one load balancer) share
+    a single lookup, and at most `per_address_limit` of their handshakes run
+    against that address and port at a time.
+
+    With inspect_chain the full presented chain is collected as well. That
+    needs an ssl module with SSLObject.get_unverified_chain (Python 3.13+);
+    older interpreters fall back to the leaf certificate alone.
+    """
+
+    def __init__(self, context=None, concurrency=100, timeout=1.0, inspect_chain=False, per_address_limit=10,
+                 dns_cache=None, resolve_timeout=2.0):
+        super(AsyncProbeEngine, self).__init__()
+        self.context = context or ssl.create_default_context()
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.inspect_chain = inspect_chain
+        self.per_address_limit = per_address_limit
+        self.dns_cache = dns_cache or DnsCache()
+        self.resolve_timeout = resolve_timeout
+
+    def run(self, targets):
+        """
+        Probes every target and returns a dict of target label to ProbeResult.
+
+        targets may be any iterable, including a generator still reading the
+        host list: it is consumed on a separate thread and probing starts with
+        the first target rather than once the whole list is in.
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.probe_all(targets))
+        finally:
+            loop.close()
+
+    async def probe_all(self, targets):
+        loop = asyncio.get_running_loop()
+        # Lookups and per-address slots live only as long as this run, so one engine can serve several loops
+        lookups = {}
+        slots = {}
+        resolve_queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        probe_queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        results = {}
+        resolvers = [asyncio.ensure_future(self._resolve_worker(resolve_queue, probe_queue, results, lookups))
+                     for _ in range(self.concurrency)]
+        probers = [asyncio.ensure_future(self._probe_worker(probe_queue, results, slots))
+                   for _ in range(self.concurrency)]
+        try:
+            await loop.run_in_executor(None, self._produce, loop, resolve_queue, targets)
+        finally:
+            for _ in resolvers:
+                await resolve_queue.put(None)
+            await asyncio.gather(*resolvers)
+            for _ in probers:
+                await probe_queue.put(None)
+            await asyncio.gather(*probers)
+        return results
+
+    def _produce(self, loop, queue, targets):
+        seen = set()
+        for target in targets:
+            if target in seen:
+                continue
+            seen.add(target)
+            asyncio.run_coroutine_threadsafe(queue.put(target), loop).result()
+
+    async def _resolve_worker(self, resolve_queue, probe_queue, results, lookups):
+        while True:
+            target = await resolve_queue.get()
+            if target is None:
+                return
+            try:
+                address = await self.resolve(target, lookups)
+            except DnsResolutionError as e:
+                logger.warning("Failed to resolve %s: %s" % (target.label, e))
+                results[target.label] = ProbeResult(target, error=e)
+                continue
+            except Exception as e:
+                # One bad entry must not end the worker and leave the rest of the run waiting on it
+                logger.warning("Failed to resolve %s: %r" % (target.label, e))
+                results[target.label] = ProbeResult(target, error=e)
+                continue
+            await probe_queue.put((target, address))
+
+    async def resolve(self, target, lookups):
+        """Returns the first address of target, looking each name up once per run however many targets share it."""
+        if target.address not in lookups:
+            lookups[target.address] = asyncio.ensure_future(
+                asyncio.wait_for(self.dns_cache.resolve(target.address), self.resolve_timeout)
+            )
+        try:
+            # Shielded so one waiter being cancelled does not cancel the lookup for the others
+            addresses = await asyncio.shield(lookups[target.address])
+        except asyncio.TimeoutError:
+            raise DnsResolutionError("%s: lookup timed out after %ss" % (target.address, self.resolve_timeout))
+        return addresses[0]
+
+    async def _probe_worker(self, queue, results, slots):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            target, address = item
+            results[target.label] = await self.probe(target, address, slots)
+
+    async def probe(self, target, address, slots):
+        """slots maps (address, port) to a semaphore shared by the targets of one run."""
+        key = (address, target.port)
+        if key not in slots:
+            slots[key] = asyncio.Semaphore(self.per_address_limit)
+        async with slots[key]:
+            try:
+                peercert, der, chain = await asyncio.wait_for(self._handshake(target, address), self.timeout)
+            except Exception as e:
+                logger.warning("Failed to connect to %s: %r" % (target.label, e))
+                return ProbeResult(target, error=e)
+        return ProbeResult(target, peercert=peercert, der=der, chain=chain)
+
+    async def _handshake(self, target, address):
+        if target.protocol in STARTTLS:
+            reader, writer = await asyncio.open_connection(address, target.port)
+            try:
+                await STARTTLS[target.protocol](reader, writer)
+                transport = await asyncio.get_running_loop().start_tls(
+                    writer.transport, writer.transport.get_protocol(), self.context, server_hostname=target.sni
+                )
+            except BaseException:
+                writer.close()
+                raise
+            ssl_object = transport.get_extra_info('ssl_object')
+        else:
+            reader, writer = await asyncio.open_connection(
+                address, target.port, ssl=self.context, server_hostname=target.sni
+            )
+            transport = writer
+            ssl_object = writer.get_extra_info('ssl_object')
+        try:
+            der = ssl_object.getpeercert(binary_form=True)
+            chain = self._presented_chain(ssl_object, der) if self.inspect_chain else None
+            return ssl_object.getpeercert(), der, chain
+        finally:
+            transport.close()
+
+    def _presented_chain(self, ssl_object, der):
+        get_unverified_chain = getattr(ssl_object, 'get_unverified_chain', None)
+        if get_unverified_chain is None:
+            return [der]
+        return [cert if isinstance(cert, bytes) else cert.public_bytes(ssl.ENCODING_DER)
+                for cert in get_unverified_chain()]
+
+
+def missing_chain_support():
+    """Returns what chain inspection needs but this runtime lacks; an empty list when it is fully supported."""
+    missing = []
+    if not hasattr(ssl.SSLObject, 'get_unverified_chain'):
+        missing.append("SSLObject.get_unverified_chain (Python 3.13+)")
+    if importlib.util.find_spec('cryptography') is None:
+        missing.append("the cryptography package")
+    return missing
+
+
+def engine_from_environment():
+    """Builds an engine from the optional probe_* Lambda environment variables."""
+    global _chain_warning_logged
+    inspect_chain = os.environ.get('inspect_chain', 'false').lower() == 'true'
+    if inspect_chain and not _chain_warning_logged:
+        missing = missing_chain_support()
+        if missing:
+            logger.warning("inspect_chain is set but this runtime lacks %s; only leaf certificates are inspected"
+                           % ' and '.join(missing))
+        _chain_warning_logged = True
+    return AsyncProbeEngine(
+        concurrency=int(os.environ.get('probe_concurrency', 100)),
+        timeout=float(os.environ.get('probe_timeout', 1.0)),
+        inspect_chain=inspect_chain,
+        per_address_limit=int(os.environ.get('probe_per_address_limit', 10)),
+        dns_cache=DNS_CACHE,
+        resolve_timeout=float(os.environ.get('dns_timeout', 2.0)),
+    )
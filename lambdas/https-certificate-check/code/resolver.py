@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import asyncio
+import ipaddress
+import logging
+import os
+import socket
+import time
+
+logger = logging.getLogger('index.resolver')
+
+
+class DnsResolutionError(Exception):
+    """
+    A name could not be resolved; reported separately from connection failures.
+    """
+
+
+class SystemResolver(object):
+    """
+    Resolves names with the event loop's getaddrinfo.
+
+    getaddrinfo does not expose record TTLs, so every answer is treated as
+    valid for `ttl` seconds. Any resolver with the same async resolve(name)
+    returning (addresses, ttl) can be used instead, e.g. a stub in tests.
+    """
+
+    def __init__(self, ttl=300):
+        super(SystemResolver, self).__init__()
+        self.ttl = ttl
+
+    async def resolve(self, name):
+        try:
+            addrinfo = await asyncio.get_running_loop().getaddrinfo(name, None, type=socket.SOCK_STREAM)
+        except (OSError, ValueError) as e:
+            # gaierror, and UnicodeError from the idna codec for names with an empty or over-long label
+            raise DnsResolutionError("%s: %s" % (name, e))
+        addresses = []
+        for family, socktype, proto, canonname, sockaddr in addrinfo:
+            if sockaddr[0] not in addresses:
+                addresses.append(sockaddr[0])
+        return addresses, self.ttl
+
+
+class DnsCache(object):
+    """
+    TTL respecting cache in front of a resolver.
+
+    Failures are cached for negative_ttl seconds so a missing name is not
+    looked up again by every target pointing at it.
+    """
+
+    def __init__(self, resolver=None, negative_ttl=30, clock=time.monotonic):
+        super(DnsCache, self).__init__()
+        self.resolver = resolver or SystemResolver()
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        # name -> (addresses or None, error or None, expiry)
+        self.entries = {}
+
+    async def resolve(self, name):
+        """Returns the addresses for name, raising DnsResolutionError when it does not resolve."""
+        try:
+            ipaddress.ip_address(name)
+            return [name]
+        except ValueError:
+            pass
+
+        now = self.clock()
+        entry = self.entries.get(name)
+        if entry is not None and entry[2] > now:
+            if entry[1] is not None:
+                raise entry[1]
+            return entry[0]
+
+        try:
+            addresses, ttl = await self.resolver.resolve(name)
+            if not addresses:
+                raise DnsResolutionError("%s: no addresses" % name)
+        except DnsResolutionError as e:
+            self.entries[name] = (None, e, now + self.negative_ttl)
+            raise
+        logger.debug("Resolved %s to %s (ttl %ss)" % (name, addresses, ttl))
+        self.entries[name] = (addresses, None, now + ttl)
+        return addresses
+
+
+# Module level so warm Lambda invocations start with the previous invocation's answers
+DNS_CACHE = DnsCache(SystemResolver(ttl=int(os.environ.get('dns_ttl', 300))))
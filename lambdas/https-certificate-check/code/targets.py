@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+DEFAULT_PORTS = {
+    'https': 443,
+    'tls': 443,
+    'smtp': 25,
+    'imap': 143,
+    'pop3': 110,
+}
+
+
+class Target(object):
+    """
+    One TLS endpoint to check: which address and port to connect to, which SNI
+    name to present and how to get to the handshake (protocol).
+
+    Targets are identified by their label, which is the plain hostname for the
+    default https-on-443 case so results read exactly as they always did.
+    """
+
+    def __init__(self, host, port=None, sni=None, address=None, protocol='https'):
+        super(Target, self).__init__()
+        if protocol not in DEFAULT_PORTS:
+            raise ValueError("Unsupported protocol %r for host %s" % (protocol, host))
+        self.host = host
+        self.protocol = protocol
+        try:
+            self.port = int(port) if port else DEFAULT_PORTS[protocol]
+        except (TypeError, ValueError):
+            raise ValueError("Invalid port %r for host %s" % (port, host))
+        self.sni = sni or host
+        self.address = address or host
+        self.label = self._label()
+
+    def _label(self):
+        label = self.sni
+        if self.address != self.sni:
+            label += '@' + self.address
+        if self.port != 443 or self.protocol not in ('https', 'tls'):
+            if ':' in label:
+                # IPv6 literal: bracket it so the port stays readable
+                label = '[%s]' % label
+            label += ':%d' % self.port
+        if self.protocol not in ('https', 'tls'):
+            label += '/' + self.protocol
+        return label
+
+    def __eq__(self, other):
+        return isinstance(other, Target) and self.label == other.label
+
+    def __hash__(self):
+        return hash(self.label)
+
+    def __repr__(self):
+        return 'Target(%s)' % self.label
+
+    def to_entry(self):
+        """Returns the host list entry this target can be rebuilt from."""
+        if self.label == self.host:
+            return self.host
+        return {'host': self.host, 'port': self.port, 'sni': self.sni, 'address': self.address,
+                'protocol': self.protocol}
+
+
+def targets_from_entry(entry):
+    """
+    Expands one host list entry into targets.
+
+    An entry is either a string ("example.com", "example.com:8443", an IPv6
+    literal or "[2001:db8::1]:8443") or a mapping with host, port, sni, address
+    and protocol. sni may be a list, in which case every name is checked
+    against the same address and port.
+
+    Raises ValueError for an entry that cannot be turned into targets.
+    """
+    if isinstance(entry, str):
+        host, port = split_host_port(entry)
+        return [Target(host, port)]
+
+    if not isinstance(entry, dict):
+        raise ValueError("Unsupported host list entry: %r" % (entry,))
+    names = entry.get('sni') or entry.get('host')
+    if not names:
+        raise ValueError("Host list entry needs a host or sni: %r" % (entry,))
+    if isinstance(names, str):
+        names = [names]
+    address = entry.get('address') or entry.get('host')
+    return [
+        Target(entry.get('host') or name, entry.get('port'), sni=name, address=address,
+               protocol=entry.get('protocol', 'https'))
+        for name in names
+    ]
+
+
+def split_host_port(value):
+    """Splits "host[:port]" into (host, port or None), leaving bare IPv6 literals whole."""
+    if value.startswith('['):
+        host, bracket, rest = value[1:].partition(']')
+        if not bracket or (rest and not rest.startswith(':')):
+            raise ValueError("Malformed bracketed host: %r" % (value,))
+        return host, rest[1:] or None
+    if value.count(':') > 1:
+        # An unbracketed IPv6 literal has no room for a port
+        return value, None
+    host, _, port = value.partition(':')
+    return host, port or None
+
+
+def entry_label(entry):
+    """Returns how a host list entry is reported when it cannot be expanded into targets."""
+    if isinstance(entry, str):
+        return entry
+    return repr(entry)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from botocore.stub import ANY, Stubber
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common', 'tests'))
+
+from cache import RescanScheduler, cache_from_url  # noqa: E402
+from lambda_stubs import client, streaming_body  # noqa: E402
+
+NOW = datetime.datetime(2024, 1, 1, 12, 0, 0)
+
+
+def days(number):
+    return datetime.timedelta(days=number)
+
+
+class RescanSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache.json')
+        self.cache = cache_from_url(self.path)
+        self.scheduler = RescanScheduler(self.cache, buffer_days=30, max_age_days=7)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_unknown_hosts_are_probed(self):
+        self.assertTrue(self.scheduler.needs_probe('a.example.com', NOW))
+
+    def test_far_from_expiry_is_answered_from_the_cache(self):
+        self.cache.put('a.example.com', NOW + days(90), 'fingerprint', NOW - days(1))
+        self.assertFalse(self.scheduler.needs_probe('a.example.com', NOW))
+
+    def test_old_entries_are_probed_again(self):
+        self.cache.put('a.example.com', NOW + days(90), 'fingerprint', NOW - days(7))
+        self.assertTrue(self.scheduler.needs_probe('a.example.com', NOW))
+
+    def test_certificates_that_could_enter_the_buffer_before_the_entry_ages_out_are_probed(self):
+        self.cache.put('a.example.com', NOW + days(36), 'fingerprint', NOW)
+        self.assertTrue(self.scheduler.needs_probe('a.example.com', NOW))
+        self.cache.put('a.example.com', NOW + days(38), 'fingerprint', NOW)
+        self.assertFalse(self.scheduler.needs_probe('a.example.com', NOW))
+        self.cache.put('a.example.com', NOW - days(1), 'fingerprint', NOW)
+        self.assertTrue(self.scheduler.needs_probe('a.example.com', NOW))
+
+    def test_entries_survive_a_save_and_load(self):
+        self.cache.put('a.example.com', NOW + days(90), 'fingerprint', NOW)
+        self.cache.save()
+        cache = cache_from_url(self.path)
+        cache.load()
+        entry = cache.get('a.example.com')
+        self.assertEqual((entry.not_after, entry.fingerprint, entry.checked), (NOW + days(90), 'fingerprint', NOW))
+
+
+class CertCacheTest(unittest.TestCase):
+
+    def test_round_trip_through_s3(self):
+        s3 = client('s3')
+        cache = cache_from_url('s3://bucket/https-certificate-check/cache.json', client=s3)
+        key = {'Bucket': 'bucket', 'Key': 'https-certificate-check/cache.json'}
+        with Stubber(s3) as stubber:
+            stubber.add_client_error('get_object', service_error_code='NoSuchKey', http_status_code=404,
+                                     expected_params=key)
+            cache.load()
+            self.assertEqual(cache.entries, {})
+
+            cache.put('a.example.com', NOW + days(90), 'fingerprint', NOW)
+            stubber.add_response('put_object', {}, dict(key, Body=ANY, ContentType='application/json'))
+            cache.save()
+
+            document = ('{"a.example.com": {"checked": "2024-01-01T12:00:00", "fingerprint": "other", '
+                        '"not_after": "2024-06-01T00:00:00"}}').encode('utf-8')
+            stubber.add_response('get_object', {'Body': streaming_body(document)}, key)
+            cache.load()
+            stubber.assert_no_pending_responses()
+        self.assertEqual(cache.get('a.example.com').fingerprint, 'other')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import sys
+import unittest
+
+from botocore.stub import Stubber
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common', 'tests'))
+# LambdaTransport builds its own client when given none
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from fanout import WORKER_TIMEOUT_MARGIN, Coordinator, InProcessTransport, LambdaTransport, shard_hosts  # noqa: E402
+from lambda_stubs import client, streaming_body  # noqa: E402
+from targets import Target, targets_from_entry  # noqa: E402
+
+HOSTS = [Target('host%d.example.com' % number) for number in range(40)] + \
+    [Target('mail.example.com', protocol='smtp'), Target('a.example.com', sni='b.example.com', port=8443)]
+
+
+def worker(event, context):
+    """Stands in for the worker handler: every host probed fine, unless the shard holds a broken one."""
+    targets = [target for entry in event['hosts'] for target in targets_from_entry(entry)]
+    if any(target.host == 'broken.example.com' for target in targets):
+        raise RuntimeError("worker crashed")
+    return {'shard': event['shard'], 'shard_count': event['shard_count'],
+            'long_lasting': sorted(target.label for target in targets)}
+
+
+class ShardHostsTest(unittest.TestCase):
+
+    def test_every_target_lands_in_exactly_one_shard(self):
+        shards = shard_hosts(HOSTS, 4)
+        self.assertEqual(len(shards), 4)
+        labels = [target.label for shard in shards for target in shard]
+        self.assertEqual(sorted(labels), sorted(target.label for target in HOSTS))
+        self.assertTrue(all(shards))
+
+    def test_shards_do_not_depend_on_input_order_or_the_other_targets(self):
+        shards = shard_hosts(HOSTS, 4)
+        self.assertEqual(shard_hosts(list(reversed(HOSTS)), 4), shards)
+        fewer = shard_hosts(HOSTS[:10], 4)
+        for shard, smaller in zip(shards, fewer):
+            self.assertTrue(set(smaller) <= set(shard))
+
+    def test_more_shards_than_targets(self):
+        shards = shard_hosts(HOSTS[:2], 8)
+        self.assertEqual(len(shards), 8)
+        self.assertEqual(sum(len(shard) for shard in shards), 2)
+
+
+class CoordinatorTest(unittest.TestCase):
+
+    def test_collects_every_shard_through_the_transport(self):
+        results = Coordinator(InProcessTransport(worker), 4).run(HOSTS)
+        self.assertEqual(len(results), 4)
+        probed = []
+        for shard, partial in results:
+            self.assertEqual(partial['long_lasting'], sorted(target.label for target in shard))
+            self.assertEqual(partial['shard_count'], 4)
+            probed.extend(partial['long_lasting'])
+        self.assertEqual(sorted(probed), sorted(target.label for target in HOSTS))
+
+    def test_failed_shard_is_returned_without_a_result(self):
+        hosts = HOSTS + [Target('broken.example.com')]
+        results = Coordinator(InProcessTransport(worker), 4).run(hosts)
+        failed = [shard for shard, partial in results if partial is None]
+        self.assertEqual(len(failed), 1)
+        self.assertIn(Target('broken.example.com'), failed[0])
+        self.assertEqual(sum(len(shard) for shard, partial in results), len(hosts))
+
+    def test_empty_shards_are_not_dispatched(self):
+        payloads = []
+        transport = InProcessTransport(lambda event, context: payloads.append(event) or {})
+        results = Coordinator(transport, 8).run(HOSTS[:2])
+        self.assertEqual(len(results), len(payloads))
+        self.assertLessEqual(len(payloads), 2)
+        self.assertEqual([payload['shard_count'] for payload in payloads], [len(payloads)] * len(payloads))
+
+
+class LambdaTransportTest(unittest.TestCase):
+
+    def test_client_waits_for_the_worker_and_does_not_retry(self):
+        transport = LambdaTransport('worker', worker_timeout=120)
+        config = transport.client.meta.config
+        self.assertEqual(config.read_timeout, 120 + WORKER_TIMEOUT_MARGIN)
+        self.assertEqual(config.retries['total_max_attempts'], 1)
+
+    def test_invokes_the_worker_and_raises_on_function_errors(self):
+        lambda_client = client('lambda')
+        transport = LambdaTransport('worker', client=lambda_client)
+        payload = {'mode': 'worker', 'shard': 0, 'shard_count': 1, 'hosts': ['a.example.com']}
+
+        def response(body, **extra):
+            body = json.dumps(body).encode('utf-8')
+            return dict({'StatusCode': 200, 'Payload': streaming_body(body)}, **extra)
+
+        expected = {'FunctionName': 'worker', 'InvocationType': 'RequestResponse',
+                    'Payload': json.dumps(payload).encode('utf-8')}
+        with Stubber(lambda_client) as stubber:
+            stubber.add_response('invoke', response({'expired': []}), expected)
+            self.assertEqual(transport.dispatch(payload), {'expired': []})
+            stubber.add_response('invoke', response({'errorMessage': 'Task timed out'}, FunctionError='Unhandled'),
+                                 expected)
+            with self.assertRaises(RuntimeError) as raised:
+                transport.dispatch(payload)
+            stubber.assert_no_pending_responses()
+        self.assertIn('Task timed out', str(raised.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
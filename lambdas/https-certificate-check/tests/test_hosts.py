@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import http.server
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+
+import hosts  # noqa: E402
+from hosts import HostListLoader, iter_hosts  # noqa: E402
+
+JSON_HOSTS = b'''{
+  "owner": {"hosts": ["nested.example.com"], "name": "hosts"},
+  "description": "hosts",
+  "hosts": ["a.example.com", {"host": "b.example.com", "ports": [443, 8443]}, "c.example.com"],
+  "after": ["ignored.example.com"]
+}'''
+
+YAML_HOSTS = b'''---
+owner:
+  hosts:
+    - nested.example.com
+description: hosts
+hosts:
+  - a.example.com
+  - host: b.example.com
+    ports: [443, 8443]
+  - c.example.com
+'''
+
+EXPECTED = ['a.example.com', {'host': 'b.example.com', 'ports': [443, 8443]}, 'c.example.com']
+
+
+class IterHostsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.chunk_size = hosts.CHUNK_SIZE
+
+    def tearDown(self):
+        hosts.CHUNK_SIZE = self.chunk_size
+
+    def test_json_only_reads_the_top_level_hosts_array(self):
+        # Small chunks split keys, strings and numbers across reads
+        for chunk_size in (1, 2, 3, 7, 64 * 1024):
+            hosts.CHUNK_SIZE = chunk_size
+            self.assertEqual(list(iter_hosts(io.BytesIO(JSON_HOSTS))), EXPECTED, chunk_size)
+
+    def test_json_many_hosts_per_chunk(self):
+        names = ['host%05d.example.com' % number for number in range(20000)]
+        document = ('{"hosts": [%s, 8443]}' % ', '.join('"%s"' % name for name in names)).encode('utf-8')
+        for chunk_size in (5, 64 * 1024):
+            hosts.CHUNK_SIZE = chunk_size
+            self.assertEqual(list(iter_hosts(io.BytesIO(document))), names + [8443], chunk_size)
+
+    def test_json_bare_array(self):
+        self.assertEqual(list(iter_hosts(io.BytesIO(b'["a.example.com", "b.example.com"]'))),
+                         ['a.example.com', 'b.example.com'])
+
+    def test_json_without_hosts(self):
+        with self.assertRaises(ValueError):
+            list(iter_hosts(io.BytesIO(b'{"owner": {"hosts": ["nested.example.com"]}}')))
+
+    def test_yaml_only_reads_the_top_level_hosts_sequence(self):
+        # Numbers stay strings: the event parser does not resolve scalar types
+        expected = ['a.example.com', {'host': 'b.example.com', 'ports': ['443', '8443']}, 'c.example.com']
+        self.assertEqual(list(iter_hosts(io.BytesIO(YAML_HOSTS))), expected)
+
+    def test_lines(self):
+        hosts.CHUNK_SIZE = 4
+        text = b'# hosts to check\na.example.com\n\nb.example.com  # load balancer\nc.example.com'
+        self.assertEqual(list(iter_hosts(io.BytesIO(text))), ['a.example.com', 'b.example.com', 'c.example.com'])
+
+
+class HostListHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the server's document with an ETag, answering 304 when the client already has it."""
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        etag = '"%d"' % self.server.version
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(self.server.document)))
+        self.end_headers()
+        self.wfile.write(self.server.document)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HostListLoaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), HostListHandler)
+        self.server.document = JSON_HOSTS
+        self.server.version = 1
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/hosts.json' % self.server.server_address[1]
+        self.directory = tempfile.mkdtemp()
+        self.state_path = os.path.join(self.directory, 'hosts-state.json')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_unchanged_list_is_replayed_from_the_saved_state(self):
+        self.assertEqual(list(HostListLoader(self.url, self.state_path).iter_hosts()), EXPECTED)
+        self.assertNotIn('If-None-Match', self.server.requests[0])
+
+        self.assertEqual(list(HostListLoader(self.url, self.state_path).iter_hosts()), EXPECTED)
+        self.assertEqual(self.server.requests[1].get('If-None-Match'), '"1"')
+
+        self.server.document = YAML_HOSTS.replace(b'c.example.com', b'd.example.com')
+        self.server.version = 2
+        changed = list(HostListLoader(self.url, self.state_path).iter_hosts())
+        self.assertEqual(changed[-1], 'd.example.com')
+        self.assertEqual(list(HostListLoader(self.url, self.state_path).iter_hosts()), changed)
+        self.assertEqual(self.server.requests[3].get('If-None-Match'), '"2"')
+
+    def test_state_of_another_url_is_not_used(self):
+        list(HostListLoader(self.url, self.state_path).iter_hosts())
+        other_url = self.url.replace('hosts.json', 'other.json')
+        self.assertEqual(list(HostListLoader(other_url, self.state_path).iter_hosts()), EXPECTED)
+        self.assertNotIn('If-None-Match', self.server.requests[1])
+
+    def test_without_state_path_every_fetch_downloads(self):
+        for _ in range(2):
+            self.assertEqual(list(HostListLoader(self.url).iter_hosts()), EXPECTED)
+        self.assertEqual([request.get('If-None-Match') for request in self.server.requests], [None, None])
+
+
+if __name__ == '__main__':
+    unittest.main()
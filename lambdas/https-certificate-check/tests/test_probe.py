@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+import asyncio
+import datetime
+import os
+import shutil
+import socketserver
+import ssl
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+
+from probe import AsyncProbeEngine  # noqa: E402
+from resolver import DnsCache, DnsResolutionError, SystemResolver  # noqa: E402
+from targets import Target  # noqa: E402
+
+try:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+except ImportError:
+    x509 = None
+
+NAMES = ['a.example.com', 'b.example.com']
+
+
+def write_certificate(directory):
+    """Writes a self-signed certificate for NAMES and its key; returns their paths."""
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, NAMES[0])])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key()) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(now - datetime.timedelta(days=1)).not_valid_after(now + datetime.timedelta(days=30)) \
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName(_name) for _name in NAMES]), critical=False) \
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True) \
+        .sign(key, hashes.SHA256())
+    cert_path = os.path.join(directory, 'cert.pem')
+    key_path = os.path.join(directory, 'key.pem')
+    with open(cert_path, 'wb') as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return cert_path, key_path
+
+
+class TLSHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        try:
+            connection = self.server.context.wrap_socket(self.request, server_side=True)
+        except (ssl.SSLError, OSError):
+            return
+        connection.recv(1)
+
+
+class SilentHandler(socketserver.BaseRequestHandler):
+    """Accepts the connection but never answers the client hello."""
+
+    def handle(self):
+        self.server.release.wait(5)
+
+
+class StubResolver(object):
+    """Resolves the test names to the loopback address and records every lookup."""
+
+    def __init__(self):
+        self.lookups = []
+
+    async def resolve(self, name):
+        self.lookups.append(name)
+        if name in NAMES or name == 'silent.example.com':
+            return ['127.0.0.1'], 300
+        if name == 'bad..example.com':
+            # What the idna codec raises for an empty label
+            raise UnicodeError("label empty or too long")
+        raise DnsResolutionError("%s: Name or service not known" % name)
+
+
+def serve(handler, **attributes):
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+@unittest.skipIf(x509 is None, "needs the cryptography package to create a certificate")
+class AsyncProbeEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        cert_path, key_path = write_certificate(self.directory)
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(cert_path, key_path)
+        self.names = []
+        server_context.sni_callback = lambda ssl_object, name, context: self.names.append(name)
+        self.server = serve(TLSHandler, context=server_context)
+        self.port = self.server.server_address[1]
+        self.resolver = StubResolver()
+        self.engine = AsyncProbeEngine(context=ssl.create_default_context(cafile=cert_path), concurrency=4,
+                                       timeout=2.0, dns_cache=DnsCache(self.resolver))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_handshakes_with_every_sni_name_and_looks_each_name_up_once(self):
+        targets = [Target(name, port=self.port) for name in NAMES] + [Target(NAMES[0], port=self.port)]
+        results = self.engine.run(iter(targets))
+        self.assertEqual(sorted(results), ['a.example.com:%d' % self.port, 'b.example.com:%d' % self.port])
+        for result in results.values():
+            self.assertTrue(result.connected, result.error)
+            self.assertEqual(len(result.fingerprint), 64)
+            self.assertIn('notAfter', result.peercert)
+        self.assertEqual(sorted(self.names), NAMES)
+        self.assertEqual(sorted(self.resolver.lookups), NAMES)
+
+    def test_targets_behind_one_address_share_its_lookup(self):
+        targets = [Target(name, port=self.port, address='a.example.com') for name in NAMES]
+        results = self.engine.run(targets)
+        self.assertTrue(all(result.connected for result in results.values()))
+        self.assertEqual(self.resolver.lookups, ['a.example.com'])
+
+    def test_resolution_failures_are_reported_per_target(self):
+        targets = [Target('missing.example.com', port=self.port), Target('bad..example.com', port=self.port),
+                   Target(NAMES[0], port=self.port)]
+        results = self.engine.run(targets)
+        missing = results['missing.example.com:%d' % self.port]
+        self.assertFalse(missing.connected)
+        self.assertTrue(missing.dns_failure)
+        # An unexpected error from the resolver fails its target only, instead of stalling the run
+        self.assertIsInstance(results['bad..example.com:%d' % self.port].error, UnicodeError)
+        self.assertTrue(results['a.example.com:%d' % self.port].connected)
+
+    def test_certificate_for_another_name_fails_verification(self):
+        engine = AsyncProbeEngine(context=self.engine.context, timeout=2.0, dns_cache=DnsCache(self.resolver))
+        targets = [Target('a.example.com', port=self.port, sni='c.example.com', address='a.example.com')]
+        result = list(engine.run(targets).values())[0]
+        self.assertFalse(result.connected)
+        self.assertIsInstance(result.error, ssl.SSLCertVerificationError)
+
+    def test_a_silent_host_only_delays_itself(self):
+        release = threading.Event()
+        silent = serve(SilentHandler, release=release)
+        try:
+            self.engine.timeout = 0.5
+            started = time.monotonic()
+            results = self.engine.run([Target('silent.example.com', port=silent.server_address[1]),
+                                       Target(NAMES[0], port=self.port)])
+            elapsed = time.monotonic() - started
+        finally:
+            release.set()
+            silent.shutdown()
+            silent.server_close()
+        self.assertIsInstance(results['silent.example.com:%d' % silent.server_address[1]].error,
+                              asyncio.TimeoutError)
+        self.assertTrue(results['a.example.com:%d' % self.port].connected)
+        self.assertLess(elapsed, 2.0)
+
+
+class SystemResolverTest(unittest.TestCase):
+
+    def resolve(self, name):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(SystemResolver(ttl=60).resolve(name))
+        finally:
+            loop.close()
+
+    def test_localhost(self):
+        addresses, ttl = self.resolve('localhost')
+        self.assertTrue(addresses)
+        self.assertEqual(ttl, 60)
+
+    def test_invalid_names_are_resolution_errors(self):
+        for name in ('bad..example.com', 'x' * 64 + '.example.com'):
+            with self.assertRaises(DnsResolutionError):
+                self.resolve(name)
+
+    def test_address_resolves_to_itself(self):
+        self.assertEqual(self.resolve('127.0.0.1')[0], ['127.0.0.1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
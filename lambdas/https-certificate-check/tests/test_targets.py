@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import importlib.util
+import os
+import sys
+import unittest
+from unittest import mock
+
+CODE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code')
+sys.path.insert(0, CODE)
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('expiration_buffer', '30')
+
+from targets import Target, targets_from_entry  # noqa: E402
+
+# Loaded under its own name: the stale security group Lambda has an index module too
+_spec = importlib.util.spec_from_file_location('https_certificate_check_index', os.path.join(CODE, 'index.py'))
+index = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(index)
+
+MALFORMED = ['host:abc', {'host': 'mail.example.com', 'protocol': 'gopher'}, 42, {'port': 443}, '[2001:db8::1']
+
+
+class TargetsFromEntryTest(unittest.TestCase):
+
+    def test_host_and_port(self):
+        self.assertEqual(targets_from_entry('example.com'), [Target('example.com')])
+        self.assertEqual(targets_from_entry('example.com:8443')[0].port, 8443)
+
+    def test_ipv6_literal_is_not_split(self):
+        target, = targets_from_entry('2001:db8::1')
+        self.assertEqual((target.host, target.port), ('2001:db8::1', 443))
+        self.assertEqual(target.label, '2001:db8::1')
+
+    def test_bracketed_ipv6_with_port(self):
+        target, = targets_from_entry('[2001:db8::1]:8443')
+        self.assertEqual((target.host, target.address, target.port), ('2001:db8::1', '2001:db8::1', 8443))
+        self.assertEqual(target.label, '[2001:db8::1]:8443')
+        self.assertEqual(targets_from_entry('[2001:db8::1]'), [Target('2001:db8::1')])
+
+    def test_sni_list(self):
+        targets = targets_from_entry({'address': '10.0.0.1', 'sni': ['a.example.com', 'b.example.com']})
+        self.assertEqual([target.label for target in targets], ['a.example.com@10.0.0.1', 'b.example.com@10.0.0.1'])
+
+    def test_malformed_entries_raise_value_error(self):
+        for entry in MALFORMED:
+            with self.assertRaises(ValueError, msg=repr(entry)):
+                targets_from_entry(entry)
+
+
+class MalformedEntryTest(unittest.TestCase):
+    """One bad host list entry is reported as unable to connect instead of aborting the run."""
+
+    def test_stream_hosts_skips_malformed_entries(self):
+        detector = index.ExpiredCertDetector(cache=None)
+        loader = mock.Mock()
+        loader.iter_hosts.return_value = iter(['a.example.com'] + MALFORMED + ['b.example.com:8443'])
+        with mock.patch.object(detector, 'host_loader', return_value=loader):
+            targets = list(detector.stream_hosts())
+        self.assertEqual(targets, [Target('a.example.com'), Target('b.example.com', 8443)])
+        self.assertEqual(detector.hosts, set(targets))
+        self.assertEqual(detector.unable_to_connect,
+                         set(['host:abc', '42', '[2001:db8::1', repr({'port': 443}),
+                              repr({'host': 'mail.example.com', 'protocol': 'gopher'})]))
+
+    def test_worker_skips_malformed_entries(self):
+        with mock.patch.object(index.ExpiredCertDetector, 'check_https_expiry_datetime') as check:
+            result = index.lambda_handler({'mode': 'worker', 'hosts': ['a.example.com', 'host:abc']}, None)
+        check.assert_called_once_with()
+        self.assertEqual(result['unable_to_connect'], ['host:abc'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+import threading
+
+# Consumer type of security group rule references; see SecurityGroupIndex.groups_in_use
+SECURITY_GROUP = 'security-group'
+
+
+class SecurityGroupIndex(object):
+    """
+    Reverse index from security group id to the resources referencing it.
+
+    Consumers are "type:id" strings, e.g. "ec2-instance:i-0123" or
+    "security-group:sg-0abc" for a group referenced by another group's rules.
+    Collectors run on several threads, so every update takes the lock.
+    """
+
+    def __init__(self):
+        super(SecurityGroupIndex, self).__init__()
+        self.all_groups = set()
+        self.consumers = {}
+        self.lock = threading.Lock()
+
+    def add_group(self, group_id):
+        with self.lock:
+            self.all_groups.add(group_id)
+
+    def add(self, consumer, group_ids):
+        with self.lock:
+            for group_id in group_ids:
+                self.consumers.setdefault(group_id, set()).add(consumer)
+
+    def groups_in_use(self):
+        """
+        Returns the groups that are in use.
+
+        A group is in use when any resource other than a security group
+        references it, or when a security group that is itself in use does.
+        Groups only referenced by stale groups are stale as well, so groups
+        referencing each other can be cleaned up together.
+        """
+        in_use = set()
+        referenced_by = {}
+        for group_id, consumers in self.consumers.items():
+            for consumer in consumers:
+                kind, _, consumer_id = consumer.partition(':')
+                if kind == SECURITY_GROUP:
+                    referenced_by.setdefault(consumer_id, set()).add(group_id)
+                else:
+                    in_use.add(group_id)
+
+        pending = list(in_use)
+        while pending:
+            for group_id in referenced_by.get(pending.pop(), ()):
+                if group_id not in in_use:
+                    in_use.add(group_id)
+                    pending.append(group_id)
+        return in_use
+
+    def why(self, group_id):
+        return sorted(self.consumers.get(group_id, ()))
+
+    def merge(self, other):
+        with self.lock:
+            self.all_groups.update(other.all_groups)
+            for group_id, consumers in other.consumers.items():
+                self.consumers.setdefault(group_id, set()).update(consumers)
+
+    def to_dict(self):
+        return {
+            'all_groups': sorted(self.all_groups),
+            'consumers': dict((group_id, sorted(consumers)) for group_id, consumers in self.consumers.items()),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        index = cls()
+        index.all_groups = set(data['all_groups'])
+        index.consumers = dict((group_id, set(consumers)) for group_id, consumers in data['consumers'].items())
+        return index
+
+
+class CollectorPlugin(object):
+    """
+    A registered collector: collect(client, index) adds what it finds to the index and returns the number of
+    resources it looked at.
+
+    events are the CloudTrail event names that can change what the plugin finds. A plugin without events
+    is collected on every run; see snapshot.ChangeDetector.
+    """
+
+    def __init__(self, name, service, collect, events=None):
+        super(CollectorPlugin, self).__init__()
+        self.name = name
+        self.service = service
+        self.collect = collect
+        self.events = events
+
+
+REGISTRY = []
+
+
+def collector(name, service, events=None):
+    """Registers a collector plugin for boto3 service `service` under `name`."""
+    def register(collect):
+        REGISTRY.append(CollectorPlugin(name, service, collect, events))
+        return collect
+    return register
+
+
+def paginate(client, operation, result_key, **kwargs):
+    """Yields every item under result_key across all pages of a describe call."""
+    for page in client.get_paginator(operation).paginate(**kwargs):
+        for item in page.get(result_key, []):
+            yield item
+
+
+@collector('security-groups', 'ec2', events=[
+    'CreateSecurityGroup', 'DeleteSecurityGroup', 'AuthorizeSecurityGroupIngress', 'AuthorizeSecurityGroupEgress',
+    'RevokeSecurityGroupIngress', 'RevokeSecurityGroupEgress', 'ModifySecurityGroupRules',
+])
+def collect_security_groups(client, index):
+    """Lists all groups; default and CloudFormation managed groups count as in use, rules reference other groups."""
+    count = 0
+    for group in paginate(client, 'describe_security_groups', 'SecurityGroups'):
+        count += 1
+        group_id = group['GroupId']
+        index.add_group(group_id)
+        # Default SGs don't have to be deleted.
+        if group['GroupName'] == 'default':
+            index.add('default-group:%s' % group_id, [group_id])
+        # SGs managed by CloudFormation don't have to be deleted.
+        for tag in group.get('Tags', []):
+            if tag['Key'] == 'aws:cloudformation:stack-id':
+                index.add('cloudformation-stack:%s' % tag['Value'], [group_id])
+        referenced = set()
+        for permission in group.get('IpPermissions', []) + group.get('IpPermissionsEgress', []):
+            for pair in permission.get('UserIdGroupPairs', []):
+                if pair.get('GroupId') and pair['GroupId'] != group_id:
+                    referenced.add(pair['GroupId'])
+        index.add('%s:%s' % (SECURITY_GROUP, group_id), referenced)
+    return count
+
+
+@collector('ec2-instances', 'ec2', events=[
+    'RunInstances', 'TerminateInstances', 'ModifyInstanceAttribute', 'ModifyNetworkInterfaceAttribute',
+])
+def collect_ec2_instances(client, index):
+    count = 0
+    for reservation in paginate(client, 'describe_instances', 'Reservations'):
+        for instance in reservation['Instances']:
+            count += 1
+            index.add('ec2-instance:%s' % instance['InstanceId'],
+                      [group['GroupId'] for group in instance['SecurityGroups']])
+    return count
+
+
+@collector('launch-configurations', 'autoscaling', events=[
+    'CreateLaunchConfiguration', 'DeleteLaunchConfiguration',
+])
+def collect_launch_configurations(client, index):
+    count = 0
+    for launch_config in paginate(client, 'describe_launch_configurations', 'LaunchConfigurations'):
+        count += 1
+        index.add('launch-configuration:%s' % launch_config['LaunchConfigurationName'],
+                  launch_config['SecurityGroups'])
+    return count
+
+
+@collector('launch-templates', 'ec2', events=[
+    'CreateLaunchTemplate', 'CreateLaunchTemplateVersion', 'ModifyLaunchTemplate', 'DeleteLaunchTemplate',
+    'DeleteLaunchTemplateVersions',
+])
+def collect_launch_templates(client, index):
+    """Checks the default and latest version of every launch template, which is what new instances use."""
+    count = 0
+    for template in paginate(client, 'describe_launch_templates', 'LaunchTemplates'):
+        count += 1
+        for version in paginate(client, 'describe_launch_template_versions', 'LaunchTemplateVersions',
+                                LaunchTemplateId=template['LaunchTemplateId'], Versions=['$Default', '$Latest']):
+            data = version.get('LaunchTemplateData', {})
+            groups = set(data.get('SecurityGroupIds', []))
+            for interface in data.get('NetworkInterfaces', []):
+                groups.update(interface.get('Groups', []))
+            index.add('launch-template:%s' % template['LaunchTemplateId'], groups)
+    return count
+
+
+@collector('network-interfaces', 'ec2', events=[
+    'CreateNetworkInterface', 'DeleteNetworkInterface', 'ModifyNetworkInterfaceAttribute', 'RunInstances',
+    'TerminateInstances',
+])
+def collect_network_interfaces(client, index):
+    count = 0
+    for eni in paginate(client, 'describe_network_interfaces', 'NetworkInterfaces'):
+        count += 1
+        index.add('network-interface:%s' % eni['NetworkInterfaceId'], [group['GroupId'] for group in eni['Groups']])
+    return count
+
+
+@collector('elbs', 'elb', events=[
+    'CreateLoadBalancer', 'DeleteLoadBalancer', 'ApplySecurityGroupsToLoadBalancer',
+])
+def collect_elbs(client, index):
+    count = 0
+    for elb in paginate(client, 'describe_load_balancers', 'LoadBalancerDescriptions'):
+        count += 1
+        index.add('elb:%s' % elb['LoadBalancerName'], elb['SecurityGroups'])
+    return count
+
+
+@collector('albs', 'elbv2', events=[
+    'CreateLoadBalancer', 'DeleteLoadBalancer', 'SetSecurityGroups',
+])
+def collect_albs(client, index):
+    count = 0
+    for alb in paginate(client, 'describe_load_balancers', 'LoadBalancers'):
+        count += 1
+        # Network load balancers may have no security groups at all
+        index.add('elbv2:%s' % alb['LoadBalancerName'], alb.get('SecurityGroups', []))
+    return count
+
+
+@collector('rds-instances', 'rds', events=[
+    'CreateDBInstance', 'CreateDBInstanceReadReplica', 'DeleteDBInstance', 'ModifyDBInstance',
+    'RestoreDBInstanceFromDBSnapshot', 'RestoreDBInstanceToPointInTime',
+])
+def collect_rds_instances(client, index):
+    count = 0
+    for rds in paginate(client, 'describe_db_instances', 'DBInstances'):
+        count += 1
+        index.add('rds:%s' % rds['DBInstanceIdentifier'],
+                  [group['VpcSecurityGroupId'] for group in rds['VpcSecurityGroups']])
+    return count
+
+
+@collector('redshift-clusters', 'redshift', events=[
+    'CreateCluster', 'DeleteCluster', 'ModifyCluster', 'RestoreFromClusterSnapshot',
+])
+def collect_redshift_clusters(client, index):
+    count = 0
+    for cluster in paginate(client, 'describe_clusters', 'Clusters'):
+        count += 1
+        index.add('redshift:%s' % cluster['ClusterIdentifier'],
+                  [group['VpcSecurityGroupId'] for group in cluster['VpcSecurityGroups']])
+    return count
+
+
+@collector('elasticache-clusters', 'elasticache', events=[
+    'CreateCacheCluster', 'DeleteCacheCluster', 'ModifyCacheCluster', 'CreateReplicationGroup',
+    'ModifyReplicationGroup', 'DeleteReplicationGroup',
+])
+def collect_elasticache_clusters(client, index):
+    count = 0
+    for cluster in paginate(client, 'describe_cache_clusters', 'CacheClusters'):
+        count += 1
+        index.add('elasticache:%s' % cluster['CacheClusterId'],
+                  [group['SecurityGroupId'] for group in cluster.get('SecurityGroups', [])])
+    return count
+
+
+@collector('efs-mount-targets', 'efs', events=[
+    'CreateMountTarget', 'DeleteMountTarget', 'ModifyMountTargetSecurityGroups',
+])
+def collect_efs_mount_targets(client, index):
+    count = 0
+    for file_system in paginate(client, 'describe_file_systems', 'FileSystems'):
+        for mount_target in paginate(client, 'describe_mount_targets', 'MountTargets',
+                                     FileSystemId=file_system['FileSystemId']):
+            count += 1
+            groups = client.describe_mount_target_security_groups(
+                MountTargetId=mount_target['MountTargetId']
+            )['SecurityGroups']
+            index.add('efs-mount-target:%s' % mount_target['MountTargetId'], groups)
+    return count
+
+
+@collector('lambda-functions', 'lambda', events=[
+    'CreateFunction20150331', 'UpdateFunctionConfiguration20150331v2', 'DeleteFunction20150331',
+])
+def collect_lambda_functions(client, index):
+    count = 0
+    for function in paginate(client, 'list_functions', 'Functions'):
+        count += 1
+        index.add('lambda:%s' % function['FunctionName'],
+                  function.get('VpcConfig', {}).get('SecurityGroupIds', []))
+    return count
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import botocore
+from botocore.config import Config
+
+from collectors import SECURITY_GROUP
+
+logger = logging.getLogger('index.deletion')
+
+THROTTLING_CODES = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException')
+
+# The engine retries throttled calls itself, so clients it creates do not retry on their own
+CLIENT_CONFIG = Config(retries={'mode': 'standard', 'max_attempts': 1})
+
+# Outcomes that need no further work when resuming from a checkpoint
+FINAL_STATUSES = ('deleted', 'not-found')
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket: acquire() blocks until a call may be made.
+
+    The rate adapts to the API: every throttled call halves it, down to
+    min_rate, and every successful call wins back a twentieth of max_rate.
+    """
+
+    def __init__(self, rate, capacity=None, min_rate=0.2, clock=time.monotonic, sleep=time.sleep):
+        super(TokenBucket, self).__init__()
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = min(min_rate, self.max_rate)
+        self.capacity = capacity or max(1.0, self.max_rate)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+            logger.info("Throttled, slowing down to %.2f calls/s" % self.rate)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class DeletionCheckpoint(object):
+    """
+    Append-only JSON lines file of outcomes, so an interrupted deletion can resume where it stopped.
+    """
+
+    def __init__(self, path):
+        super(DeletionCheckpoint, self).__init__()
+        self.path = path
+        self.lock = threading.Lock()
+        # group id -> last recorded status
+        self.statuses = {}
+        # Whether the file ends in a line cut short, which the next outcome must not be appended to
+        self.partial_line = False
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    self.partial_line = not line.endswith('\n')
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line may be cut short by the interruption
+                        continue
+                    self.statuses[entry['group_id']] = entry['status']
+
+    def done(self):
+        return set(group_id for group_id, status in self.statuses.items() if status in FINAL_STATUSES)
+
+    def record(self, outcome):
+        with self.lock:
+            self.statuses[outcome.group_id] = outcome.status
+            with open(self.path, 'a') as f:
+                if self.partial_line:
+                    f.write('\n')
+                    self.partial_line = False
+                f.write(json.dumps(outcome.to_dict()) + '\n')
+
+
+class DeletionOutcome(object):
+    """
+    What happened to one group: deleted, not-found, dry-run-ok, dry-run-failed, blocked, in-use,
+    failed or skipped (already deleted according to the checkpoint).
+    """
+
+    def __init__(self, group_id, status, detail='', attempts=0):
+        super(DeletionOutcome, self).__init__()
+        self.group_id = group_id
+        self.status = status
+        self.detail = detail
+        self.attempts = attempts
+
+    def to_dict(self):
+        return {'group_id': self.group_id, 'status': self.status, 'detail': self.detail, 'attempts': self.attempts}
+
+
+def referrers_from_index(index, group_ids):
+    """Returns group id -> ids of the groups whose rules reference it, for group_ids."""
+    referrers = {}
+    for group_id in group_ids:
+        referrers[group_id] = set()
+        for consumer in index.consumers.get(group_id, ()):
+            kind, _, consumer_id = consumer.partition(':')
+            if kind == SECURITY_GROUP:
+                referrers[group_id].add(consumer_id)
+    return referrers
+
+
+class DeletionPlan(object):
+    """
+    Orders the deletion of groups that reference each other.
+
+    A group cannot be deleted while another group's rules reference it, so
+    referencing groups go first, in waves. Groups referenced by a group that
+    is kept are blocked. Groups left over in reference cycles, and the groups
+    only they reference, end up in one last wave whose references to each
+    other are revoked before deleting.
+    """
+
+    def __init__(self, group_ids, referrers, deleted=()):
+        super(DeletionPlan, self).__init__()
+        targets = set(group_ids)
+        deleted = set(deleted)
+        self.blocked = {}
+        changed = True
+        while changed:
+            changed = False
+            for group_id in sorted(targets - set(self.blocked)):
+                kept = referrers.get(group_id, set()) - (targets - set(self.blocked)) - deleted
+                if kept:
+                    self.blocked[group_id] = sorted(kept)
+                    changed = True
+
+        remaining = targets - set(self.blocked)
+        self.depends_on = dict((group_id, referrers.get(group_id, set()) & remaining) for group_id in remaining)
+        self.waves = []
+        self.cycles = set()
+        planned = set()
+        while remaining:
+            wave = set(group_id for group_id in remaining if self.depends_on[group_id] <= planned)
+            if not wave:
+                self.cycles = set(remaining)
+                wave = set(remaining)
+            self.waves.append(sorted(wave))
+            planned |= wave
+            remaining -= wave
+
+
+class DeletionEngine(object):
+    """
+    Deletes security groups in parallel under a token bucket rate limit.
+
+    Runs a dry run of every deletion first, then deletes in the waves of a
+    DeletionPlan. Throttled calls are retried with exponential backoff and
+    jitter and slow down the bucket for every worker. Takes any EC2 client,
+    including one driven by a botocore Stubber (use max_workers=1 so the
+    calls come in a predictable order).
+    """
+
+    def __init__(self, client, bucket=None, max_workers=4, checkpoint=None, max_attempts=8, base_delay=0.5,
+                 sleep=time.sleep):
+        super(DeletionEngine, self).__init__()
+        self.client = client
+        self.bucket = bucket or TokenBucket(5)
+        self.max_workers = max_workers
+        self.checkpoint = checkpoint
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.sleep = sleep
+
+    def call(self, operation, **kwargs):
+        """Makes one rate limited API call; returns (response, attempts)."""
+        for attempt in range(1, self.max_attempts + 1):
+            self.bucket.acquire()
+            try:
+                response = getattr(self.client, operation)(**kwargs)
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] not in THROTTLING_CODES or attempt == self.max_attempts:
+                    e.attempts = attempt
+                    raise
+                self.bucket.throttled()
+                self.sleep(random.uniform(0, self.base_delay * 2 ** attempt))
+                continue
+            self.bucket.succeeded()
+            return response, attempt
+
+    def _map(self, function, items):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(function, items))
+
+    def dry_run(self, group_id):
+        try:
+            self.call('delete_security_group', GroupId=group_id, DryRun=True)
+        except botocore.exceptions.ClientError as e:
+            code = e.response['Error']['Code']
+            if code == 'DryRunOperation':
+                return DeletionOutcome(group_id, 'dry-run-ok', attempts=e.attempts)
+            if code == 'InvalidGroup.NotFound':
+                return DeletionOutcome(group_id, 'not-found', attempts=e.attempts)
+            return DeletionOutcome(group_id, 'dry-run-failed', '%s: %s' % (code, e.response['Error']['Message']),
+                                   e.attempts)
+        # Without DryRunOperation the group would have been deleted; should not happen
+        return DeletionOutcome(group_id, 'deleted', 'deleted by the dry run')
+
+    def delete(self, group_id):
+        try:
+            response, attempts = self.call('delete_security_group', GroupId=group_id)
+        except botocore.exceptions.ClientError as e:
+            code = e.response['Error']['Code']
+            status = {'InvalidGroup.NotFound': 'not-found', 'DependencyViolation': 'in-use'}.get(code, 'failed')
+            return DeletionOutcome(group_id, status, '%s: %s' % (code, e.response['Error']['Message']),
+                                   getattr(e, 'attempts', 0))
+        return DeletionOutcome(group_id, 'deleted', attempts=attempts)
+
+    def revoke_references(self, group_ids):
+        """Revokes the rules of group_ids that reference one another; returns rules revoked per group."""
+        group_ids = set(group_ids)
+        revoked = {}
+        sorted_ids = sorted(group_ids)
+        groups = []
+        for start in range(0, len(sorted_ids), 200):
+            groups.extend(self.call('describe_security_groups', GroupIds=sorted_ids[start:start + 200])[0]
+                          ['SecurityGroups'])
+        for group in groups:
+            for key, operation in (('IpPermissions', 'revoke_security_group_ingress'),
+                                   ('IpPermissionsEgress', 'revoke_security_group_egress')):
+                permissions = []
+                for permission in group.get(key, []):
+                    pairs = [{'GroupId': pair['GroupId']} for pair in permission.get('UserIdGroupPairs', [])
+                             if pair.get('GroupId') in group_ids and pair['GroupId'] != group['GroupId']]
+                    if pairs:
+                        rule = dict((field, permission[field]) for field in ('IpProtocol', 'FromPort', 'ToPort')
+                                    if field in permission)
+                        rule['UserIdGroupPairs'] = pairs
+                        permissions.append(rule)
+                if permissions:
+                    self.call(operation, GroupId=group['GroupId'], IpPermissions=permissions)
+                    revoked[group['GroupId']] = revoked.get(group['GroupId'], 0) + len(permissions)
+        return revoked
+
+    def _finish(self, outcome):
+        if self.checkpoint is not None and outcome.status != 'skipped':
+            self.checkpoint.record(outcome)
+        return outcome
+
+    def run(self, group_ids, referrers, dry_run_only=False):
+        """Returns a DeletionOutcome per group."""
+        done = self.checkpoint.done() if self.checkpoint is not None else set()
+        outcomes = dict((group_id, DeletionOutcome(group_id, 'skipped', 'deleted by an earlier run'))
+                        for group_id in group_ids if group_id in done)
+        pending = sorted(set(group_ids) - done)
+
+        for outcome in self._map(self.dry_run, pending):
+            if outcome.status != 'dry-run-ok' or dry_run_only:
+                outcomes[outcome.group_id] = self._finish(outcome)
+        if dry_run_only:
+            return [outcomes[group_id] for group_id in sorted(outcomes)]
+
+        passed = [group_id for group_id in pending if group_id not in outcomes]
+        gone = done | set(group_id for group_id, outcome in outcomes.items() if outcome.status == 'not-found')
+        plan = DeletionPlan(passed, referrers, gone)
+        for group_id, kept in plan.blocked.items():
+            outcomes[group_id] = self._finish(DeletionOutcome(
+                group_id, 'blocked', 'referenced by %s, which is not deleted' % ', '.join(kept)))
+
+        for wave in plan.waves:
+            runnable = []
+            for group_id in wave:
+                # Referrers in the same wave are part of a cycle; their references are revoked below
+                failed = sorted(referrer for referrer in plan.depends_on[group_id] - set(wave)
+                                if outcomes[referrer].status not in FINAL_STATUSES)
+                if failed:
+                    outcomes[group_id] = self._finish(DeletionOutcome(
+                        group_id, 'blocked', 'referenced by %s, which was not deleted' % ', '.join(failed)))
+                else:
+                    runnable.append(group_id)
+            if set(wave) == plan.cycles and runnable:
+                try:
+                    revoked = self.revoke_references(runnable)
+                except botocore.exceptions.ClientError as e:
+                    for group_id in runnable:
+                        outcomes[group_id] = self._finish(DeletionOutcome(
+                            group_id, 'failed', 'revoking references between groups: %s' % e))
+                    continue
+                logger.info("Revoked %d rules between groups referencing each other" % sum(revoked.values()))
+            for outcome in self._map(self.delete, runnable):
+                outcomes[outcome.group_id] = self._finish(outcome)
+        return [outcomes[group_id] for group_id in sorted(outcomes)]
+
+
+def report_deletion(outcomes):
+    print("---------------")
+
+    statuses = {}
+    for outcome in outcomes:
+        statuses.setdefault(outcome.status, []).append(outcome)
+    print("Deletion outcomes: " + ", ".join(
+        "{} {}".format(len(statuses[status]), status) for status in sorted(statuses)
+    ))
+    for outcome in outcomes:
+        print("  - ", outcome.group_id, outcome.status, outcome.detail)
+
+    print("---------------")
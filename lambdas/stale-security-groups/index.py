@@ -3,153 +3,162 @@
 # Original script from https://gist.github.com/astrikos/d782c2108d4bebaabbbd1528d2c3821d/a1ae81a3c0c39ccff7b64e52603243985130b4d0
 # Corey Quinn (twitter.com/Quinnypig) called it "It's just a hop, skip, and a jump from being turned into a Lambda function..."
 # I, Joe Gardner (github.com/joehack3r/aws), considered this a challenge and thus made it a lambda.
-# In reality, script needs to address AWS API calls returning multiple pages of results. Maybe somebody else will take that challenge.
+# Describe calls are paginated and the collector plugins in collectors.py run concurrently on one session.
 
 import boto3
 import argparse
+import concurrent.futures
+import datetime
 import os
+import sys
+import threading
+import time
+
+from collectors import REGISTRY, SecurityGroupIndex
+from deletion import (CLIENT_CONFIG, DeletionCheckpoint, DeletionEngine, TokenBucket, referrers_from_index,
+                      report_deletion)
+from snapshot import ChangeDetector, Snapshot, store_from_url
+from sweep import Sweeper, report_sweep, stale_findings
+
+try:
+    from notifications import notifier_from_environment
+except ImportError:
+    # Running from a checkout rather than code.zip: the shared module lives in lambdas/common
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+    from notifications import notifier_from_environment
 
 
 class StaleSGDetector(object):
     """
     Class to hold the logic for detecting AWS security groups that are stale.
+
+    With a snapshot store, the previous run's index is reused for every plugin
+    whose resources CloudTrail shows no changes to, and stale groups are
+    tracked across runs so only groups stale for min_stale_days are deletable.
     """
 
     def __init__(self, **kwargs):
         super(StaleSGDetector, self).__init__()
-        # self.region = kwargs["region"]
-        # self.profile = kwargs["profile"]
+        self.region = kwargs.get("region")
+        self.profile = kwargs.get("profile")
+        self.session = kwargs.get("session")
+        self.plugins = kwargs.get("plugins", REGISTRY)
+        self.snapshot_store = kwargs.get("snapshot_store")
+        self.min_stale_days = kwargs.get("min_stale_days", 0)
+        self.snapshot_max_age = datetime.timedelta(hours=kwargs.get("snapshot_max_age_hours", 36))
+        self.index = SecurityGroupIndex()
         self.all_groups = set()
         self.security_groups_in_use = set()
         self.stale_groups = set()
-        self.ec2_instances_count = 0
-        self.network_interfaces_count = 0
-        self.elbs_count = 0
-        self.albs_count = 0
-        self.rds_count = 0
-        self.redshift_count = 0
+        self.stale_since = {}
+        # Plugin name -> its part of the index, number of resources looked at, and seconds it took
+        self.fragments = {}
+        self.counts = {}
+        self.timings = {}
+        self.reused = set()
+        self.lock = threading.Lock()
 
     def get_session(self):
-        """Gets a new boto3 session"""
+        """Gets a new boto3 session, unless one was handed in"""
+        if self.session is not None:
+            return self.session
         kwargs = {}
-        # kwargs['profile_name'] = self.profile
-        # kwargs['region_name'] = self.region
+        if self.profile:
+            kwargs['profile_name'] = self.profile
+        if self.region:
+            kwargs['region_name'] = self.region
         session = boto3.Session(**kwargs)
         return session
 
+    def create_clients(self):
+        """
+        Creates one client per plugin from the shared session, up front and on this thread,
+        because sessions are not thread safe. Separate clients also let each plugin be
+        driven by its own botocore Stubber.
+        """
+        clients = dict((plugin.name, self.session.client(plugin.service)) for plugin in self.plugins)
+        if self.snapshot_store is not None:
+            clients['cloudtrail'] = self.session.client('cloudtrail')
+        return clients
+
+    def plugins_to_collect(self, snapshot, now):
+        """Returns the plugins whose part of the snapshot cannot be reused."""
+        if snapshot is None or now - snapshot.taken > self.snapshot_max_age:
+            return list(self.plugins)
+        known = [plugin for plugin in self.plugins if plugin.name in snapshot.fragments]
+        changed = ChangeDetector(self.clients['cloudtrail']).changed(known, snapshot.taken)
+        return [plugin for plugin in self.plugins if plugin.name not in snapshot.fragments or plugin.name in changed]
+
     def run(self):
         self.session = self.get_session()
-        self.get_all_security_groups()
-        self.get_ec2_security_groups()
-        self.get_launchconfig_security_groups()
-        self.get_network_interfaces_security_groups()
-        self.get_elb_security_groups()
-        self.get_alb_security_groups()
-        self.get_rds_security_groups()
-        self.get_redshift_security_groups()
+        if not getattr(self, 'clients', None):
+            self.clients = self.create_clients()
+        now = datetime.datetime.utcnow()
+        snapshot = self.snapshot_store.load() if self.snapshot_store is not None else None
+        plugins = self.plugins_to_collect(snapshot, now)
+        if plugins:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(plugins)) as executor:
+                futures = [executor.submit(self.run_plugin, plugin) for plugin in plugins]
+                for future in futures:
+                    future.result()
+        for plugin in self.plugins:
+            if plugin not in plugins:
+                self.fragments[plugin.name] = snapshot.fragments[plugin.name]
+                self.counts[plugin.name] = snapshot.counts[plugin.name]
+                self.timings[plugin.name] = 0.0
+                self.reused.add(plugin.name)
+        for plugin in self.plugins:
+            self.index.merge(self.fragments[plugin.name])
         self.calculate_stale_security_groups()
-
-    def get_all_security_groups(self):
-        """Adds all existing security groups used in the region."""
-        ec2_client = self.session.client('ec2')
-        security_groups_dict = ec2_client.describe_security_groups()
-        security_groups = security_groups_dict['SecurityGroups']
-        for group in security_groups:
-            # Default SGs don't have to be deleted.
-            if group['GroupName'] == 'default':
-                self.security_groups_in_use.add(group['GroupId'])
-            # SGs managed by CloudFormation don't have to be deleted.
-            if 'Tags' in group:
-                for tag in group['Tags']:
-                    if tag['Key'] == 'aws:cloudformation:stack-id':
-                        self.security_groups_in_use.add(group['GroupId'])
-            self.all_groups.add(group['GroupId'])
-
-    def get_ec2_security_groups(self):
-        """Adds security groups used by EC2 instances."""
-        ec2_client = self.session.client('ec2')
-        instances = ec2_client.describe_instances()
-        reservations = instances['Reservations']
-
-        for reservation in reservations:
-            for instance in reservation['Instances']:
-                self.ec2_instances_count += 1
-                for group in instance['SecurityGroups']:
-                    self.security_groups_in_use.add(group['GroupId'])
-
-    def get_launchconfig_security_groups(self):
-        """Adds security groups used by Launch Configurations instances."""
-        asg_client = self.session.client('autoscaling')
-        launch_configurations = asg_client.describe_launch_configurations()
-        for launch_config in launch_configurations['LaunchConfigurations']:
-            for group in launch_config['SecurityGroups']:
-                self.security_groups_in_use.add(group)
-
-    def get_network_interfaces_security_groups(self):
-        """Adds security groups used by Network Interfaces (ENIs)."""
-        ec2_client = self.session.client('ec2')
-        enis = ec2_client.describe_network_interfaces()
-        for eni in enis['NetworkInterfaces']:
-            self.network_interfaces_count += 1
-            for group in eni['Groups']:
-                self.security_groups_in_use.add(group['GroupId'])
-
-    def get_elb_security_groups(self):
-        """Adds security groups used by classic elastic loadbalancers (ELBs)."""
-        elb_client = self.session.client('elb')
-        elbs = elb_client.describe_load_balancers()
-        for elb in elbs['LoadBalancerDescriptions']:
-            self.elbs_count += 1
-            for group in elb['SecurityGroups']:
-                self.security_groups_in_use.add(group)
-
-    def get_alb_security_groups(self):
-        """Adds security groups used by application loadbalancers (ALBs)."""
-        alb_client = self.session.client('elbv2')
-        albs = alb_client.describe_load_balancers()
-        for alb in albs['LoadBalancers']:
-            self.albs_count += 1
-            for group in alb['SecurityGroups']:
-                self.security_groups_in_use.add(group)
-
-    def get_rds_security_groups(self):
-        """Adds security groups used by RDS."""
-        rds_client = self.session.client('rds')
-        rdses = rds_client.describe_db_instances()
-        for rds in rdses['DBInstances']:
-            self.rds_count += 1
-            for group in rds['VpcSecurityGroups']:
-                self.security_groups_in_use.add(group['VpcSecurityGroupId'])
-
-    def get_redshift_security_groups(self):
-        """Adds security groups used by Redshift."""
-        redshift_client = self.session.client('redshift')
-        redshifts = redshift_client.describe_clusters()
-        for cluster in redshifts['Clusters']:
-            self.redshift_count += 1
-            for group in cluster['VpcSecurityGroups']:
-                self.security_groups_in_use.add(group['VpcSecurityGroupId'])
+        self.track_staleness(snapshot.stale_since if snapshot is not None else {}, now)
+        if self.snapshot_store is not None:
+            self.snapshot_store.save(Snapshot(now, self.fragments, self.counts, self.stale_since))
+
+    def run_plugin(self, plugin):
+        start = time.time()
+        fragment = SecurityGroupIndex()
+        count = plugin.collect(self.clients[plugin.name], fragment)
+        with self.lock:
+            self.fragments[plugin.name] = fragment
+            self.counts[plugin.name] = count
+            self.timings[plugin.name] = time.time() - start
 
     def calculate_stale_security_groups(self):
+        self.all_groups = set(self.index.all_groups)
+        self.security_groups_in_use = self.index.groups_in_use()
         self.stale_groups = self.all_groups.difference(self.security_groups_in_use)
 
-        # Check if there is a SG in usd SGs but not in all.
-        # Could that ever be true?
-        assert (not self.security_groups_in_use.difference(self.all_groups))
+        # Groups referenced by resources but not listed belong to another account (peered VPCs) or
+        # were created while the collectors ran; either way there is nothing to delete.
+        self.security_groups_in_use &= self.all_groups
+
+    def track_staleness(self, previous, now):
+        """Keeps when each stale group became stale; a group seen in use starts over."""
+        self.stale_since = dict((group_id, previous.get(group_id, now)) for group_id in self.stale_groups)
+
+    def stale_days(self, group_id):
+        return (datetime.datetime.utcnow() - self.stale_since[group_id]).days
 
+    @property
+    def deletable_groups(self):
+        """Stale groups that have been stale for at least min_stale_days."""
+        return set(group_id for group_id in self.stale_groups if self.stale_days(group_id) >= self.min_stale_days)
 
-def report(detector_object):
+    def why(self, group_id):
+        """Returns the "type:id" consumers keeping group_id in use."""
+        return self.index.why(group_id)
+
+
+def report(detector_object, explain=False):
     print("---------------")
 
-    search_log = (
-        "Searched through {} EC2 instances, "
-        "{} network interfaces, {} ELBs, {} ALBs, "
-        "{} RDS instances, {} Redshift clusters"
-    ).format(
-        detector_object.ec2_instances_count,
-        detector_object.network_interfaces_count,
-        detector_object.elbs_count, detector_object.albs_count,
-        detector_object.rds_count, detector_object.redshift_count
+    search_log = "Searched through " + ", ".join(
+        "{} {} ({})".format(
+            detector_object.counts[plugin.name], plugin.name,
+            "from snapshot" if plugin.name in detector_object.reused
+            else "{:.1f}s".format(detector_object.timings[plugin.name])
+        )
+        for plugin in detector_object.plugins
     )
     print(search_log)
 
@@ -158,30 +167,97 @@ def report(detector_object):
     )
     print(sg_log)
 
+    if explain:
+        for sg in sorted(detector_object.security_groups_in_use):
+            print("  {} is used by {}".format(sg, ", ".join(detector_object.why(sg))))
+
     stale_log = "Following {} security groups don't seem to be used:".format(
         len(detector_object.stale_groups)
     )
     print(stale_log)
 
-    for sg in detector_object.stale_groups:
-        print("  - ", sg)
+    for sg in sorted(detector_object.stale_groups):
+        details = ["stale for {} days".format(detector_object.stale_days(sg))]
+        referenced_by = detector_object.why(sg)
+        if explain and referenced_by:
+            details.append("only referenced by stale {}".format(", ".join(referenced_by)))
+        print("  - ", sg, "({})".format("; ".join(details)))
+
+    if detector_object.min_stale_days:
+        print("{} of them have been stale for at least {} days.".format(
+            len(detector_object.deletable_groups), detector_object.min_stale_days
+        ))
 
     print("---------------")
 
 
-def send_sns(detector_object):
-    if len(detector_object.stale_groups) > 0:
-        message = "The following Security Groups were identified as stale: {}".format(detector_object.stale_groups)
+def send_sns(detector_object, notifier=None):
+    notifier = notifier or notifier_from_environment('stale-security-groups')
+    notifier.notify('stale', "Lambda Monitor: Stale Security Groups",
+                    "The following Security Groups were identified as stale",
+                    detector_object.stale_groups)
+    notifier.save()
 
-        boto3.client('sns').publish(
-            TargetArn=os.environ['sns_topic_arn'],
-            Message=message,
-            Subject="Lambda Monitor: Stale Security Groups"
-        )
+
+def send_sweep_sns(results, notifier=None):
+    notifier = notifier or notifier_from_environment('stale-security-groups')
+    notifier.notify('stale', "Lambda Monitor: Stale Security Groups",
+                    "The following Security Groups (account/region/group) were identified as stale",
+                    stale_findings(results))
+    failed = set(result.target.label for result in results if result.error is not None)
+    notifier.notify('sweep_failed', "Lambda Monitor: Stale Security Group sweep failures",
+                    "The following account/region targets could not be checked",
+                    failed)
+    notifier.save()
+
+
+def split_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()] if value else []
+
+
+def detector_options(snapshot_url=None, min_stale_days=0, snapshot_max_age_hours=36, session=None):
+    """
+    Returns a function giving the StaleSGDetector keyword arguments for a sweep target, or for
+    the single region run when called with None. {account} and {region} in snapshot_url are
+    replaced, so every target keeps its own snapshot.
+
+    Snapshots in S3 are read and written with one client made here from session (the sweep's
+    base session), because the function is called on the sweep's worker threads, where the
+    shared session must not be used, and the bucket belongs to the base account rather than
+    to the swept ones.
+    """
+    s3_client = None
+    if snapshot_url and snapshot_url.startswith('s3://'):
+        s3_client = (session or boto3.Session()).client('s3')
+
+    def options(target):
+        kwargs = {'min_stale_days': min_stale_days, 'snapshot_max_age_hours': snapshot_max_age_hours}
+        if snapshot_url:
+            kwargs['snapshot_store'] = store_from_url(snapshot_url.format(
+                account=target.account if target else 'default', region=target.region if target else 'default'
+            ), client=s3_client)
+        return kwargs
+    return options
+
+
+def detector_options_from_environment(session=None):
+    return detector_options(os.environ.get('snapshot_url'), int(os.environ.get('min_stale_days', 0)),
+                            float(os.environ.get('snapshot_max_age_hours', 36)), session)
 
 
 def lambda_handler(event, context):
-    detector = StaleSGDetector()
+    regions = split_list(os.environ.get('sweep_regions'))
+    if regions:
+        base_session = boto3.Session()
+        sweeper = Sweeper(StaleSGDetector, regions, split_list(os.environ.get('sweep_role_arns')) or None,
+                          base_session=base_session, max_workers=int(os.environ.get('sweep_max_workers', 16)),
+                          detector_options=detector_options_from_environment(base_session))
+        results = sweeper.run()
+        report_sweep(results)
+        send_sweep_sns(results)
+        return
+
+    detector = StaleSGDetector(**detector_options_from_environment()(None))
     detector.run()
     send_sns(detector)
 
@@ -200,20 +276,88 @@ if __name__ == "__main__":
         "-r", "--region", type=str, default="eu-west-1",
         help="The default region is eu-west-1."
     )
+    parser.add_argument(
+        "--regions", type=str, nargs="+",
+        help="Sweep these regions instead of only --region."
+    )
+    parser.add_argument(
+        "--role-arns", type=str, nargs="+",
+        help="With --regions, assume each of these roles and sweep every region in its account."
+    )
+    parser.add_argument(
+        "--max-workers", type=int, default=16,
+        help="Number of (account, region) targets swept at the same time."
+    )
+    parser.add_argument(
+        "-s", "--snapshot", type=str,
+        help="Path or s3://bucket/key of the snapshot to reuse and update; may contain {account} and {region}."
+    )
+    parser.add_argument(
+        "--snapshot-max-age-hours", type=float, default=36,
+        help="Collect everything again when the snapshot is older than this."
+    )
+    parser.add_argument(
+        "--min-stale-days", type=int, default=0,
+        help="Only consider groups for deletion after they have been stale this many days (needs --snapshot)."
+    )
+    parser.add_argument(
+        "-e", "--explain", help="Show which resources keep each in-use security group in use",
+        action="store_true", default=False
+    )
     parser.add_argument(
         "-d", "--delete", help="Delete security groups from AWS",
         action="store_true"
     )
+    parser.add_argument(
+        "--dry-run", help="With --delete, stop after checking every deletion with DryRun",
+        action="store_true", default=False
+    )
+    parser.add_argument(
+        "--delete-rate", type=float, default=5,
+        help="Maximum DeleteSecurityGroup (and related) calls per second."
+    )
+    parser.add_argument(
+        "--delete-workers", type=int, default=4,
+        help="Number of groups deleted at the same time."
+    )
+    parser.add_argument(
+        "--checkpoint", type=str,
+        help="File recording deletion progress, to resume an interrupted --delete. "
+             "Defaults to deleted-security-groups-<region>.jsonl."
+    )
     parser.add_argument(
         "-n", "--no-report", help="Skip showing report for Security Groups",
         action="store_true", default=False
     )
     args = parser.parse_args()
 
+    base_session = boto3.Session(profile_name=args.profile)
+    options = detector_options(args.snapshot, args.min_stale_days, args.snapshot_max_age_hours, base_session)
+    if args.regions and args.delete:
+        parser.error("--delete works on a single --region")
+    if args.regions:
+        sweeper = Sweeper(StaleSGDetector, args.regions, args.role_arns,
+                          base_session=base_session, max_workers=args.max_workers,
+                          detector_options=options)
+        results = sweeper.run()
+        if not args.no_report:
+            report_sweep(results)
+        sys.exit(0)
+
     detector = StaleSGDetector(
-        **{"region": args.region, "profile": args.profile}
+        **dict(options(None), region=args.region, profile=args.profile)
     )
     detector.run()
 
     if not args.no_report:
-        report(detector)
+        report(detector, explain=args.explain)
+
+    if args.delete:
+        groups = detector.deletable_groups
+        engine = DeletionEngine(
+            detector.session.client('ec2', config=CLIENT_CONFIG), TokenBucket(args.delete_rate), args.delete_workers,
+            DeletionCheckpoint(args.checkpoint or "deleted-security-groups-{}.jsonl".format(args.region))
+        )
+        outcomes = engine.run(groups, referrers_from_index(detector.index, groups), dry_run_only=args.dry_run)
+        if not args.no_report:
+            report_deletion(outcomes)
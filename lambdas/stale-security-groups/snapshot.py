@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import datetime
+import logging
+import os
+import sys
+
+from collectors import SecurityGroupIndex
+
+try:
+    from documents import document_store_from_url
+except ImportError:
+    # Running from a checkout rather than code.zip: the shared module lives in lambdas/common
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+    from documents import document_store_from_url
+
+logger = logging.getLogger('index.snapshot')
+
+DATE_FMT = '%Y-%m-%dT%H:%M:%S'
+
+
+class Snapshot(object):
+    """
+    What one run found, kept so the next run can reuse it.
+
+    fragments holds each plugin's own part of the index, so a plugin whose
+    resources did not change can be reused without collecting it again.
+    stale_since records when each stale group was first seen stale in an
+    unbroken series of runs.
+    """
+
+    def __init__(self, taken, fragments=None, counts=None, stale_since=None):
+        super(Snapshot, self).__init__()
+        self.taken = taken
+        self.fragments = fragments or {}
+        self.counts = counts or {}
+        self.stale_since = stale_since or {}
+
+    def to_dict(self):
+        return {
+            'taken': self.taken.strftime(DATE_FMT),
+            'plugins': dict(
+                (name, dict(fragment.to_dict(), count=self.counts.get(name, 0)))
+                for name, fragment in self.fragments.items()
+            ),
+            'stale_since': dict((group_id, since.strftime(DATE_FMT)) for group_id, since in self.stale_since.items()),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            datetime.datetime.strptime(data['taken'], DATE_FMT),
+            dict((name, SecurityGroupIndex.from_dict(plugin)) for name, plugin in data['plugins'].items()),
+            dict((name, plugin['count']) for name, plugin in data['plugins'].items()),
+            dict((group_id, datetime.datetime.strptime(since, DATE_FMT))
+                 for group_id, since in data['stale_since'].items()),
+        )
+
+
+class SnapshotStore(object):
+    """
+    Loads and saves the snapshot as a JSON document in a DocumentStore.
+    """
+
+    def __init__(self, store):
+        super(SnapshotStore, self).__init__()
+        self.store = store
+
+    def load(self):
+        try:
+            data = self.store.load()
+            return Snapshot.from_dict(data) if data else None
+        except (ValueError, KeyError) as e:
+            logger.warning("Ignoring unreadable snapshot: %s" % e)
+            return None
+
+    def save(self, snapshot):
+        self.store.save(snapshot.to_dict())
+
+
+def store_from_url(url, client=None):
+    """Returns a snapshot store for an s3://bucket/key URL or a local path; client is the S3 client to use."""
+    return SnapshotStore(document_store_from_url(url, client=client))
+
+
+# CloudTrail event source of each boto3 service name the collector plugins use
+EVENT_SOURCES = {
+    'elb': 'elasticloadbalancing.amazonaws.com',
+    'elbv2': 'elasticloadbalancing.amazonaws.com',
+    'efs': 'elasticfilesystem.amazonaws.com',
+}
+
+
+def event_source(service):
+    return EVENT_SOURCES.get(service, '%s.amazonaws.com' % service)
+
+
+class ChangeDetector(object):
+    """
+    Tells which plugins may find something different since a snapshot, from CloudTrail.
+
+    Describe calls cannot be filtered by modification time, so instead each
+    plugin lists the write events that can change its result and is only
+    collected again when one of them was recorded since the snapshot. Events
+    take a while to show up in CloudTrail, hence the margin.
+
+    LookupEvents takes one attribute and is limited to 2 calls per second, so
+    rather than one lookup per event name or per event source, the write
+    events (ReadOnly=false) of the window are read once, a page of 50 at a
+    time, and matched to plugins by event source and name here. Looking up by
+    event source alone would mostly page through Describe calls, this
+    function's own included. Paging stops as soon as every plugin is known to
+    have changed; with more than max_pages pages of write events in the window
+    the remaining plugins are counted as changed, since collecting them is
+    cheaper than reading on.
+    """
+
+    def __init__(self, client, margin=datetime.timedelta(minutes=20), max_pages=10):
+        super(ChangeDetector, self).__init__()
+        self.client = client
+        self.margin = margin
+        self.max_pages = max_pages
+
+    def changed_by_events(self, plugins, since):
+        """Returns the names of the plugins with one of their events recorded since `since`."""
+        changed = set()
+        by_source = {}
+        for plugin in plugins:
+            by_source.setdefault(event_source(plugin.service), []).append(plugin)
+        kwargs = {
+            'LookupAttributes': [{'AttributeKey': 'ReadOnly', 'AttributeValue': 'false'}],
+            'StartTime': since - self.margin,
+            'MaxResults': 50,
+        }
+        for _ in range(self.max_pages):
+            response = self.client.lookup_events(**kwargs)
+            for event in response['Events']:
+                for plugin in by_source.get(event.get('EventSource'), []):
+                    if plugin.name not in changed and event['EventName'] in plugin.events:
+                        logger.info("%s changed since %s: %s" % (plugin.name, since, event['EventName']))
+                        changed.add(plugin.name)
+            if len(changed) == len(plugins) or 'NextToken' not in response:
+                return changed
+            kwargs['NextToken'] = response['NextToken']
+        logger.info("More than %d pages of write events since %s, collecting %s again" % (
+            self.max_pages, since, ', '.join(plugin.name for plugin in plugins if plugin.name not in changed)))
+        return set(plugin.name for plugin in plugins)
+
+    def changed(self, plugins, since):
+        """Returns the names of the plugins to collect again."""
+        changed = set(plugin.name for plugin in plugins if plugin.events is None)
+        watched = [plugin for plugin in plugins if plugin.events]
+        if watched:
+            changed.update(self.changed_by_events(watched, since))
+        return changed
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import threading
+import time
+
+import boto3
+
+
+class ApiCallCounter(object):
+    """
+    Counts API calls made by clients of one session.
+
+    Must be attached before the session creates clients, because clients take
+    a copy of the session's event handlers when they are created.
+    """
+
+    def __init__(self, session):
+        super(ApiCallCounter, self).__init__()
+        self.count = 0
+        self.lock = threading.Lock()
+        # before-parameter-build fires once per API call, before anything can short-circuit it
+        session.events.register('before-parameter-build', self._count)
+
+    def _count(self, **kwargs):
+        with self.lock:
+            self.count += 1
+
+
+class SweepTarget(object):
+    """
+    One (account, region) pair. role_arn None means the credentials the sweep itself runs with.
+    """
+
+    def __init__(self, region, role_arn=None):
+        super(SweepTarget, self).__init__()
+        self.region = region
+        self.role_arn = role_arn
+
+    @property
+    def account(self):
+        return self.role_arn.split(':')[4] if self.role_arn else 'default'
+
+    @property
+    def label(self):
+        return '%s/%s' % (self.account, self.region)
+
+
+class SweepResult(object):
+    """
+    Outcome of running one detector against one target.
+    """
+
+    def __init__(self, target, detector=None, elapsed=0.0, api_calls=0, error=None):
+        super(SweepResult, self).__init__()
+        self.target = target
+        self.detector = detector
+        self.elapsed = elapsed
+        self.api_calls = api_calls
+        self.error = error
+
+
+class Sweeper(object):
+    """
+    Runs a detector per (account, region) pair in a bounded worker pool.
+
+    Each role is assumed once per sweep and its credentials are shared by all
+    of that account's regions.
+    """
+
+    def __init__(self, detector_class, regions, role_arns=None, base_session=None, max_workers=16,
+                 role_session_name='stale-security-group-sweep', detector_options=None):
+        super(Sweeper, self).__init__()
+        self.detector_class = detector_class
+        self.regions = regions
+        self.role_arns = role_arns or [None]
+        self.base_session = base_session or boto3.Session()
+        self.max_workers = max_workers
+        self.role_session_name = role_session_name
+        # target -> extra keyword arguments for the detector
+        self.detector_options = detector_options or (lambda target: {})
+        self.credentials = {}
+        self.credentials_lock = threading.Lock()
+
+    def targets(self):
+        return [SweepTarget(region, role_arn) for role_arn in self.role_arns for region in self.regions]
+
+    def _credentials(self, role_arn):
+        with self.credentials_lock:
+            if role_arn not in self.credentials:
+                response = self.base_session.client('sts').assume_role(
+                    RoleArn=role_arn, RoleSessionName=self.role_session_name
+                )
+                self.credentials[role_arn] = response['Credentials']
+            return self.credentials[role_arn]
+
+    def session_for(self, target):
+        if target.role_arn is None:
+            with self.credentials_lock:
+                credentials = self.base_session.get_credentials().get_frozen_credentials()
+            return boto3.Session(
+                aws_access_key_id=credentials.access_key,
+                aws_secret_access_key=credentials.secret_key,
+                aws_session_token=credentials.token,
+                region_name=target.region
+            )
+        credentials = self._credentials(target.role_arn)
+        return boto3.Session(
+            aws_access_key_id=credentials['AccessKeyId'],
+            aws_secret_access_key=credentials['SecretAccessKey'],
+            aws_session_token=credentials['SessionToken'],
+            region_name=target.region
+        )
+
+    def run_target(self, target):
+        start = time.time()
+        counter = None
+        try:
+            session = self.session_for(target)
+            counter = ApiCallCounter(session)
+            detector = self.detector_class(session=session, **self.detector_options(target))
+            detector.run()
+        except Exception as e:
+            return SweepResult(target, elapsed=time.time() - start, api_calls=counter.count if counter else 0,
+                               error=e)
+        return SweepResult(target, detector, time.time() - start, counter.count)
+
+    def run(self):
+        """Returns a SweepResult per target, in target order."""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self.run_target, self.targets()))
+
+
+def stale_findings(results):
+    """Returns "account/region/sg-id" for every stale group found by the sweep."""
+    return set(
+        '%s/%s' % (result.target.label, group)
+        for result in results if result.detector is not None
+        for group in result.detector.stale_groups
+    )
+
+
+def report_sweep(results):
+    print("---------------")
+
+    for result in results:
+        if result.error is not None:
+            print("{}: failed after {:.1f}s and {} API calls: {}".format(
+                result.target.label, result.elapsed, result.api_calls, result.error
+            ))
+        else:
+            print("{}: {} security groups, {} in use, {} stale in {:.1f}s and {} API calls".format(
+                result.target.label, len(result.detector.all_groups),
+                len(result.detector.security_groups_in_use), len(result.detector.stale_groups),
+                result.elapsed, result.api_calls
+            ))
+
+    print("Swept {} targets ({} failed) with {} API calls. Following {} security groups don't seem to be used:".format(
+        len(results), len([result for result in results if result.error is not None]),
+        sum(result.api_calls for result in results), len(stale_findings(results))
+    ))
+    for sg in sorted(stale_findings(results)):
+        print("  - ", sg)
+
+    print("---------------")
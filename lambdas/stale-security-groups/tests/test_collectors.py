@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import unittest
+
+import boto3
+from botocore.stub import Stubber
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common', 'tests'))
+
+from collectors import (REGISTRY, SecurityGroupIndex, collect_ec2_instances, collect_efs_mount_targets,  # noqa: E402
+                        collect_security_groups)
+from index import StaleSGDetector  # noqa: E402
+from lambda_stubs import client  # noqa: E402
+
+
+def group(group_id, name, tags=(), referenced=()):
+    return {
+        'GroupId': group_id, 'GroupName': name, 'Description': name, 'OwnerId': '123456789012', 'VpcId': 'vpc-1',
+        'Tags': list(tags),
+        'IpPermissions': [{'IpProtocol': 'tcp', 'FromPort': 443, 'ToPort': 443,
+                           'UserIdGroupPairs': [{'GroupId': other} for other in referenced]}],
+        'IpPermissionsEgress': [],
+    }
+
+
+def reservation(*instances):
+    return {'ReservationId': 'r-%s' % instances[0][0], 'Instances': [
+        {'InstanceId': instance_id, 'SecurityGroups': [{'GroupId': group_id} for group_id in group_ids]}
+        for instance_id, group_ids in instances
+    ]}
+
+
+class CollectorTest(unittest.TestCase):
+
+    def test_security_groups(self):
+        ec2 = client('ec2')
+        index = SecurityGroupIndex()
+        with Stubber(ec2) as stubber:
+            stubber.add_response('describe_security_groups', {'SecurityGroups': [
+                group('sg-default', 'default'),
+                group('sg-stack', 'stack', tags=[{'Key': 'aws:cloudformation:stack-id', 'Value': 'arn:stack'}]),
+            ], 'NextToken': 'page-2'}, {})
+            stubber.add_response('describe_security_groups', {'SecurityGroups': [
+                group('sg-web', 'web', referenced=['sg-db', 'sg-web']),
+                group('sg-db', 'db'),
+            ]}, {'NextToken': 'page-2'})
+            self.assertEqual(collect_security_groups(ec2, index), 4)
+            stubber.assert_no_pending_responses()
+        self.assertEqual(index.all_groups, set(['sg-default', 'sg-stack', 'sg-web', 'sg-db']))
+        self.assertEqual(index.why('sg-default'), ['default-group:sg-default'])
+        self.assertEqual(index.why('sg-stack'), ['cloudformation-stack:arn:stack'])
+        # A rule referencing the group itself does not count
+        self.assertEqual(index.why('sg-db'), ['security-group:sg-web'])
+        self.assertEqual(index.why('sg-web'), [])
+        # Referenced only by a group that is not in use itself
+        self.assertEqual(index.groups_in_use(), set(['sg-default', 'sg-stack']))
+
+    def test_ec2_instances_across_pages(self):
+        ec2 = client('ec2')
+        index = SecurityGroupIndex()
+        with Stubber(ec2) as stubber:
+            stubber.add_response('describe_instances', {'Reservations': [
+                reservation(('i-1', ['sg-web']), ('i-2', ['sg-web', 'sg-db'])),
+            ], 'NextToken': 'page-2'}, {})
+            stubber.add_response('describe_instances', {'Reservations': [
+                reservation(('i-3', [])),
+            ]}, {'NextToken': 'page-2'})
+            self.assertEqual(collect_ec2_instances(ec2, index), 3)
+            stubber.assert_no_pending_responses()
+        self.assertEqual(index.why('sg-web'), ['ec2-instance:i-1', 'ec2-instance:i-2'])
+        self.assertEqual(index.why('sg-db'), ['ec2-instance:i-2'])
+
+    def test_efs_mount_targets(self):
+        efs = client('efs')
+        index = SecurityGroupIndex()
+        first, second = 'fsmt-0123456789', 'fsmt-0abcdef012'
+        with Stubber(efs) as stubber:
+            stubber.add_response('describe_file_systems', {'FileSystems': [{
+                'OwnerId': '123456789012', 'CreationToken': 'token', 'FileSystemId': 'fs-1',
+                'CreationTime': '2024-01-01T00:00:00Z', 'LifeCycleState': 'available', 'NumberOfMountTargets': 2,
+                'SizeInBytes': {'Value': 0}, 'PerformanceMode': 'generalPurpose', 'Tags': [],
+            }]}, {})
+            stubber.add_response('describe_mount_targets', {'MountTargets': [
+                {'MountTargetId': mount_target_id, 'FileSystemId': 'fs-1', 'SubnetId': 'subnet-0123456789',
+                 'LifeCycleState': 'available'}
+                for mount_target_id in (first, second)
+            ]}, {'FileSystemId': 'fs-1'})
+            stubber.add_response('describe_mount_target_security_groups', {'SecurityGroups': ['sg-0efs0000']},
+                                 {'MountTargetId': first})
+            stubber.add_response('describe_mount_target_security_groups',
+                                 {'SecurityGroups': ['sg-0efs0000', 'sg-0db00000']}, {'MountTargetId': second})
+            self.assertEqual(collect_efs_mount_targets(efs, index), 2)
+            stubber.assert_no_pending_responses()
+        self.assertEqual(index.why('sg-0efs0000'), ['efs-mount-target:' + first, 'efs-mount-target:' + second])
+        self.assertEqual(index.why('sg-0db00000'), ['efs-mount-target:' + second])
+
+    def test_every_plugin_has_a_service_and_a_collect_function(self):
+        names = [plugin.name for plugin in REGISTRY]
+        self.assertEqual(len(names), len(set(names)))
+        for plugin in REGISTRY:
+            self.assertTrue(callable(plugin.collect))
+            self.assertIn(plugin.service, boto3.Session().get_available_services())
+
+
+class StaleSGDetectorTest(unittest.TestCase):
+
+    def test_groups_not_referenced_by_any_resource_are_stale(self):
+        plugins = [plugin for plugin in REGISTRY if plugin.name in ('security-groups', 'ec2-instances')]
+        detector = StaleSGDetector(session=boto3.Session(region_name='us-east-1'), plugins=plugins)
+        detector.clients = {'security-groups': client('ec2'), 'ec2-instances': client('ec2')}
+        stubbers = dict((name, Stubber(_client)) for name, _client in detector.clients.items())
+        stubbers['security-groups'].add_response('describe_security_groups', {'SecurityGroups': [
+            group('sg-default', 'default'),
+            group('sg-web', 'web'),
+            group('sg-db', 'db'),
+            group('sg-old', 'old', referenced=['sg-unused']),
+            group('sg-unused', 'unused'),
+        ]}, {})
+        stubbers['ec2-instances'].add_response('describe_instances', {'Reservations': [
+            reservation(('i-1', ['sg-web', 'sg-peer'])),
+        ]}, {})
+        for stubber in stubbers.values():
+            stubber.activate()
+        detector.run()
+        for stubber in stubbers.values():
+            stubber.assert_no_pending_responses()
+            stubber.deactivate()
+
+        self.assertEqual(detector.stale_groups, set(['sg-db', 'sg-old', 'sg-unused']))
+        # sg-peer belongs to another account, so it is not listed as in use here
+        self.assertEqual(detector.security_groups_in_use, set(['sg-default', 'sg-web']))
+        self.assertEqual(detector.counts, {'security-groups': 5, 'ec2-instances': 1})
+        self.assertEqual(detector.why('sg-web'), ['ec2-instance:i-1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
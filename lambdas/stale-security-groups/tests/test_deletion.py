@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from botocore.stub import Stubber
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common', 'tests'))
+
+from deletion import DeletionCheckpoint, DeletionEngine, DeletionPlan, TokenBucket  # noqa: E402
+from lambda_stubs import client  # noqa: E402
+
+
+def rule(*group_ids):
+    return {'IpProtocol': 'tcp', 'FromPort': 443, 'ToPort': 443,
+            'UserIdGroupPairs': [{'GroupId': group_id} for group_id in group_ids]}
+
+
+class FakeClock(object):
+    """Stands in for time.monotonic and time.sleep: sleeping moves the clock on."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_waits_for_tokens_and_adapts_to_throttling(self):
+        clock = FakeClock()
+        bucket = TokenBucket(2, clock=clock, sleep=clock.sleep)
+        for _ in range(4):
+            bucket.acquire()
+        self.assertEqual(clock.now, 1.0)
+        bucket.throttled()
+        self.assertEqual(bucket.rate, 1.0)
+        bucket.acquire()
+        self.assertEqual(clock.now, 2.0)
+        bucket.succeeded()
+        self.assertEqual(bucket.rate, 1.1)
+
+
+class DeletionPlanTest(unittest.TestCase):
+
+    def test_referencing_groups_go_first(self):
+        # sg-web references sg-app, which references sg-db
+        plan = DeletionPlan(['sg-db', 'sg-app', 'sg-web'], {'sg-db': {'sg-app'}, 'sg-app': {'sg-web'}})
+        self.assertEqual(plan.waves, [['sg-web'], ['sg-app'], ['sg-db']])
+        self.assertEqual((plan.blocked, plan.cycles), ({}, set()))
+
+    def test_groups_referenced_by_kept_groups_are_blocked(self):
+        plan = DeletionPlan(['sg-db', 'sg-app'], {'sg-db': {'sg-app'}, 'sg-app': {'sg-kept'}})
+        self.assertEqual(plan.blocked, {'sg-app': ['sg-kept'], 'sg-db': ['sg-app']})
+        self.assertEqual(plan.waves, [])
+        # Unless the kept group is already gone
+        self.assertEqual(DeletionPlan(['sg-app'], {'sg-app': {'sg-kept'}}, deleted=['sg-kept']).waves, [['sg-app']])
+
+    def test_cycles_end_up_in_the_last_wave(self):
+        plan = DeletionPlan(['sg-a', 'sg-b', 'sg-c', 'sg-d'],
+                            {'sg-a': {'sg-b'}, 'sg-b': {'sg-a'}, 'sg-c': {'sg-a'}, 'sg-d': set()})
+        self.assertEqual(plan.waves, [['sg-d'], ['sg-a', 'sg-b', 'sg-c']])
+        self.assertEqual(plan.cycles, set(['sg-a', 'sg-b', 'sg-c']))
+
+
+class DeletionEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.clock = FakeClock()
+        self.client = client('ec2')
+        self.stubber = Stubber(self.client)
+        self.stubber.activate()
+
+    def tearDown(self):
+        self.stubber.deactivate()
+        shutil.rmtree(self.directory)
+
+    def engine(self, checkpoint=None):
+        # One worker, so the calls reach the Stubber in a predictable order
+        return DeletionEngine(self.client, TokenBucket(10, clock=self.clock, sleep=self.clock.sleep), max_workers=1,
+                              checkpoint=checkpoint, base_delay=0.5, sleep=self.clock.sleep)
+
+    def dry_run(self, group_id, code='DryRunOperation'):
+        self.stubber.add_client_error('delete_security_group', service_error_code=code, service_message=code,
+                                      http_status_code=412, expected_params={'GroupId': group_id, 'DryRun': True})
+
+    def delete(self, group_id, code=None):
+        if code is None:
+            self.stubber.add_response('delete_security_group', {}, {'GroupId': group_id})
+        else:
+            self.stubber.add_client_error('delete_security_group', service_error_code=code, service_message=code,
+                                          expected_params={'GroupId': group_id})
+
+    def statuses(self, outcomes):
+        self.stubber.assert_no_pending_responses()
+        return dict((outcome.group_id, outcome.status) for outcome in outcomes)
+
+    def test_dry_run_only_deletes_nothing(self):
+        self.dry_run('sg-a')
+        self.dry_run('sg-b', 'InvalidGroup.NotFound')
+        self.dry_run('sg-c', 'UnauthorizedOperation')
+        outcomes = self.engine().run(['sg-c', 'sg-a', 'sg-b'], {}, dry_run_only=True)
+        self.assertEqual(self.statuses(outcomes), {'sg-a': 'dry-run-ok', 'sg-b': 'not-found',
+                                                   'sg-c': 'dry-run-failed'})
+        self.assertIn('UnauthorizedOperation', outcomes[2].detail)
+
+    def test_groups_that_fail_the_dry_run_are_not_deleted(self):
+        self.dry_run('sg-a')
+        self.dry_run('sg-b', 'UnauthorizedOperation')
+        self.delete('sg-a')
+        self.assertEqual(self.statuses(self.engine().run(['sg-a', 'sg-b'], {})),
+                         {'sg-a': 'deleted', 'sg-b': 'dry-run-failed'})
+
+    def test_groups_still_in_use_and_what_they_reference(self):
+        # sg-web references sg-db; an instance still uses sg-web
+        self.dry_run('sg-db')
+        self.dry_run('sg-web')
+        self.delete('sg-web', 'DependencyViolation')
+        outcomes = self.engine().run(['sg-db', 'sg-web'], {'sg-db': {'sg-web'}})
+        self.assertEqual(self.statuses(outcomes), {'sg-db': 'blocked', 'sg-web': 'in-use'})
+        self.assertEqual(outcomes[0].detail, 'referenced by sg-web, which was not deleted')
+
+    def test_throttled_calls_are_retried_with_backoff_and_slow_the_bucket_down(self):
+        self.dry_run('sg-a', 'RequestLimitExceeded')
+        self.dry_run('sg-a')
+        self.delete('sg-a', 'RequestLimitExceeded')
+        self.delete('sg-a', 'Throttling')
+        self.delete('sg-a')
+        engine = self.engine()
+        # The longest jitter: backoff doubles with every attempt at a call
+        with mock.patch('deletion.random.uniform', side_effect=lambda low, high: high):
+            outcomes = engine.run(['sg-a'], {})
+        self.assertEqual(self.statuses(outcomes), {'sg-a': 'deleted'})
+        self.assertEqual(outcomes[0].attempts, 3)
+        # Three throttled calls halve the rate three times; the deletion that went through wins a twentieth back
+        # (a passed dry run is an error response, so it does not)
+        self.assertAlmostEqual(engine.bucket.rate, 10 / 8.0 + 0.5)
+        backoffs = [delay for delay in self.clock.sleeps if delay >= 1]
+        self.assertEqual(backoffs, [1.0, 1.0, 2.0])
+
+    def test_throttling_gives_up_after_max_attempts(self):
+        for _ in range(3):
+            self.delete('sg-a', 'RequestLimitExceeded')
+        engine = self.engine()
+        engine.max_attempts = 3
+        outcome = engine.delete('sg-a')
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual((outcome.status, outcome.attempts), ('failed', 3))
+
+    def test_referencing_groups_are_deleted_in_earlier_waves(self):
+        for group_id in ('sg-app', 'sg-db', 'sg-web'):
+            self.dry_run(group_id)
+        # The Stubber fails the run if the calls come in any other order
+        self.delete('sg-web')
+        self.delete('sg-app')
+        self.delete('sg-db')
+        outcomes = self.engine().run(['sg-db', 'sg-app', 'sg-web'], {'sg-db': {'sg-app'}, 'sg-app': {'sg-web'}})
+        self.assertEqual(self.statuses(outcomes), {'sg-app': 'deleted', 'sg-db': 'deleted', 'sg-web': 'deleted'})
+
+    def test_references_within_a_cycle_are_revoked_before_deleting(self):
+        self.dry_run('sg-a')
+        self.dry_run('sg-b')
+        self.stubber.add_response('describe_security_groups', {'SecurityGroups': [
+            {'GroupId': 'sg-a', 'IpPermissions': [rule('sg-b', 'sg-a', 'sg-other')], 'IpPermissionsEgress': []},
+            {'GroupId': 'sg-b', 'IpPermissions': [], 'IpPermissionsEgress': [rule('sg-a')]},
+        ]}, {'GroupIds': ['sg-a', 'sg-b']})
+        self.stubber.add_response('revoke_security_group_ingress', {'Return': True},
+                                  {'GroupId': 'sg-a', 'IpPermissions': [rule('sg-b')]})
+        self.stubber.add_response('revoke_security_group_egress', {'Return': True},
+                                  {'GroupId': 'sg-b', 'IpPermissions': [rule('sg-a')]})
+        self.delete('sg-a')
+        self.delete('sg-b')
+        outcomes = self.engine().run(['sg-a', 'sg-b'], {'sg-a': {'sg-b'}, 'sg-b': {'sg-a'}})
+        self.assertEqual(self.statuses(outcomes), {'sg-a': 'deleted', 'sg-b': 'deleted'})
+
+    def test_resumes_from_a_checkpoint(self):
+        path = os.path.join(self.directory, 'checkpoint.jsonl')
+        with open(path, 'w') as f:
+            f.write(json.dumps({'group_id': 'sg-a', 'status': 'deleted', 'detail': '', 'attempts': 1}) + '\n')
+            f.write(json.dumps({'group_id': 'sg-b', 'status': 'in-use', 'detail': '', 'attempts': 1}) + '\n')
+            # Cut short by the interruption
+            f.write('{"group_id": "sg-c", "sta')
+        # sg-b references sg-a, which an earlier run deleted already
+        self.dry_run('sg-b')
+        self.delete('sg-b')
+        outcomes = self.engine(DeletionCheckpoint(path)).run(['sg-a', 'sg-b'], {'sg-a': {'sg-b'}})
+        self.assertEqual(self.statuses(outcomes), {'sg-a': 'skipped', 'sg-b': 'deleted'})
+        self.assertEqual(DeletionCheckpoint(path).done(), set(['sg-a', 'sg-b']))
+
+
+if __name__ == '__main__':
+    unittest.main()
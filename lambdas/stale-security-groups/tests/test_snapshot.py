@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import boto3
+from botocore.stub import Stubber
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common', 'tests'))
+
+from collectors import REGISTRY, CollectorPlugin, SecurityGroupIndex  # noqa: E402
+from index import StaleSGDetector  # noqa: E402
+from lambda_stubs import client, streaming_body  # noqa: E402
+from snapshot import ChangeDetector, Snapshot, store_from_url  # noqa: E402
+
+SINCE = datetime.datetime(2024, 1, 1, 12, 0, 0)
+MARGIN = datetime.timedelta(minutes=20)
+
+
+def plugin(name, service, events):
+    return CollectorPlugin(name, service, None, events)
+
+
+def events(*names, **kwargs):
+    source = kwargs.get('source', 'ec2.amazonaws.com')
+    return [{'EventId': str(number), 'EventName': name, 'EventSource': source}
+            for number, name in enumerate(names)]
+
+
+def json_document(snapshot):
+    return json.dumps(snapshot.to_dict(), sort_keys=True).encode('utf-8')
+
+
+def lookup(next_token=None):
+    expected = {
+        'LookupAttributes': [{'AttributeKey': 'ReadOnly', 'AttributeValue': 'false'}],
+        'StartTime': SINCE - MARGIN,
+        'MaxResults': 50,
+    }
+    if next_token is not None:
+        expected['NextToken'] = next_token
+    return expected
+
+
+class ChangeDetectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = client('cloudtrail')
+        self.stubber = Stubber(self.client)
+        self.stubber.activate()
+        self.detector = ChangeDetector(self.client, margin=MARGIN, max_pages=3)
+        self.instances = plugin('ec2-instances', 'ec2', ['RunInstances', 'TerminateInstances'])
+        self.groups = plugin('security-groups', 'ec2', ['CreateSecurityGroup'])
+
+    def tearDown(self):
+        self.stubber.deactivate()
+
+    def test_looks_up_write_events_once_and_matches_them_by_source(self):
+        self.stubber.add_response('lookup_events', {'Events': events('RunInstances') +
+                                                    events('CreateLoadBalancer', source='rds.amazonaws.com'),
+                                                    'NextToken': 'page-2'}, lookup())
+        self.stubber.add_response('lookup_events', {'Events': events('CreateTags')}, lookup('page-2'))
+        plugins = [self.instances, self.groups, plugin('elbs', 'elb', ['CreateLoadBalancer']),
+                   plugin('albs', 'elbv2', ['CreateLoadBalancer']), plugin('unknown', 'ec2', None)]
+        self.assertEqual(self.detector.changed(plugins, SINCE), set(['ec2-instances', 'unknown']))
+        self.stubber.assert_no_pending_responses()
+
+    def test_read_only_events_do_not_count(self):
+        # A lookup by event source would be all Describe calls; the ReadOnly=false lookup never returns
+        # them, and a full page of them does not mark a plugin changed either
+        self.stubber.add_response('lookup_events', {'Events': events(*['DescribeInstances'] * 50),
+                                                    'NextToken': 'page-2'}, lookup())
+        self.stubber.add_response('lookup_events', {'Events': events('AuthorizeSecurityGroupIngress')},
+                                  lookup('page-2'))
+        self.assertEqual(self.detector.changed([self.instances, self.groups], SINCE), set())
+        self.stubber.assert_no_pending_responses()
+
+    def test_stops_paging_once_every_plugin_changed(self):
+        self.stubber.add_response('lookup_events', {'Events': events('RunInstances', 'CreateSecurityGroup'),
+                                                    'NextToken': 'page-2'}, lookup())
+        self.assertEqual(self.detector.changed([self.instances, self.groups], SINCE),
+                         set(['ec2-instances', 'security-groups']))
+        self.stubber.assert_no_pending_responses()
+
+    def test_too_many_pages_count_as_changed(self):
+        for page in range(3):
+            self.stubber.add_response('lookup_events', {'Events': events('CreateTags'), 'NextToken': str(page + 1)},
+                                      lookup(str(page) if page else None))
+        self.assertEqual(self.detector.changed([self.instances], SINCE), set(['ec2-instances']))
+        self.stubber.assert_no_pending_responses()
+
+    def test_no_lookup_without_watched_plugins(self):
+        self.assertEqual(self.detector.changed([plugin('unknown', 'ec2', None)], SINCE), set(['unknown']))
+
+
+class SnapshotStoreTest(unittest.TestCase):
+
+    def test_round_trip_through_s3(self):
+        s3 = client('s3')
+        store = store_from_url('s3://bucket/stale-security-groups/snapshot.json', client=s3)
+        self.assertEqual((store.store.bucket, store.store.key), ('bucket', 'stale-security-groups/snapshot.json'))
+        fragment = SecurityGroupIndex()
+        fragment.add_group('sg-web')
+        fragment.add('ec2-instance:i-1', ['sg-web'])
+        snapshot = Snapshot(SINCE, {'ec2-instances': fragment}, {'ec2-instances': 1}, {'sg-old': SINCE})
+        with Stubber(s3) as stubber:
+            stubber.add_client_error('get_object', service_error_code='NoSuchKey', http_status_code=404,
+                                     expected_params={'Bucket': 'bucket', 'Key': 'stale-security-groups/snapshot.json'})
+            self.assertIsNone(store.load())
+            document = json_document(snapshot)
+            stubber.add_response('put_object', {}, {'Bucket': 'bucket', 'Key': 'stale-security-groups/snapshot.json',
+                                                    'Body': document, 'ContentType': 'application/json'})
+            store.save(snapshot)
+            stubber.add_response('get_object', {'Body': streaming_body(document)},
+                                 {'Bucket': 'bucket', 'Key': 'stale-security-groups/snapshot.json'})
+            loaded = store.load()
+            stubber.assert_no_pending_responses()
+        self.assertEqual(loaded.taken, SINCE)
+        self.assertEqual(loaded.fragments['ec2-instances'].why('sg-web'), ['ec2-instance:i-1'])
+        self.assertEqual(loaded.counts, {'ec2-instances': 1})
+        self.assertEqual(loaded.stale_since, {'sg-old': SINCE})
+
+
+    def test_unreadable_snapshot_is_ignored(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'snapshot.json')
+        for document in ('{not json', '{"taken": "2024-01-01T12:00:00"}'):
+            with open(path, 'w') as f:
+                f.write(document)
+            self.assertIsNone(store_from_url(path).load())
+
+
+class IncrementalRunTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = store_from_url(os.path.join(self.directory, 'snapshot.json'))
+        self.plugins = [plugin for plugin in REGISTRY if plugin.name in ('security-groups', 'lambda-functions')]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def detector(self):
+        detector = StaleSGDetector(session=boto3.Session(region_name='us-east-1'), plugins=self.plugins,
+                                   snapshot_store=self.store)
+        detector.clients = {'security-groups': client('ec2'), 'lambda-functions': client('lambda'),
+                            'cloudtrail': client('cloudtrail')}
+        detector.stubbers = dict((name, Stubber(_client)) for name, _client in detector.clients.items())
+        return detector
+
+    def run_detector(self, detector):
+        for stubber in detector.stubbers.values():
+            stubber.activate()
+        detector.run()
+        for stubber in detector.stubbers.values():
+            stubber.assert_no_pending_responses()
+            stubber.deactivate()
+
+    def test_second_run_only_collects_plugins_with_events(self):
+        first = self.detector()
+        first.stubbers['security-groups'].add_response('describe_security_groups', {'SecurityGroups': [
+            {'GroupId': 'sg-web', 'GroupName': 'web', 'Description': 'web'},
+            {'GroupId': 'sg-old', 'GroupName': 'old', 'Description': 'old'},
+        ]}, {})
+        first.stubbers['lambda-functions'].add_response('list_functions', {'Functions': [
+            {'FunctionName': 'api', 'VpcConfig': {'SecurityGroupIds': ['sg-web']}},
+        ]}, {})
+        self.run_detector(first)
+        self.assertEqual(first.stale_groups, set(['sg-old']))
+        self.assertEqual(first.reused, set())
+
+        second = self.detector()
+        second.stubbers['cloudtrail'].add_response('lookup_events', {'Events': events('CreateSecurityGroup')})
+        second.stubbers['security-groups'].add_response('describe_security_groups', {'SecurityGroups': [
+            {'GroupId': 'sg-web', 'GroupName': 'web', 'Description': 'web'},
+            {'GroupId': 'sg-old', 'GroupName': 'old', 'Description': 'old'},
+            {'GroupId': 'sg-new', 'GroupName': 'new', 'Description': 'new'},
+        ]}, {})
+        self.run_detector(second)
+        self.assertEqual(second.reused, set(['lambda-functions']))
+        self.assertEqual(second.stale_groups, set(['sg-old', 'sg-new']))
+        self.assertEqual(second.why('sg-web'), ['lambda:api'])
+        # Still stale since the first run, as recorded to the second
+        self.assertEqual(second.stale_since['sg-old'], first.stale_since['sg-old'].replace(microsecond=0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import contextlib
+import datetime
+import io
+import os
+import sys
+import unittest
+from unittest import mock
+
+import boto3
+from botocore.stub import Stubber
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sweep import ApiCallCounter, Sweeper, SweepTarget, report_sweep, stale_findings  # noqa: E402
+
+ROLES = ['arn:aws:iam::111111111111:role/sweep', 'arn:aws:iam::222222222222:role/sweep',
+         'arn:aws:iam::333333333333:role/sweep']
+REGIONS = ['us-east-1', 'eu-west-1']
+EXPIRATION = datetime.datetime(2030, 1, 1)
+
+
+def base_session():
+    return boto3.Session(aws_access_key_id='base', aws_secret_access_key='base', region_name='us-east-1')
+
+
+class FakeDetector(object):
+    """Lists the security groups of its session's account and region, and calls every group stale."""
+
+    # access key -> groups of that account; an account missing here gets an error from EC2
+    groups = {}
+
+    def __init__(self, session, **options):
+        self.session = session
+        self.options = options
+        self.all_groups = set()
+        self.security_groups_in_use = set()
+        self.stale_groups = set()
+
+    def run(self):
+        ec2 = self.session.client('ec2')
+        access_key = self.session.get_credentials().access_key
+        with Stubber(ec2) as stubber:
+            if access_key in self.groups:
+                stubber.add_response('describe_security_groups', {'SecurityGroups': [
+                    {'GroupId': group, 'GroupName': group, 'Description': group} for group in self.groups[access_key]
+                ]}, {})
+            else:
+                stubber.add_client_error('describe_security_groups', service_error_code='UnauthorizedOperation',
+                                         http_status_code=403)
+            response = ec2.describe_security_groups()
+        self.all_groups = set(group['GroupId'] for group in response['SecurityGroups'])
+        self.stale_groups = set(self.all_groups)
+
+
+class SweeperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.session = base_session()
+        self.sts = self.session.client('sts')
+        self.stubber = Stubber(self.sts)
+        self.stubber.activate()
+        for number, role_arn in enumerate(ROLES):
+            self.stubber.add_response('assume_role', {'Credentials': {
+                'AccessKeyId': 'ASIAEXAMPLEKEY00%d' % number, 'SecretAccessKey': 'secret', 'SessionToken': 'token',
+                'Expiration': EXPIRATION,
+            }}, {'RoleArn': role_arn, 'RoleSessionName': 'stale-security-group-sweep'})
+        FakeDetector.groups = {'ASIAEXAMPLEKEY000': ['sg-a'], 'ASIAEXAMPLEKEY002': ['sg-c', 'sg-d']}
+
+    def tearDown(self):
+        self.stubber.deactivate()
+
+    def sweep(self, **kwargs):
+        sweeper = Sweeper(FakeDetector, REGIONS, ROLES, base_session=self.session, max_workers=4, **kwargs)
+        with mock.patch.object(self.session, 'client', return_value=self.sts):
+            return sweeper.run()
+
+    def test_every_account_and_region_is_swept_with_one_role_assumption_per_account(self):
+        results = self.sweep()
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual([result.target.label for result in results], [
+            '111111111111/us-east-1', '111111111111/eu-west-1', '222222222222/us-east-1',
+            '222222222222/eu-west-1', '333333333333/us-east-1', '333333333333/eu-west-1',
+        ])
+        for result in results:
+            self.assertEqual(result.api_calls, 1)
+        self.assertEqual([result.detector.session.region_name for result in results if result.detector],
+                         ['us-east-1', 'eu-west-1', 'us-east-1', 'eu-west-1'])
+
+    def test_a_failing_account_does_not_stop_the_others(self):
+        results = self.sweep()
+        failed = [result.target.label for result in results if result.error is not None]
+        self.assertEqual(failed, ['222222222222/us-east-1', '222222222222/eu-west-1'])
+        self.assertEqual(stale_findings(results), set([
+            '111111111111/us-east-1/sg-a', '111111111111/eu-west-1/sg-a',
+            '333333333333/us-east-1/sg-c', '333333333333/us-east-1/sg-d',
+            '333333333333/eu-west-1/sg-c', '333333333333/eu-west-1/sg-d',
+        ]))
+
+    def test_a_role_that_cannot_be_assumed_only_fails_its_account(self):
+        self.stubber.deactivate()
+        self.stubber = Stubber(self.sts)
+        self.stubber.activate()
+        self.stubber.add_response('assume_role', {'Credentials': {
+            'AccessKeyId': 'ASIAEXAMPLEKEY000', 'SecretAccessKey': 'secret', 'SessionToken': 'token', 'Expiration': EXPIRATION,
+        }})
+        self.stubber.add_client_error('assume_role', service_error_code='AccessDenied', http_status_code=403)
+        sweeper = Sweeper(FakeDetector, ['us-east-1'], ROLES[:2], base_session=self.session, max_workers=1)
+        with mock.patch.object(self.session, 'client', return_value=self.sts):
+            results = sweeper.run()
+        self.assertIsNone(results[0].error)
+        self.assertIsNotNone(results[1].error)
+        self.assertEqual(results[1].api_calls, 0)
+
+    def test_detector_options_per_target(self):
+        results = self.sweep(detector_options=lambda target: {'label': target.label})
+        self.assertEqual(results[0].detector.options, {'label': '111111111111/us-east-1'})
+
+    def test_without_roles_the_base_credentials_are_used(self):
+        FakeDetector.groups = {'base': ['sg-base']}
+        results = Sweeper(FakeDetector, REGIONS, base_session=self.session).run()
+        self.assertEqual(stale_findings(results), set(['default/us-east-1/sg-base', 'default/eu-west-1/sg-base']))
+
+
+class ApiCallCounterTest(unittest.TestCase):
+
+    def test_counts_calls_of_clients_created_after_it(self):
+        session = base_session()
+        counter = ApiCallCounter(session)
+        ec2 = session.client('ec2')
+        with Stubber(ec2) as stubber:
+            stubber.add_response('describe_security_groups', {'SecurityGroups': []}, {})
+            stubber.add_client_error('describe_vpcs', service_error_code='Throttling', http_status_code=400)
+            ec2.describe_security_groups()
+            with self.assertRaises(Exception):
+                ec2.describe_vpcs()
+        self.assertEqual(counter.count, 2)
+
+
+class ReportSweepTest(unittest.TestCase):
+
+    def test_reports_failures_and_findings(self):
+        ok = mock.Mock(target=SweepTarget('us-east-1', ROLES[0]), error=None, elapsed=1.5, api_calls=12,
+                       detector=mock.Mock(all_groups=set(['sg-a', 'sg-b']), security_groups_in_use=set(['sg-b']),
+                                          stale_groups=set(['sg-a'])))
+        failed = mock.Mock(target=SweepTarget('us-east-1', ROLES[1]), error=Exception('AccessDenied'), elapsed=0.2,
+                           api_calls=1, detector=None)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            report_sweep([ok, failed])
+        lines = output.getvalue().splitlines()
+        self.assertIn('111111111111/us-east-1: 2 security groups, 1 in use, 1 stale in 1.5s and 12 API calls', lines)
+        self.assertIn('222222222222/us-east-1: failed after 0.2s and 1 API calls: AccessDenied', lines)
+        self.assertIn('Swept 2 targets (1 failed) with 13 API calls. Following 1 security groups '
+                      'don\'t seem to be used:', lines)
+        self.assertIn('  -  111111111111/us-east-1/sg-a', lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
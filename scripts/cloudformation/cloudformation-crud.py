@@ -3,15 +3,38 @@
 import argparse
 import boto3
 import botocore
+import concurrent.futures
+import copy
 import json
 import logging
 import os
 import sys
-import time
+import uuid
 from urllib.parse import urlparse
 
+from render import RenderError, TemplateRenderer
+from stack_catalog import StackCatalog, last_updated
+from stack_plan import ChangeSetPlanner, FingerprintCache, format_plan, stack_fingerprint
+from stack_waiter import StackWaiter, StackWaitError
+from validate_templates import format_finding, load_document, validate_definition
+
 cfn = boto3.client('cloudformation')
 
+logger = logging.getLogger(os.path.splitext(os.path.basename(__file__))[0])
+
+# Follows every stack operation in progress from one polling loop
+waiter = StackWaiter(cfn, logger)
+
+# Stacks as listed once per run, and their outputs, cached between runs
+catalog = StackCatalog(cfn)
+
+# Creates the change sets of a plan, called from several threads at a time
+planner = ChangeSetPlanner(cfn)
+
+
+class StackError(Exception):
+    """A stack that could not be created, updated or deleted; the message says why."""
+
 
 def add_dict_to_parameters(parameter_dict, current_parameters=None, multiple_parameter_values=None):
     if current_parameters is None:
@@ -49,111 +72,36 @@ def add_dict_to_parameters(parameter_dict, current_parameters=None, multiple_par
     return ()
 
 
-def add_outputs_to_parameters(stack_name, parameter_values, multiple_parameter_values):
+def describe_stack(stack_name):
+    """Returns the stack as described by CloudFormation, recording its outputs in the catalog."""
+    _stack = cfn.describe_stacks(StackName=stack_name)['Stacks'][0]
+    catalog.put(stack_name, _stack.get('Outputs', []), last_updated(_stack))
+    return _stack
+
+
+def get_stack_outputs(stack_name):
+    return describe_stack(stack_name).get('Outputs', [])
+
+
+def add_outputs_to_parameters(stack_name, parameter_values, multiple_parameter_values, outputs=None):
     logger.debug("add_outputs_to_parameters - begin")
-    _describe_stacks = cfn.describe_stacks(StackName=stack_name)
-    if 'Outputs' in _describe_stacks['Stacks'][0]:
-        for parameter in _describe_stacks['Stacks'][0]['Outputs']:
-            add_dict_to_parameters(parameter, parameter_values, multiple_parameter_values)
+    if outputs is None:
+        outputs = get_stack_outputs(stack_name)
+    for parameter in outputs:
+        add_dict_to_parameters(parameter, parameter_values, multiple_parameter_values)
     logger.debug("add_outputs_to_parameters - done")
 
 
-def get_completed_stacks():
-    logger.debug("get_completed_stacks - begin")
-    _cfn_good_completed_states = ['CREATE_COMPLETE', 'ROLLBACK_COMPLETE', 'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE']
-    _completed_stack_names = []
-
-    # "Do-While"
-    _complete_stacks = cfn.list_stacks(StackStatusFilter=_cfn_good_completed_states)
-    for _stack in _complete_stacks['StackSummaries']:
-        _completed_stack_names.append(_stack['StackName'])
-    while 'NextToken' in _complete_stacks:
-        _complete_stacks = cfn.list_stacks(StackStatusFilter=_cfn_good_completed_states,
-                                           NextToken=_complete_stacks['NextToken'])
-        for _stack in _complete_stacks['StackSummaries']:
-            _completed_stack_names.append(_stack['StackName'])
-
-    logger.debug("Completed Stacks: " + ', '.join(_completed_stack_names))
-    logger.debug("get_completed_stacks - done")
-    return _completed_stack_names
-
-
-def get_active_stacks():
-    logger.debug("get_active_stacks - begin")
-    _cfn_active_states = ['CREATE_IN_PROGRESS', 'CREATE_FAILED', 'CREATE_COMPLETE', 'ROLLBACK_IN_PROGRESS',
-                          'ROLLBACK_FAILED', 'ROLLBACK_COMPLETE', 'DELETE_IN_PROGRESS', 'DELETE_FAILED',
-                          'UPDATE_IN_PROGRESS', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_COMPLETE',
-                          'UPDATE_ROLLBACK_IN_PROGRESS', 'UPDATE_ROLLBACK_FAILED',
-                          'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_ROLLBACK_COMPLETE']
-    _active_stack_names = []
-
-    # "Do-While"
-    _active_stacks = cfn.list_stacks(StackStatusFilter=_cfn_active_states)
-    for _stack in _active_stacks['StackSummaries']:
-        _active_stack_names.append(_stack['StackName'])
-    while 'NextToken' in _active_stacks:
-        _active_stacks = cfn.list_stacks(StackStatusFilter=_cfn_active_states, NextToken=_active_stacks['NextToken'])
-        for _stack in _active_stacks['StackSummaries']:
-            _active_stack_names.append(_stack['StackName'])
-
-    logger.debug("Active Stacks: " + ', '.join(_active_stack_names))
-    logger.debug("get_active_stacks - done")
-    return _active_stack_names
-
-
-# Main
-
-# Arguments
-parser = argparse.ArgumentParser(description='Create, Read, Update, and Delete CloudFormation stacks')
-parser.add_argument('-f', '--definition-file', action='store', dest='definition_file', required=False,
-                    help='Definition file identifying stacks to create, read, update, and delete')
-loglevel_group = parser.add_mutually_exclusive_group()
-loglevel_group.add_argument('-d', '--debug', action="store_const", dest="loglevel", const=logging.DEBUG,
-                            help="Set log level to debug",
-                            default=logging.INFO)
-loglevel_group.add_argument('-v', '--verbose', action="store_const", dest="loglevel", const=logging.INFO,
-                            help="Set log level to verbose")
-args = parser.parse_args()
-
-# Initialize
-with open(args.definition_file) as cd_file:
-    product_definition = json.load(cd_file)
-
-# Set up logging
-logger = logging.getLogger(os.path.splitext(os.path.basename(__file__))[0])
-logger.setLevel(logging.DEBUG)
-# create file handler which logs even debug messages
-fh = logging.FileHandler(os.path.splitext(os.path.basename(__file__))[0] + ".log")
-fh.setLevel(logging.DEBUG)
-# create console handler with a higher log level
-ch = logging.StreamHandler()
-ch.setLevel(level=args.loglevel)
-# create formatter and add it to the handlers
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-ch.setFormatter(formatter)
-fh.setFormatter(formatter)
-# add the handlers to logger
-logger.addHandler(ch)
-logger.addHandler(fh)
-
-logger.debug("Starting script: " + str(os.path.basename(__file__)))
-logger.debug("Arguments are %s" % (args))
-
-# Get CloudFormation Parameters
-parameter_values = {}
-multiple_parameter_values = {}
-
-# Get CloudFormation Stacks
-completed_stack_names = get_completed_stacks()
-active_stack_names = get_active_stacks()
-
-if 'Parameters' in product_definition:
+def load_parameters(product_definition, parameter_values, multiple_parameter_values):
+    """Adds the parameters of the definition's Files, ExistingStacks and KeyValuePairs to parameter_values."""
+    if 'Parameters' not in product_definition:
+        return
+
     # Files
     if 'Files' in product_definition['Parameters']:
         for i in range(len(product_definition['Parameters']['Files'])):
             if len(product_definition['Parameters']['Files'][i]) != 1:
-                logger.critical("Invalid format: Only one object (parameter file) allowed per array element.")
-                sys.exit(1)
+                raise StackError("Invalid format: Only one object (parameter file) allowed per array element.")
             for key in product_definition['Parameters']['Files'][i]:
                 parameter_file_path = urlparse(
                     product_definition['Parameters']['Files'][i][key]['Properties']['Path']).path
@@ -163,177 +111,669 @@ if 'Parameters' in product_definition:
 
     # Existing Stacks
     if 'ExistingStacks' in product_definition['Parameters']:
+        _existing_stack_names = []
         for i in range(len(product_definition['Parameters']['ExistingStacks'])):
             if len(product_definition['Parameters']['ExistingStacks'][i]) != 1:
-                logger.critical("Invalid format: Only one object (existing stack) allowed per array element.")
-                sys.exit(1)
-            for parameter_stack in product_definition['Parameters']['ExistingStacks'][i]:
-                try:
-                    existing_stack_description = cfn.describe_stacks(StackName=parameter_stack)
-                except botocore.exceptions.ClientError as e:
-                    if e.response['Error']['Code'] == 'ValidationError':
-                        logger.error("Validation Error: " + e.response['Error']['Message'])
-                    continue
-                if 'Outputs' in existing_stack_description['Stacks'][0]:
-                    for parameter in existing_stack_description['Stacks'][0]['Outputs']:
-                        add_dict_to_parameters(parameter, parameter_values, multiple_parameter_values)
+                raise StackError("Invalid format: Only one object (existing stack) allowed per array element.")
+            _existing_stack_names.extend(product_definition['Parameters']['ExistingStacks'][i])
+        # Fetched all at once, then added in definition order
+        _existing_stack_outputs, _errors = catalog.outputs(_existing_stack_names)
+        for parameter_stack in _existing_stack_names:
+            if parameter_stack in _errors:
+                logger.error("Could not read the outputs of stack %s: %s" % (parameter_stack, _errors[parameter_stack]))
+                continue
+            for parameter in _existing_stack_outputs[parameter_stack]:
+                add_dict_to_parameters(parameter, parameter_values, multiple_parameter_values)
 
     # Key/Value Pairs
     if 'KeyValuePairs' in product_definition['Parameters']:
         for parameter in product_definition['Parameters']['KeyValuePairs']:
             add_dict_to_parameters(parameter, parameter_values, multiple_parameter_values)
 
-# Create/update the stacks
-if 'StacksToCreateOrUpdate' in product_definition:
-    for stack in product_definition['StacksToCreateOrUpdate']:
+
+def load_template(template_file_name):
+    """Returns the template as a string, as sent to CloudFormation, and parsed."""
+    # YAML templates are parsed with the short form intrinsic functions (!Ref, !Sub, ...) the validator reads
+    return load_document(os.path.expanduser(template_file_name))
+
+
+def load_render_variables(render, variable_files):
+    """Returns the variables of a Render property: its VariableFiles, in order, then its Variables."""
+    _variables = {}
+    for _path in render.get('VariableFiles', []):
+        _path = os.path.expanduser(urlparse(_path).path)
+        if _path not in variable_files:
+            with open(_path) as f:
+                variable_files[_path] = json.load(f)
+        # Parameter files work as well as plain objects
+        if isinstance(variable_files[_path], list):
+            for parameter in variable_files[_path]:
+                _variables[parameter['ParameterKey']] = parameter['ParameterValue']
+        else:
+            _variables.update(variable_files[_path])
+    _variables.update(render.get('Variables', {}))
+    return _variables
+
+
+def render_templates(stacks, cache_directory=None):
+    """
+    Renders the Template of each stack with a Render property from its Source, a Jinja2 template that includes
+    snippets found in its SearchPath. Templates whose source, snippets and variables did not change are not rendered.
+    """
+    _renders = [(stack_name, properties) for stack_name, properties in stacks if 'Render' in properties]
+    if not _renders:
+        return
+    try:
+        _renderer = TemplateRenderer(cache_directory)
+    except RenderError as e:
+        raise StackError(str(e))
+    _variable_files = {}
+    _rendered = 0
+    for stack_name, properties in _renders:
+        _render = properties['Render']
+        try:
+            if _renderer.render(os.path.expanduser(urlparse(_render['Source']).path),
+                                os.path.expanduser(urlparse(properties['Template']).path),
+                                load_render_variables(_render, _variable_files),
+                                [os.path.expanduser(urlparse(_path).path) for _path in _render.get('SearchPath', [])]):
+                logger.info("Rendered the template of stack %s." % stack_name)
+                _rendered += 1
+            else:
+                logger.debug("Template of stack %s is up to date." % stack_name)
+        except RenderError as e:
+            raise StackError("Could not render the template of stack %s: %s" % (stack_name, e))
+    logger.info("Rendered %d of %d templates." % (_rendered, len(_renders)))
+    try:
+        _renderer.save()
+    except OSError as e:
+        logger.warning("Could not save the render cache to %s: %s" % (cache_directory, e))
+
+
+def validate_stacks(product_definition, definition_file):
+    """Checks the templates of the stacks, and the parameters the definition gives them, without calling AWS."""
+    _errors = 0
+    for finding in validate_definition(product_definition, definition_file):
+        if finding.severity == 'error':
+            logger.error(format_finding(finding))
+            _errors += 1
+        else:
+            logger.warning(format_finding(finding))
+    if _errors:
+        raise StackError("Found %d problems in the templates or their parameters." % _errors)
+
+
+def get_stacks_to_create_or_update(product_definition):
+    """Returns (stack name, properties) of StacksToCreateOrUpdate, in definition order."""
+    _stacks = []
+    for stack in product_definition.get('StacksToCreateOrUpdate', []):
         for stack_name in stack:
-            logger.info("Working on creating/updating stack: %s" % stack_name)
-            stack_parameters = []
-            stack_missing_parameters = []
-            template_file_name = urlparse(stack[stack_name]['Properties']['Template']).path
-
-            # Read the file into a variable
-            with open(os.path.expanduser(template_file_name), 'r') as f:
-                template_body_string = f.read()
-            # Convert to json taking extra step if file was .yml
-            if template_file_name.endswith('.yml'):
-                # template_body_json = json.loads(json.dumps(yaml.load(template_body_string), sort_keys=True, indent=2))
-                template_body_json = yaml.load(template_body_string)
+            _stacks.append((stack_name, stack[stack_name]['Properties']))
+    return _stacks
+
+
+def get_stack_dependencies(stacks, templates):
+    """
+    Returns stack name -> names of the stacks it has to wait for.
+
+    A stack depends on the stacks before it in the definition whose outputs are added to the parameters and
+    include one of its template parameters, and on the stacks listed in its DependsOn property. A stack whose
+    outputs include a parameter of a stack before it also waits for that stack, so the earlier stack reads that
+    parameter before the output is added, as it would when the stacks are deployed one at a time.
+    """
+    _dependencies = {}
+    _outputs = {}
+    _parameters = {}
+    _stack_names = set(stack_name for stack_name, properties in stacks)
+    for stack_name, properties in stacks:
+        _template_parameters = set(templates[stack_name][1].get('Parameters', {}))
+        _dependencies[stack_name] = set(_producer for _producer, _output_keys in _outputs.items()
+                                        if _output_keys & _template_parameters)
+        for _depends_on in properties.get('DependsOn', []):
+            if _depends_on not in _stack_names:
+                raise StackError("Stack %s depends on %s, which is not in StacksToCreateOrUpdate" % (
+                    stack_name, _depends_on))
+            _dependencies[stack_name].add(_depends_on)
+        if properties.get('AddOutputsToParameters', True) != False:
+            _outputs[stack_name] = set(templates[stack_name][1].get('Outputs', {}))
+            _dependencies[stack_name].update(_reader for _reader, _parameter_keys in _parameters.items()
+                                             if _parameter_keys & _outputs[stack_name])
+        _parameters[stack_name] = _template_parameters
+
+    # Explicit dependencies may point forward; make sure they cannot deadlock
+    _visiting = set()
+    _visited = set()
+
+    def visit(name, path):
+        if name in _visiting:
+            raise StackError("Stacks depend on each other: " + ' -> '.join(path + [name]))
+        if name in _visited:
+            return
+        _visiting.add(name)
+        for _dependency in sorted(_dependencies[name]):
+            visit(_dependency, path + [name])
+        _visiting.discard(name)
+        _visited.add(name)
+    for stack_name, properties in stacks:
+        visit(stack_name, [])
+    return _dependencies
+
+
+def get_stack_order(stacks, dependencies):
+    """Returns the stack names in definition order, except that each comes after the stacks it depends on."""
+    _index = dict((stack_name, i) for i, (stack_name, properties) in enumerate(stacks))
+    _order = []
+    _placed = set()
+
+    def place(name):
+        if name in _placed:
+            return
+        _placed.add(name)
+        for _dependency in sorted(dependencies[name], key=_index.get):
+            place(_dependency)
+        _order.append(name)
+    for stack_name, properties in stacks:
+        place(stack_name)
+    return _order
+
+
+def get_stack_parameters(stack_name, template_body_json, parameter_values):
+    """Returns the stack's parameters, from parameter_values or the template defaults."""
+    stack_parameters = []
+    stack_missing_parameters = []
+    if 'Parameters' in template_body_json:
+        for parameter in template_body_json['Parameters']:
+            if parameter in parameter_values.keys():
+                stack_parameters.append(
+                    {'ParameterKey': parameter, 'ParameterValue': parameter_values[parameter]})
+            elif 'Default' in template_body_json['Parameters'][parameter]:
+                logger.debug("Using the default parameter value")
+                stack_parameters.append({'ParameterKey': parameter,
+                                         'ParameterValue': template_body_json['Parameters'][parameter][
+                                             'Default']})
             else:
-                template_body_json = json.loads(template_body_string)
-
-            if 'Capabilities' in stack[stack_name]['Properties']:
-                stack_capabilities = stack[stack_name]['Properties']['Capabilities']
+                stack_missing_parameters.append(parameter)
+    logger.debug("Parameter values: " + json.dumps(stack_parameters))
+    if len(stack_missing_parameters) != 0:
+        raise StackError("Missing parameters of stack %s: %s" % (stack_name, ', '.join(stack_missing_parameters)))
+    return stack_parameters
+
+
+def create_or_update_stack(stack_name, properties, template_body_string, stack_parameters, completed_stack_names,
+                           active_stack_names):
+    """
+    Starts creating or updating the stack; returns the operation (CREATE or UPDATE) and the client request token
+    its events carry, or None when there is nothing to update.
+    """
+    stack_capabilities = properties.get('Capabilities', [])
+    disable_rollback = properties.get('DisableRollback', False)
+    client_request_token = str(uuid.uuid4())
+
+    if stack_name in completed_stack_names:
+        logger.info("Stack %s is in a completed state. Starting update." % stack_name)
+        try:
+            cfn.update_stack(
+                StackName=stack_name,
+                TemplateBody=template_body_string,
+                Parameters=stack_parameters,
+                Capabilities=stack_capabilities,
+                ClientRequestToken=client_request_token
+            )
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Message'] == 'No updates are to be performed.':
+                logger.info("No updates are to be performed on stack %s." % stack_name)
+                return None
+            elif e.response['Error']['Code'] == 'ValidationError':
+                raise StackError("Validation error: " + e.response['Error']['Message'])
             else:
-                stack_capabilities = []
+                raise StackError("Unexpected ClientError: " + e.response['Error']['Message'])
+        return 'UPDATE', client_request_token
 
-            if 'DisableRollback' in stack[stack_name]['Properties']:
-                disable_rollback = stack[stack_name]['Properties']['DisableRollback']
-            else:
-                disable_rollback = False
-
-            if 'Parameters' in template_body_json:
-                for parameter in template_body_json['Parameters']:
-                    if parameter in parameter_values.keys():
-                        stack_parameters.append(
-                            {'ParameterKey': parameter, 'ParameterValue': parameter_values[parameter]})
-                    elif 'Default' in template_body_json['Parameters'][parameter]:
-                        logger.debug("Using the default parameter value")
-                        stack_parameters.append({'ParameterKey': parameter,
-                                                 'ParameterValue': template_body_json['Parameters'][parameter][
-                                                     'Default']})
-                    else:
-                        stack_missing_parameters.append(parameter)
-            logger.debug("Parameter values: " + json.dumps(stack_parameters))
-            if len(stack_missing_parameters) != 0:
-                logger.critical("Missing parameters: " + ', '.join(stack_missing_parameters))
-                exit(1)
-
-            if stack_name in completed_stack_names:
-                logger.info("Stack %s is in a completed state. Starting update." % stack_name)
-                try:
-                    response = cfn.update_stack(
-                        StackName=stack_name,
-                        TemplateBody=template_body_string,
-                        Parameters=stack_parameters,
-                        Capabilities=stack_capabilities
-                    )
-                except botocore.exceptions.ClientError as e:
-                    if e.response['Error']['Message'] == 'No updates are to be performed.':
-                        logger.info("No updates are to be performed.")
-                    elif e.response['Error']['Code'] == 'ValidationError':
-                        logger.critical("Validation error: " + e.response['Error']['Message'])
-                        exit(1)
-                    else:
-                        logger.critical("Unexpected ClientError: " + e.response['Error']['Message'])
-                        exit(1)
-
-            elif stack_name in active_stack_names:
-                logger.critical("Stack %s is active, but not in a completed state." % stack_name)
-                exit(1)
+    elif stack_name in active_stack_names:
+        raise StackError("Stack %s is active, but not in a completed state." % stack_name)
 
+    else:
+        logger.info("Stack %s does not exist. Starting create." % stack_name)
+        try:
+            cfn.create_stack(
+                StackName=stack_name,
+                TemplateBody=template_body_string,
+                Parameters=stack_parameters,
+                Capabilities=stack_capabilities,
+                DisableRollback=disable_rollback,
+                ClientRequestToken=client_request_token
+            )
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'ValidationError':
+                raise StackError("Validation error: " + e.response['Error']['Message'])
             else:
-                logger.info("Stack %s does not exist. Starting create." % stack_name)
-                try:
-                    response = cfn.create_stack(
-                        StackName=stack_name,
-                        TemplateBody=template_body_string,
-                        Parameters=stack_parameters,
-                        Capabilities=stack_capabilities,
-                        DisableRollback=disable_rollback
-                    )
-                except botocore.exceptions.ClientError as e:
-                    if e.response['Error']['Code'] == 'ValidationError':
-                        logger.critical("Validation error: " + e.response['Error']['Message'])
-                        exit(1)
-                    else:
-                        logger.critical("Unexpected ClientError: " + e.response['Error']['Message'])
-                        exit(1)
-                active_stack_names.append(stack_name)
-
+                raise StackError("Unexpected ClientError: " + e.response['Error']['Message'])
+        return 'CREATE', client_request_token
+
+
+def wait_for_stack(stack_name, operation, client_request_token):
+    try:
+        status = waiter.wait(stack_name, operation, client_request_token)
+    except StackWaitError as e:
+        raise StackError(str(e))
+    except botocore.exceptions.ClientError as e:
+        raise StackError("Unexpected ClientError: " + e.response['Error']['Message'])
+    except botocore.exceptions.BotoCoreError as e:
+        raise StackError("Could not follow stack %s: %s" % (stack_name, e))
+    logger.info("Stack %s has reached %s." % (stack_name, status))
+
+
+def create_change_set(stack_name, properties, template_body_string, stack_parameters, change_set_type, fingerprint):
+    """Creates a change set of the stack and waits until it is ready; returns the PlannedChangeSet."""
+    logger.info("Creating %s change set of stack %s." % (change_set_type, stack_name))
+    try:
+        change_set = planner.create(stack_name, change_set_type, template_body_string, stack_parameters,
+                                    properties.get('Capabilities', []), fingerprint)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == 'ValidationError':
+            raise StackError("Validation error: " + e.response['Error']['Message'])
+        else:
+            raise StackError("Unexpected ClientError: " + e.response['Error']['Message'])
+    if change_set.status == 'FAILED' and not change_set.no_changes:
+        discard_change_sets({stack_name: change_set})
+        raise StackError("Change set of stack %s failed: %s" % (stack_name, change_set.reason))
+    return change_set
+
+
+def discard_change_sets(change_sets, keep_stack=False):
+    """Deletes the change sets that were not executed, along with stacks that only exist for them."""
+    for stack_name, change_set in change_sets.items():
+        if change_set.executed or change_set.discarded:
+            continue
+        logger.debug("Deleting change set %s of stack %s" % (change_set.change_set_name, stack_name))
+        try:
+            planner.discard(change_set, keep_stack)
+        except botocore.exceptions.ClientError as e:
+            logger.warning("Could not delete change set %s of stack %s: %s" % (
+                change_set.change_set_name, stack_name, e.response['Error']['Message']))
+
+
+def execute_change_set(stack_name, properties, template_body_string, stack_parameters, completed_stack_names,
+                       active_stack_names, fingerprint, change_set=None):
+    """
+    Starts executing the stack's planned change set, or a new one when it was not planned or its template or
+    parameters changed since; returns the operation and client request token, or None when there is nothing to change.
+    """
+    if change_set is not None and change_set.fingerprint != fingerprint:
+        logger.warning("Stack %s changed since it was planned. Creating a new change set." % stack_name)
+        discard_change_sets({stack_name: change_set}, keep_stack=True)
+        change_set = None
+    if change_set is None:
+        if stack_name in active_stack_names and stack_name not in completed_stack_names:
+            raise StackError("Stack %s is active, but not in a completed state." % stack_name)
+        change_set = create_change_set(stack_name, properties, template_body_string, stack_parameters,
+                                       'UPDATE' if stack_name in completed_stack_names else 'CREATE', fingerprint)
+        for line in change_set.lines():
+            logger.info("Stack %s: %s" % (stack_name, line))
+    if not change_set.has_changes:
+        logger.info("No updates are to be performed on stack %s." % stack_name)
+        return None
+
+    logger.info("Executing change set %s of stack %s." % (change_set.change_set_name, stack_name))
+    disable_rollback = change_set.change_set_type == 'CREATE' and properties.get('DisableRollback', False)
+    try:
+        client_request_token = planner.execute(change_set, disable_rollback)
+    except botocore.exceptions.ClientError as e:
+        raise StackError("Unexpected ClientError: " + e.response['Error']['Message'])
+    return change_set.change_set_type, client_request_token
+
+
+def deploy_stack(stack_name, properties, template_body_string, stack_parameters, completed_stack_names,
+                 active_stack_names, fingerprint=None, change_sets=None):
+    """
+    Creates or updates the stack and waits for it; returns its outputs to add to the parameters, if any, and when
+    CloudFormation last updated it.
+
+    With change_sets, stack name -> planned change set, the stack is changed through a change set instead.
+    """
+    if change_sets is not None:
+        started = execute_change_set(stack_name, properties, template_body_string, stack_parameters,
+                                     completed_stack_names, active_stack_names, fingerprint,
+                                     change_sets.get(stack_name))
+    else:
+        started = create_or_update_stack(stack_name, properties, template_body_string, stack_parameters,
+                                         completed_stack_names, active_stack_names)
+    if started is not None:
+        wait_for_stack(stack_name, *started)
+    _stack = describe_stack(stack_name)
+    if properties.get('AddOutputsToParameters', True) == False:
+        logger.debug("Do not add stack outputs to parameters")
+        return [], last_updated(_stack)
+    logger.debug("Add stack outputs to parameters")
+    return _stack.get('Outputs', []), last_updated(_stack)
+
+
+def save_fingerprints(fingerprints):
+    try:
+        fingerprints.save()
+    except OSError as e:
+        logger.warning("Could not save stack fingerprints to %s: %s" % (fingerprints.path, e))
+
+
+def create_or_update_stacks(stacks, templates, parameter_values, multiple_parameter_values, completed_stack_names,
+                            active_stack_names, parallelism=4, fingerprints=None, change_sets=None):
+    """
+    Creates or updates the stacks, up to parallelism at a time, each once the stacks it depends on are done.
+
+    Parameters are resolved when a stack starts, after the outputs of every stack it depends on were added.
+    After a failure no more stacks are started; the ones in progress are waited for, then StackError is raised.
+    A stack whose fingerprint matches the one in fingerprints, and that CloudFormation did not update since it was
+    last deployed from here, is skipped without calling CloudFormation. With change_sets, stacks are changed
+    through change sets.
+    """
+    _dependencies = get_stack_dependencies(stacks, templates)
+    for stack_name, properties in stacks:
+        if _dependencies[stack_name]:
+            logger.debug("Stack %s waits for: %s" % (stack_name, ', '.join(sorted(_dependencies[stack_name]))))
+    _properties = dict(stacks)
+    _order = [stack_name for stack_name, properties in stacks]
+    _done = set()
+    _failures = []
+    _running = {}
+    _fingerprints = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallelism) as executor:
         while True:
-            stack_events = cfn.describe_stack_events(StackName=stack_name)
-            stack_resource_type = stack_events['StackEvents'][0]['ResourceType']
-            stack_resource_status = stack_events['StackEvents'][0]['ResourceStatus']
-            if stack_resource_type == 'AWS::CloudFormation::Stack' \
-                    and stack_resource_status in ['CREATE_COMPLETE', 'UPDATE_COMPLETE']:
-                logger.info("Stack %s has been created/updated." % stack_name)
-                if 'AddOutputsToParameters' in stack[stack_name]['Properties'] \
-                        and stack[stack_name]['Properties']['AddOutputsToParameters'] == False:
-                    logger.debug("Do not add stack outputs to parameters")
-                    break
-                else:
-                    logger.debug("Add stack outputs to parameters")
-                    add_outputs_to_parameters(stack_name, parameter_values, multiple_parameter_values)
+            _skipped = False
+            if not _failures:
+                _ready = [stack_name for stack_name in _order if stack_name not in _done
+                          and stack_name not in _running.values() and _dependencies[stack_name] <= _done]
+                for stack_name in _ready:
+                    if len(_running) >= parallelism:
+                        break
+                    logger.info("Working on creating/updating stack: %s" % stack_name)
+                    properties = _properties[stack_name]
+                    try:
+                        stack_parameters = get_stack_parameters(stack_name, templates[stack_name][1],
+                                                                parameter_values)
+                    except StackError as e:
+                        logger.critical(str(e))
+                        _failures.append(stack_name)
+                        break
+                    _fingerprints[stack_name] = stack_fingerprint(templates[stack_name][0], stack_parameters,
+                                                                  properties.get('Capabilities', []))
+                    _add_outputs = properties.get('AddOutputsToParameters', True) != False
+                    if fingerprints is not None and stack_name in completed_stack_names and \
+                            fingerprints.matches(stack_name, _fingerprints[stack_name],
+                                                 catalog.last_updated(stack_name), _add_outputs):
+                        logger.info("Stack %s did not change since it was last deployed." % stack_name)
+                        if _add_outputs:
+                            add_outputs_to_parameters(stack_name, parameter_values, multiple_parameter_values,
+                                                      fingerprints.outputs(stack_name))
+                        _done.add(stack_name)
+                        _skipped = True
+                        continue
+                    _future = executor.submit(deploy_stack, stack_name, properties, templates[stack_name][0],
+                                              stack_parameters, completed_stack_names, active_stack_names,
+                                              _fingerprints[stack_name], change_sets)
+                    _running[_future] = stack_name
+            if _skipped:
+                # Skipped stacks may have made others ready
+                continue
+            if not _running:
                 break
-            elif stack_resource_type == 'AWS::CloudFormation::Stack' \
-                    and stack_resource_status in ['CREATE_FAILED', 'ROLLBACK_FAILED', 'ROLLBACK_COMPLETE',
-                                                  'UPDATE_ROLLBACK_FAILED', 'UPDATE_ROLLBACK_COMPLETE']:
-                logger.critical("Stack failed to create or update.")
-                exit(1)
-            else:
-                logger.debug("Waiting for stack to complete operations")
-            time.sleep(5)
-
-if 'StacksToDelete' in product_definition:
-    for stack in product_definition['StacksToDelete']:
+            _finished, _ = concurrent.futures.wait(_running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for _future in _finished:
+                stack_name = _running.pop(_future)
+                try:
+                    _outputs, _last_updated = _future.result()
+                except StackError as e:
+                    logger.critical(str(e))
+                    _failures.append(stack_name)
+                    continue
+                if stack_name not in completed_stack_names:
+                    active_stack_names.append(stack_name)
+                add_outputs_to_parameters(stack_name, parameter_values, multiple_parameter_values, _outputs)
+                _done.add(stack_name)
+                if fingerprints is not None:
+                    _add_outputs = _properties[stack_name].get('AddOutputsToParameters', True) != False
+                    fingerprints.put(stack_name, _fingerprints[stack_name], _last_updated,
+                                     _outputs if _add_outputs else None)
+                    save_fingerprints(fingerprints)
+    if _failures:
+        raise StackError("Stopped after stacks failed: " + ', '.join(_failures))
+
+
+def plan_stacks(stacks, templates, parameter_values, multiple_parameter_values, completed_stack_names,
+                active_stack_names, fingerprints, parallelism=4, deletes=()):
+    """
+    Creates a change set of every stack that changed, up to parallelism at a time, and prints them as one plan.
+
+    Parameters are resolved as they would be when deploying, from the outputs the stacks that exist have now.
+    Stacks whose fingerprint matches get no change set, and stacks that need outputs of stacks that do not exist
+    yet cannot be planned. Returns stack name -> PlannedChangeSet; raises StackError, after deleting the change
+    sets, when a stack could not be planned.
+    """
+    _dependencies = get_stack_dependencies(stacks, templates)
+    _properties = dict(stacks)
+    _order = get_stack_order(stacks, _dependencies)
+    # Planning must not change the parameters the deployment starts with
+    _parameter_values = dict(parameter_values)
+    _multiple_parameter_values = copy.deepcopy(multiple_parameter_values)
+    _unknown_outputs = set()
+    _unchanged = []
+    _pending = {}
+    _failed = {}
+    _to_plan = []
+    _outputs = {}
+    for stack_name in _order:
+        properties = _properties[stack_name]
+        _add_outputs = properties.get('AddOutputsToParameters', True) != False
+        _waiting_for = [name for name in _order if name in _dependencies[stack_name] & _unknown_outputs]
+        if _waiting_for:
+            _pending[stack_name] = _waiting_for
+            _unknown_outputs.add(stack_name)
+            continue
+        try:
+            if stack_name in active_stack_names and stack_name not in completed_stack_names:
+                raise StackError("Stack %s is active, but not in a completed state." % stack_name)
+            stack_parameters = get_stack_parameters(stack_name, templates[stack_name][1], _parameter_values)
+        except StackError as e:
+            _failed[stack_name] = str(e)
+            _unknown_outputs.add(stack_name)
+            continue
+        _fingerprint = stack_fingerprint(templates[stack_name][0], stack_parameters,
+                                         properties.get('Capabilities', []))
+        if stack_name not in completed_stack_names:
+            _to_plan.append((stack_name, 'CREATE', stack_parameters, _fingerprint))
+            if _add_outputs:
+                _unknown_outputs.add(stack_name)
+            continue
+        if fingerprints.matches(stack_name, _fingerprint, catalog.last_updated(stack_name), _add_outputs):
+            _unchanged.append(stack_name)
+            _outputs[stack_name] = fingerprints.outputs(stack_name)
+        else:
+            _to_plan.append((stack_name, 'UPDATE', stack_parameters, _fingerprint))
+            _outputs[stack_name] = get_stack_outputs(stack_name) if _add_outputs else None
+        if _add_outputs:
+            add_outputs_to_parameters(stack_name, _parameter_values, _multiple_parameter_values,
+                                      _outputs[stack_name])
+
+    _change_sets = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallelism) as executor:
+        _futures = {}
+        for stack_name, change_set_type, stack_parameters, _fingerprint in _to_plan:
+            _future = executor.submit(create_change_set, stack_name, _properties[stack_name],
+                                      templates[stack_name][0], stack_parameters, change_set_type, _fingerprint)
+            _futures[_future] = stack_name
+        for _future in concurrent.futures.as_completed(_futures):
+            stack_name = _futures[_future]
+            try:
+                _change_sets[stack_name] = _future.result()
+            except StackError as e:
+                _failed[stack_name] = str(e)
+    for stack_name, change_set in _change_sets.items():
+        if change_set.no_changes:
+            # Nothing to change: the stack is as deployed with this fingerprint
+            fingerprints.put(stack_name, change_set.fingerprint, catalog.last_updated(stack_name), _outputs[stack_name])
+    save_fingerprints(fingerprints)
+
+    print(format_plan(_order, _change_sets, _unchanged, _pending, _failed, deletes))
+    if _failed:
+        discard_change_sets(_change_sets)
+        raise StackError("Could not plan stacks: " + ', '.join(name for name in _order if name in _failed))
+    return _change_sets
+
+
+def get_stacks_to_delete(product_definition, completed_stack_names, active_stack_names):
+    """Returns the names of the StacksToDelete that exist."""
+    return [stack_name for stack in product_definition.get('StacksToDelete', []) for stack_name in stack
+            if stack_name in active_stack_names or stack_name in completed_stack_names]
+
+
+def delete_stacks(product_definition, completed_stack_names, active_stack_names, fingerprints=None):
+    for stack in product_definition.get('StacksToDelete', []):
         for stack_name in stack:
             logger.info("Working on deleting stack: %s" % stack_name)
             if stack_name in active_stack_names or stack_name in completed_stack_names:
                 logger.debug("Stack %s exists... sending delete command." % stack_name)
+                client_request_token = str(uuid.uuid4())
                 try:
-                    response = cfn.delete_stack(
-                        StackName=stack_name
+                    cfn.delete_stack(
+                        StackName=stack_name,
+                        ClientRequestToken=client_request_token
                     )
                 except botocore.exceptions.ClientError as e:
-                    logger.critical("Unexpected ClientError: " + e)
-                    exit(1)
+                    raise StackError("Unexpected ClientError: " + e.response['Error']['Message'])
             else:
                 logger.info("Stack %s does not exist." % stack_name)
-                break
-
-            while True:
-                try:
-                    stack_events = cfn.describe_stack_events(StackName=stack_name)
-                    stack_resource_type = stack_events['StackEvents'][0]['ResourceType']
-                    stack_resource_status = stack_events['StackEvents'][0]['ResourceStatus']
-                    if stack_resource_type == 'AWS::CloudFormation::Stack' and stack_resource_status in [
-                        'DELETE_COMPLETE']:
-                        logger.debug("Stack deleted.")
-                        break
-                    elif stack_resource_type == 'AWS::CloudFormation::Stack' and stack_resource_status in [
-                        'DELETE_FAILED']:
-                        logger.critical("Stack failed to delete.")
-                        exit(1)
-                    else:
-                        logger.debug("Waiting for stack to complete deleting")
-                    time.sleep(5)
-                except botocore.exceptions.ClientError as e:
-                    if e.response['Error']['Code'] == 'ValidationError':
-                        logger.info("Stack %s has been deleted." % stack_name)
-                        break
-                    else:
-                        logger.critical("Unexpected ClientError: " + e)
-                        exit(1)
-
-logger.debug("Finished script: " + str(os.path.basename(__file__)))
+                continue
+
+            wait_for_stack(stack_name, 'DELETE', client_request_token)
+            catalog.forget(stack_name)
+            if fingerprints is not None:
+                fingerprints.remove(stack_name)
+                save_fingerprints(fingerprints)
+
+
+def main():
+    # Arguments
+    parser = argparse.ArgumentParser(description='Create, Read, Update, and Delete CloudFormation stacks')
+    parser.add_argument('-f', '--definition-file', action='store', dest='definition_file', required=False,
+                        help='Definition file identifying stacks to create, read, update, and delete')
+    parser.add_argument('-p', '--parallelism', action='store', dest='parallelism', type=int, default=4,
+                        help='Maximum number of stacks created or updated at the same time')
+    parser.add_argument('--plan', action='store_true', dest='plan',
+                        help='Print the changes that creating/updating the stacks would make, from change sets, '
+                             'without making them')
+    parser.add_argument('--change-sets', action='store_true', dest='change_sets',
+                        help='Print the plan, then make the changes by executing its change sets')
+    parser.add_argument('--state-file', action='store', dest='state_file',
+                        default=os.path.splitext(os.path.basename(__file__))[0] + '.state.json',
+                        help='File keeping a fingerprint of every stack as last deployed; stacks whose template and '
+                             'parameters did not change since, and that CloudFormation did not update since, are '
+                             'skipped')
+    parser.add_argument('--cache-file', action='store', dest='cache_file',
+                        default=os.path.splitext(os.path.basename(__file__))[0] + '.cache.json',
+                        help='File caching the outputs of stacks between runs')
+    parser.add_argument('--cache-ttl', action='store', dest='cache_ttl', type=int, default=120,
+                        help='Seconds cached stack outputs are used for; 0 to always read them from CloudFormation')
+    parser.add_argument('--render-cache', action='store', dest='render_cache',
+                        default=os.path.splitext(os.path.basename(__file__))[0] + '.render',
+                        help='Directory keeping compiled Jinja2 templates and what each template was rendered from')
+    parser.add_argument('--render-only', action='store_true', dest='render_only',
+                        help='Render the templates of stacks with a Render property, then stop')
+    parser.add_argument('--skip-validation', action='store_true', dest='skip_validation',
+                        help='Do not check the templates and their parameters before calling CloudFormation')
+    parser.add_argument('--ignore-state', action='store_true', dest='ignore_state',
+                        help='Do not skip stacks that did not change since they were last deployed, e.g. after their '
+                             'resources were changed outside CloudFormation')
+    loglevel_group = parser.add_mutually_exclusive_group()
+    loglevel_group.add_argument('-d', '--debug', action="store_const", dest="loglevel", const=logging.DEBUG,
+                                help="Set log level to debug",
+                                default=logging.INFO)
+    loglevel_group.add_argument('-v', '--verbose', action="store_const", dest="loglevel", const=logging.INFO,
+                                help="Set log level to verbose")
+    args = parser.parse_args()
+
+    # Initialize
+    with open(args.definition_file) as cd_file:
+        product_definition = json.load(cd_file)
+
+    # Set up logging
+    logger.setLevel(logging.DEBUG)
+    # create file handler which logs even debug messages
+    fh = logging.FileHandler(os.path.splitext(os.path.basename(__file__))[0] + ".log")
+    fh.setLevel(logging.DEBUG)
+    # create console handler with a higher log level
+    ch = logging.StreamHandler()
+    ch.setLevel(level=args.loglevel)
+    # create formatter and add it to the handlers
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    ch.setFormatter(formatter)
+    fh.setFormatter(formatter)
+    # add the handlers to logger
+    logger.addHandler(ch)
+    logger.addHandler(fh)
+
+    logger.debug("Starting script: " + str(os.path.basename(__file__)))
+    logger.debug("Arguments are %s" % (args))
+
+    # Get CloudFormation Parameters
+    parameter_values = {}
+    multiple_parameter_values = {}
+
+    catalog.path = args.cache_file
+    catalog.ttl = args.cache_ttl
+    catalog.region = cfn.meta.region_name
+    try:
+        # Render templates
+        stacks = get_stacks_to_create_or_update(product_definition)
+        render_templates(stacks, args.render_cache)
+        if args.render_only:
+            return
+        if not args.skip_validation:
+            validate_stacks(product_definition, args.definition_file)
+
+        # Get CloudFormation Stacks
+        catalog.load()
+        catalog.list_stacks()
+        completed_stack_names = catalog.completed_stack_names()
+        active_stack_names = catalog.active_stack_names()
+        logger.debug("Completed Stacks: " + ', '.join(completed_stack_names))
+        logger.debug("Active Stacks: " + ', '.join(active_stack_names))
+
+        load_parameters(product_definition, parameter_values, multiple_parameter_values)
+
+        # Create/update the stacks
+        templates = dict((stack_name, load_template(urlparse(properties['Template']).path))
+                         for stack_name, properties in stacks)
+        fingerprints = FingerprintCache(args.state_file, cfn.meta.region_name)
+        if not args.ignore_state:
+            fingerprints.load()
+
+        change_sets = None
+        if args.plan or args.change_sets:
+            change_sets = plan_stacks(stacks, templates, parameter_values, multiple_parameter_values,
+                                      completed_stack_names, active_stack_names, fingerprints, args.parallelism,
+                                      get_stacks_to_delete(product_definition, completed_stack_names,
+                                                           active_stack_names))
+        if args.plan:
+            discard_change_sets(change_sets)
+        else:
+            try:
+                create_or_update_stacks(stacks, templates, parameter_values, multiple_parameter_values,
+                                        completed_stack_names, active_stack_names, args.parallelism, fingerprints,
+                                        change_sets)
+            finally:
+                if change_sets:
+                    discard_change_sets(change_sets)
+
+            delete_stacks(product_definition, completed_stack_names, active_stack_names, fingerprints)
+    except StackError as e:
+        logger.critical(str(e))
+        sys.exit(1)
+    finally:
+        try:
+            catalog.save()
+        except OSError as e:
+            logger.warning("Could not save the stack cache to %s: %s" % (catalog.path, e))
+
+    logger.debug("Finished script: " + str(os.path.basename(__file__)))
+
+
+if __name__ == '__main__':
+    main()
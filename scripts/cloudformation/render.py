@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import os
+import threading
+
+try:
+    import jinja2
+    import jinja2.meta
+except ImportError:
+    jinja2 = None
+
+from stack_catalog import save_json
+
+
+class RenderError(Exception):
+    """A template that could not be rendered; the message says why."""
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class TemplateRenderer(object):
+    """
+    Renders CloudFormation templates from Jinja2 sources that include snippets, such as cloudformation/resources.
+
+    Includes are looked up in the source's directory, then in the search path. Compiled templates are kept in a
+    Jinja2 bytecode cache under cache_directory, next to a manifest of what every output was rendered from: the
+    content hash of the source and of each snippet it includes, and the variables. An output whose inputs did not
+    change is not rendered again. The snippets a source includes are found by parsing it, once per version of each
+    file; a source that includes a computed name is always rendered. Undefined variables are errors.
+    """
+
+    def __init__(self, cache_directory=None):
+        if jinja2 is None:
+            raise RenderError("Rendering templates needs jinja2: pip install jinja2")
+        self.cache_directory = cache_directory
+        self.bytecode_cache = None
+        self.manifest_path = None
+        # output path -> {'Inputs': hash of everything it was rendered from, 'Output': hash of what was written}
+        self.outputs = {}
+        # file content hash -> names of the templates it includes, or None when it includes a computed name
+        self.includes = {}
+        if cache_directory:
+            os.makedirs(os.path.join(cache_directory, 'bytecode'), exist_ok=True)
+            self.bytecode_cache = jinja2.FileSystemBytecodeCache(os.path.join(cache_directory, 'bytecode'))
+            self.manifest_path = os.path.join(cache_directory, 'manifest.json')
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path) as f:
+                    manifest = json.load(f)
+                self.outputs = manifest.get('Outputs', {})
+                self.includes = manifest.get('Includes', {})
+        self.environments = {}
+        # path -> content hash, read once per run
+        self.hashes = {}
+        self.used = set()
+        self.lock = threading.Lock()
+
+    def environment(self, search_path):
+        search_path = tuple(search_path)
+        with self.lock:
+            if search_path not in self.environments:
+                self.environments[search_path] = jinja2.Environment(
+                    loader=jinja2.FileSystemLoader(list(search_path)),
+                    bytecode_cache=self.bytecode_cache,
+                    undefined=jinja2.StrictUndefined,
+                    keep_trailing_newline=True,
+                    auto_reload=False
+                )
+            return self.environments[search_path]
+
+    def file_hash(self, path):
+        with self.lock:
+            if path in self.hashes:
+                return self.hashes[path]
+        with open(path, 'rb') as f:
+            digest = content_hash(f.read())
+        with self.lock:
+            self.hashes[path] = digest
+        return digest
+
+    def inputs(self, environment, name):
+        """Returns the paths of the template and every template it includes, or None when that is not known."""
+        paths = []
+        to_visit = [name]
+        seen = set()
+        while to_visit:
+            name = to_visit.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            try:
+                source, path, _ = environment.loader.get_source(environment, name)
+            except jinja2.TemplateNotFound:
+                raise RenderError("Template %s was not found" % name)
+            paths.append(path)
+            digest = content_hash(source.encode('utf-8'))
+            with self.lock:
+                self.hashes[path] = digest
+                self.used.add(digest)
+                known = digest in self.includes
+                includes = self.includes.get(digest)
+            if not known:
+                try:
+                    referenced = list(jinja2.meta.find_referenced_templates(environment.parse(source)))
+                except jinja2.TemplateSyntaxError as e:
+                    raise RenderError("%s, line %s: %s" % (path, e.lineno, e.message))
+                includes = None if None in referenced else sorted(set(referenced))
+                with self.lock:
+                    self.includes[digest] = includes
+            if includes is None:
+                return None
+            to_visit.extend(includes)
+        return sorted(paths)
+
+    def render(self, source, output, variables, search_path=()):
+        """
+        Renders source into output, unless neither its inputs nor the output changed since it was last rendered.
+        Returns whether it was rendered. The output is only written when its content changes, and has to be valid
+        JSON unless it is a .yml file.
+        """
+        source = os.path.abspath(source)
+        output = os.path.abspath(output)
+        environment = self.environment([os.path.dirname(source)] + [os.path.abspath(path) for path in search_path])
+        name = os.path.basename(source)
+        paths = self.inputs(environment, name)
+        if paths is not None:
+            inputs = content_hash(json.dumps({
+                'Files': [[path, self.file_hash(path)] for path in paths],
+                'Variables': variables,
+            }, sort_keys=True, default=str).encode('utf-8'))
+        else:
+            inputs = None
+        with self.lock:
+            previous = self.outputs.get(output)
+        if inputs is not None and previous is not None and previous['Inputs'] == inputs and os.path.exists(output) \
+                and self.file_hash(output) == previous['Output']:
+            return False
+
+        try:
+            rendered = environment.get_template(name).render(variables)
+        except jinja2.TemplateSyntaxError as e:
+            raise RenderError("%s, line %s: %s" % (e.filename or source, e.lineno, e.message))
+        except jinja2.TemplateError as e:
+            raise RenderError("%s: %s" % (source, e))
+        if not output.endswith('.yml'):
+            try:
+                json.loads(rendered)
+            except ValueError as e:
+                lines = rendered.splitlines()
+                line = lines[e.lineno - 1].strip() if 0 < getattr(e, 'lineno', 0) <= len(lines) else ''
+                raise RenderError("%s does not render to valid JSON: %s: %s" % (source, e, line))
+
+        data = rendered.encode('utf-8')
+        digest = content_hash(data)
+        if not os.path.exists(output) or self.file_hash(output) != digest:
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+            with open(output + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(output + '.tmp', output)
+            with self.lock:
+                self.hashes[output] = digest
+        with self.lock:
+            if inputs is not None:
+                self.outputs[output] = {'Inputs': inputs, 'Output': digest}
+            else:
+                self.outputs.pop(output, None)
+        return True
+
+    def save(self):
+        if self.manifest_path is None:
+            return
+        with self.lock:
+            # Includes of file versions not seen in this run are dropped; they are parsed again if they come back
+            manifest = {'Outputs': dict(self.outputs),
+                        'Includes': dict((digest, includes) for digest, includes in self.includes.items()
+                                         if digest in self.used)}
+        save_json(self.manifest_path, manifest)
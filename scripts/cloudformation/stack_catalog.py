@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import json
+import os
+import tempfile
+import threading
+import time
+
+import botocore
+
+COMPLETED_STATUSES = ['CREATE_COMPLETE', 'ROLLBACK_COMPLETE', 'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE']
+ACTIVE_STATUSES = ['CREATE_IN_PROGRESS', 'CREATE_FAILED', 'CREATE_COMPLETE', 'ROLLBACK_IN_PROGRESS', 'ROLLBACK_FAILED',
+                   'ROLLBACK_COMPLETE', 'DELETE_IN_PROGRESS', 'DELETE_FAILED', 'UPDATE_IN_PROGRESS',
+                   'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_IN_PROGRESS',
+                   'UPDATE_ROLLBACK_FAILED', 'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS',
+                   'UPDATE_ROLLBACK_COMPLETE']
+
+
+def save_json(path, document):
+    """Writes document to path in one step, so an interrupted run leaves the previous file in place."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def last_updated(stack):
+    """When CloudFormation last changed the stack (a stack summary or description), as an ISO 8601 string."""
+    value = stack.get('LastUpdatedTime') or stack.get('CreationTime')
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+class StackCatalog(object):
+    """
+    The stacks of one region: their status from a single listing, and their outputs.
+
+    Outputs are fetched concurrently, up to max_workers at a time, and kept in a JSON file for ttl seconds so runs
+    shortly after each other share them. Each entry records the stack's LastUpdatedTime, so once the stacks are
+    listed, a stack updated since its outputs were cached (by another pipeline, say) is described again. With no
+    path or a ttl of 0 nothing is cached between runs.
+    """
+
+    def __init__(self, client, path=None, ttl=120, region=None, max_workers=8, clock=time.time):
+        self.client = client
+        self.path = path
+        self.ttl = ttl
+        self.region = region
+        self.max_workers = max_workers
+        self.clock = clock
+        self.statuses = None
+        # stack name -> when CloudFormation last changed it, from the listing
+        self.updated = {}
+        self.entries = {}
+        self.changed = set()
+        self.lock = threading.Lock()
+        self.api_count = 0
+
+    def key(self, stack_name):
+        return '%s/%s' % (self.region, stack_name) if self.region else stack_name
+
+    def load(self):
+        """Reads the outputs cached by earlier runs that did not expire yet."""
+        if self.path and self.ttl > 0 and os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    entries = json.load(f).get('Stacks', {})
+            except ValueError:
+                # As in save(): a broken cache file is read as an empty one
+                entries = {}
+            with self.lock:
+                self.entries = dict((key, entry) for key, entry in entries.items() if self.fresh(entry))
+        return self
+
+    def fresh(self, entry):
+        return self.clock() - entry['Fetched'] < self.ttl
+
+    def current(self, stack_name, entry):
+        """Whether a cached entry is fresh and, when the stacks were listed, of the stack as last updated."""
+        if not self.fresh(entry):
+            return False
+        return stack_name not in self.updated or entry.get('LastUpdated') == self.updated[stack_name]
+
+    def list_stacks(self):
+        """Lists every stack that exists once, paging through list_stacks; returns stack name -> status."""
+        statuses = {}
+        updated = {}
+        kwargs = {'StackStatusFilter': ACTIVE_STATUSES}
+        while True:
+            response = self.client.list_stacks(**kwargs)
+            self.api_count += 1
+            for summary in response['StackSummaries']:
+                statuses[summary['StackName']] = summary['StackStatus']
+                updated[summary['StackName']] = last_updated(summary)
+            if 'NextToken' not in response:
+                break
+            kwargs['NextToken'] = response['NextToken']
+        self.statuses = statuses
+        self.updated = updated
+        return statuses
+
+    def completed_stack_names(self):
+        return [stack_name for stack_name, status in self.statuses.items() if status in COMPLETED_STATUSES]
+
+    def active_stack_names(self):
+        return list(self.statuses)
+
+    def last_updated(self, stack_name):
+        return self.updated.get(stack_name)
+
+    def outputs(self, stack_names):
+        """
+        Returns (stack name -> outputs, stack name -> error message) for the stacks, in one round of concurrent
+        describe_stacks calls for the ones whose outputs are not cached. Stacks the listing does not have are
+        reported missing without a call.
+        """
+        outputs = {}
+        errors = {}
+        to_fetch = []
+        for stack_name in stack_names:
+            if self.statuses is not None and stack_name not in self.statuses:
+                errors[stack_name] = "Stack with id %s does not exist" % stack_name
+                continue
+            with self.lock:
+                entry = self.entries.get(self.key(stack_name))
+            if entry is not None and self.current(stack_name, entry):
+                outputs[stack_name] = entry['Outputs']
+            elif stack_name not in to_fetch:
+                to_fetch.append(stack_name)
+        if to_fetch:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.max_workers, len(to_fetch))) as executor:
+                futures = dict((executor.submit(self.describe, stack_name), stack_name) for stack_name in to_fetch)
+                for future in concurrent.futures.as_completed(futures):
+                    stack_name = futures[future]
+                    try:
+                        outputs[stack_name] = future.result()
+                    except botocore.exceptions.ClientError as e:
+                        errors[stack_name] = e.response['Error']['Message']
+        return outputs, errors
+
+    def describe(self, stack_name):
+        response = self.client.describe_stacks(StackName=stack_name)
+        with self.lock:
+            self.api_count += 1
+        stack_outputs = response['Stacks'][0].get('Outputs', [])
+        self.put(stack_name, stack_outputs, last_updated(response['Stacks'][0]))
+        return stack_outputs
+
+    def put(self, stack_name, stack_outputs, stack_last_updated=None):
+        """
+        Records the stack's outputs as of now, e.g. after the stack was created or updated from here, and when
+        CloudFormation last updated the stack they belong to.
+        """
+        entry = {'Outputs': [{'OutputKey': output['OutputKey'], 'OutputValue': output['OutputValue']}
+                             for output in stack_outputs], 'Fetched': self.clock(), 'LastUpdated': stack_last_updated}
+        with self.lock:
+            self.entries[self.key(stack_name)] = entry
+            if stack_last_updated is not None:
+                self.updated[stack_name] = stack_last_updated
+            self.changed.add(self.key(stack_name))
+
+    def forget(self, stack_name):
+        with self.lock:
+            self.entries.pop(self.key(stack_name), None)
+            self.changed.add(self.key(stack_name))
+
+    def save(self):
+        """Merges the outputs fetched or changed by this run into the file, dropping expired entries."""
+        if not self.path or self.ttl <= 0 or not self.changed:
+            return
+        entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    entries = json.load(f).get('Stacks', {})
+            except ValueError:
+                # Another run is not expected to leave a broken file, but a cache is not worth failing for
+                entries = {}
+        with self.lock:
+            for key in self.changed:
+                if key in self.entries:
+                    entries[key] = self.entries[key]
+                else:
+                    entries.pop(key, None)
+        save_json(self.path, {'Stacks': dict((key, entry) for key, entry in entries.items() if self.fresh(entry))})
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+import botocore
+
+from stack_catalog import save_json
+from stack_waiter import THROTTLING_CODES
+
+CHANGE_SET_PREFIX = 'crud-'
+CHANGE_SET_FINAL_STATUSES = ['CREATE_COMPLETE', 'FAILED']
+# A change set fails with one of these reasons when the stack would not change
+NO_CHANGES_REASONS = ["didn't contain changes", 'No updates are to be performed']
+
+
+def stack_fingerprint(template_body_string, stack_parameters, capabilities=()):
+    """Hash of everything sent to CloudFormation to create or update a stack: template, parameters, capabilities."""
+    document = {
+        'TemplateBody': template_body_string,
+        'Parameters': sorted([parameter['ParameterKey'], parameter['ParameterValue']]
+                             for parameter in stack_parameters),
+        'Capabilities': sorted(capabilities),
+    }
+    return hashlib.sha256(json.dumps(document, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class FingerprintCache(object):
+    """
+    The fingerprint, outputs and last update time of each stack as last deployed from here, kept in a JSON file.
+
+    A stack whose fingerprint still matches, and whose LastUpdatedTime in the stack listing is still the one
+    recorded, needs no call to CloudFormation; its outputs come from the file. A stack updated some other way (the
+    console, another checkout) therefore is deployed again. Changes to its resources made outside CloudFormation
+    (drift) are not noticed, so the file can be ignored to deploy regardless. Stacks are kept by region and name,
+    so one file serves every region.
+    """
+
+    def __init__(self, path, region=None):
+        self.path = path
+        self.region = region
+        self.stacks = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.stacks = json.load(f).get('Stacks', {})
+        return self
+
+    def key(self, stack_name):
+        return '%s/%s' % (self.region, stack_name) if self.region else stack_name
+
+    def matches(self, stack_name, fingerprint, last_updated, need_outputs=True):
+        """
+        Whether the stack was last deployed with this fingerprint, CloudFormation did not update it since (it was
+        last updated at last_updated, as recorded then) and its outputs are known when needed.
+        """
+        with self.lock:
+            entry = self.stacks.get(self.key(stack_name))
+        return entry is not None and entry['Fingerprint'] == fingerprint \
+            and last_updated is not None and entry.get('LastUpdated') == last_updated \
+            and (not need_outputs or entry.get('Outputs') is not None)
+
+    def outputs(self, stack_name):
+        with self.lock:
+            entry = self.stacks.get(self.key(stack_name))
+        return entry.get('Outputs') if entry is not None else None
+
+    def put(self, stack_name, fingerprint, last_updated, outputs=None):
+        entry = {'Fingerprint': fingerprint, 'LastUpdated': last_updated,
+                 'Deployed': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+        if outputs is not None:
+            entry['Outputs'] = [{'OutputKey': output['OutputKey'], 'OutputValue': output['OutputValue']}
+                                for output in outputs]
+        with self.lock:
+            self.stacks[self.key(stack_name)] = entry
+
+    def remove(self, stack_name):
+        with self.lock:
+            self.stacks.pop(self.key(stack_name), None)
+
+    def save(self):
+        with self.lock:
+            document = {'Stacks': dict(self.stacks)}
+        save_json(self.path, document)
+
+
+class PlannedChangeSet(object):
+    """A change set created for a stack; status is CREATE_COMPLETE when there are changes to execute."""
+
+    def __init__(self, stack_name, change_set_type, fingerprint):
+        self.stack_name = stack_name
+        self.change_set_type = change_set_type
+        self.fingerprint = fingerprint
+        self.change_set_name = CHANGE_SET_PREFIX + uuid.uuid4().hex
+        self.status = None
+        self.reason = None
+        self.changes = []
+        self.executed = False
+        self.discarded = False
+
+    @property
+    def has_changes(self):
+        return self.status == 'CREATE_COMPLETE'
+
+    @property
+    def no_changes(self):
+        return self.status == 'FAILED' and any(reason in (self.reason or '') for reason in NO_CHANGES_REASONS)
+
+    def lines(self):
+        """One line per resource change: action, logical ID, type and whether the resource is replaced."""
+        _lines = []
+        for change in self.changes:
+            resource_change = change.get('ResourceChange', {})
+            line = "%-7s %s (%s)" % (resource_change.get('Action', '?'), resource_change.get('LogicalResourceId'),
+                                     resource_change.get('ResourceType'))
+            if resource_change.get('Action') == 'Modify':
+                line += " replacement: %s" % resource_change.get('Replacement', 'False')
+                if resource_change.get('Scope'):
+                    line += ", changes: %s" % ', '.join(resource_change['Scope'])
+            _lines.append(line)
+        return _lines
+
+
+class ChangeSetPlanner(object):
+    """
+    Creates, describes, executes and discards change sets.
+
+    create() blocks until the change set is ready, polling with a delay that grows from min_delay to max_delay, so
+    change sets are created in parallel by calling it from several threads. A change set of a stack that would not
+    change is deleted right away.
+    """
+
+    def __init__(self, client, min_delay=1.0, max_delay=10.0):
+        self.client = client
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+
+    def create(self, stack_name, change_set_type, template_body_string, stack_parameters, capabilities, fingerprint):
+        planned = PlannedChangeSet(stack_name, change_set_type, fingerprint)
+        self.client.create_change_set(
+            StackName=stack_name,
+            ChangeSetName=planned.change_set_name,
+            ChangeSetType=change_set_type,
+            TemplateBody=template_body_string,
+            Parameters=stack_parameters,
+            Capabilities=capabilities
+        )
+        delay = self.min_delay
+        while planned.status not in CHANGE_SET_FINAL_STATUSES:
+            time.sleep(delay * random.uniform(0.5, 1.0))
+            try:
+                self.describe(planned)
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] not in THROTTLING_CODES:
+                    raise
+                delay = min(self.max_delay, delay * 2)
+                continue
+            delay = min(self.max_delay, delay * 1.5)
+        if planned.no_changes:
+            self.discard(planned)
+        return planned
+
+    def describe(self, planned):
+        kwargs = {'StackName': planned.stack_name, 'ChangeSetName': planned.change_set_name}
+        changes = []
+        while True:
+            response = self.client.describe_change_set(**kwargs)
+            changes.extend(response.get('Changes', []))
+            if 'NextToken' not in response:
+                break
+            kwargs['NextToken'] = response['NextToken']
+        planned.status = response['Status']
+        planned.reason = response.get('StatusReason')
+        planned.changes = changes
+
+    def execute(self, planned, disable_rollback=False):
+        """Starts executing the change set; returns the client request token its stack events carry."""
+        client_request_token = str(uuid.uuid4())
+        self.client.execute_change_set(
+            StackName=planned.stack_name,
+            ChangeSetName=planned.change_set_name,
+            DisableRollback=disable_rollback,
+            ClientRequestToken=client_request_token
+        )
+        planned.executed = True
+        return client_request_token
+
+    def discard(self, planned, keep_stack=False):
+        """
+        Deletes the change set. A stack that only exists for a CREATE change set is deleted with it, unless keep_stack
+        is set because another change set is about to be created for it.
+        """
+        if planned.change_set_type == 'CREATE' and not keep_stack:
+            self.client.delete_stack(StackName=planned.stack_name)
+        else:
+            self.client.delete_change_set(StackName=planned.stack_name, ChangeSetName=planned.change_set_name)
+        planned.discarded = True
+
+
+def format_plan(stack_names, planned, unchanged, pending, failed, deletes=()):
+    """Returns the plan as text: every stack in order, with its changes, then the stacks to delete and a summary."""
+    _lines = []
+    _counts = {'Add': 0, 'Modify': 0, 'Remove': 0}
+    _replacements = 0
+    for stack_name in stack_names:
+        if stack_name in planned and planned[stack_name].has_changes:
+            change_set = planned[stack_name]
+            _lines.append("Stack %s: %s, change set %s" % (stack_name, change_set.change_set_type.lower(),
+                                                            change_set.change_set_name))
+            _lines.extend("    " + line for line in change_set.lines())
+            for change in change_set.changes:
+                resource_change = change.get('ResourceChange', {})
+                if resource_change.get('Action') in _counts:
+                    _counts[resource_change['Action']] += 1
+                if resource_change.get('Replacement') in ('True', 'Conditional'):
+                    _replacements += 1
+        elif stack_name in planned or stack_name in unchanged:
+            _lines.append("Stack %s: no changes" % stack_name)
+        elif stack_name in pending:
+            _lines.append("Stack %s: not planned, needs the outputs of %s" % (stack_name, ', '.join(pending[stack_name])))
+        elif stack_name in failed:
+            _lines.append("Stack %s: could not be planned: %s" % (stack_name, failed[stack_name]))
+    for stack_name in deletes:
+        _lines.append("Stack %s: delete" % stack_name)
+    _changed = [change_set for change_set in planned.values() if change_set.has_changes]
+    _lines.append("Plan: %d to create, %d to update, %d unchanged, %d not planned, %d to delete; "
+                  "resources: %d to add, %d to modify (%d may be replaced), %d to remove" % (
+                      len([c for c in _changed if c.change_set_type == 'CREATE']),
+                      len([c for c in _changed if c.change_set_type == 'UPDATE']),
+                      len(unchanged) + len(planned) - len(_changed), len(pending) + len(failed), len(deletes),
+                      _counts['Add'], _counts['Modify'], _replacements, _counts['Remove']))
+    return '\n'.join(_lines)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+import datetime
+import logging
+import random
+import threading
+import time
+
+import botocore
+
+STACK_RESOURCE_TYPE = 'AWS::CloudFormation::Stack'
+
+SUCCEEDED_STATUSES = ['CREATE_COMPLETE', 'UPDATE_COMPLETE', 'DELETE_COMPLETE', 'IMPORT_COMPLETE']
+FAILED_STATUSES = ['CREATE_FAILED', 'ROLLBACK_COMPLETE', 'ROLLBACK_FAILED', 'DELETE_FAILED', 'UPDATE_ROLLBACK_COMPLETE',
+                   'UPDATE_ROLLBACK_FAILED', 'IMPORT_ROLLBACK_COMPLETE', 'IMPORT_ROLLBACK_FAILED']
+
+THROTTLING_CODES = ['Throttling', 'ThrottlingException', 'RequestLimitExceeded']
+
+
+class StackWaitError(Exception):
+    """A stack operation that ended in a failed state; reason is the first resource failure reported."""
+
+    def __init__(self, stack_name, status, reason=None):
+        message = "Stack %s ended in %s" % (stack_name, status)
+        if reason:
+            message += ": " + reason
+        super(StackWaitError, self).__init__(message)
+        self.stack_name = stack_name
+        self.status = status
+        self.reason = reason
+
+
+class StackWaitTimeout(StackWaitError):
+    """A stack operation that did not end within the time waited for it; it may still be in progress."""
+
+    def __init__(self, stack_name, timeout):
+        super(StackWaitError, self).__init__("Stack %s did not reach a final state within %s seconds"
+                                             % (stack_name, timeout))
+        self.stack_name = stack_name
+        self.status = None
+        self.reason = None
+        self.timeout = timeout
+
+
+class WatchedStack(object):
+    """One stack operation followed by a StackWaiter; wait() blocks until it ends."""
+
+    def __init__(self, stack_name, operation, client_request_token, since):
+        self.stack_name = stack_name
+        self.operation = operation
+        self.client_request_token = client_request_token
+        self.since = since
+        self.last_event_id = None
+        self.status = None
+        self.reason = None
+        self.error = None
+        self.delay = None
+        self.next_poll = 0
+        self.done = threading.Event()
+
+    def belongs(self, event):
+        """Whether an event, newer than the last one seen, is part of this operation."""
+        if self.client_request_token is not None:
+            return event.get('ClientRequestToken') == self.client_request_token
+        return event['Timestamp'] >= self.since
+
+    def starts(self, event):
+        """Whether the event is the one this operation started with, when there is no token to go by."""
+        return self.client_request_token is None and event['ResourceType'] == STACK_RESOURCE_TYPE \
+            and event['LogicalResourceId'] == self.stack_name \
+            and event['ResourceStatus'] == self.operation + '_IN_PROGRESS'
+
+    def wait(self, timeout=None):
+        """
+        Returns the final status, or raises StackWaitError when the operation failed and StackWaitTimeout when it
+        did not end within timeout seconds.
+        """
+        if not self.done.wait(timeout):
+            raise StackWaitTimeout(self.stack_name, timeout)
+        if self.error is not None:
+            raise self.error
+        return self.status
+
+
+class StackWaiter(object):
+    """
+    Follows any number of stack operations from one polling thread.
+
+    Each poll fetches only the events newer than the last one seen, newest
+    first, stopping at the last seen event ID or at the first event of another
+    operation (by ClientRequestToken when the operation was started with one).
+    New events are logged as they come in, oldest first. A stack with news is
+    polled again after min_delay; a quiet one backs off up to max_delay, and
+    throttling doubles its delay. Delays are jittered so stacks started
+    together do not poll together. Takes any CloudFormation client, including
+    one driven by a botocore Stubber with poll() called directly.
+    """
+
+    def __init__(self, client, logger=None, min_delay=2.0, max_delay=20.0, clock=time.time):
+        self.client = client
+        self.logger = logger or logging.getLogger(__name__)
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.watched = []
+        self.condition = threading.Condition()
+        self.thread = None
+        self.api_count = 0
+
+    def watch(self, stack_name, operation, client_request_token=None):
+        """Starts following an operation (CREATE, UPDATE or DELETE) that was just started on the stack."""
+        # Without a token, events since a minute before now may belong to the operation, allowing for clock skew
+        watched = WatchedStack(stack_name, operation, client_request_token,
+                               datetime_from_timestamp(self.clock() - 60))
+        watched.delay = self.min_delay
+        watched.next_poll = self.clock() + self.min_delay * random.uniform(0.5, 1.0)
+        with self.condition:
+            self.watched.append(watched)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+        return watched
+
+    def wait(self, stack_name, operation, client_request_token=None, timeout=None):
+        return self.watch(stack_name, operation, client_request_token).wait(timeout)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.watched:
+                    self.condition.wait()
+                delay = min(watched.next_poll for watched in self.watched) - self.clock()
+                if delay > 0:
+                    self.condition.wait(delay)
+            self.poll()
+
+    def poll(self):
+        """Polls every stack that is due, once; returns the stacks still followed."""
+        now = self.clock()
+        with self.condition:
+            due = [watched for watched in self.watched if watched.next_poll <= now]
+        for watched in due:
+            try:
+                news = self.poll_stack(watched)
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] in THROTTLING_CODES:
+                    watched.delay = min(self.max_delay, watched.delay * 2)
+                    watched.next_poll = self.clock() + watched.delay * random.uniform(0.5, 1.0)
+                    continue
+                elif watched.operation == 'DELETE' and 'does not exist' in e.response['Error']['Message']:
+                    self.finish(watched, 'DELETE_COMPLETE')
+                    continue
+                else:
+                    self.finish(watched, None, e)
+                    continue
+            except Exception as e:
+                # Whoever waits for the stack gets the error; the loop goes on for the others
+                self.finish(watched, None, e)
+                continue
+            if watched.done.is_set():
+                continue
+            watched.delay = self.min_delay if news else min(self.max_delay, watched.delay * 1.5)
+            watched.next_poll = self.clock() + watched.delay * random.uniform(0.5, 1.0)
+        with self.condition:
+            self.watched = [watched for watched in self.watched if not watched.done.is_set()]
+            return list(self.watched)
+
+    def poll_stack(self, watched):
+        """Fetches and logs the stack's new events; returns whether there were any."""
+        events = []
+        kwargs = {'StackName': watched.stack_name}
+        finished_paging = False
+        while not finished_paging:
+            response = self.client.describe_stack_events(**kwargs)
+            self.api_count += 1
+            for event in response['StackEvents']:
+                if event['EventId'] == watched.last_event_id or not watched.belongs(event):
+                    finished_paging = True
+                    break
+                events.append(event)
+                if watched.last_event_id is None and watched.starts(event):
+                    finished_paging = True
+                    break
+            if 'NextToken' not in response:
+                break
+            kwargs['NextToken'] = response['NextToken']
+        if not events:
+            return False
+        if watched.last_event_id is None and not watched.starts(events[-1]) and watched.client_request_token is None:
+            # Without a token, only events after the operation's first event are known to be part of it
+            return False
+        watched.last_event_id = events[0]['EventId']
+        for event in reversed(events):
+            self.log_event(event)
+            if event['ResourceStatus'].endswith('FAILED') and event.get('ResourceStatusReason') \
+                    and watched.reason is None:
+                watched.reason = "%s: %s" % (event['LogicalResourceId'], event['ResourceStatusReason'])
+            if event['ResourceType'] == STACK_RESOURCE_TYPE and event['LogicalResourceId'] == watched.stack_name:
+                if event['ResourceStatus'] in SUCCEEDED_STATUSES:
+                    self.finish(watched, event['ResourceStatus'])
+                elif event['ResourceStatus'] in FAILED_STATUSES:
+                    self.finish(watched, event['ResourceStatus'],
+                                StackWaitError(watched.stack_name, event['ResourceStatus'], watched.reason))
+        return True
+
+    def log_event(self, event):
+        message = "Stack %s: %s (%s) %s" % (event['StackName'], event['LogicalResourceId'], event['ResourceType'],
+                                            event['ResourceStatus'])
+        if event.get('ResourceStatusReason'):
+            message += ": " + event['ResourceStatusReason']
+        if event['ResourceStatus'].endswith('FAILED'):
+            self.logger.warning(message)
+        else:
+            self.logger.info(message)
+
+    def finish(self, watched, status, error=None):
+        watched.status = status
+        watched.error = error
+        watched.done.set()
+
+
+def datetime_from_timestamp(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
@@ -0,0 +1,10 @@
+#!/usr/bin/env python3
+
+# Shared by the tests in this directory.
+
+import boto3
+
+
+def client(service='cloudformation', region='us-east-1'):
+    """A client with dummy credentials, for a botocore Stubber to answer."""
+    return boto3.client(service, region_name=region, aws_access_key_id='testing', aws_secret_access_key='testing')
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+import importlib.util
+import os
+import sys
+import threading
+import time
+import unittest
+
+DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, DIRECTORY)
+# The script creates its CloudFormation client on import
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+_spec = importlib.util.spec_from_file_location('cloudformation_crud', os.path.join(DIRECTORY, 'cloudformation-crud.py'))
+crud = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(crud)
+
+
+def template(parameters=(), outputs=(), defaults=None):
+    body = {'Parameters': dict((key, {'Type': 'String'}) for key in parameters),
+            'Outputs': dict((key, {'Value': key}) for key in outputs)}
+    for key, value in (defaults or {}).items():
+        body['Parameters'][key]['Default'] = value
+    return '{}', body
+
+
+def stack(name, **properties):
+    return name, dict({'Template': name + '.json'}, **properties)
+
+
+class StackDependencyTest(unittest.TestCase):
+
+    def test_consumers_wait_for_earlier_producers_only(self):
+        stacks = [stack('vpc'), stack('db'), stack('app')]
+        templates = {'vpc': template(outputs=['VpcId']), 'db': template(['VpcId'], ['DbHost']),
+                     'app': template(['VpcId', 'DbHost'])}
+        dependencies = crud.get_stack_dependencies(stacks, templates)
+        self.assertEqual(dependencies, {'vpc': set(), 'db': set(['vpc']), 'app': set(['vpc', 'db'])})
+        self.assertEqual(crud.get_stack_order(stacks, dependencies), ['vpc', 'db', 'app'])
+
+    def test_outputs_not_added_to_parameters_are_no_dependency(self):
+        stacks = [stack('vpc', AddOutputsToParameters=False), stack('app')]
+        templates = {'vpc': template(outputs=['VpcId']), 'app': template(['VpcId'])}
+        self.assertEqual(crud.get_stack_dependencies(stacks, templates), {'vpc': set(), 'app': set()})
+
+    def test_later_stack_with_an_output_an_earlier_stack_reads_waits_for_it(self):
+        # app reads Domain as given or defaulted; dns outputs a Domain of its own afterwards
+        stacks = [stack('app'), stack('dns'), stack('web')]
+        templates = {'app': template(['Domain'], defaults={'Domain': 'example.com'}),
+                     'dns': template(outputs=['Domain']), 'web': template(['Domain'])}
+        dependencies = crud.get_stack_dependencies(stacks, templates)
+        self.assertEqual(dependencies, {'app': set(), 'dns': set(['app']), 'web': set(['dns'])})
+        self.assertEqual(crud.get_stack_order(stacks, dependencies), ['app', 'dns', 'web'])
+
+    def test_forward_depends_on(self):
+        stacks = [stack('app', DependsOn=['db']), stack('vpc'), stack('db')]
+        templates = {'app': template(), 'vpc': template(), 'db': template()}
+        dependencies = crud.get_stack_dependencies(stacks, templates)
+        self.assertEqual(dependencies['app'], set(['db']))
+        self.assertEqual(crud.get_stack_order(stacks, dependencies), ['db', 'app', 'vpc'])
+
+    def test_depends_on_an_unknown_stack(self):
+        with self.assertRaises(crud.StackError):
+            crud.get_stack_dependencies([stack('app', DependsOn=['db'])], {'app': template()})
+
+    def test_cycles_are_rejected(self):
+        stacks = [stack('a', DependsOn=['b']), stack('b', DependsOn=['a'])]
+        with self.assertRaises(crud.StackError) as raised:
+            crud.get_stack_dependencies(stacks, {'a': template(), 'b': template()})
+        self.assertIn('a -> b -> a', str(raised.exception))
+
+    def test_forward_depends_on_against_the_read_order_is_a_cycle(self):
+        # app reads Domain before dns outputs it, yet asks to wait for dns
+        stacks = [stack('app', DependsOn=['dns']), stack('dns')]
+        templates = {'app': template(['Domain'], defaults={'Domain': 'example.com'}),
+                     'dns': template(outputs=['Domain'])}
+        with self.assertRaises(crud.StackError):
+            crud.get_stack_dependencies(stacks, templates)
+
+
+class CreateOrUpdateStacksTest(unittest.TestCase):
+    """Runs the scheduler with deploy_stack replaced, so stacks finish in an order the test picks."""
+
+    def setUp(self):
+        self.deploy_stack = crud.deploy_stack
+        self.parameters = {}
+        self.lock = threading.Lock()
+        crud.deploy_stack = self.fake_deploy_stack
+
+    def tearDown(self):
+        crud.deploy_stack = self.deploy_stack
+
+    def fake_deploy_stack(self, stack_name, properties, template_body_string, stack_parameters,
+                          completed_stack_names, active_stack_names, fingerprint=None, change_sets=None):
+        with self.lock:
+            self.parameters[stack_name] = dict((parameter['ParameterKey'], parameter['ParameterValue'])
+                                               for parameter in stack_parameters)
+        time.sleep(0.2 if stack_name == 'vpc' else 0)
+        return [{'OutputKey': key, 'OutputValue': key.lower() + '-from-' + stack_name}
+                for key in self.templates[stack_name][1]['Outputs']], None
+
+    def test_parameters_do_not_depend_on_which_stack_finishes_first(self):
+        # app waits for the slow vpc; dns could otherwise finish and add its Domain before app starts
+        stacks = [stack('vpc'), stack('app'), stack('dns'), stack('web')]
+        self.templates = {'vpc': template(outputs=['VpcId']),
+                          'app': template(['VpcId', 'Domain'], defaults={'Domain': 'example.com'}),
+                          'dns': template(outputs=['Domain']), 'web': template(['Domain'])}
+        parameter_values = {}
+        crud.create_or_update_stacks(stacks, self.templates, parameter_values, {}, [], [], parallelism=4)
+        self.assertEqual(self.parameters['app'], {'VpcId': 'vpcid-from-vpc', 'Domain': 'example.com'})
+        self.assertEqual(self.parameters['web'], {'Domain': 'domain-from-dns'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, DIRECTORY)
+
+from render import RenderError, TemplateRenderer  # noqa: E402
+from validate_templates import check_file  # noqa: E402
+
+CLOUDFORMATION = os.path.abspath(os.path.join(DIRECTORY, '..', '..', 'cloudformation'))
+WEBAPP = os.path.join(CLOUDFORMATION, 'templates', 'webapp_autoscaling.json.j2')
+WEBAPP_VARIABLES = {'product': 'shop', 'role': 'webapp', 'name': 'shop-webapp'}
+
+
+class RenderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = os.path.join(self.tmp, 'cache')
+        self.source_directory = os.path.join(self.tmp, 'source')
+        os.makedirs(os.path.join(self.source_directory, 'snippets'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, text):
+        path = os.path.join(self.source_directory, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def render(self, source, variables=None, output='out.json', renderer=None):
+        """Renders with a new renderer, as a new run of the script would, unless one is given."""
+        renderer = renderer or TemplateRenderer(self.cache)
+        rendered = renderer.render(source, os.path.join(self.tmp, output), variables or {}, [self.source_directory])
+        renderer.save()
+        return rendered
+
+    def output(self, output='out.json'):
+        with open(os.path.join(self.tmp, output)) as f:
+            return json.load(f)
+
+
+class RepositoryTemplateTest(RenderTestCase):
+    """The repo's own source template, assembled from the snippets in cloudformation/resources and parameters."""
+
+    def test_renders_to_a_valid_template(self):
+        renderer = TemplateRenderer(self.cache)
+        output = os.path.join(self.tmp, 'webapp.json')
+        self.assertTrue(renderer.render(WEBAPP, output, WEBAPP_VARIABLES, [CLOUDFORMATION]))
+        with open(output) as f:
+            template = json.load(f)
+        self.assertEqual(sorted(template['Resources']),
+                         ['AutoScalingGroup', 'LaunchConfiguration', 'WaitCondition', 'WaitHandle'])
+        self.assertIn('AMI', template['Parameters'])
+        self.assertIn({'Key': 'role', 'Value': 'webapp', 'PropagateAtLaunch': 'true'},
+                      template['Resources']['AutoScalingGroup']['Properties']['Tags'])
+        findings, _ = check_file(output)
+        self.assertEqual([finding for finding in findings if finding.severity == 'error'], [])
+
+    def test_finds_every_snippet(self):
+        renderer = TemplateRenderer()
+        paths = renderer.inputs(renderer.environment([os.path.dirname(WEBAPP), CLOUDFORMATION]),
+                                os.path.basename(WEBAPP))
+        self.assertEqual([os.path.relpath(path, CLOUDFORMATION) for path in paths], sorted([
+            'parameters/commonParameters.json.snippet',
+            'parameters/ec2InstanceType.json.snippet',
+            'parameters/launchConfigurationAutoScalingGroup.json.snippet',
+            'resources/autoscaling/launchConfigurationAutoScalingGroup.json.snippet.j2',
+            'resources/autoscaling/userDataWaitConditionHandle.json.snippet.j2',
+            'resources/autoscaling/waitConditionHandleWaitCondition.json.snippet.j2',
+            'templates/webapp_autoscaling.json.j2',
+        ]))
+
+    def test_missing_variables_are_errors(self):
+        with self.assertRaisesRegex(RenderError, "'name' is undefined"):
+            TemplateRenderer().render(WEBAPP, os.path.join(self.tmp, 'webapp.json'),
+                                      {'product': 'shop', 'role': 'webapp'}, [CLOUDFORMATION])
+
+
+class TemplateRendererTest(RenderTestCase):
+
+    def setUp(self):
+        super(TemplateRendererTest, self).setUp()
+        self.write('snippets/resource.json.snippet.j2', '"{{name}}": {"Type": "AWS::SNS::Topic"}')
+        self.write('snippets/outer.json.snippet.j2', '{% include "snippets/resource.json.snippet.j2" %}')
+        self.source = self.write('stack.json.j2',
+                                 '{"Resources": {{ "{" }}{% include "snippets/outer.json.snippet.j2" %}}}')
+
+    def test_skips_unchanged_inputs(self):
+        self.assertTrue(self.render(self.source, {'name': 'Topic'}))
+        self.assertEqual(self.output(), {'Resources': {'Topic': {'Type': 'AWS::SNS::Topic'}}})
+        self.assertFalse(self.render(self.source, {'name': 'Topic'}))
+
+    def test_renders_again_when_a_nested_snippet_changes(self):
+        self.render(self.source, {'name': 'Topic'})
+        self.write('snippets/resource.json.snippet.j2', '"{{name}}": {"Type": "AWS::SQS::Queue"}')
+        self.assertTrue(self.render(self.source, {'name': 'Topic'}))
+        self.assertEqual(self.output(), {'Resources': {'Topic': {'Type': 'AWS::SQS::Queue'}}})
+        self.assertFalse(self.render(self.source, {'name': 'Topic'}))
+
+    def test_renders_again_when_variables_change(self):
+        self.render(self.source, {'name': 'Topic'})
+        self.assertTrue(self.render(self.source, {'name': 'Alerts'}))
+        self.assertEqual(list(self.output()['Resources']), ['Alerts'])
+
+    def test_renders_again_when_the_output_was_changed_or_removed(self):
+        self.render(self.source, {'name': 'Topic'})
+        with open(os.path.join(self.tmp, 'out.json'), 'w') as f:
+            f.write('{}')
+        self.assertTrue(self.render(self.source, {'name': 'Topic'}))
+        os.remove(os.path.join(self.tmp, 'out.json'))
+        self.assertTrue(self.render(self.source, {'name': 'Topic'}))
+
+    def test_finds_nested_includes(self):
+        renderer = TemplateRenderer()
+        paths = renderer.inputs(renderer.environment([self.source_directory]), 'stack.json.j2')
+        self.assertEqual([os.path.relpath(path, self.source_directory) for path in paths],
+                         ['snippets/outer.json.snippet.j2', 'snippets/resource.json.snippet.j2', 'stack.json.j2'])
+
+    def test_computed_includes_are_always_rendered(self):
+        source = self.write('computed.json.j2', '{"Resources": {{ "{" }}{% include snippet %}}}')
+        variables = {'name': 'Topic', 'snippet': 'snippets/resource.json.snippet.j2'}
+        self.assertTrue(self.render(source, variables))
+        self.assertTrue(self.render(source, variables))
+
+    def test_missing_include(self):
+        source = self.write('missing.json.j2', '{% include "snippets/missing.json.snippet.j2" %}')
+        with self.assertRaisesRegex(RenderError, 'snippets/missing.json.snippet.j2 was not found'):
+            self.render(source)
+
+    def test_undefined_variables_are_errors(self):
+        with self.assertRaisesRegex(RenderError, "'name' is undefined"):
+            self.render(self.source)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'out.json')))
+
+    def test_syntax_errors_name_the_file(self):
+        source = self.write('broken.json.j2', '{\n{% if %}\n}')
+        with self.assertRaisesRegex(RenderError, 'broken.json.j2, line 2'):
+            self.render(source)
+
+    def test_invalid_json_is_rejected(self):
+        source = self.write('invalid.json.j2', '{\n"Resources": {\n"A": 1,\n}\n}')
+        with self.assertRaisesRegex(RenderError, 'does not render to valid JSON'):
+            self.render(source)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'out.json')))
+
+    def test_yaml_outputs_are_not_checked_as_json(self):
+        source = self.write('stack.yml.j2', 'Resources:\n  {{name}}:\n    Type: AWS::SNS::Topic\n')
+        self.assertTrue(self.render(source, {'name': 'Topic'}, output='out.yml'))
+
+    def test_works_without_a_cache_directory(self):
+        renderer = TemplateRenderer()
+        output = os.path.join(self.tmp, 'out.json')
+        self.assertTrue(renderer.render(self.source, output, {'name': 'Topic'}, [self.source_directory]))
+        self.assertFalse(renderer.render(self.source, output, {'name': 'Topic'}, [self.source_directory]))
+
+
+if __name__ == '__main__':
+    unittest.main()
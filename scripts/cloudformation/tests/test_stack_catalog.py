@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from botocore.stub import Stubber
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cloudformation_stubs import client  # noqa: E402
+from stack_catalog import ACTIVE_STATUSES, StackCatalog  # noqa: E402
+
+CREATED = datetime.datetime(2024, 1, 1, 12, 0, 0, tzinfo=datetime.timezone.utc)
+UPDATED = CREATED + datetime.timedelta(hours=1)
+
+
+def summary(stack_name, updated=None):
+    _summary = {'StackName': stack_name, 'StackStatus': 'CREATE_COMPLETE', 'CreationTime': CREATED}
+    if updated is not None:
+        _summary.update(StackStatus='UPDATE_COMPLETE', LastUpdatedTime=updated)
+    return _summary
+
+
+def description(stack_name, value, updated=None):
+    return {'Stacks': [dict(summary(stack_name, updated), Outputs=outputs(value))]}
+
+
+def outputs(value):
+    return [{'OutputKey': 'Value', 'OutputValue': value}]
+
+
+class StackCatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache.json')
+        self.now = 1000.0
+        self.client = client()
+        self.stubber = Stubber(self.client)
+        self.stubber.activate()
+
+    def tearDown(self):
+        self.stubber.deactivate()
+        shutil.rmtree(self.directory)
+
+    def catalog(self):
+        # One worker: the Stubber answers in order, so concurrent calls could get each other's responses
+        return StackCatalog(self.client, self.path, ttl=120, region='us-east-1', max_workers=1,
+                            clock=lambda: self.now).load()
+
+    def list_stacks(self, catalog, *summaries):
+        self.stubber.add_response('list_stacks', {'StackSummaries': list(summaries)},
+                                  {'StackStatusFilter': ACTIVE_STATUSES})
+        catalog.list_stacks()
+
+    def describe(self, stack_name, value, updated=None):
+        self.stubber.add_response('describe_stacks', description(stack_name, value, updated),
+                                  {'StackName': stack_name})
+
+    def test_listing_follows_pages_and_records_when_each_stack_was_last_updated(self):
+        self.stubber.add_response('list_stacks', {'StackSummaries': [summary('app', UPDATED)], 'NextToken': 'page-2'},
+                                  {'StackStatusFilter': ACTIVE_STATUSES})
+        self.stubber.add_response('list_stacks', {'StackSummaries': [summary('db')]},
+                                  {'StackStatusFilter': ACTIVE_STATUSES, 'NextToken': 'page-2'})
+        catalog = self.catalog()
+        self.assertEqual(catalog.list_stacks(), {'app': 'UPDATE_COMPLETE', 'db': 'CREATE_COMPLETE'})
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual(catalog.last_updated('app'), UPDATED.isoformat())
+        self.assertEqual(catalog.last_updated('db'), CREATED.isoformat())
+        self.assertIsNone(catalog.last_updated('web'))
+
+    def test_stacks_missing_from_the_listing_are_not_described(self):
+        catalog = self.catalog()
+        self.list_stacks(catalog, summary('vpc'))
+        self.describe('vpc', 'vpc-1')
+        found, errors = catalog.outputs(['vpc', 'db', 'vpc'])
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual(found, {'vpc': outputs('vpc-1')})
+        self.assertEqual(errors, {'db': "Stack with id db does not exist"})
+        self.assertEqual(catalog.api_count, 2)
+
+    def test_cached_outputs_are_used_until_they_expire(self):
+        catalog = self.catalog()
+        self.list_stacks(catalog, summary('vpc'))
+        self.describe('vpc', 'vpc-1')
+        catalog.outputs(['vpc'])
+        catalog.save()
+
+        self.now += 60
+        catalog = self.catalog()
+        self.list_stacks(catalog, summary('vpc'))
+        self.assertEqual(catalog.outputs(['vpc']), ({'vpc': outputs('vpc-1')}, {}))
+        self.stubber.assert_no_pending_responses()
+
+        self.now += 61
+        catalog = self.catalog()
+        self.list_stacks(catalog, summary('vpc'))
+        self.describe('vpc', 'vpc-2')
+        self.assertEqual(catalog.outputs(['vpc']), ({'vpc': outputs('vpc-2')}, {}))
+        self.stubber.assert_no_pending_responses()
+
+    def test_stack_updated_since_its_outputs_were_cached_is_described_again(self):
+        catalog = self.catalog()
+        self.list_stacks(catalog, summary('vpc'))
+        self.describe('vpc', 'vpc-1')
+        catalog.outputs(['vpc'])
+        catalog.save()
+
+        # Another pipeline updated the stack within the ttl
+        self.now += 10
+        catalog = self.catalog()
+        self.list_stacks(catalog, summary('vpc', UPDATED))
+        self.describe('vpc', 'vpc-2', UPDATED)
+        self.assertEqual(catalog.outputs(['vpc']), ({'vpc': outputs('vpc-2')}, {}))
+        catalog.save()
+        self.stubber.assert_no_pending_responses()
+
+        self.now += 10
+        catalog = self.catalog()
+        self.list_stacks(catalog, summary('vpc', UPDATED))
+        self.assertEqual(catalog.outputs(['vpc']), ({'vpc': outputs('vpc-2')}, {}))
+        self.stubber.assert_no_pending_responses()
+
+    def test_describe_errors_are_reported_per_stack(self):
+        catalog = self.catalog()
+        self.stubber.add_client_error('describe_stacks', service_error_code='ValidationError',
+                                      service_message='Stack with id vpc does not exist',
+                                      expected_params={'StackName': 'vpc'})
+        self.assertEqual(catalog.outputs(['vpc']), ({}, {'vpc': 'Stack with id vpc does not exist'}))
+
+    def test_broken_cache_file_is_ignored(self):
+        with open(self.path, 'w') as f:
+            f.write('{"Stacks": ')
+        catalog = self.catalog()
+        self.assertEqual(catalog.entries, {})
+        catalog.put('vpc', outputs('vpc-1'))
+        catalog.save()
+        self.assertEqual(self.catalog().entries['us-east-1/vpc']['Outputs'], outputs('vpc-1'))
+
+
+class ConcurrentClient(object):
+    """Answers describe_stacks after a short delay, keeping track of how many calls overlapped."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.most_in_flight = 0
+
+    def describe_stacks(self, StackName):
+        with self.lock:
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        time.sleep(0.05)
+        with self.lock:
+            self.in_flight -= 1
+        return description(StackName, StackName + '-value')
+
+
+class ConcurrentFetchTest(unittest.TestCase):
+
+    def test_outputs_are_fetched_up_to_max_workers_at_a_time(self):
+        client = ConcurrentClient()
+        catalog = StackCatalog(client, max_workers=3)
+        stack_names = ['stack%d' % number for number in range(7)]
+        found, errors = catalog.outputs(stack_names)
+        self.assertEqual(found, dict((stack_name, outputs(stack_name + '-value')) for stack_name in stack_names))
+        self.assertEqual(errors, {})
+        self.assertEqual(client.most_in_flight, 3)
+        self.assertEqual(catalog.api_count, 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from botocore.stub import ANY, Stubber
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cloudformation_stubs import client  # noqa: E402
+from stack_plan import ChangeSetPlanner, FingerprintCache, format_plan, stack_fingerprint  # noqa: E402
+
+TEMPLATE = '{"Resources": {"Topic": {"Type": "AWS::SNS::Topic"}}}'
+PARAMETERS = [{'ParameterKey': 'Name', 'ParameterValue': 'app'}]
+UPDATED = '2024-01-01T12:00:00+00:00'
+
+
+def resource_change(action, logical_id, replacement=None):
+    change = {'Action': action, 'LogicalResourceId': logical_id, 'ResourceType': 'AWS::SNS::Topic'}
+    if replacement is not None:
+        change['Replacement'] = replacement
+        change['Scope'] = ['Properties']
+    return {'Type': 'Resource', 'ResourceChange': change}
+
+
+class ChangeSetPlannerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = client()
+        self.stubber = Stubber(self.client)
+        self.stubber.activate()
+        self.planner = ChangeSetPlanner(self.client, min_delay=0, max_delay=0)
+
+    def tearDown(self):
+        self.stubber.deactivate()
+
+    def expect_create(self, change_set_type):
+        self.stubber.add_response('create_change_set', {'Id': 'change-set-id', 'StackId': 'stack-id'}, {
+            'StackName': 'app', 'ChangeSetName': ANY, 'ChangeSetType': change_set_type, 'TemplateBody': TEMPLATE,
+            'Parameters': PARAMETERS, 'Capabilities': ['CAPABILITY_IAM'],
+        })
+
+    def expect_describe(self, status, changes=(), reason=None, next_token=None, request_token=None):
+        response = {'Status': status, 'Changes': list(changes)}
+        if reason is not None:
+            response['StatusReason'] = reason
+        if next_token is not None:
+            response['NextToken'] = next_token
+        expected = {'StackName': 'app', 'ChangeSetName': ANY}
+        if request_token is not None:
+            expected['NextToken'] = request_token
+        self.stubber.add_response('describe_change_set', response, expected)
+
+    def create(self, change_set_type='UPDATE'):
+        return self.planner.create('app', change_set_type, TEMPLATE, PARAMETERS, ['CAPABILITY_IAM'], 'fingerprint')
+
+    def test_waits_for_the_change_set_and_reads_every_page_of_changes(self):
+        self.expect_create('UPDATE')
+        self.expect_describe('CREATE_IN_PROGRESS')
+        self.expect_describe('CREATE_COMPLETE', [resource_change('Modify', 'Topic', 'True')], next_token='page-2')
+        self.expect_describe('CREATE_COMPLETE', [resource_change('Add', 'Queue')], request_token='page-2')
+        planned = self.create()
+        self.stubber.assert_no_pending_responses()
+        self.assertTrue(planned.has_changes)
+        self.assertFalse(planned.discarded)
+        self.assertEqual(planned.lines(), [
+            "Modify  Topic (AWS::SNS::Topic) replacement: True, changes: Properties",
+            "Add     Queue (AWS::SNS::Topic)",
+        ])
+
+    def test_describe_is_retried_when_throttled(self):
+        self.expect_create('UPDATE')
+        self.stubber.add_client_error('describe_change_set', service_error_code='Throttling',
+                                      service_message='Rate exceeded')
+        self.expect_describe('CREATE_COMPLETE', [resource_change('Add', 'Queue')])
+        self.assertTrue(self.create().has_changes)
+        self.stubber.assert_no_pending_responses()
+
+    def test_change_set_without_changes_is_deleted(self):
+        self.expect_create('UPDATE')
+        self.expect_describe('FAILED', reason="The submitted information didn't contain changes. "
+                                              "Submit different information to create a change set.")
+        self.stubber.add_response('delete_change_set', {}, {'StackName': 'app', 'ChangeSetName': ANY})
+        planned = self.create()
+        self.stubber.assert_no_pending_responses()
+        self.assertTrue(planned.no_changes)
+        self.assertTrue(planned.discarded)
+
+    def test_discarding_a_create_change_set_deletes_its_stack(self):
+        self.expect_create('CREATE')
+        self.expect_describe('CREATE_COMPLETE', [resource_change('Add', 'Topic')])
+        planned = self.create('CREATE')
+        self.stubber.add_response('delete_stack', {}, {'StackName': 'app'})
+        self.planner.discard(planned)
+        self.stubber.assert_no_pending_responses()
+
+        self.stubber.add_response('delete_change_set', {}, {'StackName': 'app',
+                                                            'ChangeSetName': planned.change_set_name})
+        self.planner.discard(planned, keep_stack=True)
+        self.stubber.assert_no_pending_responses()
+
+    def test_execute_sends_a_client_request_token(self):
+        self.expect_create('UPDATE')
+        self.expect_describe('CREATE_COMPLETE', [resource_change('Add', 'Queue')])
+        planned = self.create()
+        self.stubber.add_response('execute_change_set', {}, {
+            'StackName': 'app', 'ChangeSetName': planned.change_set_name, 'DisableRollback': False,
+            'ClientRequestToken': ANY,
+        })
+        token = self.planner.execute(planned)
+        self.stubber.assert_no_pending_responses()
+        self.assertTrue(planned.executed)
+        self.assertTrue(token)
+
+    def test_other_errors_are_raised(self):
+        self.expect_create('UPDATE')
+        self.stubber.add_client_error('describe_change_set', service_error_code='AccessDenied',
+                                      service_message='Not allowed')
+        with self.assertRaises(Exception) as raised:
+            self.create()
+        self.assertIn('AccessDenied', str(raised.exception))
+
+    def test_format_plan(self):
+        self.expect_create('CREATE')
+        self.expect_describe('CREATE_COMPLETE', [resource_change('Add', 'Topic')])
+        planned = self.create('CREATE')
+        text = format_plan(['app', 'db', 'web'], {'app': planned}, ['db'], {'web': ['app']}, {}, deletes=['old'])
+        self.assertEqual(text.splitlines()[-1], "Plan: 1 to create, 0 to update, 1 unchanged, 1 not planned, "
+                                                "1 to delete; resources: 1 to add, 0 to modify (0 may be replaced), "
+                                                "0 to remove")
+        self.assertIn("Stack web: not planned, needs the outputs of app", text)
+
+
+class FingerprintCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'fingerprints.json')
+        self.fingerprint = stack_fingerprint(TEMPLATE, PARAMETERS, ['CAPABILITY_IAM'])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_fingerprint_ignores_parameter_and_capability_order(self):
+        parameters = PARAMETERS + [{'ParameterKey': 'Env', 'ParameterValue': 'dev'}]
+        self.assertEqual(stack_fingerprint(TEMPLATE, parameters, ['A', 'B']),
+                         stack_fingerprint(TEMPLATE, list(reversed(parameters)), ['B', 'A']))
+        self.assertNotEqual(stack_fingerprint(TEMPLATE, PARAMETERS), stack_fingerprint(TEMPLATE + ' ', PARAMETERS))
+
+    def test_matches_only_while_the_stack_was_not_updated_since(self):
+        cache = FingerprintCache(self.path, 'us-east-1')
+        cache.put('app', self.fingerprint, UPDATED, [{'OutputKey': 'Arn', 'OutputValue': 'arn', 'Description': 'x'}])
+        cache.save()
+
+        cache = FingerprintCache(self.path, 'us-east-1').load()
+        self.assertTrue(cache.matches('app', self.fingerprint, UPDATED))
+        self.assertEqual(cache.outputs('app'), [{'OutputKey': 'Arn', 'OutputValue': 'arn'}])
+        self.assertFalse(cache.matches('app', self.fingerprint, '2024-01-02T12:00:00+00:00'))
+        self.assertFalse(cache.matches('app', self.fingerprint, None))
+        self.assertFalse(cache.matches('app', 'other', UPDATED))
+        self.assertFalse(FingerprintCache(self.path, 'eu-west-1').load().matches('app', self.fingerprint, UPDATED))
+
+    def test_outputs_are_required_only_when_needed(self):
+        cache = FingerprintCache(self.path)
+        cache.put('app', self.fingerprint, UPDATED)
+        self.assertFalse(cache.matches('app', self.fingerprint, UPDATED))
+        self.assertTrue(cache.matches('app', self.fingerprint, UPDATED, need_outputs=False))
+        cache.remove('app')
+        self.assertFalse(cache.matches('app', self.fingerprint, UPDATED, need_outputs=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
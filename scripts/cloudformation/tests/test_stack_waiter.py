@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+import datetime
+import os
+import sys
+import unittest
+
+from botocore.stub import Stubber
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cloudformation_stubs import client  # noqa: E402
+from stack_waiter import StackWaiter, StackWaitError, StackWaitTimeout, WatchedStack  # noqa: E402
+
+START = datetime.datetime(2024, 1, 1, 12, 0, 0, tzinfo=datetime.timezone.utc)
+
+
+def event(event_id, logical_id, status, seconds=0, token='token', resource_type='AWS::SNS::Topic', reason=None):
+    _event = {
+        'StackId': 'arn:aws:cloudformation:us-east-1:123456789012:stack/app/1',
+        'EventId': event_id,
+        'StackName': 'app',
+        'LogicalResourceId': logical_id,
+        'ResourceType': resource_type,
+        'ResourceStatus': status,
+        'Timestamp': START + datetime.timedelta(seconds=seconds),
+    }
+    if token is not None:
+        _event['ClientRequestToken'] = token
+    if reason is not None:
+        _event['ResourceStatusReason'] = reason
+    return _event
+
+
+def stack_event(event_id, status, seconds=0, token='token', reason=None):
+    return event(event_id, 'app', status, seconds, token, 'AWS::CloudFormation::Stack', reason)
+
+
+class StackWaiterTest(unittest.TestCase):
+    """Replays describe_stack_events sequences through a Stubber and calls poll() directly."""
+
+    def setUp(self):
+        self.client = client()
+        self.stubber = Stubber(self.client)
+        self.stubber.activate()
+        self.now = 1000.0
+        self.waiter = StackWaiter(self.client, min_delay=1, max_delay=8, clock=lambda: self.now)
+
+    def tearDown(self):
+        self.stubber.deactivate()
+
+    def follow(self, operation='CREATE', token='token'):
+        # Not through watch(), which starts the polling thread
+        watched = WatchedStack('app', operation, token, START - datetime.timedelta(seconds=60))
+        watched.delay = self.waiter.min_delay
+        self.waiter.watched.append(watched)
+        return watched
+
+    def respond(self, events, next_token=None, request_token=None):
+        response = {'StackEvents': events}
+        if next_token is not None:
+            response['NextToken'] = next_token
+        expected = {'StackName': 'app'}
+        if request_token is not None:
+            expected['NextToken'] = request_token
+        self.stubber.add_response('describe_stack_events', response, expected)
+
+    def poll(self):
+        self.now += 100
+        return self.waiter.poll()
+
+    def test_reads_events_of_the_operation_until_it_completes(self):
+        watched = self.follow()
+        self.respond([
+            event('3', 'Topic', 'CREATE_IN_PROGRESS', 2),
+            stack_event('2', 'CREATE_IN_PROGRESS', 1),
+            stack_event('1', 'UPDATE_COMPLETE', token='older-operation'),
+        ])
+        self.assertEqual(self.poll(), [watched])
+        self.assertEqual(watched.last_event_id, '3')
+
+        # Only the events newer than the last one seen are read
+        self.respond([
+            stack_event('5', 'CREATE_COMPLETE', 4),
+            event('4', 'Topic', 'CREATE_COMPLETE', 3),
+            event('3', 'Topic', 'CREATE_IN_PROGRESS', 2),
+            stack_event('2', 'CREATE_IN_PROGRESS', 1),
+        ])
+        self.assertEqual(self.poll(), [])
+        self.assertEqual(watched.wait(0), 'CREATE_COMPLETE')
+        self.assertEqual(self.waiter.api_count, 2)
+        self.stubber.assert_no_pending_responses()
+
+    def test_pages_until_the_last_event_seen(self):
+        watched = self.follow()
+        self.respond([stack_event('1', 'CREATE_IN_PROGRESS')])
+        self.poll()
+        self.respond([event('4', 'Topic', 'CREATE_COMPLETE', 3), event('3', 'Topic', 'CREATE_IN_PROGRESS', 2)],
+                     next_token='page-2')
+        self.respond([event('2', 'Queue', 'CREATE_COMPLETE', 1), stack_event('1', 'CREATE_IN_PROGRESS')],
+                     request_token='page-2')
+        self.poll()
+        self.assertEqual(watched.last_event_id, '4')
+        self.assertFalse(watched.done.is_set())
+        self.stubber.assert_no_pending_responses()
+
+    def test_quiet_stacks_back_off_and_news_resets_the_delay(self):
+        watched = self.follow()
+        self.respond([])
+        self.poll()
+        self.assertEqual(watched.delay, 1.5)
+        self.respond([])
+        self.poll()
+        self.assertEqual(watched.delay, 2.25)
+        self.respond([stack_event('1', 'CREATE_IN_PROGRESS')])
+        self.poll()
+        self.assertEqual(watched.delay, 1)
+
+    def test_failure_reports_the_first_resource_failure(self):
+        watched = self.follow()
+        self.respond([
+            stack_event('5', 'ROLLBACK_COMPLETE', 5),
+            event('4', 'Queue', 'CREATE_FAILED', 4, reason='Resource creation cancelled'),
+            event('3', 'Topic', 'CREATE_FAILED', 3, reason='Topic name already taken'),
+            stack_event('2', 'CREATE_IN_PROGRESS', 1),
+        ])
+        self.poll()
+        with self.assertRaises(StackWaitError) as raised:
+            watched.wait(0)
+        self.assertEqual(raised.exception.status, 'ROLLBACK_COMPLETE')
+        self.assertEqual(raised.exception.reason, 'Topic: Topic name already taken')
+
+    def test_throttling_doubles_the_delay(self):
+        watched = self.follow()
+        self.stubber.add_client_error('describe_stack_events', service_error_code='Throttling',
+                                      service_message='Rate exceeded')
+        self.assertEqual(self.poll(), [watched])
+        self.assertEqual(watched.delay, 2)
+        self.assertFalse(watched.done.is_set())
+
+    def test_other_errors_go_to_the_waiting_caller(self):
+        watched = self.follow()
+        self.stubber.add_client_error('describe_stack_events', service_error_code='AccessDenied',
+                                      service_message='Not allowed')
+        self.assertEqual(self.poll(), [])
+        with self.assertRaises(Exception) as raised:
+            watched.wait(0)
+        self.assertIn('AccessDenied', str(raised.exception))
+
+    def test_deleted_stack_that_no_longer_exists_is_complete(self):
+        watched = self.follow('DELETE')
+        self.stubber.add_client_error('describe_stack_events', service_error_code='ValidationError',
+                                      service_message='Stack [app] does not exist')
+        self.poll()
+        self.assertEqual(watched.wait(0), 'DELETE_COMPLETE')
+
+    def test_without_a_token_waits_for_the_operation_to_start(self):
+        watched = self.follow(token=None)
+        # The previous operation's events, within the clock skew allowance, are not taken for this one
+        self.respond([stack_event('2', 'UPDATE_COMPLETE', token=None),
+                      event('1', 'Topic', 'UPDATE_COMPLETE', token=None)])
+        self.poll()
+        self.assertIsNone(watched.last_event_id)
+        self.respond([
+            stack_event('4', 'CREATE_COMPLETE', 4, token=None),
+            stack_event('3', 'CREATE_IN_PROGRESS', 3, token=None),
+            stack_event('2', 'UPDATE_COMPLETE', token=None),
+        ])
+        self.poll()
+        self.assertEqual(watched.wait(0), 'CREATE_COMPLETE')
+
+    def test_timeout_is_its_own_error(self):
+        watched = self.follow()
+        with self.assertRaises(StackWaitTimeout) as raised:
+            watched.wait(0.01)
+        self.assertEqual(str(raised.exception), "Stack app did not reach a final state within 0.01 seconds")
+        self.assertIsNone(raised.exception.status)
+
+
+if __name__ == '__main__':
+    unittest.main()
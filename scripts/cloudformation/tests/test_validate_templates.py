@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, DIRECTORY)
+
+from validate_templates import (TemplateModel, check_definition, check_file, check_files,  # noqa: E402
+                                check_parameter_value, check_template, validate_definition)
+
+TEMPLATES = os.path.abspath(os.path.join(DIRECTORY, '..', '..', 'cloudformation', 'templates'))
+
+TEMPLATE = {
+    'Parameters': {
+        'Environment': {'Type': 'String', 'AllowedValues': ['dev', 'prod']},
+        'Size': {'Type': 'Number', 'Default': '2'},
+    },
+    'Mappings': {'Regions': {'us-east-1': {'Ami': 'ami-12345678'}}},
+    'Conditions': {'IsProd': {'Fn::Equals': [{'Ref': 'Environment'}, 'prod']}},
+    'Resources': {
+        'Queue': {'Type': 'AWS::SQS::Queue', 'Condition': 'IsProd', 'Properties': {'DelaySeconds': {'Ref': 'Size'}}},
+        'Topic': {
+            'Type': 'AWS::SNS::Topic',
+            'DependsOn': 'Queue',
+            'Properties': {
+                'DisplayName': {'Fn::Sub': '${Environment}-${AWS::Region}-${Queue.Arn}'},
+                'Subscription': [{'Endpoint': {'Fn::GetAtt': ['Queue', 'Arn']}, 'Protocol': 'sqs'}],
+                'TopicName': {'Fn::FindInMap': ['Regions', {'Ref': 'AWS::Region'}, 'Ami']},
+                'KmsMasterKeyId': {'Fn::If': ['IsProd', 'alias/prod', {'Ref': 'AWS::NoValue'}]},
+            },
+        },
+    },
+    'Outputs': {'TopicArn': {'Value': {'Ref': 'Topic'}}},
+}
+
+RESOURCE_TYPES = {
+    'AWS::SQS::Queue': {'Attributes': ['Arn', 'QueueName'], 'Properties': {
+        'DelaySeconds': {'Required': False}, 'QueueName': {'Required': False}}},
+    'AWS::SNS::Topic': {'Attributes': ['TopicName'], 'Properties': dict(
+        (name, {'Required': False}) for name in ('DisplayName', 'Subscription', 'TopicName', 'KmsMasterKeyId'))},
+}
+
+
+def findings(document, resource_types=None):
+    return [(finding.severity, finding.where, finding.message)
+            for finding in check_template(TemplateModel('template.json', document), resource_types)]
+
+
+def changed(**sections):
+    document = json.loads(json.dumps(TEMPLATE))
+    for section, items in sections.items():
+        if items is None:
+            del document[section]
+        else:
+            document.setdefault(section, {}).update(items)
+    return document
+
+
+class TemplateModelTest(unittest.TestCase):
+
+    def test_collects_every_reference(self):
+        model = TemplateModel('template.json', TEMPLATE)
+        self.assertEqual(sorted(name for where, name, in_conditions in model.refs),
+                         ['AWS::NoValue', 'AWS::Region', 'AWS::Region', 'Environment', 'Environment', 'Size', 'Topic'])
+        self.assertEqual([(where, name) for where, name, in_conditions in model.refs if in_conditions],
+                         [('Conditions.IsProd.Fn::Equals.0', 'Environment')])
+        self.assertEqual(sorted(model.getatts), [
+            ('Resources.Topic.Properties.DisplayName.Fn::Sub', 'Queue', 'Arn'),
+            ('Resources.Topic.Properties.Subscription.0.Endpoint', 'Queue', 'Arn'),
+        ])
+        self.assertEqual(model.map_refs, [('Resources.Topic.Properties.TopicName', 'Regions', None)])
+        self.assertEqual(sorted(name for where, name in model.condition_refs), ['IsProd', 'IsProd'])
+        self.assertEqual(model.depends_on, [('Resources.Topic.DependsOn', 'Queue')])
+
+    def test_getatt_and_sub_forms(self):
+        model = TemplateModel('template.json', {'Resources': {'Topic': {'Type': 'AWS::SNS::Topic', 'Properties': {
+            'A': {'Fn::GetAtt': 'Queue.Arn'},
+            'B': {'Fn::Sub': ['${Name}-${Other}-${!Literal}', {'Name': {'Ref': 'Param'}}]},
+        }}}})
+        self.assertEqual(sorted((resource, attribute) for where, resource, attribute in model.getatts),
+                         [('Queue', 'Arn')])
+        self.assertEqual(sorted(name for where, name, in_conditions in model.refs), ['Other', 'Param'])
+
+    def test_summary(self):
+        self.assertEqual(TemplateModel('template.json', TEMPLATE).summary(),
+                         {'Parameters': TEMPLATE['Parameters'], 'Outputs': ['TopicArn']})
+
+
+class CheckTemplateTest(unittest.TestCase):
+
+    def test_valid_template(self):
+        self.assertEqual(findings(TEMPLATE, RESOURCE_TYPES), [])
+
+    def test_undefined_targets(self):
+        document = changed(Resources={'Broken': {
+            'Type': 'AWS::SNS::Topic',
+            'DependsOn': ['Queue', 'Missing'],
+            'Condition': 'IsDev',
+            'Properties': {
+                'DisplayName': {'Ref': 'Nothing'},
+                'TopicName': {'Fn::GetAtt': ['Ghost', 'Arn']},
+                'Subscription': {'Fn::Sub': '${Unknown}'},
+                'KmsMasterKeyId': {'Fn::FindInMap': ['Regions', 'eu-west-1', 'Ami']},
+                'Tags': {'Fn::FindInMap': ['Zones', 'a', 'b']},
+            },
+        }})
+        self.assertEqual(sorted(findings(document)), sorted([
+            ('error', 'Resources.Broken.Properties.DisplayName',
+             "Ref to Nothing, which is not a parameter or resource"),
+            ('error', 'Resources.Broken.Properties.Subscription.Fn::Sub',
+             "Ref to Unknown, which is not a parameter or resource"),
+            ('error', 'Resources.Broken.Properties.TopicName', "Fn::GetAtt of Ghost, which is not a resource"),
+            ('error', 'Resources.Broken.Condition', "Condition IsDev is not defined"),
+            ('error', 'Resources.Broken.DependsOn', "DependsOn Missing, which is not a resource"),
+            ('error', 'Resources.Broken.Properties.KmsMasterKeyId', "Mapping Regions has no key eu-west-1"),
+            ('error', 'Resources.Broken.Properties.Tags', "Fn::FindInMap of Zones, which is not a mapping"),
+        ]))
+
+    def test_conditions_cannot_refer_to_resources(self):
+        document = changed(Conditions={'HasQueue': {'Fn::Equals': [{'Ref': 'Queue'}, '']}},
+                           Outputs={'Queue': {'Condition': 'HasQueue', 'Value': 'x'}})
+        self.assertEqual(findings(document), [
+            ('error', 'Conditions.HasQueue.Fn::Equals.0',
+             "Conditions can only refer to parameters, not resource Queue"),
+        ])
+
+    def test_unused_parameters_and_conditions_are_warnings(self):
+        document = changed(Parameters={'Unused': {'Type': 'String'}},
+                           Conditions={'Never': {'Fn::Equals': ['a', 'b']}})
+        self.assertEqual(sorted(findings(document)), [
+            ('warning', 'Conditions.Never', "Condition is never used"),
+            ('warning', 'Parameters.Unused', "Parameter is never used"),
+        ])
+
+    def test_parameters(self):
+        document = changed(Parameters={
+            'NoType': {'Description': 'x'},
+            'BadType': {'Type': 'Boolean'},
+            'Subnets': {'Type': 'List<AWS::EC2::Subnet::Id>'},
+            'Ssm': {'Type': 'AWS::SSM::Parameter::Value<String>'},
+            'BadDefault': {'Type': 'String', 'AllowedValues': ['a'], 'Default': 'b'},
+        })
+        errors = [(where, message) for severity, where, message in findings(document) if severity == 'error']
+        self.assertEqual(sorted(errors), [
+            ('Parameters.BadDefault.Default', "b is not one of the AllowedValues"),
+            ('Parameters.BadType.Type', "Unknown parameter type Boolean"),
+            ('Parameters.NoType', "Parameter has no Type"),
+        ])
+
+    def test_structure(self):
+        self.assertEqual(findings([]), [('error', '', "Not a template: the top level is not an object")])
+        self.assertIn(('error', 'Resources', "A template needs at least one resource"),
+                      findings(changed(Resources=None)))
+        document = changed(Resources={'NoType': {}, 'Bad': {'Type': 'SNS Topic'}}, Outputs={'Empty': {}})
+        self.assertEqual(sorted(f for f in findings(document) if f[0] == 'error'), [
+            ('error', 'Outputs.Empty', "Output has no Value"),
+            ('error', 'Resources.Bad.Type', "Malformed resource type SNS Topic"),
+            ('error', 'Resources.NoType', "Resource has no Type"),
+        ])
+
+    def test_limits(self):
+        document = changed(Resources=dict(('Queue%d' % i, {'Type': 'AWS::SQS::Queue'}) for i in range(500)))
+        self.assertIn(('error', 'Resources', "502 resources, more than the 500 allowed"), findings(document))
+        model = TemplateModel('template.json', TEMPLATE, size=60000)
+        self.assertEqual(check_template(model)[0].message,
+                         "Template is 60000 bytes, more than the 51200 that can be sent as TemplateBody")
+
+    def test_resource_specification(self):
+        document = changed(Resources={'Other': {'Type': 'AWS::SNS::Topic', 'Properties': {
+            'Name': {'Fn::GetAtt': ['Queue', 'Url']},
+            'Stack': {'Fn::GetAtt': ['Nested', 'Outputs.Name']},
+        }}, 'Nested': {'Type': 'AWS::CloudFormation::Stack'}, 'Custom': {'Type': 'Custom::Thing'}})
+        specification = dict(RESOURCE_TYPES, **{'AWS::SQS::Queue': {'Attributes': ['Arn'], 'Properties': {
+            'DelaySeconds': {'Required': False}, 'QueueName': {'Required': True}}}})
+        self.assertEqual(sorted(findings(document, specification)), [
+            ('error', 'Resources.Nested.Type', "Unknown resource type AWS::CloudFormation::Stack"),
+            ('error', 'Resources.Other.Properties.Name', "AWS::SNS::Topic has no property Name"),
+            ('error', 'Resources.Other.Properties.Name', "AWS::SQS::Queue has no attribute Url"),
+            ('error', 'Resources.Other.Properties.Stack', "AWS::SNS::Topic has no property Stack"),
+            ('error', 'Resources.Queue.Properties', "AWS::SQS::Queue needs property QueueName"),
+        ])
+
+
+class CheckParameterValueTest(unittest.TestCase):
+
+    def test_allowed_values(self):
+        parameter = {'Type': 'String', 'AllowedValues': ['dev', 'prod']}
+        self.assertEqual(check_parameter_value(parameter, 'dev'), [])
+        self.assertEqual(check_parameter_value(parameter, 'qa'), ["qa is not one of the AllowedValues"])
+
+    def test_lists_check_every_item(self):
+        parameter = {'Type': 'CommaDelimitedList', 'AllowedValues': ['a', 'b']}
+        self.assertEqual(check_parameter_value(parameter, 'a,b'), [])
+        self.assertEqual(check_parameter_value(parameter, ['a', 'c']), ["c is not one of the AllowedValues"])
+
+    def test_allowed_pattern_matches_the_whole_value(self):
+        parameter = {'Type': 'String', 'AllowedPattern': '[a-z]+'}
+        self.assertEqual(check_parameter_value(parameter, 'abc'), [])
+        self.assertEqual(check_parameter_value(parameter, 'abc1'), ["abc1 does not match AllowedPattern [a-z]+"])
+        # Java-only syntax is left to CloudFormation
+        self.assertEqual(check_parameter_value({'Type': 'String', 'AllowedPattern': '\\p{javaLowerCase}+'}, 'A'), [])
+
+    def test_lengths(self):
+        parameter = {'Type': 'String', 'MinLength': '2', 'MaxLength': 3}
+        self.assertEqual(check_parameter_value(parameter, 'ab'), [])
+        self.assertEqual(check_parameter_value(parameter, 'a'), ["a is shorter than MinLength 2"])
+        self.assertEqual(check_parameter_value(parameter, 'abcd'), ["abcd is longer than MaxLength 3"])
+
+    def test_numbers(self):
+        parameter = {'Type': 'Number', 'MinValue': '1', 'MaxValue': '10'}
+        self.assertEqual(check_parameter_value(parameter, 5), [])
+        self.assertEqual(check_parameter_value(parameter, '0'), ["0 is less than MinValue 1"])
+        self.assertEqual(check_parameter_value(parameter, '11.5'), ["11.5 is more than MaxValue 10"])
+        self.assertEqual(check_parameter_value(parameter, 'x'), ["x is not a number"])
+        self.assertEqual(check_parameter_value({'Type': 'List<Number>', 'MaxValue': 3}, '1,4'),
+                         ["4 is more than MaxValue 3"])
+
+
+class FileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, text):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_yaml_short_form_tags(self):
+        path = self.write('template.yml', '\n'.join([
+            'Parameters:',
+            '  Environment: {Type: String}',
+            'Conditions:',
+            '  IsProd: !Equals [!Ref Environment, prod]',
+            'Resources:',
+            '  Queue: {Type: "AWS::SQS::Queue"}',
+            '  Topic:',
+            '    Type: AWS::SNS::Topic',
+            '    Condition: IsProd',
+            '    Properties:',
+            '      DisplayName: !Sub "${Environment}-${Queue.Arn}"',
+            '      TopicName: !GetAtt Queue.QueueName',
+            '      KmsMasterKeyId: !If [IsProd, !GetAtt [Missing, Arn], !Ref "AWS::NoValue"]',
+            '      Tags: !Select [0, !GetAZs ""]',
+            '',
+        ]))
+        template_findings, summary = check_file(path)
+        self.assertEqual([(finding.where, finding.message) for finding in template_findings], [
+            ('Resources.Topic.Properties.KmsMasterKeyId.Fn::If.1', "Fn::GetAtt of Missing, which is not a resource"),
+        ])
+        self.assertEqual(summary, {'Parameters': {'Environment': {'Type': 'String'}}, 'Outputs': []})
+
+    def test_unparseable_templates(self):
+        template_findings, summary = check_file(self.write('broken.json', '{"Resources": '))
+        self.assertIsNone(summary)
+        self.assertTrue(template_findings[0].message.startswith("Could not read template"))
+        template_findings, summary = check_file(self.write('broken.yml', 'Resources: [\n'))
+        self.assertIsNone(summary)
+        self.assertTrue(template_findings[0].message.startswith("Could not parse template"))
+
+    def test_repository_templates_have_no_errors(self):
+        paths = [os.path.join(TEMPLATES, name) for name in sorted(os.listdir(TEMPLATES))
+                 if name.endswith(('.json', '.yml'))]
+        template_findings, summaries = check_files(paths, jobs=1)
+        self.assertEqual([finding for finding in template_findings if finding.severity == 'error'], [])
+        self.assertEqual(len(summaries), len(paths))
+
+
+def stack(name, template, **properties):
+    return {name: {'Properties': dict({'Template': 'file://' + template}, **properties)}}
+
+
+class CheckDefinitionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.network = self.template('network.json', {'Environment': {'Type': 'String'}}, ['VpcId'])
+        self.app = self.template('app.json', {
+            'Environment': {'Type': 'String', 'AllowedValues': ['dev', 'prod']},
+            'VpcId': {'Type': 'String'},
+            'Size': {'Type': 'Number', 'Default': '1'},
+        }, [])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def template(self, name, parameters, outputs):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as f:
+            json.dump({'Parameters': parameters, 'Resources': {'Queue': {'Type': 'AWS::SQS::Queue'}},
+                       'Outputs': dict((output, {'Value': output}) for output in outputs)}, f)
+        return path
+
+    def definition(self, stacks, pairs=(), existing_stacks=()):
+        return {
+            'Parameters': {'KeyValuePairs': [{'ParameterKey': key, 'ParameterValue': value} for key, value in pairs],
+                           'ExistingStacks': list(existing_stacks)},
+            'StacksToCreateOrUpdate': stacks,
+        }
+
+    def messages(self, definition):
+        return [(finding.severity, finding.where, finding.message)
+                for finding in validate_definition(definition, 'definition.json', jobs=1)
+                if finding.path == 'definition.json']
+
+    def test_outputs_of_earlier_stacks_are_parameters(self):
+        definition = self.definition([stack('Network', self.network), stack('App', self.app)], [('Environment', 'dev')])
+        self.assertEqual(self.messages(definition), [])
+
+    def test_missing_and_invalid_parameters(self):
+        definition = self.definition([stack('App', self.app), stack('Network', self.network)],
+                                     [('Environment', 'qa')])
+        self.assertEqual(self.messages(definition), [
+            ('error', 'StacksToCreateOrUpdate.App', "Parameter Environment: qa is not one of the AllowedValues"),
+            ('error', 'StacksToCreateOrUpdate.App', "Parameter VpcId is not given"),
+        ])
+
+    def test_depends_on_makes_outputs_of_later_stacks_available(self):
+        definition = self.definition([stack('App', self.app, DependsOn=['Network']), stack('Network', self.network)],
+                                     [('Environment', 'dev')])
+        self.assertEqual(self.messages(definition), [])
+
+    def test_outputs_not_added_to_parameters(self):
+        definition = self.definition([stack('Network', self.network, AddOutputsToParameters=False),
+                                      stack('App', self.app)], [('Environment', 'dev')])
+        self.assertEqual(self.messages(definition), [
+            ('error', 'StacksToCreateOrUpdate.App', "Parameter VpcId is not given"),
+        ])
+
+    def test_existing_stacks_turn_missing_parameters_into_warnings(self):
+        definition = self.definition([stack('App', self.app)], [('Environment', 'dev')],
+                                     existing_stacks=[{'Network': 'network stack'}])
+        self.assertEqual(self.messages(definition), [
+            ('warning', 'StacksToCreateOrUpdate.App', "Parameter VpcId is only given if an existing stack outputs it"),
+        ])
+
+    def test_conflicting_values(self):
+        definition = self.definition([stack('Network', self.network)],
+                                     [('Environment', 'dev'), ('Environment', 'prod')])
+        self.assertEqual(self.messages(definition), [
+            ('error', 'StacksToCreateOrUpdate.Network', "Parameter Environment has several values: dev, prod"),
+        ])
+
+    def test_parameter_files(self):
+        path = os.path.join(self.tmp, 'parameters.json')
+        with open(path, 'w') as f:
+            json.dump([{'ParameterKey': 'Environment', 'ParameterValue': 'prod'}], f)
+        definition = self.definition([stack('Network', self.network)])
+        definition['Parameters']['Files'] = [{'Common': {'Properties': {'Path': 'file://' + path}}}]
+        self.assertEqual(self.messages(definition), [])
+        definition['Parameters']['Files'] = [{'Common': {'Properties': {'Path': 'file://' + path + '.missing'}}}]
+        self.assertEqual(self.messages(definition)[0][:2], ('error', 'Parameters'))
+
+    def test_unreadable_templates_are_skipped(self):
+        definition = self.definition([stack('Missing', os.path.join(self.tmp, 'missing.json'))])
+        self.assertEqual(check_definition(definition, {}), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
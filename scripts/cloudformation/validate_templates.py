@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import re
+import sys
+from urllib.parse import urlparse
+
+PSEUDO_PARAMETERS = ['AWS::AccountId', 'AWS::NotificationARNs', 'AWS::NoValue', 'AWS::Partition', 'AWS::Region',
+                     'AWS::StackId', 'AWS::StackName', 'AWS::URLSuffix']
+PARAMETER_TYPES = ['String', 'Number', 'List<Number>', 'CommaDelimitedList']
+PARAMETER_TYPE_PATTERN = re.compile(r'^(AWS::[A-Za-z0-9]+::[A-Za-z0-9:]+|List<AWS::[A-Za-z0-9]+::[A-Za-z0-9:]+>|'
+                                    r'AWS::SSM::Parameter::(Name|Value<.+>))$')
+RESOURCE_TYPE_PATTERN = re.compile(r'^((AWS|Alexa)::[A-Za-z0-9]+::[A-Za-z0-9]+|Custom::[A-Za-z0-9_@-]{1,60})$')
+SUB_VARIABLE = re.compile(r'\$\{([^!}][^}]*)\}')
+# Sizes past which CloudFormation rejects a template sent as TemplateBody
+MAX_TEMPLATE_BODY = 51200
+MAX_PARAMETERS = 200
+MAX_RESOURCES = 500
+MAX_OUTPUTS = 200
+
+Finding = collections.namedtuple('Finding', ['severity', 'path', 'where', 'message'])
+
+# Resource type -> {'Attributes': ..., 'Properties': ...} of a CloudFormation resource specification, set per worker
+_resource_types = None
+
+
+def load_document(path):
+    """Returns the template parsed from JSON, or from YAML with the short form of intrinsic functions."""
+    with open(path) as f:
+        body = f.read()
+    if not path.endswith(('.yml', '.yaml')):
+        return body, json.loads(body)
+    import yaml
+
+    class Loader(yaml.SafeLoader):
+        pass
+
+    def intrinsic(loader, suffix, node):
+        name = suffix if suffix in ('Ref', 'Condition') else 'Fn::' + suffix
+        if isinstance(node, yaml.ScalarNode):
+            value = loader.construct_scalar(node)
+            if name == 'Fn::GetAtt':
+                value = value.split('.', 1)
+        elif isinstance(node, yaml.SequenceNode):
+            value = loader.construct_sequence(node, deep=True)
+        else:
+            value = loader.construct_mapping(node, deep=True)
+        return {name: value}
+    Loader.add_multi_constructor('!', intrinsic)
+    return body, yaml.load(body, Loader=Loader)
+
+
+class TemplateModel(object):
+    """
+    A template parsed once, with its sections indexed by logical name and every reference between them collected
+    in one walk: Ref, Fn::GetAtt, Fn::Sub variables, Fn::FindInMap, conditions and DependsOn. References are
+    (where, ...) tuples, where is the dotted location in the template.
+    """
+
+    def __init__(self, path, document, size=0):
+        self.path = path
+        self.size = size
+        self.document = document if isinstance(document, dict) else {}
+        self.parameters = self.section('Parameters')
+        self.mappings = self.section('Mappings')
+        self.conditions = self.section('Conditions')
+        self.resources = self.section('Resources')
+        self.outputs = self.section('Outputs')
+        self.refs = []
+        self.getatts = []
+        self.condition_refs = []
+        self.map_refs = []
+        self.depends_on = []
+        self.index()
+
+    def section(self, name):
+        value = self.document.get(name)
+        return value if isinstance(value, dict) else {}
+
+    def index(self):
+        for name, condition in self.conditions.items():
+            self.walk(condition, 'Conditions.' + name, in_conditions=True)
+        for name, resource in self.resources.items():
+            if not isinstance(resource, dict):
+                continue
+            where = 'Resources.' + name
+            if 'Condition' in resource:
+                self.condition_refs.append((where + '.Condition', resource['Condition']))
+            depends_on = resource.get('DependsOn', [])
+            for target in [depends_on] if isinstance(depends_on, str) else depends_on:
+                self.depends_on.append((where + '.DependsOn', target))
+            for key in ('Properties', 'Metadata', 'CreationPolicy', 'UpdatePolicy'):
+                if key in resource:
+                    self.walk(resource[key], where + '.' + key)
+        for name, output in self.outputs.items():
+            if not isinstance(output, dict):
+                continue
+            where = 'Outputs.' + name
+            if 'Condition' in output:
+                self.condition_refs.append((where + '.Condition', output['Condition']))
+            self.walk(output.get('Value'), where + '.Value')
+            if 'Export' in output:
+                self.walk(output['Export'], where + '.Export')
+
+    def walk(self, node, where, in_conditions=False):
+        if isinstance(node, list):
+            for i, item in enumerate(node):
+                self.walk(item, '%s.%d' % (where, i), in_conditions)
+            return
+        if not isinstance(node, dict):
+            return
+        if len(node) == 1:
+            function, value = next(iter(node.items()))
+            if function == 'Ref' and isinstance(value, str):
+                self.refs.append((where, value, in_conditions))
+                return
+            if function == 'Fn::GetAtt':
+                if isinstance(value, str):
+                    value = value.split('.', 1)
+                if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str):
+                    self.getatts.append((where, value[0], value[1] if isinstance(value[1], str) else None))
+                    self.walk(value[1], where + '.Fn::GetAtt', in_conditions)
+                    return
+            if function == 'Fn::Sub':
+                template, variables = (value, {}) if isinstance(value, str) else (value + [None, None])[:2]
+                variables = variables if isinstance(variables, dict) else {}
+                self.walk(variables, where + '.Fn::Sub', in_conditions)
+                if isinstance(template, str):
+                    for name in SUB_VARIABLE.findall(template):
+                        if name in variables:
+                            continue
+                        if '.' in name:
+                            resource, attribute = name.split('.', 1)
+                            self.getatts.append((where + '.Fn::Sub', resource, attribute))
+                        else:
+                            self.refs.append((where + '.Fn::Sub', name, in_conditions))
+                return
+            if function == 'Fn::If' and isinstance(value, list) and value and isinstance(value[0], str):
+                self.condition_refs.append((where + '.Fn::If.0', value[0]))
+                for i, item in enumerate(value[1:], 1):
+                    self.walk(item, '%s.Fn::If.%d' % (where, i), in_conditions)
+                return
+            if function == 'Condition' and in_conditions and isinstance(value, str):
+                self.condition_refs.append((where, value))
+                return
+            if function == 'Fn::FindInMap' and isinstance(value, list) and value:
+                if isinstance(value[0], str):
+                    self.map_refs.append((where, value[0], value[1] if len(value) > 1 and
+                                          isinstance(value[1], str) else None))
+                self.walk(value, where + '.Fn::FindInMap', in_conditions)
+                return
+        for key, value in node.items():
+            self.walk(value, where + '.' + key, in_conditions)
+
+    def summary(self):
+        """What the definition checks need, small enough to send back from a worker process."""
+        return {
+            'Parameters': dict((name, parameter) for name, parameter in self.parameters.items()
+                               if isinstance(parameter, dict)),
+            'Outputs': sorted(self.outputs),
+        }
+
+
+def check_template(model, resource_types=None):
+    """Returns the findings of one template; resource_types, from a resource specification, is optional."""
+    findings = []
+
+    def error(where, message):
+        findings.append(Finding('error', model.path, where, message))
+
+    def warning(where, message):
+        findings.append(Finding('warning', model.path, where, message))
+
+    if not model.document:
+        error('', "Not a template: the top level is not an object")
+        return findings
+    if not model.resources:
+        error('Resources', "A template needs at least one resource")
+    if model.size > MAX_TEMPLATE_BODY:
+        error('', "Template is %d bytes, more than the %d that can be sent as TemplateBody" % (
+            model.size, MAX_TEMPLATE_BODY))
+    for section, items, limit in (('Parameters', model.parameters, MAX_PARAMETERS),
+                                  ('Resources', model.resources, MAX_RESOURCES),
+                                  ('Outputs', model.outputs, MAX_OUTPUTS)):
+        if len(items) > limit:
+            error(section, "%d %s, more than the %d allowed" % (len(items), section.lower(), limit))
+        if section in model.document and not isinstance(model.document[section], dict):
+            error(section, "Section is not an object")
+
+    for name, parameter in model.parameters.items():
+        where = 'Parameters.' + name
+        if not isinstance(parameter, dict) or 'Type' not in parameter:
+            error(where, "Parameter has no Type")
+            continue
+        if parameter['Type'] not in PARAMETER_TYPES and not PARAMETER_TYPE_PATTERN.match(parameter['Type']):
+            error(where + '.Type', "Unknown parameter type %s" % parameter['Type'])
+        if 'Default' in parameter:
+            for message in check_parameter_value(parameter, parameter['Default']):
+                error(where + '.Default', message)
+
+    for name, resource in model.resources.items():
+        where = 'Resources.' + name
+        if not isinstance(resource, dict) or not isinstance(resource.get('Type'), str):
+            error(where, "Resource has no Type")
+            continue
+        resource_type = resource['Type']
+        if not RESOURCE_TYPE_PATTERN.match(resource_type):
+            error(where + '.Type', "Malformed resource type %s" % resource_type)
+        elif resource_types is not None and resource_type not in resource_types \
+                and not resource_type.startswith('Custom::'):
+            error(where + '.Type', "Unknown resource type %s" % resource_type)
+        elif resource_types is not None and resource_type in resource_types:
+            specified = resource_types[resource_type].get('Properties', {})
+            properties = resource.get('Properties', {})
+            if isinstance(properties, dict):
+                for property_name in properties:
+                    if property_name not in specified:
+                        error(where + '.Properties.' + property_name,
+                              "%s has no property %s" % (resource_type, property_name))
+                for property_name, specification in specified.items():
+                    if specification.get('Required') and property_name not in properties:
+                        error(where + '.Properties', "%s needs property %s" % (resource_type, property_name))
+
+    for name, output in model.outputs.items():
+        if not isinstance(output, dict) or 'Value' not in output:
+            error('Outputs.' + name, "Output has no Value")
+
+    referenced_parameters = set()
+    for where, name, in_conditions in model.refs:
+        if name in model.parameters:
+            referenced_parameters.add(name)
+        elif name in PSEUDO_PARAMETERS:
+            pass
+        elif name in model.resources:
+            if in_conditions:
+                error(where, "Conditions can only refer to parameters, not resource %s" % name)
+        else:
+            error(where, "Ref to %s, which is not a parameter or resource" % name)
+    for where, resource, attribute in model.getatts:
+        if resource not in model.resources:
+            error(where, "Fn::GetAtt of %s, which is not a resource" % resource)
+        elif resource_types is not None and attribute is not None:
+            resource_type = model.resources[resource].get('Type') if isinstance(model.resources[resource], dict) \
+                else None
+            attributes = resource_types.get(resource_type, {}).get('Attributes')
+            # Nested stack outputs (Outputs.Name) are not in the specification
+            if attributes is not None and '.' not in attribute and attribute not in attributes:
+                error(where, "%s has no attribute %s" % (resource_type, attribute))
+    for where, name in model.condition_refs:
+        if name not in model.conditions:
+            error(where, "Condition %s is not defined" % name)
+    for where, name in model.depends_on:
+        if name not in model.resources:
+            error(where, "DependsOn %s, which is not a resource" % name)
+    for where, mapping, key in model.map_refs:
+        if mapping not in model.mappings:
+            error(where, "Fn::FindInMap of %s, which is not a mapping" % mapping)
+        elif key is not None and isinstance(model.mappings[mapping], dict) and key not in model.mappings[mapping]:
+            error(where, "Mapping %s has no key %s" % (mapping, key))
+
+    for name in model.parameters:
+        if name not in referenced_parameters:
+            warning('Parameters.' + name, "Parameter is never used")
+    used_conditions = set(name for where, name in model.condition_refs)
+    for name in model.conditions:
+        if name not in used_conditions:
+            warning('Conditions.' + name, "Condition is never used")
+    return findings
+
+
+def check_parameter_value(parameter, value):
+    """Returns why value does not meet the parameter's constraints, if it does not."""
+    messages = []
+    value = str(value) if not isinstance(value, list) else ','.join(str(item) for item in value)
+    parameter_type = parameter.get('Type', 'String')
+    items = value.split(',') if parameter_type.startswith('List<') or parameter_type == 'CommaDelimitedList' \
+        else [value]
+    if 'AllowedValues' in parameter:
+        allowed = [str(allowed_value) for allowed_value in parameter['AllowedValues']]
+        for item in items:
+            if item not in allowed:
+                messages.append("%s is not one of the AllowedValues" % item)
+    if 'AllowedPattern' in parameter and len(items) == 1:
+        try:
+            if re.fullmatch(parameter['AllowedPattern'], value) is None:
+                messages.append("%s does not match AllowedPattern %s" % (value, parameter['AllowedPattern']))
+        except re.error:
+            # Patterns are Java regular expressions; the few Python cannot compile are left to CloudFormation
+            pass
+    if 'MinLength' in parameter and len(value) < int(parameter['MinLength']):
+        messages.append("%s is shorter than MinLength %s" % (value, parameter['MinLength']))
+    if 'MaxLength' in parameter and len(value) > int(parameter['MaxLength']):
+        messages.append("%s is longer than MaxLength %s" % (value, parameter['MaxLength']))
+    if parameter_type in ('Number', 'List<Number>'):
+        for item in items:
+            try:
+                number = float(item)
+            except ValueError:
+                messages.append("%s is not a number" % item)
+                continue
+            if 'MinValue' in parameter and number < float(parameter['MinValue']):
+                messages.append("%s is less than MinValue %s" % (item, parameter['MinValue']))
+            if 'MaxValue' in parameter and number > float(parameter['MaxValue']):
+                messages.append("%s is more than MaxValue %s" % (item, parameter['MaxValue']))
+    return messages
+
+
+def set_resource_types(resource_types):
+    global _resource_types
+    _resource_types = resource_types
+
+
+def check_file(path):
+    """Parses and checks one template; returns its findings and summary, or no summary when it does not parse."""
+    try:
+        body, document = load_document(path)
+    except (OSError, ValueError) as e:
+        return [Finding('error', path, '', "Could not read template: %s" % e)], None
+    except Exception as e:
+        # YAML errors, without importing yaml for JSON templates
+        return [Finding('error', path, '', "Could not parse template: %s" % e)], None
+    model = TemplateModel(path, document, len(body.encode('utf-8')))
+    return check_template(model, _resource_types), model.summary()
+
+
+def check_files(paths, jobs=None, resource_types=None):
+    """
+    Checks the templates, each in one of up to jobs worker processes; returns (findings, path -> summary).
+    With jobs of 1, or a single template, everything runs in this process.
+    """
+    paths = list(collections.OrderedDict.fromkeys(paths))
+    findings = []
+    summaries = {}
+    if jobs == 1 or len(paths) <= 1:
+        set_resource_types(resource_types)
+        results = [check_file(path) for path in paths]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=set_resource_types,
+                                                    initargs=(resource_types,)) as executor:
+            results = list(executor.map(check_file, paths, chunksize=4))
+    for path, (template_findings, summary) in zip(paths, results):
+        findings.extend(template_findings)
+        summaries[path] = summary
+    return findings, summaries
+
+
+def definition_path(url):
+    return os.path.expanduser(urlparse(url).path)
+
+
+def load_definition_values(product_definition):
+    """Returns parameter name -> values given by the definition's Files and KeyValuePairs."""
+    values = collections.OrderedDict()
+    parameters = product_definition.get('Parameters', {})
+    pairs = []
+    for parameter_file in parameters.get('Files', []):
+        for key in parameter_file:
+            with open(definition_path(parameter_file[key]['Properties']['Path'])) as f:
+                pairs.extend(json.load(f))
+    pairs.extend(parameters.get('KeyValuePairs', []))
+    for pair in pairs:
+        values.setdefault(pair['ParameterKey'], [])
+        if pair['ParameterValue'] not in values[pair['ParameterKey']]:
+            values[pair['ParameterKey']].append(pair['ParameterValue'])
+    return values
+
+
+def check_definition(product_definition, summaries, definition_file=''):
+    """
+    Returns the findings of checking every stack's template parameters against what the definition provides:
+    parameter files, key/value pairs and the outputs of the stacks it waits for. Outputs of ExistingStacks are not
+    known before calling CloudFormation, so parameters they might provide are warnings rather than errors.
+    """
+    findings = []
+    try:
+        values = load_definition_values(product_definition)
+    except (OSError, ValueError, KeyError) as e:
+        return [Finding('error', definition_file, 'Parameters', "Could not read parameters: %s" % e)]
+    existing_stacks = bool(product_definition.get('Parameters', {}).get('ExistingStacks'))
+    stacks = [(stack_name, stack[stack_name]['Properties'])
+              for stack in product_definition.get('StacksToCreateOrUpdate', []) for stack_name in stack]
+    summaries = dict((stack_name, summaries.get(definition_path(properties['Template'])))
+                     for stack_name, properties in stacks)
+    outputs = dict((stack_name, summaries[stack_name]['Outputs']) for stack_name, properties in stacks
+                   if summaries[stack_name] is not None and properties.get('AddOutputsToParameters', True) != False)
+    for i, (stack_name, properties) in enumerate(stacks):
+        if summaries[stack_name] is None:
+            continue
+        # A stack gets the outputs of the stacks before it, and of those it explicitly depends on
+        available = set()
+        for producer in [name for name, _ in stacks[:i]] + properties.get('DependsOn', []):
+            available.update(outputs.get(producer, ()))
+        where = 'StacksToCreateOrUpdate.%s' % stack_name
+        for name, parameter in summaries[stack_name]['Parameters'].items():
+            if name in values:
+                if len(values[name]) > 1:
+                    findings.append(Finding('error', definition_file, where, "Parameter %s has several values: %s" % (
+                        name, ', '.join(str(value) for value in values[name]))))
+                    continue
+                for message in check_parameter_value(parameter, values[name][0]):
+                    findings.append(Finding('error', definition_file, where, "Parameter %s: %s" % (name, message)))
+            elif name in available or 'Default' in parameter:
+                continue
+            elif existing_stacks:
+                findings.append(Finding('warning', definition_file, where,
+                                        "Parameter %s is only given if an existing stack outputs it" % name))
+            else:
+                findings.append(Finding('error', definition_file, where, "Parameter %s is not given" % name))
+    return findings
+
+
+def definition_templates(product_definition):
+    return [definition_path(stack[stack_name]['Properties']['Template'])
+            for stack in product_definition.get('StacksToCreateOrUpdate', []) for stack_name in stack]
+
+
+def validate_definition(product_definition, definition_file='', jobs=None, resource_types=None):
+    """Checks the templates of the definition's stacks, then their parameters; returns the findings."""
+    findings, summaries = check_files(definition_templates(product_definition), jobs, resource_types)
+    return findings + check_definition(product_definition, summaries, definition_file)
+
+
+def load_resource_types(path):
+    """Reads the ResourceTypes of a CloudFormation resource specification file."""
+    with open(path) as f:
+        specification = json.load(f)
+    return dict((resource_type, {'Attributes': sorted(details.get('Attributes', {})),
+                                 'Properties': dict((name, {'Required': property_details.get('Required', False)})
+                                                    for name, property_details in details.get('Properties', {}).items())})
+                for resource_type, details in specification.get('ResourceTypes', {}).items())
+
+
+def format_finding(finding):
+    location = finding.path + (':' + finding.where if finding.where else '')
+    return "%s: %s: %s" % (location, finding.severity, finding.message)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check CloudFormation templates, and the parameters a definition file '
+                                                 'gives them, without calling AWS')
+    parser.add_argument('templates', nargs='*', help='Template files or directories of templates to check')
+    parser.add_argument('-f', '--definition-file', action='store', dest='definition_file',
+                        help='Definition file whose stacks and parameters to check')
+    parser.add_argument('-s', '--resource-spec', action='store', dest='resource_spec',
+                        help='CloudFormation resource specification, to check resource types, properties and '
+                             'attributes')
+    parser.add_argument('-j', '--jobs', action='store', dest='jobs', type=int, default=None,
+                        help='Number of templates checked at the same time; defaults to the number of CPUs')
+    parser.add_argument('-w', '--no-warnings', action='store_true', dest='no_warnings',
+                        help='Only report errors')
+    args = parser.parse_args()
+    if not args.templates and not args.definition_file:
+        parser.error('give templates to check, a definition file, or both')
+
+    resource_types = load_resource_types(args.resource_spec) if args.resource_spec else None
+    paths = []
+    for template in args.templates:
+        if os.path.isdir(template):
+            paths.extend(sorted(os.path.join(template, name) for name in os.listdir(template)
+                                if name.endswith(('.json', '.yml', '.yaml'))))
+        else:
+            paths.append(template)
+    product_definition = None
+    if args.definition_file:
+        with open(args.definition_file) as f:
+            product_definition = json.load(f)
+        paths.extend(definition_templates(product_definition))
+    findings, summaries = check_files(paths, args.jobs, resource_types)
+    if product_definition is not None:
+        findings.extend(check_definition(product_definition, summaries, args.definition_file))
+
+    errors = 0
+    for finding in findings:
+        if finding.severity == 'error':
+            errors += 1
+        elif args.no_warnings:
+            continue
+        print(format_finding(finding))
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
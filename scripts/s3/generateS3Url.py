@@ -2,8 +2,30 @@
 
 import argparse
 import boto3
+import csv
+import datetime
+import fnmatch
+import hashlib
+import hmac
+import json
 import logging
 import os
+import queue
+import re
+import sys
+import threading
+from botocore.config import Config
+from urllib.parse import quote
+
+from s3inventory import InventoryManifest, LocalOpener, isCurrentObject, iterRecords
+
+# Presigned SigV4 URLs are valid for at most 7 days
+MAX_TTL = 7 * 24 * 3600
+
+# Pages of keys the lister may get ahead of the signer by, and keys per page read from a manifest
+PREFETCH_PAGES = 16
+MANIFEST_BATCH = 1000
+
 
 def genrateUrl(s3connection, bucket, key, ttl):
 	return s3connection.generate_presigned_url(
@@ -16,6 +38,248 @@ def genrateUrl(s3connection, bucket, key, ttl):
 	)
 
 
+def bucketRegion(s3client, bucket):
+	location = s3client.get_bucket_location(Bucket=bucket)['LocationConstraint']
+	if location is None:
+		return 'us-east-1'
+	if location == 'EU':
+		return 'eu-west-1'
+	return location
+
+
+class BotoSigner(object):
+	"""Presigns one key at a time with generate_presigned_url."""
+
+	def __init__(self, s3client, bucket, ttl):
+		self.s3client = s3client
+		self.bucket = bucket
+		self.ttl = ttl
+		self.expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)
+
+	def sign(self, key):
+		return genrateUrl(self.s3client, self.bucket, key, self.ttl)
+
+
+class LocalSigner(object):
+	"""
+	Presigns GET URLs of one bucket with SigV4 query authentication, byte for byte as botocore does.
+
+	Everything but the key is the same for every URL signed at one time: the endpoint, the credential scope,
+	the query string and the signing key derived from the secret key. They are worked out once, so signing
+	a key is one SHA-256 of its canonical request and one HMAC with a copy of a keyed HMAC object.
+	The endpoint is taken from a URL botocore presigns, so addressing style and host match its choice.
+	"""
+
+	def __init__(self, s3client, credentials, region, bucket, ttl, now=None):
+		now = now or datetime.datetime.utcnow()
+		self.expires = now + datetime.timedelta(seconds=ttl)
+		probe = s3client.generate_presigned_url(ClientMethod='get_object',
+												Params={'Bucket': bucket, 'Key': 'probe'}, ExpiresIn=ttl)
+		scheme, _, rest = probe.partition('://')
+		host, _, path = rest.partition('?')[0].partition('/')
+		self.base_url = '%s://%s' % (scheme, host)
+		self.path_prefix = '/' + path[:-len('probe')]
+
+		timestamp = now.strftime('%Y%m%dT%H%M%SZ')
+		scope = '%s/%s/s3/aws4_request' % (timestamp[:8], region)
+		params = {
+			'X-Amz-Algorithm': 'AWS4-HMAC-SHA256',
+			'X-Amz-Credential': '%s/%s' % (credentials.access_key, scope),
+			'X-Amz-Date': timestamp,
+			'X-Amz-Expires': str(ttl),
+			'X-Amz-SignedHeaders': 'host',
+		}
+		# botocore adds the token after the other parameters in the URL; it is signed in sorted order like them
+		query = ['%s=%s' % (name, quote(value, safe='-_.~')) for name, value in sorted(params.items())]
+		if credentials.token:
+			query.append('X-Amz-Security-Token=' + quote(credentials.token, safe='-_.~'))
+		self.query = '&'.join(query)
+		self.request_suffix = '\n%s\nhost:%s\n\nhost\nUNSIGNED-PAYLOAD' % ('&'.join(sorted(query)), host)
+		self.string_prefix = 'AWS4-HMAC-SHA256\n%s\n%s\n' % (timestamp, scope)
+
+		signing_key = ('AWS4' + credentials.secret_key).encode('utf-8')
+		for part in (timestamp[:8], region, 's3', 'aws4_request'):
+			signing_key = hmac.new(signing_key, part.encode('utf-8'), hashlib.sha256).digest()
+		self.hmac = hmac.new(signing_key, digestmod=hashlib.sha256)
+
+	def sign(self, key):
+		path = self.path_prefix + quote(key, safe='/~')
+		canonical_request = 'GET\n' + path + self.request_suffix
+		signature = self.hmac.copy()
+		signature.update((self.string_prefix + hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()).encode('utf-8'))
+		return self.base_url + path + '?' + self.query + '&X-Amz-Signature=' + signature.hexdigest()
+
+
+def makeSigner(session, region, bucket, ttl, signer='local', now=None):
+	"""Returns a signer of URLs of the bucket, which is in region."""
+	if signer == 'boto':
+		return BotoSigner(session.client('s3', region_name=region), bucket, ttl)
+	s3client = session.client('s3', region_name=region, config=Config(signature_version='s3v4'))
+	return LocalSigner(s3client, session.get_credentials().get_frozen_credentials(), region, bucket, ttl, now)
+
+
+class KeyFilter(object):
+	"""
+	Selects objects by key glob or regex, size and modification time, all optional.
+
+	Objects are (key, size, last_modified) with last_modified an ISO 8601 UTC string, which compares like the
+	time it stands for; size and last_modified are None when the key source does not know them.
+	"""
+
+	def __init__(self, include=None, exclude=None, regex=None, min_size=None, max_size=None, modified_after=None,
+				 modified_before=None):
+		self.include = include or []
+		self.include_re = re.compile('|'.join(fnmatch.translate(glob) for glob in self.include)) if self.include else None
+		self.exclude_re = re.compile('|'.join(fnmatch.translate(glob) for glob in exclude)) if exclude else None
+		self.regex = re.compile(regex) if regex else None
+		self.min_size = min_size
+		self.max_size = max_size
+		self.modified_after = modified_after
+		self.modified_before = modified_before
+
+	def needsMetadata(self):
+		return any(value is not None for value in (self.min_size, self.max_size, self.modified_after,
+												   self.modified_before))
+
+	def listPrefix(self):
+		"""The longest prefix every included key starts with, to narrow listing down server side."""
+		prefixes = [re.split(r'[*?\[]', glob, maxsplit=1)[0] for glob in self.include]
+		return os.path.commonprefix(prefixes) if prefixes else ''
+
+	def matches(self, key, size, last_modified):
+		if self.include_re is not None and not self.include_re.match(key):
+			return False
+		if self.exclude_re is not None and self.exclude_re.match(key):
+			return False
+		if self.regex is not None and not self.regex.search(key):
+			return False
+		if self.min_size is not None and size < self.min_size:
+			return False
+		if self.max_size is not None and size > self.max_size:
+			return False
+		if self.modified_after is not None and last_modified < self.modified_after:
+			return False
+		if self.modified_before is not None and last_modified >= self.modified_before:
+			return False
+		return True
+
+	def select(self, objects):
+		return [key for key, size, last_modified in objects if self.matches(key, size, last_modified)]
+
+
+def isoTime(value):
+	"""Normalises a date or date and time given on the command line to the ISO 8601 form filters compare with."""
+	for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+		try:
+			return datetime.datetime.strptime(value.rstrip('Z'), fmt).strftime('%Y-%m-%dT%H:%M:%S')
+		except ValueError:
+			pass
+	raise argparse.ArgumentTypeError("Not a date or date and time: %s" % (value))
+
+
+def listKeyBatches(s3client, bucket, counter, prefix='', delimiter=None):
+	"""
+	Yields the bucket's objects under prefix a page at a time, counting list calls in counter[0].
+
+	With a delimiter, only objects directly under the prefix are listed, not those further down.
+	"""
+	kwargs = {'Bucket': bucket, 'MaxKeys': 1000, 'Prefix': prefix}
+	if delimiter:
+		kwargs['Delimiter'] = delimiter
+	while True:
+		object_list = s3client.list_objects_v2(**kwargs)
+		counter[0] += 1
+		# Keys ending with / are folders
+		yield [(_object['Key'], _object['Size'], _object['LastModified'].strftime('%Y-%m-%dT%H:%M:%S'))
+			   for _object in object_list.get('Contents', []) if not _object['Key'].endswith('/')]
+		if not object_list['IsTruncated']:
+			return
+		kwargs['ContinuationToken'] = object_list['NextContinuationToken']
+
+
+def manifestBatches(path):
+	"""
+	Yields the objects of a manifest file a batch at a time, reading it as it goes.
+
+	A manifest.json of an S3 Inventory report gives current objects with their size and modification time;
+	with its data files in ../data or next to it. Any other file, or - for stdin, lists one key per line.
+	"""
+	if path.endswith('.json'):
+		with open(path, 'rb') as f:
+			manifest = InventoryManifest.load(f)
+		objects = ((record.key, record.size, record.last_modified and record.last_modified[:19])
+				   for record in iterRecords(manifest, LocalOpener(path))
+				   if isCurrentObject(record) and not record.key.endswith('/'))
+	else:
+		lines = sys.stdin if path == '-' else open(path)
+		objects = ((line.rstrip('\r\n'), None, None) for line in lines if line.strip())
+	batch = []
+	try:
+		for _object in objects:
+			batch.append(_object)
+			if len(batch) == MANIFEST_BATCH:
+				yield batch
+				batch = []
+	finally:
+		if not path.endswith('.json') and path != '-':
+			lines.close()
+	if batch:
+		yield batch
+
+
+def filterBatches(batches, key_filter):
+	for batch in batches:
+		yield key_filter.select(batch)
+
+
+def prefetch(batches, depth=PREFETCH_PAGES):
+	"""Runs a generator of batches in a thread, so producing the next batches overlaps consuming this one."""
+	batch_queue = queue.Queue(maxsize=depth)
+	done = object()
+
+	def produce():
+		try:
+			for batch in batches:
+				batch_queue.put(batch)
+		except Exception as e:
+			batch_queue.put(e)
+		batch_queue.put(done)
+
+	producer = threading.Thread(target=produce)
+	producer.daemon = True
+	producer.start()
+	while True:
+		batch = batch_queue.get()
+		if batch is done:
+			return
+		if isinstance(batch, Exception):
+			raise batch
+		yield batch
+
+
+class UrlWriter(object):
+	"""Writes URLs a batch at a time: one per line, or key, URL and expiry as JSON lines or CSV."""
+
+	FORMATS = ('text', 'jsonl', 'csv')
+
+	def __init__(self, stream, output_format, expires):
+		self.stream = stream
+		self.output_format = output_format
+		self.expires = expires.strftime('%Y-%m-%dT%H:%M:%SZ')
+		self.csv = csv.writer(stream) if output_format == 'csv' else None
+		if self.csv:
+			self.csv.writerow(['key', 'url', 'expires'])
+
+	def write(self, rows):
+		if self.output_format == 'text':
+			self.stream.write(''.join(url + '\n' for key, url in rows))
+		elif self.output_format == 'jsonl':
+			self.stream.write(''.join(json.dumps({'key': key, 'url': url, 'expires': self.expires}) + '\n'
+									  for key, url in rows))
+		else:
+			self.csv.writerows([key, url, self.expires] for key, url in rows)
+
+
 def main():
 
 	# Arguments
@@ -26,9 +290,49 @@ def main():
 	parser.add_argument('-k', '--key', action='store', metavar='<S3 key>', nargs='*',
 						dest='keys', required=False,
 						help='S3 object key(s)')
-	parser.add_argument('-t', '--ttl', action='store', metavar='<TTL>', nargs=1,
+	parser.add_argument('-m', '--manifest', action='store', metavar='<File>',
+						dest='manifest', required=False, default=None,
+						help='Sign the keys in this file, one per line (- for stdin), or the current objects of an '
+							 'S3 Inventory manifest.json, instead of listing the bucket')
+	parser.add_argument('-p', '--prefix', action='store', metavar='<Prefix>',
+						dest='prefix', required=False, default=None,
+						help='Only list keys starting with this (default: the fixed start of the --include globs)')
+	parser.add_argument('--delimiter', action='store', metavar='<Delimiter>',
+						dest='delimiter', required=False, default=None,
+						help='Only list keys directly under the prefix, e.g. with /, not in its subfolders')
+	parser.add_argument('-i', '--include', action='store', metavar='<Glob>', nargs='+',
+						dest='include', required=False, default=[],
+						help='Only sign keys matching one of these globs; * also matches /')
+	parser.add_argument('-x', '--exclude', action='store', metavar='<Glob>', nargs='+',
+						dest='exclude', required=False, default=[],
+						help='Do not sign keys matching one of these globs')
+	parser.add_argument('-r', '--regex', action='store', metavar='<Regex>',
+						dest='regex', required=False, default=None,
+						help='Only sign keys in which this regular expression is found')
+	parser.add_argument('--min-size', action='store', metavar='<Bytes>', type=int,
+						dest='min_size', required=False, default=None,
+						help='Only sign objects of at least this size')
+	parser.add_argument('--max-size', action='store', metavar='<Bytes>', type=int,
+						dest='max_size', required=False, default=None,
+						help='Only sign objects of at most this size')
+	parser.add_argument('--modified-after', action='store', metavar='<YYYY-MM-DD[THH:MM[:SS]]>', type=isoTime,
+						dest='modified_after', required=False, default=None,
+						help='Only sign objects last modified at or after this time, in UTC')
+	parser.add_argument('--modified-before', action='store', metavar='<YYYY-MM-DD[THH:MM[:SS]]>', type=isoTime,
+						dest='modified_before', required=False, default=None,
+						help='Only sign objects last modified before this time, in UTC')
+	parser.add_argument('-t', '--ttl', action='store', metavar='<TTL>', type=int,
 						dest='ttl', required=False, default=3600,
 						help='How long, in seconds, the generated URL is valid')
+	parser.add_argument('-s', '--signer', action='store', choices=('local', 'boto'),
+						dest='signer', required=False, default='local',
+						help='Sign URLs locally with SigV4 in batches (default), or one at a time with boto')
+	parser.add_argument('-f', '--format', action='store', choices=UrlWriter.FORMATS,
+						dest='output_format', required=False, default='text',
+						help='Write one URL per line (default), or key, URL and expiry as JSON lines or CSV')
+	parser.add_argument('-o', '--output', action='store', metavar='<File>',
+						dest='output', required=False, default=None,
+						help='Write URLs to this file instead of stdout')
 
 	loglevel_group = parser.add_mutually_exclusive_group()
 	loglevel_group.add_argument('-d', '--debug', action="store_const", dest="loglevel", const=logging.DEBUG,
@@ -37,10 +341,17 @@ def main():
 	loglevel_group.add_argument('-v', '--verbose', action="store_const", dest="loglevel", const=logging.INFO,
 								help="Set log level to verbose")
 	args = parser.parse_args()
+	if not 0 < args.ttl <= MAX_TTL:
+		parser.error("--ttl must be between 1 and %d seconds" % (MAX_TTL))
+	key_filter = KeyFilter(args.include, args.exclude, args.regex, args.min_size, args.max_size,
+						   args.modified_after, args.modified_before)
+	if key_filter.needsMetadata() and (args.keys or args.manifest and not args.manifest.endswith('.json')):
+		parser.error("Size and modification time filters need a listing or an inventory manifest")
 
 
 	# Variables
 	total_api_count = 0
+	total_url_count = 0
 
 	# Logging
 	logger = logging.getLogger(os.path.splitext(os.path.basename(__file__))[0])
@@ -64,44 +375,42 @@ def main():
 	logger.debug("Starting script: " + str(os.path.basename(__file__)))
 	logger.debug("Arguments are %s" % (args))
 
-	s3client = boto3.client('s3')
+	session = boto3.session.Session()
+	region = bucketRegion(session.client('s3'), args.bucket[0])
+	total_api_count += 1
+	signer = makeSigner(session, region, args.bucket[0], args.ttl, args.signer)
+	credentials = session.get_credentials()
+	if getattr(credentials, '_expiry_time', None) and credentials._expiry_time.replace(tzinfo=None) < signer.expires:
+		logger.warning("The credentials expire before the URLs, which stop working when they do")
+
+	list_counter = [0]
 	if args.keys:
-		for key in args.keys:
-			if key.startswith("/"):
-				key = key[1:]
-			logger.debug("Generating URL for bucket: %s; key: %s; ttl: %s" % (args.bucket[0], key, args.ttl[0]))
-			print(genrateUrl(s3client, args.bucket[0], key, args.ttl[0]))
-			total_api_count += 1
+		batches = [[(key[1:] if key.startswith("/") else key, None, None) for key in args.keys]]
+	elif args.manifest:
+		batches = manifestBatches(args.manifest)
 	else:
-		object_list = s3client.list_objects(Bucket=args.bucket[0], MaxKeys=1000)
-		total_api_count += 1
-		# "Do-While"
-		if 'Contents' in object_list:
-			for object in object_list['Contents']:
-				key = object['Key']
-				logger.debug("Key is: %s" % (key))
-				if key.endswith("/"):
-					logger.debug("Key is a directory... skipping.")
-					next
-				else:
-					logger.debug("Generating URL for bucket: %s; key: %s; ttl: %s" % (args.bucket[0], key, args.ttl[0]))
-					print(genrateUrl(s3client, args.bucket[0], key, args.ttl[0]))
-					total_api_count += 1
-			while object_list['IsTruncated']:
-				object_list = s3client.list_objects(Bucket=args.bucket[0], MaxKeys=1000,
-												Marker=object_list['Contents'][-1]['Key'])
-				total_api_count += 1
-				for object in object_list['Contents']:
-					key = object['Key']
-					logger.debug("Key is: %s" % (key))
-					if key.endswith("/"):
-						logger.debug("Key is a directory... skipping.")
-						next
-					else:
-						logger.debug("Generating URL for bucket: %s; key: %s; ttl: %s" % (args.bucket[0], key, args.ttl[0]))
-						print(genrateUrl(s3client, args.bucket[0], key, args.ttl[0]))
-						total_api_count += 1
+		prefix = args.prefix if args.prefix != None else key_filter.listPrefix()
+		logger.debug("Listing keys starting with: %s" % (prefix))
+		batches = listKeyBatches(session.client('s3', region_name=region), args.bucket[0], list_counter, prefix,
+								 args.delimiter)
+	batches = prefetch(filterBatches(batches, key_filter))
+
+	stream = open(args.output, 'w', newline='', buffering=1024 * 1024) if args.output else sys.stdout
+	writer = UrlWriter(stream, args.output_format, signer.expires)
+	try:
+		for batch in batches:
+			rows = [(key, signer.sign(key)) for key in batch]
+			writer.write(rows)
+			total_url_count += len(rows)
+			logger.debug("Signed %d URLs" % (total_url_count))
+	finally:
+		if args.output:
+			stream.close()
+		else:
+			stream.flush()
+	total_api_count += list_counter[0]
 
+	logger.debug("Total number of URLs: %d" % (total_url_count))
 	logger.debug("Total number of API calls: %d" % (total_api_count))
 	logger.debug("Finished script: " + str(os.path.basename(__file__)))
 
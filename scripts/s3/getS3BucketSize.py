@@ -2,8 +2,540 @@
 
 import argparse
 import boto3
+import botocore
+import datetime
 import logging
 import os
+import queue
+import threading
+
+from s3inventory import (InventoryError, InventoryManifest, InventoryRecord, LocalOpener, S3Opener,
+						 findInventoryConfiguration, findLatestManifest, isCurrentObject, iterFileRecords)
+from s3breakdown import BreakdownSink, writeBreakdown
+from s3keyindex import KeyIndex, ListingCheckpoint
+
+# Characters keyspace ranges are split on. Ranges always tile the whole keyspace, so keys using other
+# characters are still listed; they just do not get a range of their own.
+PARTITION_CHARACTERS = '!-.0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+
+
+def bucketRegion(location_constraint):
+	# get_bucket_location returns no constraint for us-east-1 and the legacy 'EU' for eu-west-1
+	if not location_constraint:
+		return 'us-east-1'
+	if location_constraint == 'EU':
+		return 'eu-west-1'
+	return location_constraint
+
+
+class ClientPool(object):
+	"""One client per service and region, shared by all workers. Clients are thread safe, creating them is not."""
+
+	def __init__(self, session=None):
+		self.session = session or boto3.session.Session()
+		self.clients = {}
+		self.lock = threading.Lock()
+
+	def get(self, region, service='s3'):
+		with self.lock:
+			if (service, region) not in self.clients:
+				self.clients[(service, region)] = self.session.client(service, region_name=region)
+			return self.clients[(service, region)]
+
+
+class KeyRange(object):
+	"""Keys after start_after (None: from the first key) up to and including end (None: to the last key)."""
+
+	def __init__(self, start_after=None, end=None):
+		self.start_after = start_after
+		self.end = end
+
+
+class BucketTotals(object):
+	"""Size, object count and API calls of one bucket, added to by every worker listing part of it."""
+
+	def __init__(self, name):
+		self.name = name
+		self.region = None
+		# How the bucket was sized: list, inventory, metrics or index; and for inventory and metrics, as of when
+		self.engine = 'list'
+		self.as_of = None
+		self.size = 0
+		self.object_count = 0
+		self.api_count = 0
+		# Tasks queued or running; the bucket is finished when this drops to 0
+		self.pending = 0
+		# Key ranges not completely listed yet, with start_after moved along as pages come in
+		self.ranges = set()
+		self.failed = False
+		self.done = False
+		self.lock = threading.Lock()
+
+	def add(self, size, object_count, api_count):
+		with self.lock:
+			self.size += size
+			self.object_count += object_count
+			self.api_count += api_count
+
+	def toDict(self):
+		"""The totals so far, for a checkpoint; the caller holds the lock."""
+		return {
+			'region': self.region,
+			'engine': self.engine,
+			'size': self.size,
+			'object_count': self.object_count,
+			'api_count': self.api_count,
+			'done': self.done,
+			'ranges': [[key_range.start_after, key_range.end] for key_range in self.ranges],
+		}
+
+	def restore(self, state):
+		self.region = state['region']
+		self.engine = state['engine']
+		self.size = state['size']
+		self.object_count = state['object_count']
+		self.api_count = state['api_count']
+		self.done = state['done']
+
+
+def isOverheadStorageType(storage_type):
+	"""Whether a BucketSizeBytes StorageType is billing overhead, e.g. GlacierObjectOverhead, rather than object data."""
+	return storage_type.endswith('Overhead')
+
+
+def splitRange(first_key, last_key, end, count):
+	"""
+	Returns up to count keys strictly between last_key and end (None: no end) to split that range on.
+
+	first_key and last_key are the first and last key of the page just listed. Boundaries are tried on the
+	character before the one where the page's keys start to differ, the likeliest place for the rest of the
+	keys to spread out, and on shorter prefixes until some fall inside the range.
+	"""
+	shared_with_end = len(os.path.commonprefix([last_key, end])) if end is not None else 0
+	depth = len(os.path.commonprefix([first_key, last_key])) - 1
+	boundaries = []
+	while depth >= shared_with_end and not boundaries:
+		prefix = last_key[:depth]
+		boundaries = [prefix + c for c in PARTITION_CHARACTERS
+					  if last_key < prefix + c and (end is None or prefix + c < end)]
+		depth -= 1
+	if len(boundaries) <= count:
+		return boundaries
+	step = float(len(boundaries)) / count
+	return [boundaries[int(i * step)] for i in range(count)]
+
+
+class SizingEngine(object):
+	"""
+	Sizes buckets with a pool of worker threads.
+
+	Every bucket starts as one key range. Whenever a worker finishes a page of
+	a range and other workers are idle, it splits the rest of its range, keeps
+	the first part and queues the others, so a single huge bucket ends up being
+	listed by several workers at once. A range (start_after, end] holds the
+	keys after start_after up to and including end.
+	"""
+
+	ENGINES = ('auto', 'inventory', 'metrics', 'list', 'index')
+
+	def __init__(self, client_pool, workers=32, max_partitions=None, logger=None, engine='auto',
+				 max_inventory_age=datetime.timedelta(days=8), max_metrics_age=datetime.timedelta(days=3),
+				 local_manifests=None, sinks=None, key_index=None, list_versions=False):
+		self.client_pool = client_pool
+		self.workers = workers
+		self.max_partitions = max_partitions or workers
+		self.logger = logger or logging.getLogger(__name__)
+		# auto uses an inventory report, else CloudWatch metrics, else lists the bucket
+		self.engine = engine
+		self.max_inventory_age = max_inventory_age
+		self.max_metrics_age = max_metrics_age
+		# bucket name -> path of a manifest.json on disk, used instead of looking for one in S3
+		self.local_manifests = local_manifests or {}
+		# Get every listed or inventoried object: begin(bucket) before a bucket's first records, add(bucket,
+		# records) per page, complete(bucket) once all were added, flush() before a checkpoint is written.
+		# getState(bucket) and setState(bucket, state) save and restore what they kept of a bucket with a checkpoint
+		self.sinks = sinks or []
+		# KeyIndex the index engine sizes buckets from
+		self.key_index = key_index
+		# List every version rather than current objects only, for sinks breaking sizes down by version state;
+		# totals still count current objects only
+		self.list_versions = list_versions
+		self.tasks = queue.Queue()
+		self.idle = 0
+		self.lock = threading.Lock()
+		# (bucket name, exception) of every task that failed in the last run
+		self.errors = []
+
+	def _put(self, totals, task):
+		with totals.lock:
+			totals.pending += 1
+			if task[0] == 'range':
+				totals.ranges.add(task[2])
+		self.tasks.put(task)
+
+	def _done(self, totals):
+		with totals.lock:
+			totals.pending -= 1
+			finished = totals.pending == 0
+			if finished:
+				totals.done = not totals.failed
+		if finished and totals.done and totals.engine in ('list', 'inventory'):
+			for sink in self.sinks:
+				sink.complete(totals.name)
+		if finished:
+			if totals.as_of is not None:
+				source = "%s of %s" % (totals.engine, totals.as_of.strftime('%Y-%m-%d %H:%M'))
+			else:
+				source = {'list': "listing", 'index': "key index"}[totals.engine]
+			self.logger.debug("Bucket %s has %s objects using %d B: %.1f KiB: %.1f MiB: %.1f GiB (from %s)" % (totals.name, totals.object_count, totals.size, totals.size*1.0/1024, totals.size*1.0/1024/1024, totals.size*1.0/1024/1024/1024, source))
+			self.logger.debug("Bucket API calls: %d" % (totals.api_count))
+
+	def locate(self, totals):
+		"""Finds the bucket's region, then queues its sizing with the first engine that can size it."""
+		if self.engine == 'index':
+			totals.engine = 'index'
+			self.readKeyIndex(totals)
+			return
+		if totals.name in self.local_manifests:
+			path = self.local_manifests[totals.name]
+			with open(path, 'rb') as f:
+				self.queueInventory(totals, InventoryManifest.load(f), LocalOpener(path))
+			return
+		location = self.client_pool.get('us-east-1').get_bucket_location(Bucket=totals.name)['LocationConstraint']
+		totals.add(0, 0, 1)
+		totals.region = bucketRegion(location)
+		if self.engine in ('auto', 'inventory') and self.useInventory(totals):
+			return
+		if self.engine in ('auto', 'metrics') and self.useMetrics(totals):
+			return
+		if self.engine in ('auto', 'list'):
+			for sink in self.sinks:
+				sink.begin(totals.name)
+			self._put(totals, ('range', totals, KeyRange()))
+		else:
+			raise InventoryError("No recent %s to size the bucket with" % (self.engine))
+
+	def useInventory(self, totals):
+		"""Queues the data files of the bucket's latest inventory report, if there is a recent one."""
+		s3client = self.client_pool.get(totals.region)
+		try:
+			configuration, api_count = findInventoryConfiguration(s3client, totals.name)
+		except botocore.exceptions.ClientError as e:
+			self.logger.debug("Cannot read inventory configurations of %s: %s" % (totals.name, e))
+			totals.add(0, 0, 1)
+			return False
+		totals.add(0, 0, api_count)
+		if configuration is None:
+			return False
+		destination = configuration['Destination']['S3BucketDestination']['Bucket'].split(':::')[-1]
+		location = self.client_pool.get('us-east-1').get_bucket_location(Bucket=destination)['LocationConstraint']
+		destination_client = self.client_pool.get(bucketRegion(location))
+		manifest_key, api_count = findLatestManifest(destination_client, totals.name, configuration)
+		totals.add(0, 0, api_count + 1)
+		if manifest_key is None:
+			return False
+		manifest = InventoryManifest.load(destination_client.get_object(Bucket=destination, Key=manifest_key)['Body'])
+		totals.add(0, 0, 1)
+		if datetime.datetime.utcnow() - manifest.created > self.max_inventory_age:
+			self.logger.debug("Latest inventory of %s is from %s, too old to use" % (totals.name, manifest.created))
+			return False
+		self.queueInventory(totals, manifest, S3Opener(destination_client, destination))
+		return True
+
+	def queueInventory(self, totals, manifest, opener):
+		totals.engine = 'inventory'
+		totals.as_of = manifest.created
+		for sink in self.sinks:
+			sink.begin(totals.name)
+		for key in manifest.files:
+			self._put(totals, ('inventory', totals, manifest, key, opener))
+
+	def readInventoryFile(self, totals, manifest, key, opener):
+		"""Adds up one data file of an inventory report; the files of one report are read by several workers."""
+		size = 0
+		object_count = 0
+		records = []
+		for record in iterFileRecords(manifest, opener, key):
+			if isCurrentObject(record):
+				size += record.size
+				object_count += 1
+			records.append(record)
+			if len(records) == 1000:
+				self.addRecords(totals, records)
+				records = []
+		self.addRecords(totals, records)
+		totals.add(size, object_count, 1 if isinstance(opener, S3Opener) else 0)
+
+	def addRecords(self, totals, records):
+		for sink in self.sinks:
+			sink.add(totals.name, records)
+
+	def readKeyIndex(self, totals):
+		"""Sizes a bucket from the local key index of an earlier complete listing."""
+		if totals.name not in self.key_index.completeBuckets():
+			raise InventoryError("The key index has no complete listing of the bucket")
+		records = []
+		for record in self.key_index.iterRecords(totals.name):
+			records.append(record)
+			if len(records) == 1000:
+				self.addRecords(totals, records)
+				totals.add(sum(r.size for r in records), len(records), 0)
+				records = []
+		self.addRecords(totals, records)
+		totals.add(sum(r.size for r in records), len(records), 0)
+
+	def useMetrics(self, totals):
+		"""Takes size and object count from the daily CloudWatch storage metrics, if there are recent ones."""
+		cloudwatch = self.client_pool.get(totals.region, 'cloudwatch')
+		bucket_dimension = {'Name': 'BucketName', 'Value': totals.name}
+		storage_types = []
+		kwargs = {'Namespace': 'AWS/S3', 'MetricName': 'BucketSizeBytes', 'Dimensions': [bucket_dimension]}
+		while True:
+			response = cloudwatch.list_metrics(**kwargs)
+			totals.add(0, 0, 1)
+			for metric in response['Metrics']:
+				storage_types.extend(d['Value'] for d in metric['Dimensions'] if d['Name'] == 'StorageType')
+			if 'NextToken' not in response:
+				break
+			kwargs['NextToken'] = response['NextToken']
+		if not storage_types:
+			return False
+
+		def query(query_id, metric_name, storage_type):
+			return {'Id': query_id, 'MetricStat': {'Metric': {
+				'Namespace': 'AWS/S3', 'MetricName': metric_name,
+				'Dimensions': [bucket_dimension, {'Name': 'StorageType', 'Value': storage_type}]
+			}, 'Period': 86400, 'Stat': 'Average'}}
+		# The *ObjectOverhead and *SizeOverhead types are metadata S3 bills for archived and small objects,
+		# which neither a listing nor an inventory counts; they are queried to be reported separately
+		queries = [query(('overhead%d' if isOverheadStorageType(storage_type) else 'size%d') % i, 'BucketSizeBytes',
+						 storage_type) for i, storage_type in enumerate(storage_types)]
+		queries.append(query('objects', 'NumberOfObjects', 'AllStorageTypes'))
+		now = datetime.datetime.utcnow()
+		kwargs = {'MetricDataQueries': queries, 'StartTime': now - self.max_metrics_age, 'EndTime': now,
+				  'ScanBy': 'TimestampDescending'}
+		latest = {}
+		while True:
+			response = cloudwatch.get_metric_data(**kwargs)
+			totals.add(0, 0, 1)
+			for result in response['MetricDataResults']:
+				if result['Values'] and result['Id'] not in latest:
+					latest[result['Id']] = (result['Values'][0], result['Timestamps'][0])
+			if 'NextToken' not in response:
+				break
+			kwargs['NextToken'] = response['NextToken']
+		if 'objects' not in latest:
+			return False
+		# Both metrics count noncurrent versions too, unlike a listing
+		totals.engine = 'metrics'
+		totals.as_of = min(timestamp for value, timestamp in latest.values()).replace(tzinfo=None)
+		overhead = int(sum(value for query_id, (value, timestamp) in latest.items() if query_id.startswith('overhead')))
+		if overhead:
+			self.logger.debug("Bucket %s is billed for another %d B of storage overhead, not counted in its size" % (
+				totals.name, overhead))
+		totals.add(int(sum(value for query_id, (value, timestamp) in latest.items() if query_id.startswith('size'))),
+				   int(latest['objects'][0]), 0)
+		return True
+
+	def listRange(self, totals, key_range):
+		if self.list_versions:
+			return self.listVersionsRange(totals, key_range)
+		s3client = self.client_pool.get(totals.region)
+		kwargs = {'Bucket': totals.name, 'MaxKeys': 1000}
+		if key_range.start_after is not None:
+			kwargs['StartAfter'] = key_range.start_after
+		while True:
+			object_list = s3client.list_objects_v2(**kwargs)
+			records = []
+			past_end = False
+			for _object in object_list.get('Contents', []):
+				if key_range.end is not None and _object['Key'] > key_range.end:
+					past_end = True
+					break
+				records.append(InventoryRecord(_object['Key'], _object['Size'], _object.get('StorageClass'),
+											   _object['LastModified'].strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+											   True, False, None))
+			finished = past_end or not object_list['IsTruncated']
+			self.addPage(totals, key_range, records, finished)
+			if finished:
+				return
+			kwargs['ContinuationToken'] = object_list['NextContinuationToken']
+			self.split(totals, key_range, object_list['Contents'][0]['Key'], records[-1].key)
+
+	def listVersionsRange(self, totals, key_range):
+		"""
+		Lists every version and delete marker of a range, so that sinks can tell current from noncurrent data.
+
+		A page can end part way through the versions of a key. Those are held back until the key is complete,
+		so that start_after, and a checkpoint of it, only ever moves past keys whose versions were all added.
+		"""
+		s3client = self.client_pool.get(totals.region)
+		kwargs = {'Bucket': totals.name, 'MaxKeys': 1000}
+		if key_range.start_after is not None:
+			kwargs['KeyMarker'] = key_range.start_after
+		held_back = []
+		while True:
+			version_list = s3client.list_object_versions(**kwargs)
+			versions = [(_version, False) for _version in version_list.get('Versions', [])]
+			versions += [(_version, True) for _version in version_list.get('DeleteMarkers', [])]
+			# In S3's own order: by key, then the current version or delete marker, then newest first
+			versions.sort(key=lambda item: (item[0]['Key'], not item[0]['IsLatest'],
+											-item[0]['LastModified'].timestamp()))
+			records = held_back
+			past_end = False
+			for _version, is_delete_marker in versions:
+				if key_range.end is not None and _version['Key'] > key_range.end:
+					past_end = True
+					break
+				records.append(InventoryRecord(_version['Key'], _version.get('Size', 0), _version.get('StorageClass'),
+											   _version['LastModified'].strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+											   _version['IsLatest'], is_delete_marker, _version.get('VersionId')))
+			finished = past_end or not version_list['IsTruncated']
+			held_back = []
+			if not finished:
+				complete = len(records)
+				while complete and records[complete - 1].key == version_list['NextKeyMarker']:
+					complete -= 1
+				records, held_back = records[:complete], records[complete:]
+			self.addPage(totals, key_range, records, finished)
+			if finished:
+				return
+			kwargs['KeyMarker'] = version_list['NextKeyMarker']
+			kwargs['VersionIdMarker'] = version_list['NextVersionIdMarker']
+			self.split(totals, key_range, versions[0][0]['Key'], version_list['NextKeyMarker'])
+
+	def addPage(self, totals, key_range, records, finished):
+		"""Adds a listed page of a range to the bucket's totals and sinks, and moves the range past it."""
+		current = [record for record in records if isCurrentObject(record)]
+		# Sinks get the page under the same lock, so a checkpoint of the bucket sees them at the same point
+		with totals.lock:
+			self.addRecords(totals, records)
+			totals.size += sum(record.size for record in current)
+			totals.object_count += len(current)
+			totals.api_count += 1
+			if records:
+				key_range.start_after = records[-1].key
+			if finished:
+				totals.ranges.discard(key_range)
+
+	def split(self, totals, key_range, first_key, last_key):
+		"""Queues the tail of the range after last_key for idle workers, shrinking key_range to the first part."""
+		with self.lock:
+			idle = self.idle
+		with totals.lock:
+			room = self.max_partitions - totals.pending
+		count = min(idle - self.tasks.qsize(), room)
+		if count <= 0:
+			return
+		boundaries = splitRange(first_key, last_key, key_range.end, count)
+		if not boundaries:
+			return
+		self.logger.debug("Splitting %s after %s into %d ranges" % (totals.name, last_key, len(boundaries) + 1))
+		tails = [KeyRange(start, stop) for start, stop in zip(boundaries, boundaries[1:] + [key_range.end])]
+		# Shrunk and registered in one step, so a checkpoint never sees the shorter range without its tails
+		with totals.lock:
+			key_range.end = boundaries[0]
+			totals.ranges.update(tails)
+			totals.pending += len(tails)
+		for tail in tails:
+			self.tasks.put(('range', totals, tail))
+
+	def worker(self):
+		while True:
+			with self.lock:
+				self.idle += 1
+			task = self.tasks.get()
+			with self.lock:
+				self.idle -= 1
+			if task is None:
+				# Counted as done too, or the next run's tasks.join() would wait for it
+				self.tasks.task_done()
+				return
+			totals = task[1]
+			try:
+				if task[0] == 'locate':
+					self.locate(totals)
+				elif task[0] == 'inventory':
+					self.readInventoryFile(totals, *task[2:])
+				else:
+					self.listRange(totals, task[2])
+			except Exception as e:
+				self.logger.error("Failed on bucket %s: %s" % (totals.name, e))
+				self.errors.append((totals.name, e))
+				with totals.lock:
+					totals.failed = True
+			finally:
+				self._done(totals)
+				self.tasks.task_done()
+
+	def saveCheckpoint(self, checkpoint, results):
+		state = {}
+		for totals in results:
+			with totals.lock:
+				state[totals.name] = totals.toDict()
+				# Inventories are read again when resuming, so what sinks kept of them is not saved until done
+				if totals.done or totals.engine == 'list':
+					state[totals.name]['sinks'] = [sink.getState(totals.name) for sink in self.sinks]
+		# Whatever the state above counts has been handed to the sinks; make sure they keep it
+		for sink in self.sinks:
+			sink.flush()
+		checkpoint.save(state)
+
+	def checkpointer(self, checkpoint, results, interval, stop):
+		while not stop.wait(interval):
+			self.saveCheckpoint(checkpoint, results)
+			self.logger.debug("Saved checkpoint %s" % (checkpoint.path))
+
+	def run(self, bucket_names, checkpoint=None, checkpoint_interval=60):
+		"""
+		Returns the BucketTotals of every bucket, in the order given.
+
+		With a ListingCheckpoint, progress is saved every checkpoint_interval seconds and a saved run is resumed:
+		finished buckets are not sized again and listings continue from the saved key ranges. Buckets sized from
+		an inventory report start over. The checkpoint is removed once every bucket was sized.
+		"""
+		self.errors = []
+		results = [BucketTotals(name) for name in bucket_names]
+		saved = checkpoint.load() if checkpoint is not None else {}
+		for totals in results:
+			state = saved.get(totals.name)
+			if state is not None and (state['done'] or state['engine'] == 'list' and state['ranges']):
+				for sink, sink_state in zip(self.sinks, state.get('sinks', [])):
+					if sink_state is not None:
+						sink.setState(totals.name, sink_state)
+			if state is not None and state['done']:
+				totals.restore(state)
+				self.logger.debug("Bucket %s was sized by the checkpointed run" % (totals.name))
+			elif state is not None and state['engine'] == 'list' and state['ranges']:
+				totals.restore(state)
+				self.logger.debug("Resuming %d key ranges of bucket %s" % (len(state['ranges']), totals.name))
+				for start_after, end in state['ranges']:
+					self._put(totals, ('range', totals, KeyRange(start_after, end)))
+			else:
+				self._put(totals, ('locate', totals))
+		threads = [threading.Thread(target=self.worker) for _ in range(self.workers)]
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+		stop = threading.Event()
+		if checkpoint is not None:
+			saver = threading.Thread(target=self.checkpointer, args=(checkpoint, results, checkpoint_interval, stop))
+			saver.daemon = True
+			saver.start()
+		self.tasks.join()
+		stop.set()
+		for _ in threads:
+			self.tasks.put(None)
+		for thread in threads:
+			thread.join()
+		if checkpoint is not None:
+			saver.join()
+			if self.errors:
+				self.saveCheckpoint(checkpoint, results)
+			else:
+				checkpoint.remove()
+		return results
+
 
 def main():
 
@@ -12,6 +544,52 @@ def main():
 	parser.add_argument('-b', '--buckets', action='store', metavar='<S3 Bucket>', nargs='+',
 						dest='bucket_filter', required=False,
 						help='Specific S3 buckets to check the size of')
+	parser.add_argument('-w', '--workers', action='store', metavar='<Workers>', type=int,
+						dest='workers', required=False, default=32,
+						help='Number of list calls made at the same time, across all buckets')
+	parser.add_argument('-p', '--max-partitions', action='store', metavar='<Partitions>', type=int,
+						dest='max_partitions', required=False, default=None,
+						help='Maximum number of key ranges of one bucket listed at the same time (default: workers)')
+	parser.add_argument('-e', '--engine', action='store', choices=SizingEngine.ENGINES,
+						dest='engine', required=False, default='auto',
+						help='How to size buckets: from S3 Inventory reports, CloudWatch metrics, by listing them, from '
+							 'the --key-index of an earlier run, or auto: the first of inventory, metrics and listing '
+							 'available for each bucket (default)')
+	parser.add_argument('--max-inventory-age', action='store', metavar='<Days>', type=float,
+						dest='max_inventory_age', required=False, default=8,
+						help='Ignore inventory reports older than this')
+	parser.add_argument('--max-metrics-age', action='store', metavar='<Days>', type=float,
+						dest='max_metrics_age', required=False, default=3,
+						help='Ignore CloudWatch metrics older than this')
+	parser.add_argument('-m', '--inventory-manifest', action='store', metavar='<manifest.json>', nargs='+',
+						dest='inventory_manifests', required=False, default=[],
+						help='Inventory manifests on disk, with their data files in ../data or next to them. '
+							 'Without --buckets, only the buckets of these manifests are sized')
+	parser.add_argument('-c', '--checkpoint', action='store', metavar='<File>',
+						dest='checkpoint', required=False, default=None,
+						help='Save progress to this file and, when it exists, resume the run it was saved by')
+	parser.add_argument('--checkpoint-interval', action='store', metavar='<Seconds>', type=float,
+						dest='checkpoint_interval', required=False, default=60,
+						help='How often to save progress to the checkpoint')
+	parser.add_argument('-k', '--key-index', action='store', metavar='<File.sqlite>',
+						dest='key_index', required=False, default=None,
+						help='Keep the key, size, storage class and modification time of every listed or inventoried '
+							 'object in this SQLite file; with --engine index, size buckets from it without calling S3')
+	parser.add_argument('-o', '--breakdown', action='store', metavar='<File.json|File.csv>',
+						dest='breakdown', required=False, default=None,
+						help='Write each bucket\'s size by prefix, storage class, age and version state to this file, '
+							 'as CSV if it ends with .csv, else JSON. Listed buckets are listed with all their versions '
+							 'for this, one call per 1000 versions; inventoried buckets have noncurrent versions only if '
+							 'their inventory includes them. Buckets sized from CloudWatch metrics have totals only')
+	parser.add_argument('--prefix-depth', action='store', metavar='<Depth>', type=int,
+						dest='prefix_depth', required=False, default=2,
+						help='Break sizes down by prefixes of up to this many levels')
+	parser.add_argument('--top-prefixes', action='store', metavar='<Count>', type=int,
+						dest='top_prefixes', required=False, default=50,
+						help='Number of largest prefixes reported per level')
+	parser.add_argument('--delimiter', action='store', metavar='<Delimiter>',
+						dest='delimiter', required=False, default='/',
+						help='Separates the levels of prefixes in keys')
 
 	loglevel_group = parser.add_mutually_exclusive_group()
 	loglevel_group.add_argument('-d', '--debug', action="store_const", dest="loglevel", const=logging.DEBUG,
@@ -24,8 +602,6 @@ def main():
 	# Variables
 	total_bucket_size = 0
 	total_object_count = 0
-	bucket_size = 0
-	object_count = 0
 	total_api_count = 0
 
 	# Logging
@@ -50,44 +626,62 @@ def main():
 	logger.debug("Starting script: " + str(os.path.basename(__file__)))
 	logger.debug("Arguments are %s" % (args))
 
-	s3client = boto3.client('s3', region_name = 'us-east-1')
+	client_pool = ClientPool()
 
-	_all_buckets_list = s3client.list_buckets()['Buckets']
-	total_api_count += 1
+	local_manifests = {}
+	for path in args.inventory_manifests:
+		with open(path, 'rb') as f:
+			local_manifests[InventoryManifest.load(f).source_bucket] = path
 
-	for bucket in _all_buckets_list:
-		bucket_api_count = 0
-		if args.bucket_filter != None and bucket['Name'] not in args.bucket_filter:
-			logger.debug("Skippig bucket due to filter: %s" % (bucket['Name']))
-		else:
-			logger.debug("Working on bucket: %s" % (bucket['Name']))
-			bucket_region = s3client.get_bucket_location(Bucket=bucket['Name'])['LocationConstraint']
-			bucket_api_count += 1
-			# Recreate client for the proper region
-			# https://github.com/boto/boto3/issues/145
-			s3client = boto3.client('s3', region_name = bucket_region)
-			# "Do-While"
-			bucket_size = 0
-			object_count = 0
-			object_list = s3client.list_objects(Bucket=bucket['Name'], MaxKeys=1000)
-			bucket_api_count += 1
-			if 'Contents' in object_list:
-				object_count += len(object_list['Contents'])
-				for _object in object_list['Contents']:
-					bucket_size += _object['Size']
-				while object_list['IsTruncated']:
-					object_list = s3client.list_objects(Bucket=bucket['Name'], MaxKeys=1000, Marker=object_list['Contents'][-1]['Key'])
-					bucket_api_count += 1
-					object_count += len(object_list['Contents'])    
-					for _object in object_list['Contents']:
-						bucket_size += _object['Size']
-			logger.debug("Bucket %s has %s objects using %d B: %.1f KiB: %.1f MiB: %.1f GiB" % (bucket['Name'], object_count, bucket_size, bucket_size*1.0/1024, bucket_size*1.0/1024/1024, bucket_size*1.0/1024/1024/1024))
-			total_bucket_size += bucket_size
-			total_object_count += object_count
-			total_api_count += bucket_api_count
-			logger.debug("Bucket API calls: %d" % (bucket_api_count))
+	if args.engine == 'index' and args.key_index == None:
+		parser.error("--engine index needs --key-index")
+
+	if local_manifests and args.bucket_filter == None:
+		bucket_names = sorted(local_manifests)
+	elif args.engine == 'index' and args.bucket_filter == None:
+		bucket_names = sorted(KeyIndex(args.key_index).completeBuckets())
+	else:
+		_all_buckets_list = client_pool.get('us-east-1').list_buckets()['Buckets']
+		total_api_count += 1
+
+		bucket_names = []
+		for bucket in _all_buckets_list:
+			if args.bucket_filter != None and bucket['Name'] not in args.bucket_filter:
+				logger.debug("Skippig bucket due to filter: %s" % (bucket['Name']))
+			else:
+				bucket_names.append(bucket['Name'])
+
+	sinks = []
+	key_index = None
+	if args.key_index != None:
+		key_index = KeyIndex(args.key_index)
+		key_index.start()
+		# Sizing from the index must not write to it
+		if args.engine != 'index':
+			sinks.append(key_index)
+	breakdown = None
+	if args.breakdown != None:
+		breakdown = BreakdownSink(depth=args.prefix_depth, top=args.top_prefixes, delimiter=args.delimiter)
+		sinks.append(breakdown)
+	checkpoint = ListingCheckpoint(args.checkpoint) if args.checkpoint != None else None
+
+	engine = SizingEngine(client_pool, workers=args.workers, max_partitions=args.max_partitions, logger=logger,
+						  engine=args.engine, max_inventory_age=datetime.timedelta(days=args.max_inventory_age),
+						  max_metrics_age=datetime.timedelta(days=args.max_metrics_age), local_manifests=local_manifests,
+						  sinks=sinks, key_index=key_index, list_versions=breakdown != None)
+	results = engine.run(bucket_names, checkpoint=checkpoint, checkpoint_interval=args.checkpoint_interval)
+	if key_index != None:
+		key_index.stop()
+	if breakdown != None:
+		writeBreakdown(args.breakdown, results, breakdown)
+	for totals in results:
+		total_bucket_size += totals.size
+		total_object_count += totals.object_count
+		total_api_count += totals.api_count
 	logger.info("Bucket Totals: %s objects using %d B: %.1f KiB: %.1f MiB: %.1f GiB" % (total_object_count, total_bucket_size, total_bucket_size*1.0/1024, total_bucket_size*1.0/1024/1024, total_bucket_size*1.0/1024/1024/1024))
 	print("Bucket Totals: %s objects using %d B: %.1f KiB: %.1f MiB: %.1f GiB" % (total_object_count, total_bucket_size, total_bucket_size*1.0/1024, total_bucket_size*1.0/1024/1024, total_bucket_size*1.0/1024/1024/1024))
+	if engine.errors:
+		logger.error("Could not size %d buckets, totals are incomplete" % (len(engine.errors)))
 	logger.debug("Total number of API calls: %d" % (total_api_count))
 	logger.debug("Finished script: " + str(os.path.basename(__file__)))
 
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+import csv
+import datetime
+import heapq
+import json
+import threading
+
+# Age buckets, by days since last modified: under 30 days, 30 to 90 days, ...
+AGE_DAYS = (30, 90, 180, 365, 730)
+
+
+class SpaceSaving(object):
+	"""
+	Space-Saving heavy hitter sketch: the prefixes holding the most bytes, in at most capacity counters.
+
+	When a new prefix comes in and every counter is taken, it replaces the prefix with the fewest bytes and
+	inherits its bytes as error. A prefix's true size is between size - error and size, and every prefix holding
+	more than total / capacity bytes is kept. The smallest counter is found with a heap of (size, prefix) entries
+	that go stale as sizes grow; stale entries are skipped, and the heap is rebuilt when it holds too many.
+	"""
+
+	def __init__(self, capacity):
+		self.capacity = capacity
+		# prefix -> [size, object count, error]
+		self.counters = {}
+		self.heap = []
+
+	def add(self, prefix, size):
+		counter = self.counters.get(prefix)
+		if counter is None:
+			if len(self.counters) < self.capacity:
+				counter = self.counters[prefix] = [0, 0, 0]
+			else:
+				smallest = self._popSmallest()
+				counter = self.counters[prefix] = [smallest[0], smallest[1], smallest[0]]
+		counter[0] += size
+		counter[1] += 1
+		heapq.heappush(self.heap, (counter[0], prefix))
+		if len(self.heap) > 4 * self.capacity:
+			self.heap = [(counter[0], prefix) for prefix, counter in self.counters.items()]
+			heapq.heapify(self.heap)
+
+	def _popSmallest(self):
+		while True:
+			size, prefix = heapq.heappop(self.heap)
+			counter = self.counters.get(prefix)
+			if counter is not None and counter[0] == size:
+				return self.counters.pop(prefix)
+
+	def top(self, count):
+		"""Returns the count largest prefixes as (prefix, size, object count, error), largest first."""
+		return [(prefix, counter[0], counter[1], counter[2]) for prefix, counter in
+				heapq.nlargest(count, self.counters.items(), key=lambda item: item[1][0])]
+
+	def getState(self):
+		return dict((prefix, list(counter)) for prefix, counter in self.counters.items())
+
+	def setState(self, counters):
+		self.counters = dict((prefix, list(counter)) for prefix, counter in counters.items())
+		self.heap = [(counter[0], prefix) for prefix, counter in self.counters.items()]
+		heapq.heapify(self.heap)
+
+
+class Breakdown(object):
+	"""
+	Size and object count of one bucket by storage class, age, version state and prefix, in one pass.
+
+	Memory does not grow with the number of objects: prefixes are kept in a SpaceSaving sketch per depth, the
+	rest in a handful of counters. Every version is counted, since noncurrent versions are billed too.
+	"""
+
+	def __init__(self, depth=2, top=50, delimiter='/', now=None):
+		self.depth = depth
+		self.top = top
+		self.delimiter = delimiter
+		now = now or datetime.datetime.utcnow()
+		# Inventories and listings give ISO 8601 UTC times, which sort like the times they stand for
+		self.age_cutoffs = [(now - datetime.timedelta(days=days)).strftime('%Y-%m-%dT%H:%M:%S') for days in AGE_DAYS]
+		self.age_names = ['<%dd' % AGE_DAYS[0]] + ['%d-%dd' % (low, high) for low, high in zip(AGE_DAYS, AGE_DAYS[1:])] + \
+						 ['>=%dd' % AGE_DAYS[-1], 'unknown']
+		# Spare counters keep large prefixes from being evicted by a long tail of small ones; size_error bounds the rest
+		self.prefixes = [SpaceSaving(top * 10) for _ in range(depth)]
+		self.storage_classes = {}
+		self.ages = {}
+		self.versions = {}
+		self.lock = threading.Lock()
+
+	def _count(self, counters, name, size):
+		counter = counters.get(name)
+		if counter is None:
+			counter = counters[name] = [0, 0]
+		counter[0] += size
+		counter[1] += 1
+
+	def age(self, last_modified):
+		if not last_modified:
+			return self.age_names[-1]
+		for i, cutoff in enumerate(self.age_cutoffs):
+			if last_modified >= cutoff:
+				return self.age_names[i]
+		return self.age_names[-2]
+
+	def add(self, records):
+		with self.lock:
+			for record in records:
+				if record.is_delete_marker:
+					self._count(self.versions, 'delete-marker', 0)
+					continue
+				self._count(self.versions, 'noncurrent' if record.is_latest is False else 'current', record.size)
+				self._count(self.storage_classes, record.storage_class or 'STANDARD', record.size)
+				self._count(self.ages, self.age(record.last_modified), record.size)
+				parts = record.key.split(self.delimiter, self.depth)
+				# The last part is the object's name, not a prefix
+				for depth in range(1, min(self.depth, len(parts) - 1) + 1):
+					self.prefixes[depth - 1].add(self.delimiter.join(parts[:depth]) + self.delimiter, record.size)
+
+	def getState(self):
+		with self.lock:
+			return {
+				'storage_classes': dict((name, list(counter)) for name, counter in self.storage_classes.items()),
+				'ages': dict((name, list(counter)) for name, counter in self.ages.items()),
+				'versions': dict((name, list(counter)) for name, counter in self.versions.items()),
+				'prefixes': [sketch.getState() for sketch in self.prefixes],
+			}
+
+	def setState(self, state):
+		with self.lock:
+			self.storage_classes = state['storage_classes']
+			self.ages = state['ages']
+			self.versions = state['versions']
+			for sketch, counters in zip(self.prefixes, state['prefixes']):
+				sketch.setState(counters)
+
+	def toDict(self):
+		with self.lock:
+			def sizes(counters):
+				return dict((name, {'size': size, 'objects': count}) for name, (size, count) in sorted(counters.items()))
+			return {
+				'storage_classes': sizes(self.storage_classes),
+				'ages': sizes(self.ages),
+				'versions': sizes(self.versions),
+				'prefixes': [[{'prefix': prefix, 'size': size, 'objects': count, 'size_error': error}
+							  for prefix, size, count, error in sketch.top(self.top)] for sketch in self.prefixes],
+			}
+
+
+class BreakdownSink(object):
+	"""Sink of a SizingEngine that keeps a Breakdown per bucket."""
+
+	def __init__(self, depth=2, top=50, delimiter='/'):
+		self.depth = depth
+		self.top = top
+		self.delimiter = delimiter
+		self.now = datetime.datetime.utcnow()
+		self.breakdowns = {}
+		self.lock = threading.Lock()
+
+	def _breakdown(self, bucket):
+		with self.lock:
+			if bucket not in self.breakdowns:
+				self.breakdowns[bucket] = Breakdown(self.depth, self.top, self.delimiter, self.now)
+			return self.breakdowns[bucket]
+
+	def begin(self, bucket):
+		with self.lock:
+			self.breakdowns[bucket] = Breakdown(self.depth, self.top, self.delimiter, self.now)
+
+	def add(self, bucket, records):
+		self._breakdown(bucket).add(records)
+
+	def complete(self, bucket):
+		pass
+
+	def flush(self):
+		pass
+
+	def getState(self, bucket):
+		with self.lock:
+			breakdown = self.breakdowns.get(bucket)
+		return breakdown.getState() if breakdown is not None else None
+
+	def setState(self, bucket, state):
+		self._breakdown(bucket).setState(state)
+
+
+def breakdownRows(results, sink):
+	"""Returns CSV rows of bucket, dimension, name, size, objects and size error, totals first."""
+	rows = [['bucket', 'dimension', 'name', 'size', 'objects', 'size_error']]
+	for totals in results:
+		rows.append([totals.name, 'total', totals.engine, totals.size, totals.object_count, 0])
+		breakdown = sink.breakdowns.get(totals.name)
+		if breakdown is None:
+			continue
+		data = breakdown.toDict()
+		for dimension in ('storage_classes', 'ages', 'versions'):
+			for name, counter in data[dimension].items():
+				rows.append([totals.name, dimension, name, counter['size'], counter['objects'], 0])
+		for depth, prefixes in enumerate(data['prefixes'], 1):
+			for prefix in prefixes:
+				rows.append([totals.name, 'prefix%d' % depth, prefix['prefix'], prefix['size'], prefix['objects'],
+							 prefix['size_error']])
+	return rows
+
+
+def writeBreakdown(path, results, sink):
+	"""Writes the totals and breakdown of every bucket to path, as CSV if it ends with .csv, else JSON."""
+	with open(path, 'w', newline='') as f:
+		if path.endswith('.csv'):
+			csv.writer(f).writerows(breakdownRows(results, sink))
+			return
+		buckets = {}
+		for totals in results:
+			buckets[totals.name] = {
+				'source': totals.engine,
+				'as_of': totals.as_of.strftime('%Y-%m-%dT%H:%M:%S') if totals.as_of is not None else None,
+				'complete': totals.done,
+				'size': totals.size,
+				'objects': totals.object_count,
+			}
+			if totals.name in sink.breakdowns:
+				buckets[totals.name].update(sink.breakdowns[totals.name].toDict())
+		json.dump({'buckets': buckets}, f, indent=2, sort_keys=True)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+import collections
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+from urllib.parse import unquote_plus
+
+# One inventory line. last_modified is kept as the ISO 8601 string found in the inventory
+InventoryRecord = collections.namedtuple('InventoryRecord', [
+	'key', 'size', 'storage_class', 'last_modified', 'is_latest', 'is_delete_marker', 'version_id'])
+
+# Inventory field -> InventoryRecord field, as named in CSV manifests' fileSchema
+CSV_FIELDS = {
+	'Key': 'key',
+	'Size': 'size',
+	'StorageClass': 'storage_class',
+	'LastModifiedDate': 'last_modified',
+	'IsLatest': 'is_latest',
+	'IsDeleteMarker': 'is_delete_marker',
+	'VersionId': 'version_id',
+}
+
+# The same fields as named in ORC and Parquet data files
+COLUMNAR_FIELDS = {
+	'key': 'key',
+	'size': 'size',
+	'storage_class': 'storage_class',
+	'last_modified_date': 'last_modified',
+	'is_latest': 'is_latest',
+	'is_delete_marker': 'is_delete_marker',
+	'version_id': 'version_id',
+}
+
+MANIFEST_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}-\d{2}Z$')
+
+# Rows read at a time from ORC and Parquet files
+BATCH_ROWS = 65536
+
+
+class InventoryError(Exception):
+	"""An inventory that cannot be used to size its bucket."""
+
+
+class InventoryManifest(object):
+	"""The manifest.json of one inventory report."""
+
+	def __init__(self, data):
+		self.source_bucket = data['sourceBucket']
+		self.destination_bucket = data['destinationBucket'].split(':::')[-1]
+		self.file_format = data['fileFormat'].upper()
+		self.file_schema = data.get('fileSchema', '')
+		self.files = [f['key'] for f in data['files']]
+		self.created = datetime.datetime.utcfromtimestamp(int(data['creationTimestamp']) / 1000.0)
+		if self.file_format == 'CSV':
+			self.columns = [field.strip() for field in self.file_schema.split(',')]
+			if 'Size' not in self.columns:
+				raise InventoryError("Inventory of %s does not include object sizes" % (self.source_bucket))
+
+	@classmethod
+	def load(cls, stream):
+		return cls(json.loads(stream.read().decode('utf-8')))
+
+
+class LocalOpener(object):
+	"""
+	Opens the data files of a manifest saved on disk, e.g. a fixture or a synced copy of the destination bucket.
+
+	Files are looked for where S3 puts them, in data/ next to the manifest's date folder, and next to the manifest.
+	"""
+
+	def __init__(self, manifest_path):
+		self.manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+
+	def open(self, key):
+		name = os.path.basename(key)
+		for path in (os.path.join(os.path.dirname(self.manifest_dir), 'data', name), os.path.join(self.manifest_dir, name)):
+			if os.path.exists(path):
+				return open(path, 'rb')
+		raise InventoryError("Inventory file %s not found near %s" % (key, self.manifest_dir))
+
+
+class S3Opener(object):
+	"""Opens the data files of a manifest straight from the destination bucket, as streams."""
+
+	def __init__(self, client, bucket):
+		self.client = client
+		self.bucket = bucket
+		self.api_count = 0
+
+	def open(self, key):
+		self.api_count += 1
+		return self.client.get_object(Bucket=self.bucket, Key=key)['Body']
+
+
+def _boolean(value):
+	if isinstance(value, bool) or value is None:
+		return value
+	return value.lower() == 'true'
+
+
+def iterCsvRecords(stream, columns):
+	"""Streams records from a gzipped CSV inventory file, one line in memory at a time."""
+	positions = [(CSV_FIELDS[column], i) for i, column in enumerate(columns) if column in CSV_FIELDS]
+	lines = io.TextIOWrapper(gzip.GzipFile(fileobj=stream), encoding='utf-8', newline='')
+	for row in csv.reader(lines):
+		fields = dict((field, row[i]) for field, i in positions if i < len(row))
+		yield InventoryRecord(
+			unquote_plus(fields.get('key', '')),
+			int(fields['size']) if fields.get('size') else 0,
+			fields.get('storage_class') or None,
+			fields.get('last_modified') or None,
+			_boolean(fields.get('is_latest')),
+			_boolean(fields.get('is_delete_marker')),
+			fields.get('version_id') or None,
+		)
+
+
+def iterColumnarRecords(stream, file_format):
+	"""
+	Streams records from an ORC or Parquet inventory file, BATCH_ROWS rows at a time. Needs pyarrow.
+
+	Both formats need a seekable file, so the stream is first copied to a temporary file.
+	"""
+	try:
+		import pyarrow.orc
+		import pyarrow.parquet
+	except ImportError:
+		raise InventoryError("pyarrow is needed to read %s inventories" % (file_format))
+
+	with tempfile.TemporaryFile() as local:
+		shutil.copyfileobj(stream, local, 1024 * 1024)
+		local.seek(0)
+		if file_format == 'PARQUET':
+			data = pyarrow.parquet.ParquetFile(local)
+			names = data.schema_arrow.names
+			batches = data.iter_batches(batch_size=BATCH_ROWS, columns=[name for name in names if name in COLUMNAR_FIELDS])
+		else:
+			data = pyarrow.orc.ORCFile(local)
+			names = data.schema.names
+			batches = (data.read_stripe(i, columns=[name for name in names if name in COLUMNAR_FIELDS])
+					   for i in range(data.nstripes))
+		for batch in batches:
+			columns = batch.to_pydict()
+			fields = dict((COLUMNAR_FIELDS[name], values) for name, values in columns.items())
+			if 'size' not in fields:
+				raise InventoryError("Inventory does not include object sizes")
+			for i in range(batch.num_rows):
+				last_modified = fields['last_modified'][i] if 'last_modified' in fields else None
+				if isinstance(last_modified, datetime.datetime):
+					last_modified = last_modified.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+				yield InventoryRecord(
+					fields['key'][i] if 'key' in fields else '',
+					fields['size'][i] or 0,
+					fields['storage_class'][i] if 'storage_class' in fields else None,
+					last_modified,
+					fields['is_latest'][i] if 'is_latest' in fields else None,
+					fields['is_delete_marker'][i] if 'is_delete_marker' in fields else None,
+					fields['version_id'][i] if 'version_id' in fields else None,
+				)
+
+
+def iterFileRecords(manifest, opener, key):
+	"""Streams the records of one data file of the manifest."""
+	stream = opener.open(key)
+	try:
+		if manifest.file_format == 'CSV':
+			for record in iterCsvRecords(stream, manifest.columns):
+				yield record
+		elif manifest.file_format in ('ORC', 'PARQUET'):
+			for record in iterColumnarRecords(stream, manifest.file_format):
+				yield record
+		else:
+			raise InventoryError("Unknown inventory format %s" % (manifest.file_format))
+	finally:
+		stream.close()
+
+
+def iterRecords(manifest, opener):
+	"""Streams the records of every data file of the manifest."""
+	for key in manifest.files:
+		for record in iterFileRecords(manifest, opener, key):
+			yield record
+
+
+def isCurrentObject(record):
+	"""Whether a record counts towards the bucket's size the way a listing would: current, not a delete marker."""
+	return record.is_latest is not False and not record.is_delete_marker
+
+
+def findInventoryConfiguration(s3client, bucket):
+	"""
+	Returns the bucket's inventory configuration best suited to sizing it, or None; and the API calls made.
+
+	Only enabled inventories of the whole bucket that include object sizes can size it.
+	"""
+	api_count = 0
+	configurations = []
+	kwargs = {'Bucket': bucket}
+	while True:
+		response = s3client.list_bucket_inventory_configurations(**kwargs)
+		api_count += 1
+		configurations.extend(response.get('InventoryConfigurationList', []))
+		if not response.get('IsTruncated'):
+			break
+		kwargs['ContinuationToken'] = response['NextContinuationToken']
+	usable = [c for c in configurations
+			  if c['IsEnabled'] and 'Filter' not in c and 'Size' in c.get('OptionalFields', [])]
+	# Inventories of current versions only are smaller to read
+	usable.sort(key=lambda c: c['IncludedObjectVersions'] != 'Current')
+	return (usable[0] if usable else None), api_count
+
+
+def findLatestManifest(s3client, bucket, configuration):
+	"""Returns the key of the newest manifest.json of an inventory configuration, or None; and the API calls made."""
+	destination = configuration['Destination']['S3BucketDestination']
+	prefix = destination.get('Prefix', '')
+	if prefix and not prefix.endswith('/'):
+		prefix += '/'
+	prefix += '%s/%s/' % (bucket, configuration['Id'])
+	api_count = 0
+	dates = []
+	kwargs = {'Bucket': destination['Bucket'].split(':::')[-1], 'Prefix': prefix, 'Delimiter': '/'}
+	while True:
+		response = s3client.list_objects_v2(**kwargs)
+		api_count += 1
+		for common_prefix in response.get('CommonPrefixes', []):
+			name = common_prefix['Prefix'][len(prefix):].rstrip('/')
+			if MANIFEST_DATE.match(name):
+				dates.append(name)
+		if not response['IsTruncated']:
+			break
+		kwargs['ContinuationToken'] = response['NextContinuationToken']
+	if not dates:
+		return None, api_count
+	return prefix + max(dates) + '/manifest.json', api_count
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+import json
+import os
+import queue
+import sqlite3
+import threading
+
+from s3inventory import InventoryRecord
+
+# Rows written per transaction
+COMMIT_ROWS = 50000
+
+
+class KeyIndex(object):
+	"""
+	SQLite index of listed keys, so later analyses can query it instead of listing S3 again.
+
+	SQLite connections cannot be shared between threads, so workers hand
+	their records to one writer thread, which batches them into transactions.
+	Rows are upserted, so pages listed again after resuming do no harm. When a
+	write fails, the writer keeps emptying the queue and the error is raised
+	from the next add, flush or stop, so that a run fails rather than hangs.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.queue = queue.Queue(maxsize=64)
+		self.connection = None
+		self.thread = None
+		# First error of the writer thread, raised again to whoever adds, flushes or stops
+		self.error = None
+
+	def _connect(self):
+		connection = sqlite3.connect(self.path)
+		connection.execute('PRAGMA journal_mode=WAL')
+		connection.execute('PRAGMA synchronous=NORMAL')
+		connection.execute('CREATE TABLE IF NOT EXISTS objects (bucket TEXT, key TEXT, size INTEGER, storage_class TEXT, '
+						   'last_modified TEXT, PRIMARY KEY (bucket, key)) WITHOUT ROWID')
+		connection.execute('CREATE TABLE IF NOT EXISTS buckets (bucket TEXT PRIMARY KEY, complete INTEGER)')
+		return connection
+
+	def start(self):
+		self.thread = threading.Thread(target=self._write)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _write(self):
+		connection = None
+		pending = 0
+		while True:
+			item = self.queue.get()
+			command = item[0]
+			# After an error nothing more is written, but the queue is still drained so that callers never block
+			if self.error is None:
+				try:
+					if connection is None:
+						connection = self._connect()
+					if command == 'records':
+						connection.executemany('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?)', (
+							(item[1], record.key, record.size, record.storage_class, record.last_modified)
+							for record in item[2]))
+						pending += len(item[2])
+					elif command == 'begin':
+						connection.execute('DELETE FROM objects WHERE bucket = ?', (item[1],))
+						connection.execute('INSERT OR REPLACE INTO buckets VALUES (?, 0)', (item[1],))
+					elif command == 'complete':
+						connection.execute('INSERT OR REPLACE INTO buckets VALUES (?, 1)', (item[1],))
+					if command != 'records' or pending >= COMMIT_ROWS:
+						connection.commit()
+						pending = 0
+				except Exception as e:
+					self.error = e
+			if command == 'flush':
+				item[1].set()
+			self.queue.task_done()
+			if command == 'stop':
+				if connection is not None:
+					connection.close()
+				return
+
+	def _raiseError(self):
+		"""Raises the error the writer thread stopped writing on, if any."""
+		if self.error is not None:
+			raise self.error
+
+	def begin(self, bucket):
+		"""Forgets a bucket's keys before it is listed from the start."""
+		self._raiseError()
+		self.queue.put(('begin', bucket))
+
+	def add(self, bucket, records):
+		self._raiseError()
+		# Only current objects are indexed, like a listing returns them
+		self.queue.put(('records', bucket, [record for record in records
+											if record.is_latest is not False and not record.is_delete_marker]))
+
+	def complete(self, bucket):
+		self._raiseError()
+		self.queue.put(('complete', bucket))
+
+	def getState(self, bucket):
+		# The index keeps its rows itself; pages listed again after resuming are upserted
+		return None
+
+	def setState(self, bucket, state):
+		pass
+
+	def flush(self):
+		"""Returns once everything added so far is committed."""
+		done = threading.Event()
+		self.queue.put(('flush', done))
+		done.wait()
+		self._raiseError()
+
+	def stop(self):
+		self.queue.put(('stop',))
+		self.thread.join()
+		self._raiseError()
+
+	def completeBuckets(self):
+		connection = self._connect()
+		try:
+			return set(row[0] for row in connection.execute('SELECT bucket FROM buckets WHERE complete = 1'))
+		finally:
+			connection.close()
+
+	def iterRecords(self, bucket):
+		"""Streams a bucket's indexed keys in key order, as InventoryRecords."""
+		connection = self._connect()
+		try:
+			for key, size, storage_class, last_modified in connection.execute(
+					'SELECT key, size, storage_class, last_modified FROM objects WHERE bucket = ? ORDER BY key', (bucket,)):
+				yield InventoryRecord(key, size, storage_class, last_modified, True, False, None)
+		finally:
+			connection.close()
+
+
+class ListingCheckpoint(object):
+	"""
+	JSON file with the progress of a sizing run: per bucket, its totals so far and the key ranges still to list.
+
+	Written to a temporary file and renamed, so an interruption leaves either the previous or the new checkpoint.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+
+	def load(self):
+		"""Returns bucket name -> saved state, empty when there is no checkpoint."""
+		if not os.path.exists(self.path):
+			return {}
+		with open(self.path) as f:
+			return json.load(f)['buckets']
+
+	def save(self, buckets):
+		tmp_path = self.path + '.tmp'
+		with open(tmp_path, 'w') as f:
+			json.dump({'version': 1, 'buckets': buckets}, f)
+		os.replace(tmp_path, self.path)
+
+	def remove(self):
+		if os.path.exists(self.path):
+			os.remove(self.path)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+import datetime
+import os
+import sys
+import unittest
+from unittest import mock
+
+import boto3
+from botocore.config import Config
+from botocore.credentials import Credentials
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from generateS3Url import LocalSigner  # noqa: E402
+
+NOW = datetime.datetime(2024, 3, 1, 12, 30, 45)
+
+KEYS = ['plain.txt', 'folder/sub folder/file name.csv', 'café/日本.txt', 'a+b=c&d?e#f.bin',
+		'tilde~and%percent', 'double//slash', '/leading', 'quote\'s "and" <brackets>']
+
+
+class LocalSignerTest(unittest.TestCase):
+	"""Compares LocalSigner with botocore, both signing at the frozen time NOW."""
+
+	def urls(self, region, bucket, ttl, token=None):
+		credentials = Credentials('AKIDEXAMPLE', 'wJalrXUtnFEMI/K7MDENG/bPxRfiCYEXAMPLEKEY', token)
+		client = boto3.client('s3', region_name=region, aws_access_key_id=credentials.access_key,
+							  aws_secret_access_key=credentials.secret_key, aws_session_token=token,
+							  config=Config(signature_version='s3v4'))
+		with mock.patch('botocore.auth.get_current_datetime', return_value=NOW):
+			signer = LocalSigner(client, credentials.get_frozen_credentials(), region, bucket, ttl, NOW)
+			for key in KEYS:
+				expected = client.generate_presigned_url(ClientMethod='get_object',
+														 Params={'Bucket': bucket, 'Key': key}, ExpiresIn=ttl)
+				yield key, signer.sign(key), expected
+
+	def assertSignsLikeBotocore(self, region, bucket, ttl, token=None):
+		for key, url, expected in self.urls(region, bucket, ttl, token):
+			self.assertEqual(url, expected, "%s %s %s" % (region, bucket, key))
+
+	def test_regions(self):
+		for region in ('us-east-1', 'eu-west-1', 'ap-southeast-2', 'eu-central-1'):
+			self.assertSignsLikeBotocore(region, 'example-bucket', 3600)
+
+	def test_expiry_values(self):
+		for ttl in (1, 900, 86400, 7 * 24 * 3600):
+			self.assertSignsLikeBotocore('us-west-2', 'example-bucket', ttl)
+
+	def test_bucket_names_addressed_by_path(self):
+		self.assertSignsLikeBotocore('eu-west-1', 'example.bucket.with.dots', 3600)
+
+	def test_session_token(self):
+		self.assertSignsLikeBotocore('us-east-1', 'example-bucket', 3600, token='FwoGZXIvYXdzEJr//////////+token=')
+
+	def test_expiry(self):
+		client = boto3.client('s3', region_name='us-east-1', aws_access_key_id='testing',
+							  aws_secret_access_key='testing', config=Config(signature_version='s3v4'))
+		signer = LocalSigner(client, Credentials('testing', 'testing'), 'us-east-1', 'example-bucket', 600, NOW)
+		self.assertEqual(signer.expires, NOW + datetime.timedelta(seconds=600))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import datetime
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import boto3
+from botocore.stub import Stubber
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import generateS3Url  # noqa: E402
+from generateS3Url import KeyFilter, filterBatches, listKeyBatches, manifestBatches  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+CSV_MANIFEST = os.path.join(FIXTURES, 'inventory-csv-bucket', 'csv-inventory', '2024-03-01T00-00Z', 'manifest.json')
+
+NOW = datetime.datetime(2024, 3, 1, 12, 30, 45)
+
+
+class KeyFilterTest(unittest.TestCase):
+
+	OBJECTS = [('logs/2024/app.log', 10, '2024-01-10T00:00:00'), ('logs/2024/app.log.gz', 500, '2024-02-01T00:00:00'),
+			   ('logs/2023/app.log', 2000, '2023-12-31T23:59:59'), ('data/report.csv', 50, '2024-01-15T08:00:00')]
+
+	def test_no_criteria_selects_everything(self):
+		key_filter = KeyFilter()
+		self.assertEqual(key_filter.select(self.OBJECTS), [key for key, size, last_modified in self.OBJECTS])
+		self.assertFalse(key_filter.needsMetadata())
+		self.assertEqual(key_filter.listPrefix(), '')
+
+	def test_include_and_exclude_globs(self):
+		key_filter = KeyFilter(include=['logs/*'], exclude=['*.gz'])
+		self.assertEqual(key_filter.select(self.OBJECTS), ['logs/2024/app.log', 'logs/2023/app.log'])
+
+	def test_globs_match_the_whole_key(self):
+		self.assertEqual(KeyFilter(include=['*.log']).select(self.OBJECTS), ['logs/2024/app.log', 'logs/2023/app.log'])
+
+	def test_regex_is_searched_anywhere_in_the_key(self):
+		self.assertEqual(KeyFilter(regex=r'20(23|24)/app\.log$').select(self.OBJECTS),
+						 ['logs/2024/app.log', 'logs/2023/app.log'])
+
+	def test_size_bounds_are_inclusive(self):
+		key_filter = KeyFilter(min_size=50, max_size=500)
+		self.assertEqual(key_filter.select(self.OBJECTS), ['logs/2024/app.log.gz', 'data/report.csv'])
+		self.assertTrue(key_filter.needsMetadata())
+
+	def test_modified_after_is_inclusive_and_modified_before_exclusive(self):
+		key_filter = KeyFilter(modified_after='2024-01-10T00:00:00', modified_before='2024-02-01T00:00:00')
+		self.assertEqual(key_filter.select(self.OBJECTS), ['logs/2024/app.log', 'data/report.csv'])
+
+	def test_list_prefix_is_common_to_every_include(self):
+		self.assertEqual(KeyFilter(include=['logs/2024/*', 'logs/2023/*.log']).listPrefix(), 'logs/202')
+		self.assertEqual(KeyFilter(include=['logs/[0-9]*']).listPrefix(), 'logs/')
+		self.assertEqual(KeyFilter(include=['logs/*', 'data/*']).listPrefix(), '')
+
+
+class ListKeyBatchesTest(unittest.TestCase):
+
+	def setUp(self):
+		self.s3 = boto3.client('s3', region_name='us-east-1', aws_access_key_id='testing',
+							   aws_secret_access_key='testing')
+		self.stubber = Stubber(self.s3)
+		self.stubber.activate()
+
+	def tearDown(self):
+		self.stubber.deactivate()
+
+	def page(self, keys, token=None):
+		response = {'IsTruncated': token is not None,
+					'Contents': [{'Key': key, 'Size': len(key), 'LastModified': NOW} for key in keys]}
+		if token is not None:
+			response['NextContinuationToken'] = token
+		return response
+
+	def test_listing_is_narrowed_to_the_prefix_of_the_include_globs(self):
+		key_filter = KeyFilter(include=['logs/2024/*.gz'])
+		self.stubber.add_response('list_objects_v2', self.page(['logs/2024/a.gz', 'logs/2024/a.txt'], 'token'),
+								  {'Bucket': 'bucket', 'MaxKeys': 1000, 'Prefix': 'logs/2024/'})
+		self.stubber.add_response('list_objects_v2', self.page(['logs/2024/b.gz']),
+								  {'Bucket': 'bucket', 'MaxKeys': 1000, 'Prefix': 'logs/2024/',
+								   'ContinuationToken': 'token'})
+		counter = [0]
+		batches = filterBatches(listKeyBatches(self.s3, 'bucket', counter, key_filter.listPrefix()), key_filter)
+		self.assertEqual(list(batches), [['logs/2024/a.gz'], ['logs/2024/b.gz']])
+		self.assertEqual(counter, [2])
+		self.stubber.assert_no_pending_responses()
+
+	def test_delimiter_lists_only_keys_directly_under_the_prefix(self):
+		self.stubber.add_response('list_objects_v2', self.page(['logs/', 'logs/a.gz']),
+								  {'Bucket': 'bucket', 'MaxKeys': 1000, 'Prefix': 'logs/', 'Delimiter': '/'})
+		batches = list(listKeyBatches(self.s3, 'bucket', [0], 'logs/', '/'))
+		# The folder key is left out
+		self.assertEqual(batches, [[('logs/a.gz', 9, '2024-03-01T12:30:45')]])
+		self.stubber.assert_no_pending_responses()
+
+	def test_no_prefix_lists_the_whole_bucket(self):
+		self.stubber.add_response('list_objects_v2', {'IsTruncated': False},
+								  {'Bucket': 'bucket', 'MaxKeys': 1000, 'Prefix': ''})
+		self.assertEqual(list(listKeyBatches(self.s3, 'bucket', [0], KeyFilter().listPrefix())), [[]])
+
+
+class ManifestBatchesTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def test_key_per_line_file_in_batches(self):
+		path = os.path.join(self.tmp, 'keys.txt')
+		with open(path, 'w') as f:
+			f.write('a\r\nb c\n\n  \nd/e\nf')
+		with mock.patch.object(generateS3Url, 'MANIFEST_BATCH', 2):
+			batches = list(manifestBatches(path))
+		self.assertEqual(batches, [[('a', None, None), ('b c', None, None)], [('d/e', None, None), ('f', None, None)]])
+
+	def test_stdin(self):
+		with mock.patch.object(sys, 'stdin', io.StringIO('a\nb\n')):
+			self.assertEqual(list(manifestBatches('-')), [[('a', None, None), ('b', None, None)]])
+
+	def test_inventory_manifest_gives_current_objects_with_metadata(self):
+		self.assertEqual([_object for batch in manifestBatches(CSV_MANIFEST) for _object in batch], [
+			('docs/readme.txt', 100, '2024-02-01T10:00:00'),
+			('photos/café 1.jpg', 2048, '2023-12-24T08:30:00'),
+			('photos/a+b.jpg', 1000, '2024-02-20T08:30:00'),
+		])
+
+	def test_filters_apply_to_manifest_objects(self):
+		key_filter = KeyFilter(include=['photos/*'], modified_after='2024-01-01T00:00:00')
+		self.assertEqual(list(filterBatches(manifestBatches(CSV_MANIFEST), key_filter)), [['photos/a+b.jpg']])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import boto3
+from botocore.stub import ANY, Stubber
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from getS3BucketSize import BucketTotals, ClientPool, SizingEngine, splitRange  # noqa: E402
+from s3breakdown import BreakdownSink  # noqa: E402
+from s3keyindex import KeyIndex, ListingCheckpoint  # noqa: E402
+
+NOW = datetime.datetime(2024, 3, 1)
+
+
+def client(service, region='us-east-1'):
+	return boto3.client(service, region_name=region, aws_access_key_id='testing', aws_secret_access_key='testing')
+
+
+def clientPool(*clients):
+	"""A ClientPool handing out the given clients, with their region, rather than creating its own."""
+	pool = ClientPool(boto3.session.Session(region_name='us-east-1'))
+	for _client in clients:
+		pool.clients[(_client.meta.service_model.service_name, _client.meta.region_name)] = _client
+	return pool
+
+
+def bucketKeys():
+	"""Keys spread unevenly over prefixes, as real buckets are, including characters ranges are not split on."""
+	keys = ['logs/2024/%02d/%04d.gz' % (month, number) for month in range(1, 13) for number in range(500)]
+	keys += ['images/%s%d.jpg' % (letter, number) for letter in 'abcxyz' for number in range(100)]
+	keys += ['a', 'z', 'Zeta/1', '~tilde', 'ümlaut/1', 'data/%05d' % 7]
+	return sorted(keys)
+
+
+class FakeS3(object):
+	"""
+	Serves list_objects_v2 from a sorted list of keys, like S3: keys after StartAfter, then after the token.
+
+	Sizes are the keys' lengths. fail_after makes every call after that many fail, as an interrupted run would.
+	delay gives the other workers time to go idle, so that ranges get split.
+	"""
+
+	def __init__(self, keys, fail_after=None, delay=0):
+		self.keys = keys
+		self.fail_after = fail_after
+		self.delay = delay
+		self.calls = []
+		self.lock = threading.Lock()
+
+	def get_bucket_location(self, Bucket):
+		return {'LocationConstraint': None}
+
+	def list_objects_v2(self, Bucket, MaxKeys=1000, StartAfter=None, ContinuationToken=None):
+		with self.lock:
+			self.calls.append(StartAfter)
+			if self.fail_after is not None and len(self.calls) > self.fail_after:
+				raise IOError("Connection reset")
+		time.sleep(self.delay)
+		after = ContinuationToken or StartAfter
+		keys = [key for key in self.keys if after is None or key > after]
+		page = keys[:MaxKeys]
+		response = {'IsTruncated': len(keys) > MaxKeys, 'Contents': [
+			{'Key': key, 'Size': len(key), 'StorageClass': 'STANDARD', 'LastModified': NOW} for key in page]}
+		if response['IsTruncated']:
+			response['NextContinuationToken'] = page[-1]
+		return response
+
+
+class FakeVersionedS3(FakeS3):
+	"""
+	Serves list_object_versions too, from the keys with their versions, newest first, like S3.
+
+	Key i has i % 3 noncurrent versions of size 1 under its current one, every seventh key has been deleted, and
+	big_key has 2500 versions, so that its versions span pages.
+	"""
+
+	def __init__(self, keys, big_key, fail_after=None, delay=0):
+		FakeS3.__init__(self, keys, fail_after, delay)
+		self.versions = []
+		for i, key in enumerate(keys):
+			noncurrent = 2500 if key == big_key else i % 3
+			if i % 7 == 0:
+				self.versions.append({'Key': key, 'VersionId': 'delete', 'IsLatest': True, 'LastModified': NOW})
+			self.versions.append({'Key': key, 'VersionId': 'current', 'IsLatest': i % 7 != 0, 'Size': len(key)})
+			for number in range(noncurrent):
+				self.versions.append({'Key': key, 'VersionId': 'v%d' % number, 'IsLatest': False, 'Size': 1})
+		for version in self.versions:
+			version.update({'StorageClass': 'STANDARD', 'LastModified': NOW})
+
+	def currentSize(self):
+		return sum(v['Size'] for v in self.versions if v['IsLatest'] and v['VersionId'] != 'delete')
+
+	def currentCount(self):
+		return len([v for v in self.versions if v['IsLatest'] and v['VersionId'] != 'delete'])
+
+	def versionCounts(self):
+		counts = {}
+		for version in self.versions:
+			counts[version['Key']] = counts.get(version['Key'], 0) + 1
+		return counts
+
+	def list_object_versions(self, Bucket, MaxKeys=1000, KeyMarker=None, VersionIdMarker=None):
+		with self.lock:
+			self.calls.append((KeyMarker, VersionIdMarker))
+			if self.fail_after is not None and len(self.calls) > self.fail_after:
+				raise IOError("Connection reset")
+		time.sleep(self.delay)
+		start = 0
+		for i, version in enumerate(self.versions):
+			if KeyMarker is None:
+				break
+			if VersionIdMarker is not None and (version['Key'], version['VersionId']) == (KeyMarker, VersionIdMarker):
+				start = i + 1
+				break
+			if VersionIdMarker is None and version['Key'] > KeyMarker:
+				start = i
+				break
+		else:
+			start = len(self.versions)
+		page = self.versions[start:start + MaxKeys]
+		response = {'IsTruncated': start + MaxKeys < len(self.versions),
+					'Versions': [v for v in page if v['VersionId'] != 'delete'],
+					'DeleteMarkers': [dict((name, v[name]) for name in ('Key', 'VersionId', 'IsLatest', 'LastModified'))
+									  for v in page if v['VersionId'] == 'delete']}
+		if response['IsTruncated']:
+			response['NextKeyMarker'] = page[-1]['Key']
+			response['NextVersionIdMarker'] = page[-1]['VersionId']
+		return response
+
+
+class RecordingSink(object):
+	"""Sink counting how often each key was handed over."""
+
+	def __init__(self):
+		self.keys = {}
+		self.lock = threading.Lock()
+
+	def begin(self, bucket):
+		pass
+
+	def add(self, bucket, records):
+		with self.lock:
+			for record in records:
+				self.keys[record.key] = self.keys.get(record.key, 0) + 1
+
+	def complete(self, bucket):
+		pass
+
+	def flush(self):
+		pass
+
+	def getState(self, bucket):
+		return None
+
+	def setState(self, bucket, state):
+		pass
+
+
+def runListing(s3, workers=1, checkpoint=None, **kwargs):
+	pool = clientPool()
+	pool.clients[('s3', 'us-east-1')] = s3
+	engine = SizingEngine(pool, workers=workers, engine='list', **kwargs)
+	totals, = engine.run(['bucket'], checkpoint=checkpoint)
+	return engine, totals
+
+
+class SplitRangeTest(unittest.TestCase):
+
+	def test_boundaries_fall_between_the_page_and_the_end(self):
+		boundaries = splitRange('logs/2024/01/0000.gz', 'logs/2024/01/0999.gz', None, 4)
+		self.assertEqual(len(boundaries), 4)
+		self.assertEqual(boundaries, sorted(boundaries))
+		for boundary in boundaries:
+			self.assertGreater(boundary, 'logs/2024/01/0999.gz')
+
+	def test_respects_the_range_end(self):
+		for boundary in splitRange('images/a0.jpg', 'images/a99.jpg', 'images/x', 8):
+			self.assertTrue('images/a99.jpg' < boundary < 'images/x', boundary)
+
+	def test_no_room_to_split(self):
+		self.assertEqual(splitRange('a/1', 'a/2', 'a/2!', 4), [])
+
+
+class KeyRangeSplittingTest(unittest.TestCase):
+
+	def test_split_listing_adds_up_to_a_serial_listing(self):
+		keys = bucketKeys()
+		serial_engine, serial = runListing(FakeS3(keys))
+		sink = RecordingSink()
+		s3 = FakeS3(keys, delay=0.02)
+		engine, parallel = runListing(s3, workers=8, sinks=[sink])
+		self.assertEqual(engine.errors, [])
+		self.assertEqual((serial.size, serial.object_count), (sum(len(key) for key in keys), len(keys)))
+		self.assertEqual((parallel.size, parallel.object_count), (serial.size, serial.object_count))
+		self.assertTrue(parallel.done)
+		# Every key was counted once, and the bucket really was listed in several ranges
+		self.assertEqual(sink.keys, dict((key, 1) for key in keys))
+		self.assertGreater(len(set(s3.calls)), 1)
+		self.assertEqual(parallel.api_count, len(s3.calls) + 1)
+
+
+class EngineErrorsTest(unittest.TestCase):
+
+	def test_errors_exist_before_a_run_and_are_kept_per_run(self):
+		pool = clientPool()
+		pool.clients[('s3', 'us-east-1')] = FakeS3(bucketKeys(), fail_after=1)
+		engine = SizingEngine(pool, workers=1, engine='list')
+		self.assertEqual(engine.errors, [])
+		engine.run(['bucket'])
+		self.assertEqual([bucket for bucket, error in engine.errors], ['bucket'])
+		pool.clients[('s3', 'us-east-1')] = FakeS3(bucketKeys())
+		totals, = engine.run(['bucket'])
+		self.assertEqual(engine.errors, [])
+		self.assertTrue(totals.done)
+
+
+class CheckpointResumeTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		self.checkpoint = ListingCheckpoint(os.path.join(self.tmp, 'checkpoint.json'))
+		self.keys = bucketKeys()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def test_resumes_an_interrupted_range_where_it_stopped(self):
+		key_index = KeyIndex(os.path.join(self.tmp, 'keys.db'))
+		key_index.start()
+		engine, interrupted = runListing(FakeS3(self.keys, fail_after=3), checkpoint=self.checkpoint,
+										 sinks=[key_index], key_index=key_index)
+		self.assertEqual(len(engine.errors), 1)
+		self.assertFalse(interrupted.done)
+		self.assertEqual(interrupted.object_count, 3000)
+		saved = self.checkpoint.load()['bucket']
+		self.assertEqual((saved['object_count'], saved['ranges']), (3000, [[self.keys[2999], None]]))
+
+		s3 = FakeS3(self.keys)
+		engine, resumed = runListing(s3, checkpoint=self.checkpoint, sinks=[key_index], key_index=key_index)
+		key_index.stop()
+		self.assertEqual(engine.errors, [])
+		self.assertTrue(resumed.done)
+		self.assertEqual((resumed.size, resumed.object_count), (sum(len(key) for key in self.keys), len(self.keys)))
+		# Listing went on after the last key counted, and the finished run removed its checkpoint
+		self.assertEqual(s3.calls[0], self.keys[2999])
+		self.assertFalse(os.path.exists(self.checkpoint.path))
+		self.assertEqual([record.key for record in key_index.iterRecords('bucket')], self.keys)
+		self.assertEqual(key_index.completeBuckets(), set(['bucket']))
+
+	def test_resumes_split_ranges(self):
+		_, interrupted = runListing(FakeS3(self.keys, fail_after=6, delay=0.02), workers=8,
+									checkpoint=self.checkpoint)
+		self.assertFalse(interrupted.done)
+		sink = RecordingSink()
+		engine, resumed = runListing(FakeS3(self.keys), workers=8, checkpoint=self.checkpoint, sinks=[sink])
+		self.assertEqual(engine.errors, [])
+		self.assertEqual((resumed.size, resumed.object_count), (sum(len(key) for key in self.keys), len(self.keys)))
+		# Only what the interrupted run had not counted was listed again
+		self.assertEqual(sum(sink.keys.values()), len(self.keys) - interrupted.object_count)
+
+	def test_finished_buckets_are_not_listed_again(self):
+		self.checkpoint.save({'bucket': dict(BucketTotals('bucket').toDict(), region='us-east-1', size=10,
+											 object_count=2, done=True)})
+		s3 = FakeS3(self.keys)
+		_, totals = runListing(s3, checkpoint=self.checkpoint)
+		self.assertEqual((totals.size, totals.object_count, s3.calls), (10, 2, []))
+
+	def test_checkpoint_file(self):
+		self.assertEqual(self.checkpoint.load(), {})
+		self.checkpoint.save({'bucket': {'ranges': [['a', None]]}})
+		with open(self.checkpoint.path) as f:
+			self.assertEqual(json.load(f), {'version': 1, 'buckets': {'bucket': {'ranges': [['a', None]]}}})
+		self.assertFalse(os.path.exists(self.checkpoint.path + '.tmp'))
+		self.checkpoint.remove()
+		self.checkpoint.remove()
+		self.assertFalse(os.path.exists(self.checkpoint.path))
+
+
+class VersionListingTest(unittest.TestCase):
+
+	def setUp(self):
+		self.keys = bucketKeys()
+		self.big_key = self.keys[700]
+
+	def assertCounted(self, s3, totals):
+		self.assertTrue(totals.done)
+		self.assertEqual((totals.size, totals.object_count), (s3.currentSize(), s3.currentCount()))
+
+	def test_totals_count_current_objects_and_sinks_get_every_version(self):
+		s3 = FakeVersionedS3(self.keys, self.big_key)
+		sink = RecordingSink()
+		breakdown = BreakdownSink(top=1000)
+		engine, totals = runListing(s3, sinks=[sink, breakdown], list_versions=True)
+		self.assertEqual(engine.errors, [])
+		self.assertCounted(s3, totals)
+		self.assertEqual(sink.keys, s3.versionCounts())
+		versions = breakdown.breakdowns['bucket'].toDict()['versions']
+		self.assertEqual(versions['current'], {'size': s3.currentSize(), 'objects': s3.currentCount()})
+		self.assertEqual(versions['delete-marker']['objects'], len(self.keys[::7]))
+		noncurrent = [version['Size'] for version in s3.versions if not version['IsLatest']]
+		self.assertEqual(versions['noncurrent'], {'size': sum(noncurrent), 'objects': len(noncurrent)})
+
+	def test_split_listing_adds_up_to_a_serial_listing(self):
+		s3 = FakeVersionedS3(self.keys, self.big_key, delay=0.02)
+		sink = RecordingSink()
+		engine, totals = runListing(s3, workers=8, sinks=[sink], list_versions=True)
+		self.assertEqual(engine.errors, [])
+		self.assertCounted(s3, totals)
+		self.assertEqual(sink.keys, s3.versionCounts())
+		self.assertGreater(len(set(key_marker for key_marker, version_id_marker in s3.calls)), 1)
+
+	def test_versions_of_a_key_are_handed_over_latest_first(self):
+		def version(key, version_id, is_latest, days_old):
+			return {'Key': key, 'VersionId': version_id, 'IsLatest': is_latest, 'Size': 1,
+					'LastModified': NOW - datetime.timedelta(days=days_old)}
+
+		# Versions and delete markers come in separate lists, so their order has to be restored
+		page = {'IsTruncated': False, 'Versions': [version('b', 'b1', False, 9), version('a', 'a1', False, 9),
+												   version('a', 'a2', False, 1), version('b', 'b2', True, 5)],
+				'DeleteMarkers': [version('a', 'a3', True, 0)]}
+		s3 = FakeS3([])
+		s3.list_object_versions = lambda **kwargs: page
+		order = []
+		sink = RecordingSink()
+		sink.add = lambda bucket, records: order.extend(record.version_id for record in records)
+		engine, totals = runListing(s3, sinks=[sink], list_versions=True)
+		self.assertEqual(engine.errors, [])
+		self.assertEqual(order, ['a3', 'a2', 'a1', 'b2', 'b1'])
+		self.assertEqual(totals.object_count, 1)
+
+	def test_resumes_after_the_last_complete_key(self):
+		checkpoint_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, checkpoint_dir)
+		checkpoint = ListingCheckpoint(os.path.join(checkpoint_dir, 'checkpoint.json'))
+		sink = RecordingSink()
+		# The third page ends part way through big_key's versions
+		engine, interrupted = runListing(FakeVersionedS3(self.keys, self.big_key, fail_after=2),
+										 checkpoint=checkpoint, sinks=[sink], list_versions=True)
+		self.assertEqual(len(engine.errors), 1)
+		self.assertNotIn(self.big_key, sink.keys)
+		self.assertEqual(checkpoint.load()['bucket']['ranges'], [[self.keys[699], None]])
+		s3 = FakeVersionedS3(self.keys, self.big_key)
+		engine, resumed = runListing(s3, checkpoint=checkpoint, sinks=[sink], list_versions=True)
+		self.assertEqual(engine.errors, [])
+		self.assertCounted(s3, resumed)
+		# Versions of big_key seen before the interruption were not added twice
+		self.assertEqual(s3.calls[0], (self.keys[699], None))
+		self.assertEqual(sink.keys, s3.versionCounts())
+
+
+class MetricsEngineTest(unittest.TestCase):
+
+	def setUp(self):
+		self.cloudwatch = client('cloudwatch', 'eu-west-1')
+		self.stubber = Stubber(self.cloudwatch)
+		self.stubber.activate()
+		self.engine = SizingEngine(clientPool(self.cloudwatch), engine='metrics')
+		self.totals = BucketTotals('bucket')
+		self.totals.region = 'eu-west-1'
+
+	def tearDown(self):
+		self.stubber.deactivate()
+
+	def metric(self, storage_type):
+		return {'Namespace': 'AWS/S3', 'MetricName': 'BucketSizeBytes', 'Dimensions': [
+			{'Name': 'BucketName', 'Value': 'bucket'}, {'Name': 'StorageType', 'Value': storage_type}]}
+
+	def test_overhead_storage_types_are_not_counted(self):
+		storage_types = ['StandardStorage', 'GlacierStorage', 'GlacierObjectOverhead', 'GlacierS3ObjectOverhead',
+						 'DeepArchiveStorage', 'DeepArchiveS3ObjectOverhead']
+		self.stubber.add_response('list_metrics', {'Metrics': [self.metric(t) for t in storage_types]}, {
+			'Namespace': 'AWS/S3', 'MetricName': 'BucketSizeBytes',
+			'Dimensions': [{'Name': 'BucketName', 'Value': 'bucket'}]})
+		values = {'size0': 1000.0, 'size1': 200.0, 'overhead2': 32768.0, 'overhead3': 8.0, 'size4': 50.0,
+				  'overhead5': 8.0, 'objects': 7.0}
+		self.stubber.add_response('get_metric_data', {'MetricDataResults': [
+			{'Id': query_id, 'Values': [value], 'Timestamps': [NOW]} for query_id, value in sorted(values.items())
+		]}, {'MetricDataQueries': ANY, 'StartTime': ANY, 'EndTime': ANY, 'ScanBy': 'TimestampDescending'})
+		self.assertTrue(self.engine.useMetrics(self.totals))
+		self.stubber.assert_no_pending_responses()
+		self.assertEqual((self.totals.engine, self.totals.size, self.totals.object_count), ('metrics', 1250, 7))
+		self.assertEqual(self.totals.as_of, NOW)
+		self.assertEqual(self.totals.api_count, 2)
+
+	def test_no_metrics(self):
+		self.stubber.add_response('list_metrics', {'Metrics': []})
+		self.assertFalse(self.engine.useMetrics(self.totals))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+import csv
+import datetime
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from getS3BucketSize import BucketTotals  # noqa: E402
+from s3breakdown import Breakdown, BreakdownSink, SpaceSaving, writeBreakdown  # noqa: E402
+from s3inventory import InventoryRecord  # noqa: E402
+
+NOW = datetime.datetime(2024, 3, 1)
+
+
+def record(key, size, days_old=1, storage_class='STANDARD', is_latest=True, is_delete_marker=False):
+	last_modified = (NOW - datetime.timedelta(days=days_old)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+	return InventoryRecord(key, size, storage_class, last_modified, is_latest, is_delete_marker, None)
+
+
+class SpaceSavingTest(unittest.TestCase):
+
+	def stream(self):
+		"""A long tail of small prefixes around a few large ones, in random order."""
+		rng = random.Random(7)
+		items = [('big%d/' % (i % 5), 1000 + i) for i in range(500)]
+		items += [('small%d/' % rng.randrange(2000), rng.randrange(1, 50)) for _ in range(5000)]
+		rng.shuffle(items)
+		return items
+
+	def test_error_bounds(self):
+		capacity = 50
+		sketch = SpaceSaving(capacity)
+		true_sizes = {}
+		for prefix, size in self.stream():
+			sketch.add(prefix, size)
+			true_sizes[prefix] = true_sizes.get(prefix, 0) + size
+		total = sum(true_sizes.values())
+		self.assertLessEqual(len(sketch.counters), capacity)
+		for prefix, size, count, error in sketch.top(capacity):
+			self.assertLessEqual(size - error, true_sizes[prefix])
+			self.assertGreaterEqual(size, true_sizes[prefix])
+			self.assertLessEqual(error, total / capacity)
+		# Every prefix holding more than total / capacity is kept
+		kept = set(prefix for prefix, size, count, error in sketch.top(capacity))
+		for prefix, size in true_sizes.items():
+			if size > total / capacity:
+				self.assertIn(prefix, kept)
+		self.assertEqual([prefix for prefix, size, count, error in sketch.top(5)],
+						 sorted(('big%d/' % i for i in range(5)), key=lambda p: -true_sizes[p]))
+
+	def test_exact_while_under_capacity(self):
+		sketch = SpaceSaving(10)
+		for prefix, size in [('a/', 5), ('b/', 3), ('a/', 2)]:
+			sketch.add(prefix, size)
+		self.assertEqual(sketch.top(10), [('a/', 7, 2, 0), ('b/', 3, 1, 0)])
+
+	def test_state_round_trip(self):
+		sketch = SpaceSaving(5)
+		for prefix, size in self.stream()[:200]:
+			sketch.add(prefix, size)
+		restored = SpaceSaving(5)
+		restored.setState(json.loads(json.dumps(sketch.getState())))
+		self.assertEqual(restored.top(5), sketch.top(5))
+		sketch.add('new/', 1)
+		restored.add('new/', 1)
+		self.assertEqual(restored.top(5), sketch.top(5))
+
+
+class BreakdownTest(unittest.TestCase):
+
+	RECORDS = [
+		record('logs/2024/a.gz', 100, days_old=10),
+		record('logs/2024/b.gz', 200, days_old=100, storage_class='STANDARD_IA'),
+		record('logs/2023/c.gz', 300, days_old=400, storage_class='GLACIER'),
+		record('images/d.jpg', 50, days_old=1000),
+		record('top-level.txt', 5, days_old=31),
+		record('logs/2024/a.gz', 70, days_old=40, is_latest=False),
+		record('gone.txt', 0, is_delete_marker=True),
+	]
+
+	def breakdown(self, records=RECORDS):
+		breakdown = Breakdown(depth=2, top=10, now=NOW)
+		breakdown.add(records)
+		return breakdown
+
+	def test_dimensions(self):
+		data = self.breakdown().toDict()
+		self.assertEqual(data['storage_classes'], {
+			'GLACIER': {'size': 300, 'objects': 1},
+			'STANDARD': {'size': 225, 'objects': 4},
+			'STANDARD_IA': {'size': 200, 'objects': 1},
+		})
+		self.assertEqual(data['ages'], {
+			'<30d': {'size': 100, 'objects': 1},
+			'30-90d': {'size': 75, 'objects': 2},
+			'90-180d': {'size': 200, 'objects': 1},
+			'365-730d': {'size': 300, 'objects': 1},
+			'>=730d': {'size': 50, 'objects': 1},
+		})
+		self.assertEqual(data['versions'], {
+			'current': {'size': 655, 'objects': 5},
+			'noncurrent': {'size': 70, 'objects': 1},
+			'delete-marker': {'size': 0, 'objects': 1},
+		})
+
+	def test_prefixes_by_depth(self):
+		data = self.breakdown().toDict()
+		self.assertEqual(data['prefixes'][0], [
+			{'prefix': 'logs/', 'size': 670, 'objects': 4, 'size_error': 0},
+			{'prefix': 'images/', 'size': 50, 'objects': 1, 'size_error': 0},
+		])
+		self.assertEqual([(p['prefix'], p['size']) for p in data['prefixes'][1]],
+						 [('logs/2024/', 370), ('logs/2023/', 300)])
+
+	def test_unknown_age(self):
+		breakdown = Breakdown(now=NOW)
+		breakdown.add([InventoryRecord('a', 1, None, None, None, None, None)])
+		self.assertEqual(breakdown.toDict()['ages'], {'unknown': {'size': 1, 'objects': 1}})
+
+	def test_pages_added_apart_merge_into_one_breakdown(self):
+		whole = self.breakdown()
+		sink = BreakdownSink(depth=2, top=10)
+		sink.now = NOW
+		sink.begin('bucket')
+		for i in range(0, len(self.RECORDS), 2):
+			sink.add('bucket', self.RECORDS[i:i + 2])
+		self.assertEqual(sink.breakdowns['bucket'].toDict(), whole.toDict())
+
+	def test_state_round_trip_through_a_checkpoint(self):
+		first, rest = self.RECORDS[:3], self.RECORDS[3:]
+		sink = BreakdownSink(depth=2, top=10)
+		sink.now = NOW
+		sink.begin('bucket')
+		sink.add('bucket', first)
+		state = json.loads(json.dumps(sink.getState('bucket')))
+		resumed = BreakdownSink(depth=2, top=10)
+		resumed.now = NOW
+		resumed.setState('bucket', state)
+		resumed.add('bucket', rest)
+		self.assertEqual(resumed.breakdowns['bucket'].toDict(), self.breakdown().toDict())
+		self.assertIsNone(resumed.getState('other'))
+
+
+class WriteBreakdownTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		self.sink = BreakdownSink(depth=1, top=10)
+		self.sink.now = NOW
+		self.sink.begin('listed')
+		self.sink.add('listed', [record('a/1', 10), record('a/2', 20, storage_class='GLACIER')])
+		self.listed = BucketTotals('listed')
+		self.listed.size, self.listed.object_count, self.listed.done = 30, 2, True
+		self.metrics = BucketTotals('metrics')
+		self.metrics.engine, self.metrics.as_of, self.metrics.size, self.metrics.object_count = 'metrics', NOW, 99, 3
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def test_json(self):
+		path = os.path.join(self.tmp, 'breakdown.json')
+		writeBreakdown(path, [self.listed, self.metrics], self.sink)
+		with open(path) as f:
+			buckets = json.load(f)['buckets']
+		self.assertEqual(buckets['metrics'], {'source': 'metrics', 'as_of': '2024-03-01T00:00:00', 'complete': False,
+											  'size': 99, 'objects': 3})
+		self.assertEqual(buckets['listed']['storage_classes'], {'GLACIER': {'size': 20, 'objects': 1},
+																'STANDARD': {'size': 10, 'objects': 1}})
+		self.assertEqual(buckets['listed']['prefixes'], [[{'prefix': 'a/', 'size': 30, 'objects': 2, 'size_error': 0}]])
+
+	def test_csv(self):
+		path = os.path.join(self.tmp, 'breakdown.csv')
+		writeBreakdown(path, [self.listed, self.metrics], self.sink)
+		with open(path, newline='') as f:
+			rows = list(csv.reader(f))
+		self.assertEqual(rows[0], ['bucket', 'dimension', 'name', 'size', 'objects', 'size_error'])
+		self.assertIn(['listed', 'total', 'list', '30', '2', '0'], rows)
+		self.assertIn(['listed', 'storage_classes', 'GLACIER', '20', '1', '0'], rows)
+		self.assertIn(['listed', 'prefix1', 'a/', '30', '2', '0'], rows)
+		self.assertEqual([row for row in rows if row[0] == 'metrics'], [['metrics', 'total', 'metrics', '99', '3', '0']])
+
+
+if __name__ == '__main__':
+	unittest.main()
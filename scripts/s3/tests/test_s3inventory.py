@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import gzip
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from s3inventory import (InventoryError, InventoryManifest, LocalOpener, isCurrentObject,  # noqa: E402
+						 iterCsvRecords, iterRecords)
+
+try:
+	import pyarrow  # noqa: F401
+except ImportError:
+	pyarrow = None
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+CSV_MANIFEST = os.path.join(FIXTURES, 'inventory-csv-bucket', 'csv-inventory', '2024-03-01T00-00Z', 'manifest.json')
+PARQUET_MANIFEST = os.path.join(FIXTURES, 'inventory-parquet-bucket', 'parquet-inventory', '2024-03-01T00-00Z',
+								'manifest.json')
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'getS3BucketSize.py')
+
+
+def loadManifest(path):
+	with open(path, 'rb') as f:
+		return InventoryManifest.load(f)
+
+
+def records(path):
+	return list(iterRecords(loadManifest(path), LocalOpener(path)))
+
+
+class InventoryManifestTest(unittest.TestCase):
+
+	def test_csv_manifest(self):
+		manifest = loadManifest(CSV_MANIFEST)
+		self.assertEqual(manifest.source_bucket, 'inventory-csv-bucket')
+		self.assertEqual(manifest.destination_bucket, 'inventory-destination')
+		self.assertEqual(manifest.file_format, 'CSV')
+		self.assertEqual(manifest.columns[:3], ['Bucket', 'Key', 'VersionId'])
+		self.assertEqual(len(manifest.files), 2)
+		self.assertEqual(manifest.created.strftime('%Y-%m-%d %H:%M'), '2024-03-01 00:00')
+
+	def test_csv_manifest_without_sizes_is_rejected(self):
+		with self.assertRaises(InventoryError):
+			InventoryManifest({'sourceBucket': 'b', 'destinationBucket': 'arn:aws:s3:::d', 'fileFormat': 'CSV',
+							   'fileSchema': 'Bucket, Key', 'files': [], 'creationTimestamp': '0'})
+
+	def test_missing_data_file(self):
+		with self.assertRaises(InventoryError):
+			LocalOpener(CSV_MANIFEST).open('inventory-csv-bucket/csv-inventory/data/missing.csv.gz')
+
+
+class CsvRecordsTest(unittest.TestCase):
+
+	def test_reads_every_line_of_every_file(self):
+		keys = [(record.key, record.version_id) for record in records(CSV_MANIFEST)]
+		self.assertEqual(keys, [('docs/readme.txt', 'v1'), ('docs/readme.txt', 'v0'), ('old/gone.txt', 'v2'),
+								('old/gone.txt', 'v1'), ('photos/café 1.jpg', 'v1'), ('photos/a+b.jpg', 'v1')])
+
+	def test_fields(self):
+		record = records(CSV_MANIFEST)[4]
+		self.assertEqual(record.size, 2048)
+		self.assertEqual(record.storage_class, 'GLACIER')
+		self.assertEqual(record.last_modified, '2023-12-24T08:30:00.000Z')
+		self.assertIs(record.is_latest, True)
+		self.assertIs(record.is_delete_marker, False)
+
+	def test_delete_markers_have_no_size_or_storage_class(self):
+		marker = records(CSV_MANIFEST)[2]
+		self.assertEqual((marker.size, marker.storage_class, marker.is_delete_marker), (0, None, True))
+
+	def test_columns_follow_the_file_schema(self):
+		data = io.BytesIO()
+		with gzip.GzipFile(fileobj=data, mode='wb') as f:
+			f.write(b'"1234","STANDARD","a%2Fb+c","inventory-csv-bucket"\n')
+		data.seek(0)
+		record, = iterCsvRecords(data, ['Size', 'StorageClass', 'Key', 'Bucket'])
+		self.assertEqual((record.key, record.size, record.storage_class), ('a/b c', 1234, 'STANDARD'))
+		# Fields the inventory does not include are unknown rather than false
+		self.assertIsNone(record.is_latest)
+		self.assertTrue(isCurrentObject(record))
+
+
+class CurrentObjectTest(unittest.TestCase):
+
+	def test_noncurrent_versions_and_delete_markers_are_left_out(self):
+		current = [(record.key, record.size) for record in records(CSV_MANIFEST) if isCurrentObject(record)]
+		self.assertEqual(current, [('docs/readme.txt', 100), ('photos/café 1.jpg', 2048), ('photos/a+b.jpg', 1000)])
+
+
+@unittest.skipIf(pyarrow is None, "needs pyarrow")
+class ParquetRecordsTest(unittest.TestCase):
+
+	def test_reads_records(self):
+		parquet_records = records(PARQUET_MANIFEST)
+		self.assertEqual([(record.key, record.size, record.is_latest, record.is_delete_marker)
+						  for record in parquet_records],
+						 [('logs/2024/01.log', 300, True, False), ('logs/2024/01.log', 200, False, False),
+						  ('logs/2024/02.log', 700, True, False), ('tmp/deleted', 0, True, True)])
+		self.assertEqual(parquet_records[2].storage_class, 'INTELLIGENT_TIERING')
+		self.assertEqual(parquet_records[2].last_modified, '2024-02-15T00:00:00.000Z')
+
+	def test_current_objects(self):
+		self.assertEqual(sum(record.size for record in records(PARQUET_MANIFEST) if isCurrentObject(record)), 1000)
+
+
+class InventoryManifestOptionTest(unittest.TestCase):
+	"""Runs getS3BucketSize.py on the fixtures, which needs no AWS access."""
+
+	def setUp(self):
+		# The script writes its log file to the working directory
+		self.tmp = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def size(self, *manifests):
+		output = subprocess.check_output([sys.executable, SCRIPT, '--inventory-manifest'] + list(manifests),
+										 cwd=self.tmp, stderr=subprocess.STDOUT, universal_newlines=True)
+		return [line for line in output.splitlines() if line.startswith('Bucket Totals:')][0]
+
+	def test_sizes_current_objects_from_the_csv_inventory(self):
+		self.assertTrue(self.size(CSV_MANIFEST).startswith('Bucket Totals: 3 objects using 3148 B'))
+
+	@unittest.skipIf(pyarrow is None, "needs pyarrow")
+	def test_sizes_several_buckets_from_their_inventories(self):
+		self.assertTrue(self.size(CSV_MANIFEST, PARQUET_MANIFEST).startswith('Bucket Totals: 5 objects using 4148 B'))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from s3inventory import InventoryRecord  # noqa: E402
+from s3keyindex import KeyIndex  # noqa: E402
+
+
+def record(key, size, is_latest=True, is_delete_marker=False, storage_class='STANDARD'):
+	return InventoryRecord(key, size, storage_class, '2024-03-01T00:00:00.000Z', is_latest, is_delete_marker, None)
+
+
+class KeyIndexTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		self.index = KeyIndex(os.path.join(self.tmp, 'keys.db'))
+		self.index.start()
+
+	def tearDown(self):
+		if self.index.thread.is_alive():
+			self.index.stop()
+		shutil.rmtree(self.tmp)
+
+	def keys(self, bucket):
+		return [(r.key, r.size, r.storage_class) for r in self.index.iterRecords(bucket)]
+
+	def test_records_are_queried_in_key_order(self):
+		self.index.begin('bucket')
+		self.index.add('bucket', [record('b', 2), record('a', 1, storage_class='GLACIER')])
+		self.index.add('other', [record('c', 3)])
+		self.index.flush()
+		self.assertEqual(self.keys('bucket'), [('a', 1, 'GLACIER'), ('b', 2, 'STANDARD')])
+		self.assertEqual(self.keys('other'), [('c', 3, 'STANDARD')])
+
+	def test_pages_listed_again_are_upserted(self):
+		self.index.begin('bucket')
+		self.index.add('bucket', [record('a', 1), record('b', 2)])
+		self.index.add('bucket', [record('b', 5), record('c', 3)])
+		self.index.flush()
+		self.assertEqual(self.keys('bucket'), [('a', 1, 'STANDARD'), ('b', 5, 'STANDARD'), ('c', 3, 'STANDARD')])
+
+	def test_only_current_objects_are_indexed(self):
+		self.index.add('bucket', [record('a', 1), record('a', 9, is_latest=False),
+								  record('b', 0, is_delete_marker=True), record('c', 4, is_latest=None)])
+		self.index.flush()
+		self.assertEqual([key for key, size, storage_class in self.keys('bucket')], ['a', 'c'])
+
+	def test_begin_forgets_the_bucket_and_complete_marks_it(self):
+		self.index.begin('bucket')
+		self.index.add('bucket', [record('old', 1)])
+		self.index.complete('bucket')
+		self.index.flush()
+		self.assertEqual(self.index.completeBuckets(), set(['bucket']))
+		self.index.begin('bucket')
+		self.index.add('bucket', [record('new', 2)])
+		self.index.flush()
+		self.assertEqual(self.keys('bucket'), [('new', 2, 'STANDARD')])
+		self.assertEqual(self.index.completeBuckets(), set())
+
+	def test_survives_a_restart(self):
+		self.index.begin('bucket')
+		self.index.add('bucket', [record('a', 1)])
+		self.index.complete('bucket')
+		self.index.stop()
+		reopened = KeyIndex(self.index.path)
+		self.assertEqual(reopened.completeBuckets(), set(['bucket']))
+		self.assertEqual([r.key for r in reopened.iterRecords('bucket')], ['a'])
+
+
+class KeyIndexWriteErrorTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def assertFailsWithoutHanging(self, index, error):
+		# Far more pages than the queue holds: the writer keeps draining them, or add raises straight away
+		for _ in range(index.queue.maxsize * 4):
+			try:
+				index.add('bucket', [record('a', 1)])
+			except error:
+				break
+		with self.assertRaises(error):
+			index.flush()
+		with self.assertRaises(error):
+			index.add('bucket', [record('b', 2)])
+		with self.assertRaises(error):
+			index.stop()
+		self.assertFalse(index.thread.is_alive())
+
+	def test_bad_row(self):
+		index = KeyIndex(os.path.join(self.tmp, 'keys.db'))
+		index.start()
+		index.add('bucket', [record('a', object())])
+		self.assertFailsWithoutHanging(index, sqlite3.Error)
+
+	def test_unwritable_database(self):
+		index = KeyIndex(os.path.join(self.tmp, 'missing', 'keys.db'))
+		index.start()
+		self.assertFailsWithoutHanging(index, sqlite3.OperationalError)
+
+
+if __name__ == '__main__':
+	unittest.main()